@@ -61,6 +61,9 @@ to clusters easier. For example::
 
     [brim]
     additional_confs = /etc/common.conf "/another file.conf" ~/.common.conf
+
+Parsing large trees of conf files can take a while, so read_conf can
+also keep a compiled cache of its results; see its cache_path parameter.
 """
 """Copyright and License.
 
@@ -80,6 +83,8 @@ limitations under the License.
 """
 from ConfigParser import Error, NoOptionError, NoSectionError, SafeConfigParser
 from csv import reader
+from marshal import dumps, loads
+from os import getpid, rename, stat, unlink
 from os.path import expanduser
 from sys import exit
 from textwrap import wrap
@@ -91,6 +96,9 @@ TRUE_VALUES = ['1', 'on', 't', 'true', 'y', 'yes']
 FALSE_VALUES = ['0', 'f', 'false', 'n', 'no', 'off']
 """A list of lowercase string values that equate to False."""
 
+CONF_CACHE_VERSION = 1
+"""The format version of the compiled caches written by read_conf."""
+
 
 class Conf(object):
     """Wraps a configuration dict for richer access methods.
@@ -229,7 +237,16 @@ class Conf(object):
         return str(self)
 
 
-def _read_conf(parser, conf_files_read, conf_file, exit_on_read_exception):
+def _stamp_conf_file(conf_file):
+    try:
+        st = stat(conf_file)
+    except OSError:
+        return None
+    return (st.st_ino, st.st_size, st.st_mtime, st.st_ctime)
+
+
+def _read_conf(parser, conf_files_read, conf_file, exit_on_read_exception,
+               conf_stamps=None):
     if len(conf_files_read) > 50:
         msg = (
             'Tried to read more than 50 conf files.\n'
@@ -240,6 +257,12 @@ def _read_conf(parser, conf_files_read, conf_file, exit_on_read_exception):
             exit(msg)
         else:
             raise Error(msg)
+    if conf_stamps is not None:
+        # Stamped before reading so an edit made during the read is not
+        # mistaken for what was read.
+        conf_stamps.append(
+            (expanduser(conf_file),
+             _stamp_conf_file(expanduser(conf_file))))
     if exit_on_read_exception:
         try:
             conf_files_read.extend(parser.read([expanduser(conf_file)]))
@@ -256,10 +279,41 @@ def _read_conf(parser, conf_files_read, conf_file, exit_on_read_exception):
         for conf_file in list(
                 reader([additional_confs], delimiter=' '))[0]:
             _read_conf(
-                parser, conf_files_read, conf_file, exit_on_read_exception)
+                parser, conf_files_read, conf_file, exit_on_read_exception,
+                conf_stamps)
+
 
+def _load_conf_cache(cache_path, conf_files):
+    try:
+        with open(cache_path, 'rb') as fp:
+            version, cached_conf_files, conf_stamps, conf_files_read, store = \
+                loads(fp.read())
+    except (IOError, EOFError, ValueError, TypeError):
+        return None
+    if version != CONF_CACHE_VERSION or cached_conf_files != conf_files:
+        return None
+    for conf_file, stamp in conf_stamps:
+        if _stamp_conf_file(conf_file) != stamp:
+            return None
+    return Conf(store, files=conf_files_read)
 
-def read_conf(conf_files, exit_on_read_exception=True):
+
+def _save_conf_cache(cache_path, conf_files, conf_stamps, conf):
+    temp_path = '%s.%s' % (cache_path, getpid())
+    try:
+        with open(temp_path, 'wb') as fp:
+            fp.write(dumps((
+                CONF_CACHE_VERSION, conf_files, conf_stamps, conf.files,
+                conf.store)))
+        rename(temp_path, cache_path)
+    except (IOError, OSError):
+        try:
+            unlink(temp_path)
+        except OSError:
+            pass
+
+
+def read_conf(conf_files, exit_on_read_exception=True, cache_path=None):
     """Returns a new :py:class:`Conf` instance.
 
     The new instance is based on the results from reading the conf_files
@@ -278,6 +332,14 @@ def read_conf(conf_files, exit_on_read_exception=True):
     default. If you set exit_on_read_exception to False, the
     ConfigParser.Error be raised instead.
 
+    If a cache_path is given, the results are also written there in a
+    compiled form along with the identity, size, and modification times
+    of every conf file tried, including those from additional_confs and
+    those that did not exist. Later calls with the same conf_files
+    return the cached results without parsing anything as long as none
+    of those files have changed. A cache that cannot be read or written
+    is simply ignored.
+
     :param conf_files: An iterable of conf files or a string
         representing a single conf file to read and translate.
         Values in files further into the list override any values from
@@ -286,16 +348,31 @@ def read_conf(conf_files, exit_on_read_exception=True):
     :param exit_on_read_exception: A boolean that indicates whether
         sys.exit should be called on error or if a ConfigParser.Error
         should be raised instead.
+    :param cache_path: The path to the compiled cache file to use, if
+        any.
     :returns: A new :py:class:`Conf` instance representing the
         configuration read from the conf_files.
     """
     if isinstance(conf_files, basestring):
         conf_files = [conf_files]
+    conf_stamps = None
+    if cache_path:
+        conf_files = list(conf_files)
+        cache_key = [expanduser(f) for f in conf_files]
+        conf = _load_conf_cache(cache_path, cache_key)
+        if conf:
+            return conf
+        conf_stamps = []
     parser = SafeConfigParser()
     conf_files_read = []
     for conf_file in conf_files:
-        _read_conf(parser, conf_files_read, conf_file, exit_on_read_exception)
+        _read_conf(
+            parser, conf_files_read, conf_file, exit_on_read_exception,
+            conf_stamps)
     store = {}
     for section in parser.sections():
         store[section] = dict(parser.items(section))
-    return Conf(store, files=conf_files_read)
+    conf = Conf(store, files=conf_files_read)
+    if cache_path:
+        _save_conf_cache(cache_path, cache_key, conf_stamps, conf)
+    return conf
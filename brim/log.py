@@ -20,7 +20,7 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 
-__all__ = ['get_logger', 'NOTICE', 'sysloggable_excinfo']
+__all__ = ['get_logger', 'NOTICE', 'sysloggable_excinfo', 'use_os_threads']
 
 import logging
 from eventlet.green import thread, threading
@@ -117,6 +117,26 @@ def sysloggable_excinfo(*excinfo):
     return '%s %r' % (lines[-1], lines)
 
 
+def use_os_threads():
+    """Switches logging over to OS thread locks.
+
+    Logging is patched above to use Eventlet's green locks, which cannot
+    safely be shared by OS threads. This is called by brimd workers
+    using the threads concurrency_model before they start their threads.
+    The locks of existing handlers are replaced as well. The ``txn``
+    attribute remains local to each OS thread as well as each coroutine.
+    """
+    import thread as os_thread
+    import threading as os_threading
+    logging.thread = os_thread
+    logging.threading = os_threading
+    logging._lock = os_threading.RLock()
+    for ref in logging._handlerList:
+        handler = ref()
+        if handler:
+            handler.createLock()
+
+
 def get_logger(route, name, level, facility='LOG_USER', console=False):
     """Returns a Logger based on the information given.
 
@@ -23,31 +23,50 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 
+import sys
 from ctypes import c_ulong, sizeof as ctypes_sizeof
-from errno import EINVAL, ENOENT, ESRCH
+from errno import EAGAIN, ECONNREFUSED, EINTR, EINVAL, ENOENT, ESRCH
 from inspect import getargspec
-from itertools import chain
+from itertools import chain, izip_longest
 from mmap import mmap
 from optparse import OptionParser
-from os import fork, kill, unlink
-from os.path import expanduser
-from signal import SIGHUP, SIGTERM
-from socket import error as socket_error
+from os import chmod, close, fdopen, fork, getpid, kill, killpg, unlink
+from os.path import abspath, expanduser
+from Queue import Queue
+from random import randint
+from resource import getrusage, RUSAGE_SELF
+from select import error as select_error, select
+from signal import SIG_IGN, signal, SIGHUP, SIGTERM, SIGURG, SIGUSR1, \
+    SIGUSR2
+from socket import AF_UNIX, error as socket_error, getfqdn, MSG_DONTWAIT, \
+    SHUT_RDWR, SHUT_WR, SOCK_STREAM, socket, timeout as socket_timeout
+from SocketServer import BaseServer
 from sys import argv as sys_argv, stdin as sys_stdin, stdout as sys_stdout, \
     stderr as sys_stderr
-from time import gmtime, strftime, time
+from tempfile import mkstemp
+from thread import get_ident
+from threading import Lock, Semaphore, Thread
+from time import gmtime, sleep as time_sleep, strftime, time
 from urllib import unquote, unquote_plus
 from uuid import uuid4
+from wsgiref.simple_server import ServerHandler, WSGIRequestHandler, \
+    WSGIServer
 
 from brim.conf import read_conf
-from brim.service import capture_exceptions_stdout_stderr, droppriv, \
-    get_listening_tcp_socket, get_listening_udp_socket, sustain_workers
-from eventlet import GreenPool, sleep, wsgi
+from brim.service import capture_exceptions_stdout_stderr, \
+    DatagramBatchReceiver, DatagramBatchSender, droppriv, get_cpu_affinity, \
+    get_listening_tcp_socket, get_listening_udp_socket, get_numa_nodes, \
+    get_ssl_context, get_udp_drops, handoff_listening_sockets, \
+    parse_cpu_list, receive_listening_sockets, set_cpu_affinity, \
+    SocketSplicer, SocketStream, StackSampler, sustain_workers, tune_socket, \
+    worker_ready
+from eventlet import GreenPool, sleep, spawn, spawn_n, wsgi
 from eventlet.greenio import shutdown_safe
-from eventlet.hubs import use_hub
+from eventlet.greenthread import getcurrent
+from eventlet.hubs import get_hub, trampoline, use_hub
 
 from brim import __version__
-from brim.log import get_logger, sysloggable_excinfo
+from brim.log import get_logger, sysloggable_excinfo, use_os_threads
 
 try:
     from setproctitle import setproctitle
@@ -120,6 +139,102 @@ def _send_pid_sig(pid_file, sig, expect_exit=False, pid_override=None):
     return (False, 0)
 
 
+def _conf_error(section, option, value, conversion_type, err):
+    raise Exception('Configuration value [%s] %s of %r cannot be '
+                    'converted to %s.' %
+                    (section, option, value, conversion_type))
+
+
+def load_wsgi_app(app_name, conf):
+    """Loads and configures the WSGI app for the [app_name] section.
+
+    The app's class is imported from the section's call option and
+    checked to be usable before its parse_conf and stats_conf, if any,
+    are called. This is what :py:class:`WSGISubserver` does for each of
+    its apps, and apps that run pipelines of their own, like
+    :py:class:`brim.wsgi_router.WSGIRouter`, can do the same.
+
+    :param app_name: The name of the app and its conf section.
+    :param conf: The :py:class:`brim.conf.Conf` to configure it from.
+    :returns: A tuple of (app_class, app_conf, app_stats) where app_conf
+        is to be passed as the parsed_conf when instantiating the app
+        and app_stats is the app's list of (stat_name, stat_type) pairs.
+    :raises Exception: If the app cannot be loaded or configured.
+    """
+    call = conf.get(app_name, 'call')
+    if not call:
+        raise Exception(
+            "App [%s] not configured with 'call' option." % app_name)
+    try:
+        mod, cls = call.rsplit('.', 1)
+    except ValueError:
+        raise Exception(
+            'Invalid call value %r for app [%s].' % (call, app_name))
+    try:
+        app_class = getattr(__import__(mod, fromlist=[cls]), cls)
+    except (AttributeError, ImportError):
+        raise Exception(
+            'Could not load class %r for app [%s].' % (call, app_name))
+    try:
+        args = len(getargspec(app_class.__init__).args)
+        if args != 4:
+            raise Exception(
+                'Would not be able to instantiate %r for app [%s]. '
+                'Incorrect number of args, %s, should be 4 (self, '
+                'name, conf, next_app).' % (call, app_name, args))
+    except TypeError as err:
+        if str(err).endswith(' is not a Python function'):
+            err = 'Probably not a class.'
+        raise Exception(
+            'Would not be able to instantiate %r for app [%s]. %s' %
+            (call, app_name, err))
+    try:
+        args = len(getargspec(app_class.__call__).args)
+        if args != 3:
+            raise Exception(
+                'Would not be able to use %r for app [%s]. Incorrect '
+                'number of __call__ args, %s, should be 3 (self, env, '
+                'start_response).' % (call, app_name, args))
+    except TypeError as err:
+        if str(err).endswith(' is not a Python function'):
+            err = 'Probably no __call__ method.'
+        raise Exception(
+            'Would not be able to use %r for app [%s]. %s' %
+            (call, app_name, err))
+    if hasattr(app_class, 'parse_conf'):
+        try:
+            args = len(getargspec(app_class.parse_conf).args)
+            if args != 3:
+                raise Exception(
+                    'Cannot use %r for app [%s]. Incorrect number of '
+                    'parse_conf args, %s, should be 3 (cls, name, '
+                    'conf).' % (call, app_name, args))
+        except TypeError as err:
+            if str(err).endswith(' is not a Python function'):
+                err = 'parse_conf probably not a method.'
+            raise Exception('Cannot use %r for app [%s]. %s' %
+                            (call, app_name, err))
+        app_conf = app_class.parse_conf(app_name, conf)
+    else:
+        app_conf = conf
+    app_stats = []
+    if hasattr(app_class, 'stats_conf'):
+        try:
+            args = len(getargspec(app_class.stats_conf).args)
+            if args != 3:
+                raise Exception(
+                    'Cannot use %r for app [%s]. Incorrect number of '
+                    'stats_conf args, %s, should be 3 (cls, name, '
+                    'conf).' % (call, app_name, args))
+        except TypeError as err:
+            if str(err).endswith(' is not a Python function'):
+                err = 'stats_conf probably not a method.'
+            raise Exception('Cannot use %r for app [%s]. %s' %
+                            (call, app_name, err))
+        app_stats = list(app_class.stats_conf(app_name, app_conf))
+    return app_class, app_conf, app_stats
+
+
 def _log_quote(value):
     return ''.join(_log_quote_chars(value))
 
@@ -132,6 +247,16 @@ def _log_quote_chars(value):
             yield c
 
 
+class _WorkerDrain(SystemExit):
+    """Raised in a worker to have it stop accepting and drain.
+
+    This subclasses SystemExit so that Eventlet's WSGI server will
+    treat it as a request to stop accepting, wait for in-progress
+    requests, and return.
+    """
+    pass
+
+
 class _BucketStats(object):
     """Used to track server stats by allocating a shared memory mmap.
 
@@ -150,9 +275,13 @@ class _BucketStats(object):
            reported as the overall stat.
     * max: The maximum value of the stat for all buckets will be
            reported as the overall stat.
+
+    The lock is held while incrementing so that workers using the
+    threads concurrency_model don't lose counts.
     """
 
     def __init__(self, bucket_names, stats_conf):
+        self.lock = Lock()
         self.bucket_names = bucket_names
         self.bucket_count = len(bucket_names)
         self.stats_conf = stats_conf
@@ -181,11 +310,12 @@ class _BucketStats(object):
             if v is not None:
                 v.value = int(value)
 
-    def incr(self, bucket_id, name):
+    def incr(self, bucket_id, name, amount=1):
         if self.bucket_count:
             v = self._stats[bucket_id].get(name)
             if v is not None:
-                v.value += 1
+                with self.lock:
+                    v.value += amount
 
 
 class _Stats(object):
@@ -207,8 +337,20 @@ class _Stats(object):
     def set(self, name, value):
         self.bucket_stats.set(self.bucket_id, name, value)
 
-    def incr(self, name):
-        self.bucket_stats.incr(self.bucket_id, name)
+    def incr(self, name, amount=1):
+        self.bucket_stats.incr(self.bucket_id, name, amount)
+
+
+def _eventlet_conn_state(conn, addr):
+    """Returns the argument Eventlet's wsgi.Server.process_request takes.
+
+    Newer Eventlet versions take an [addr, conn, state] list that their
+    own accept loop uses to track idle connections; older versions take
+    a (conn, addr) tuple.
+    """
+    if hasattr(wsgi, 'STATE_IDLE'):
+        return [addr, conn, wsgi.STATE_IDLE]
+    return (conn, addr)
 
 
 class _EventletWSGINullLogger():
@@ -291,6 +433,210 @@ class _WsgiOutput(object):
         return rv
 
 
+class _AppTimer(object):
+    """Times a WSGI app for the app_timing option.
+
+    Each call is counted in the app's <name>.call_count stat. The wall
+    clock time spent in the app, both in the call and in iterating the
+    response body it returns, is added to its <name>.self_usec stat
+    less any time spent in the timed apps it calls in turn.
+    """
+
+    def __init__(self, name, app):
+        self.name = name
+        self.app = app
+        self.call_count_stat = '%s.call_count' % name
+        self.self_usec_stat = '%s.self_usec' % name
+
+    def __call__(self, env, start_response):
+        env['brim.stats'].incr(self.call_count_stat)
+        return _AppTimerOutput(
+            self, self.time(env, self.app, env, start_response), env)
+
+    def time(self, env, func, *args):
+        """Returns func(*args) after adding its time to the app's stat.
+
+        env['brim._app_usec'] collects the time of the timed calls made
+        within this one, so it can be subtracted from this one's time
+        and then added, in full, to the time of the timed call this one
+        was made within.
+        """
+        outer_usec = env.get('brim._app_usec', 0)
+        env['brim._app_usec'] = 0
+        start = time()
+        try:
+            return func(*args)
+        finally:
+            usec = int(round((time() - start) * 1000000))
+            inner_usec = env['brim._app_usec']
+            env['brim._app_usec'] = outer_usec + usec
+            env['brim.stats'].incr(
+                self.self_usec_stat, max(0, usec - inner_usec))
+
+
+class _AppTimerOutput(object):
+    """Times the iteration of a response body for an _AppTimer."""
+
+    def __init__(self, timer, body, env):
+        self.timer = timer
+        self.body = iter(body)
+        self.env = env
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        return self.timer.time(self.env, self.body.next)
+
+
+class _ThreadPool(object):
+    """A fixed size pool of OS threads.
+
+    Used in place of Eventlet's GreenPool by workers using the threads
+    concurrency_model, offering the same spawn_n and waitall methods.
+    spawn_n blocks while all the threads are busy. Exceptions raised by
+    the functions run are sent to sys.excepthook, which brimd has log
+    them.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self._idle = Semaphore(size)
+        self._queue = Queue()
+        self._threads = []
+        for _junk in xrange(size):
+            thread = Thread(target=self._run)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            func, args = item
+            try:
+                func(*args)
+            except Exception:
+                sys.excepthook(*sys.exc_info())
+            finally:
+                self._idle.release()
+
+    def spawn_n(self, func, *args):
+        self._idle.acquire()
+        self._queue.put((func, args))
+
+    def waitall(self):
+        for thread in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+
+
+class _ThreadsWSGIInput(object):
+    """Limits reading the request body to its Content-Length.
+
+    The wsgiref server used by the threads concurrency_model otherwise
+    gives the app the raw connection to read from. Requests without a
+    Content-Length have an empty body.
+    """
+
+    def __init__(self, rfile, length):
+        self.rfile = rfile
+        self.remaining = length
+
+    def close(self):
+        pass
+
+    def read(self, size=None):
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        if not size:
+            return ''
+        rv = self.rfile.read(size)
+        self.remaining -= len(rv)
+        return rv
+
+    def readline(self, size=None):
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        if not size:
+            return ''
+        rv = self.rfile.readline(size)
+        self.remaining -= len(rv)
+        return rv
+
+    def readlines(self, sizehint=None):
+        return list(iter(self.readline, ''))
+
+
+class _ThreadsWSGIRequestHandler(WSGIRequestHandler):
+    """wsgiref request handler for the threads concurrency_model."""
+
+    def setup(self):
+        self.timeout = self.server.client_timeout
+        WSGIRequestHandler.setup(self)
+
+    def handle(self):
+        # As WSGIRequestHandler.handle but with the body length limited.
+        self.raw_requestline = self.rfile.readline(65537)
+        if len(self.raw_requestline) > 65536:
+            self.requestline = ''
+            self.request_version = ''
+            self.command = ''
+            self.send_error(414)
+            return
+        if not self.parse_request():
+            return
+        env = self.get_environ()
+        try:
+            length = max(0, int(env.get('CONTENT_LENGTH') or 0))
+        except ValueError:
+            length = 0
+        handler = ServerHandler(
+            _ThreadsWSGIInput(self.rfile, length), self.wfile,
+            self.get_stderr(), env)
+        handler.request_handler = self
+        handler.run(self.server.get_app())
+
+    def log_message(self, *args):
+        # Requests are logged by WSGISubserver._log_request instead.
+        pass
+
+
+class _ThreadsWSGIServer(WSGIServer):
+    """wsgiref server for the threads concurrency_model.
+
+    Rather than running its own accept loop, the worker hands each
+    accepted connection to :py:meth:`handle_connection` on one of its
+    threads. This serves one request per connection, using HTTP/1.0.
+
+    :param sock: The already listening socket.
+    :param app: The WSGI app to serve.
+    :param client_timeout: The seconds of client inactivity allowed.
+    """
+
+    def __init__(self, sock, app, client_timeout):
+        # TCPServer.__init__ is skipped since it would create a socket.
+        BaseServer.__init__(
+            self, sock.getsockname(), _ThreadsWSGIRequestHandler)
+        self.socket = sock
+        self.server_name = getfqdn(self.server_address[0])
+        self.server_port = self.server_address[1]
+        self.client_timeout = client_timeout
+        self.setup_environ()
+        self.set_app(app)
+
+    def handle_connection(self, conn, addr):
+        try:
+            self.finish_request(conn, addr)
+        except socket_error:
+            pass
+        finally:
+            self.shutdown_request(conn)
+
+
 class Subserver(object):
     """Base class for brimd subservers (wsgi, tcp, udp, daemons).
 
@@ -325,6 +671,11 @@ class Subserver(object):
         self.worker_count = 1
         self.worker_names = ['0']
         self.stats_conf = {'start_time': 'worker'}
+        self.sampler = None
+        """The :py:class:`brim.service.StackSampler` of the worker.
+
+        Set once the worker starts; see :py:meth:`profile`.
+        """
 
     def _parse_conf(self, conf):
         """Translates the conf into instance attributes.
@@ -384,6 +735,21 @@ class Subserver(object):
             raise Exception(
                 'Could not load function %r for [%s] json_loads.' %
                 (self.json_loads, self.name))
+        self.profile_seconds = conf.get_int(
+            self.name, 'profile_seconds',
+            conf.get_int('brim', 'profile_seconds', 30))
+        if self.profile_seconds < 1:
+            raise Exception('Invalid [%s] profile_seconds %r.' %
+                            (self.name, self.profile_seconds))
+        self.profile_interval = conf.get_float(
+            self.name, 'profile_interval',
+            conf.get_float('brim', 'profile_interval', 0.01))
+        if self.profile_interval <= 0:
+            raise Exception('Invalid [%s] profile_interval %r.' %
+                            (self.name, self.profile_interval))
+        self.profile_dir = conf.get_path(
+            self.name, 'profile_dir',
+            conf.get_path('brim', 'profile_dir', '/tmp'))
 
     def _privileged_start(self):
         """Called just before dropping privileges and calling _start.
@@ -401,6 +767,42 @@ class Subserver(object):
         """
         self.bucket_stats = bucket_stats
 
+    def _profile_on_sigurg(self):
+        """Has the calling worker profile itself on SIGURG.
+
+        The worker samples its stacks for profile_seconds and writes
+        them in folded form to a file in profile_dir named for the
+        subserver, the worker's pid, and the time; the file name is
+        logged when profiling starts. The file is always newly created,
+        with a random suffix and readable only by the worker's user, so
+        a shared profile_dir like /tmp is safe to use.
+        """
+        def _urg_signal(*args):
+            try:
+                fd, path = mkstemp(
+                    prefix='%s-%d-%s-' % (
+                        self.name, getpid(),
+                        strftime('%Y%m%d%H%M%S', gmtime())),
+                    suffix='.folded', dir=self.profile_dir)
+            except OSError as err:
+                self.logger.error('Could not create profile in %s: %s' %
+                                  (self.profile_dir, err))
+                return
+
+            def _write_profile(folded):
+                with fdopen(fd, 'w') as fp:
+                    fp.write(folded)
+
+            if self.sampler.start(self.profile_seconds, _write_profile):
+                self.logger.info('Profiling for %ss to %s' %
+                                 (self.profile_seconds, path))
+            else:
+                close(fd)
+                unlink(path)
+                self.logger.info('Already profiling.')
+
+        signal(SIGURG, _urg_signal)
+
 
 class IPSubserver(Subserver):
     """Base class for "raw" IP based subservers.
@@ -415,17 +817,57 @@ class IPSubserver(Subserver):
 
     def __init__(self, server, name):
         Subserver.__init__(self, server, name)
+        self.handed_off = False
+        self.worker_greenlet = None
+        self.draining = False
+        self.concurrency_model = 'eventlet'
+        self.stats_conf.update({
+            'recycle_requests_count': 'sum', 'recycle_rss_count': 'sum'})
+        self.worker_request_limit = 0
+        self.worker_request_count = 0
+        self.socket_options = {}
+        self.socket_granted = {}
+        self.ssl_ciphers = None
+        self.ssl_alpn_protocols = None
+        self.ssl_session_tickets = True
+        self.ssl_handshake_timeout = 0
+        self.ssl_context = None
+        self.hub_lag_interval = 0
+        self.hub_lag_log_threshold = 0
 
     def _parse_conf(self, conf):
         Subserver._parse_conf(self, conf)
         self.ip = conf.get(self.name, 'ip', conf.get('brim', 'ip', '*'))
         self.port = conf.get_int(
             self.name, 'port', conf.get_int('brim', 'port', 80))
+        self.max_workers = conf.get_int(
+            self.name, 'max_workers', conf.get_int('brim', 'max_workers', 0))
+        self.min_workers = conf.get_int(
+            self.name, 'min_workers', conf.get_int('brim', 'min_workers', 1))
+        if self.max_workers and not \
+                1 <= self.min_workers <= self.max_workers:
+            raise Exception(
+                'Invalid [%s] min_workers %r; must be from 1 to max_workers '
+                '%r.' % (self.name, self.min_workers, self.max_workers))
+        self.scale_target = conf.get_int(
+            self.name, 'scale_target', conf.get_int('brim', 'scale_target', 8))
+        if self.scale_target < 1:
+            raise Exception('Invalid [%s] scale_target %r.' %
+                            (self.name, self.scale_target))
+        self.scale_interval = conf.get_int(
+            self.name, 'scale_interval',
+            conf.get_int('brim', 'scale_interval', 5))
+        if self.scale_interval < 1:
+            raise Exception('Invalid [%s] scale_interval %r.' %
+                            (self.name, self.scale_interval))
+        if self.max_workers:
+            self.stats_conf.update({'in_flight': 'sum',
+                                    'in_flight_peak': 'worker'})
         if self.server.no_daemon:
             self.worker_count = 0
             self.worker_names = ['0']
         else:
-            self.worker_count = conf.get_int(
+            self.worker_count = self.max_workers or conf.get_int(
                 self.name, 'workers', conf.get_int('brim', 'workers', 1))
             self.worker_names = [
                 str(i) for i in xrange(self.worker_count or 1)]
@@ -444,6 +886,51 @@ class IPSubserver(Subserver):
         self.listen_retry = conf.get_int(
             self.name, 'listen_retry',
             conf.get_int('brim', 'listen_retry', 30))
+        self.reload_batch = conf.get_int(
+            self.name, 'reload_batch', conf.get_int('brim', 'reload_batch', 1))
+        self.concurrency_model = conf.get(
+            self.name, 'concurrency_model',
+            conf.get('brim', 'concurrency_model', 'eventlet')).lower()
+        if self.concurrency_model not in ('eventlet', 'threads'):
+            raise Exception('Invalid [%s] concurrency_model %r.' %
+                            (self.name, self.concurrency_model))
+        if self.server.no_daemon:
+            # All subservers run in the one process on Eventlet then.
+            self.concurrency_model = 'eventlet'
+        self.threads_per_worker = conf.get_int(
+            self.name, 'threads_per_worker',
+            conf.get_int('brim', 'threads_per_worker', 32))
+        if self.threads_per_worker < 1:
+            raise Exception('Invalid [%s] threads_per_worker %r.' %
+                            (self.name, self.threads_per_worker))
+        cpu_affinity = conf.get(
+            self.name, 'cpu_affinity', conf.get('brim', 'cpu_affinity'))
+        self.cpu_affinity = []
+        self.cpu_affinity_auto = bool(
+            cpu_affinity and cpu_affinity.lower() == 'auto')
+        if self.cpu_affinity_auto:
+            try:
+                allowed = set(get_cpu_affinity())
+            except OSError as err:
+                raise Exception(
+                    'Cannot use [%s] cpu_affinity: %s' % (self.name, err))
+            nodes = [[cpu for cpu in cpus if cpu in allowed]
+                     for cpus in get_numa_nodes()]
+            nodes = [cpus for cpus in nodes if cpus] or [sorted(allowed)]
+            # Interleaving the NUMA nodes spreads the workers across them.
+            self.cpu_affinity = [
+                cpu for cpus in izip_longest(*nodes) for cpu in cpus
+                if cpu is not None]
+        elif cpu_affinity:
+            try:
+                self.cpu_affinity = parse_cpu_list(cpu_affinity)
+            except ValueError:
+                pass
+            if not self.cpu_affinity:
+                raise Exception('Invalid [%s] cpu_affinity %r.' %
+                                (self.name, cpu_affinity))
+        if self.cpu_affinity:
+            self.stats_conf['cpu'] = 'worker'
         eventlet_hub = conf.get(self.name, 'eventlet_hub',
                                 conf.get('brim', 'eventlet_hub'))
         self.eventlet_hub = None
@@ -467,6 +954,587 @@ class IPSubserver(Subserver):
         if eventlet_hub and self.eventlet_hub is None:
             raise Exception('Could not load [%s] eventlet_hub %r.' %
                             (self.name, eventlet_hub))
+        self.max_requests_per_worker = conf.get_int(
+            self.name, 'max_requests_per_worker',
+            conf.get_int('brim', 'max_requests_per_worker', 0))
+        self.max_requests_jitter = conf.get_int(
+            self.name, 'max_requests_jitter',
+            conf.get_int('brim', 'max_requests_jitter', 0))
+        self.max_worker_rss = conf.get_int(
+            self.name, 'max_worker_rss',
+            conf.get_int('brim', 'max_worker_rss', 0))
+        self.hub_lag_interval = conf.get_float(
+            self.name, 'hub_lag_interval',
+            conf.get_float('brim', 'hub_lag_interval', 0))
+        if self.hub_lag_interval < 0:
+            raise Exception('Invalid [%s] hub_lag_interval %r.' %
+                            (self.name, self.hub_lag_interval))
+        self.hub_lag_log_threshold = conf.get_float(
+            self.name, 'hub_lag_log_threshold',
+            conf.get_float('brim', 'hub_lag_log_threshold', 0))
+        if self.hub_lag_log_threshold < 0:
+            raise Exception('Invalid [%s] hub_lag_log_threshold %r.' %
+                            (self.name, self.hub_lag_log_threshold))
+        if self.hub_lag_interval and self.concurrency_model != 'threads':
+            self.stats_conf.update({
+                'hub_lag_max_usec': 'max', 'hub_lag_1ms_count': 'sum',
+                'hub_lag_10ms_count': 'sum', 'hub_lag_100ms_count': 'sum',
+                'hub_lag_1s_count': 'sum'})
+        self._parse_socket_options(
+            conf, ('socket_rcvbuf', 'socket_sndbuf', 'socket_busy_poll'))
+
+    def _parse_ssl_options(self, conf):
+        """Parses the options for the SSL context of TCP subservers.
+
+        The SSL stats are added when certfile and keyfile are set.
+        """
+        self.ssl_ciphers = conf.get(
+            self.name, 'ssl_ciphers', conf.get('brim', 'ssl_ciphers'))
+        alpn_protocols = conf.get(
+            self.name, 'ssl_alpn_protocols',
+            conf.get('brim', 'ssl_alpn_protocols'))
+        self.ssl_alpn_protocols = None
+        if alpn_protocols:
+            self.ssl_alpn_protocols = [
+                p.strip() for p in alpn_protocols.split(',') if p.strip()]
+        self.ssl_session_tickets = conf.get_bool(
+            self.name, 'ssl_session_tickets',
+            conf.get_bool('brim', 'ssl_session_tickets', True))
+        self.ssl_handshake_timeout = conf.get_int(
+            self.name, 'ssl_handshake_timeout',
+            conf.get_int('brim', 'ssl_handshake_timeout', 10))
+        if self.ssl_handshake_timeout < 0:
+            raise Exception('Invalid [%s] ssl_handshake_timeout %r.' %
+                            (self.name, self.ssl_handshake_timeout))
+        if self.certfile and self.keyfile:
+            self.stats_conf.update({
+                'ssl_handshake_count': 'sum',
+                'ssl_handshake_failure_count': 'sum',
+                'ssl_handshake_timeout_count': 'sum',
+                'ssl_handshake_usec': 'sum', 'ssl_session_hit_count': 'sum'})
+
+    def _load_ssl_context(self):
+        """Creates the ssl_context if certfile and keyfile are set.
+
+        Called from _privileged_start so the key file may be readable by
+        root only, and so every worker shares the context's session
+        ticket keys.
+        """
+        if not self.certfile or not self.keyfile:
+            return
+        try:
+            self.ssl_context = get_ssl_context(
+                self.certfile, self.keyfile, ciphers=self.ssl_ciphers,
+                alpn_protocols=self.ssl_alpn_protocols,
+                session_tickets=self.ssl_session_tickets,
+                style=None if self.concurrency_model == 'threads' else
+                'eventlet')
+        # ssl.SSLError is an IOError.
+        except (IOError, NotImplementedError) as err:
+            raise Exception(
+                'Could not load [%s] SSL context: %s' % (self.name, err))
+
+    def _ssl_handshake(self, sock, stats):
+        """Wraps an accepted socket with SSL and does the handshake.
+
+        This is done by the connection's own coroutine or thread rather
+        than when accepting, so a slow handshake holds up just its own
+        connection. The handshake is counted in the ssl_handshake_count
+        stat, its time in ssl_handshake_usec, and the context's session
+        cache and ticket resumptions so far in ssl_session_hit_count.
+        Should the handshake fail, the socket is closed and counted in
+        ssl_handshake_failure_count instead, and also in
+        ssl_handshake_timeout_count if it took ssl_handshake_timeout.
+
+        :param sock: The just accepted socket.socket.
+        :param stats: The worker's stats.
+        :returns: The SSL wrapped socket or None if the handshake failed.
+        """
+        start = time()
+        timeout = sock.gettimeout()
+        if self.ssl_handshake_timeout:
+            sock.settimeout(self.ssl_handshake_timeout)
+        try:
+            sock = self.ssl_context.wrap_socket(
+                sock, server_side=True, do_handshake_on_connect=False)
+            sock.do_handshake()
+            sock.settimeout(timeout)
+        # ssl.SSLError is a socket.error. Eventlet raises SSLError rather
+        # than socket.timeout for timeouts, so the time taken is checked.
+        except socket_error:
+            stats.incr('ssl_handshake_failure_count')
+            if self.ssl_handshake_timeout and \
+                    time() - start >= self.ssl_handshake_timeout:
+                stats.incr('ssl_handshake_timeout_count')
+            sock.close()
+            return None
+        stats.incr('ssl_handshake_count')
+        stats.incr('ssl_handshake_usec', int((time() - start) * 1000000))
+        stats.set('ssl_session_hit_count',
+                  self.ssl_context.session_stats()['hits'])
+        return sock
+
+    def _parse_socket_options(self, conf, options):
+        """Adds the options given to socket_options when set.
+
+        These are passed to :py:func:`brim.service.tune_socket` for the
+        listening socket and each gets a stat of the value the kernel
+        granted.
+        """
+        for option in options:
+            if option == 'tcp_nodelay':
+                value = int(conf.get_bool(
+                    self.name, option, conf.get_bool('brim', option, False)))
+            else:
+                value = conf.get_int(
+                    self.name, option, conf.get_int('brim', option, 0))
+                if value < 0:
+                    raise Exception(
+                        'Invalid [%s] %s %r.' % (self.name, option, value))
+            if value:
+                self.socket_options[option] = value
+                self.stats_conf[option] = 'max'
+
+    def _tune_socket(self):
+        """Applies socket_options to the listening socket.
+
+        Called from _privileged_start so the buffer sizes may exceed the
+        kernel's usual caps.
+        """
+        try:
+            self.socket_granted = tune_socket(
+                self.sock, **self.socket_options)
+        except socket_error as err:
+            raise Exception(
+                'Could not tune [%s] socket: %s' % (self.name, err))
+
+    def _start(self, bucket_stats):
+        Subserver._start(self, bucket_stats)
+        # Every worker shares the listening socket and so its options.
+        for name, value in self.socket_granted.iteritems():
+            for bucket_id in xrange(bucket_stats.bucket_count):
+                bucket_stats.set(bucket_id, name, value)
+
+    def _reload(self):
+        """Re-reads the configuration ahead of a rolling reload.
+
+        This is called in the subserver's main process by
+        :py:func:`brim.service.sustain_workers` on SIGUSR1, just before
+        the workers are replaced; the replacement workers will use the
+        new configuration. Options that would require rebinding the
+        listening socket or resizing the shared stats cannot be changed
+        by a reload; doing so raises an Exception and the existing
+        configuration is kept, as it is if :py:meth:`_prepare_reload`
+        raises.
+        """
+        conf = read_conf(
+            self.server.conf_files, exit_on_read_exception=False,
+            cache_path=self.server.conf_cache)
+        if not conf.files:
+            raise Exception('No configuration found.')
+        conf.error = _conf_error
+        subserver = self.__class__(self.server, self.name)
+        subserver._parse_conf(conf)
+        self._check_reload(subserver)
+        subserver._prepare_reload()
+        keep = dict((attr, getattr(self, attr)) for attr in (
+            'sock', 'bucket_stats', 'stats_conf', 'worker_id', 'start_time',
+            'handed_off', 'ssl_context'))
+        self.__dict__.update(subserver.__dict__)
+        self.__dict__.update(keep)
+        self.logger = get_logger(
+            self.name, self.log_name, self.log_level, self.log_facility,
+            self.server.no_daemon)
+
+    def _check_reload(self, subserver):
+        """Raises an Exception if subserver cannot replace this one.
+
+        :param subserver: The newly parsed subserver.
+        """
+        for attr in ('ip', 'port', 'certfile', 'keyfile', 'backlog',
+                     'worker_count', 'max_workers', 'cpu_affinity',
+                     'concurrency_model', 'socket_options', 'ssl_ciphers',
+                     'ssl_alpn_protocols', 'ssl_session_tickets'):
+            if getattr(subserver, attr) != getattr(self, attr):
+                raise Exception(
+                    'Cannot change [%s] %s with a reload; a restart is '
+                    'required.' % (self.name, attr))
+        if subserver.stats_conf != self.stats_conf:
+            raise Exception(
+                'Cannot change [%s] stats with a reload; a restart is '
+                'required.' % self.name)
+
+    def _prepare_reload(self):
+        """Readies a newly parsed subserver to replace the running one.
+
+        This is called by :py:meth:`_reload` on the new subserver before
+        any of the running subserver's configuration is replaced, so an
+        Exception raised here abandons the reload cleanly.
+        """
+        pass
+
+    def _scale(self, workers_active):
+        """Returns the number of workers wanted when max_workers is set.
+
+        This is called in the subserver's main process by
+        :py:func:`brim.service.sustain_workers` every scale_interval
+        seconds. The active workers' in_flight_peak stats, the most
+        requests each had in progress since the last call, are totaled
+        and enough workers are wanted to bring the average down to
+        scale_target. Any worker that reached its limit,
+        concurrent_per_worker or, with the threads concurrency_model,
+        threads_per_worker, is saturated and also means another worker
+        is wanted. Workers are added all at once but retired one per
+        call so brief lulls don't cause churn. The stats of a retired
+        worker are zeroed so they aren't counted if its worker id is
+        made active again.
+
+        :param workers_active: The number of workers running, or 0 at
+            startup.
+        :returns: The number of workers wanted, from min_workers to
+            max_workers.
+        """
+        if not workers_active:
+            return self.min_workers
+        in_flight = 0
+        saturated = False
+        if self.concurrency_model == 'threads':
+            limit = self.threads_per_worker
+        else:
+            limit = self.concurrent_per_worker
+        for worker_id in xrange(workers_active):
+            peak = self.bucket_stats.get(worker_id, 'in_flight_peak')
+            self.bucket_stats.set(
+                worker_id, 'in_flight_peak',
+                self.bucket_stats.get(worker_id, 'in_flight'))
+            in_flight += peak
+            if peak >= limit:
+                saturated = True
+        workers_wanted = -(-in_flight // self.scale_target)
+        if saturated:
+            workers_wanted = max(workers_wanted, workers_active + 1)
+        if workers_wanted < workers_active:
+            workers_wanted = workers_active - 1
+        workers_wanted = max(
+            self.min_workers, min(self.max_workers, workers_wanted))
+        for worker_id in xrange(workers_wanted, workers_active):
+            self.bucket_stats.set(worker_id, 'in_flight', 0)
+            self.bucket_stats.set(worker_id, 'in_flight_peak', 0)
+        return workers_wanted
+
+    def _note_in_flight(self, delta):
+        """Adjusts the calling worker's in_flight stats by delta.
+
+        Only tracked when max_workers is set, for :py:meth:`_scale`.
+        """
+        if not self.max_workers or self.worker_id < 0:
+            return
+        with self.bucket_stats.lock:
+            in_flight = max(
+                0, self.bucket_stats.get(self.worker_id, 'in_flight') + delta)
+            self.bucket_stats.set(self.worker_id, 'in_flight', in_flight)
+            if in_flight > self.bucket_stats.get(
+                    self.worker_id, 'in_flight_peak'):
+                self.bucket_stats.set(
+                    self.worker_id, 'in_flight_peak', in_flight)
+
+    def _reset_in_flight(self):
+        """Zeroes the calling worker's in_flight stats as it starts.
+
+        A worker that was killed or crashed leaves its counts behind in
+        the shared stats, which its replacement would otherwise inherit.
+        """
+        if not self.max_workers or self.worker_id < 0:
+            return
+        with self.bucket_stats.lock:
+            self.bucket_stats.set(self.worker_id, 'in_flight', 0)
+            self.bucket_stats.set(self.worker_id, 'in_flight_peak', 0)
+
+    def _wrap_handler(self, handler, batch=False):
+        """Returns handler wrapped for _note_in_flight and _check_recycle.
+
+        :param handler: The TCP or UDP handler to wrap.
+        :param batch: True if the handler's last argument is a list of
+            datagrams, each counting as a request for
+            max_requests_per_worker.
+        """
+        recycle = not self.server.no_daemon and (
+            self.max_requests_per_worker or self.max_worker_rss)
+        if not self.max_workers and not recycle:
+            return handler
+
+        def _handler(*args):
+            self._note_in_flight(1)
+            try:
+                handler(*args)
+            finally:
+                self._note_in_flight(-1)
+                if recycle:
+                    self._check_recycle(len(args[-1]) if batch else 1)
+
+        return _handler
+
+    def _start_recycle(self):
+        """Readies the calling worker for _check_recycle.
+
+        The max_requests_per_worker limit gets up to max_requests_jitter
+        added, which keeps workers started together from all recycling
+        at the same time.
+        """
+        self.worker_request_count = 0
+        self.worker_request_limit = 0
+        if self.max_requests_per_worker and not self.server.no_daemon:
+            self.worker_request_limit = self.max_requests_per_worker + \
+                randint(0, self.max_requests_jitter)
+
+    def _check_recycle(self, requests=1):
+        """Has the worker drain and exit once past a recycle limit.
+
+        After each request, the worker is checked against the
+        max_requests_per_worker and max_worker_rss limits. Once past
+        either, the worker stops accepting new requests and exits after
+        those in progress complete, to be replaced by a fresh worker by
+        :py:func:`brim.service.sustain_workers`. This keeps memory
+        fragmentation and leaks in app code from accumulating. The
+        reason is counted in the recycle_requests_count or
+        recycle_rss_count stat. For TCP, a request is a connection and,
+        for UDP, a datagram.
+
+        :param requests: The number of requests just completed.
+        """
+        if self.server.no_daemon or self.draining:
+            return
+        self.worker_request_count += requests
+        reason = None
+        if self.worker_request_limit and \
+                self.worker_request_count >= self.worker_request_limit:
+            reason = 'requests'
+        # ru_maxrss is in kilobytes.
+        elif self.max_worker_rss and \
+                getrusage(RUSAGE_SELF).ru_maxrss * 1024 >= \
+                self.max_worker_rss:
+            reason = 'rss'
+        if reason:
+            _Stats(self.bucket_stats, self.worker_id).incr(
+                'recycle_%s_count' % reason)
+            self.logger.info(
+                'Recycling worker %s due to max_%s after %s requests.' % (
+                    self.worker_id,
+                    'requests_per_worker' if reason == 'requests' else
+                    'worker_rss',
+                    self.worker_request_count))
+            self._drain()
+
+    def _start_hub_lag_watch(self):
+        """Spawns _watch_hub_lag for the calling worker if configured.
+
+        Only workers using the eventlet concurrency_model have a hub to
+        watch.
+        """
+        if self.hub_lag_interval and self.concurrency_model != 'threads':
+            self._hub_lag_beat = time()
+            self._hub_lag_stack = None
+            if self.hub_lag_log_threshold:
+                thread = Thread(
+                    target=self._watch_hub_lag_stack, args=(get_ident(),))
+                thread.daemon = True
+                thread.start()
+            spawn_n(self._watch_hub_lag,
+                    _Stats(self.bucket_stats, self.worker_id))
+
+    def _watch_hub_lag(self, stats):
+        """Keeps the hub_lag_* stats current.
+
+        Runs for the life of the worker, sleeping hub_lag_interval
+        seconds at a time and noting how late each sleep wakes up. A
+        late wakeup means something kept the worker from getting back
+        to its hub, usually a blocking call, and every other coroutine
+        of the worker waited that long as well. Any stack noted by
+        :py:meth:`_watch_hub_lag_stack` is logged once the hub is
+        running again.
+        """
+        while True:
+            start = self._hub_lag_beat = time()
+            sleep(self.hub_lag_interval)
+            lag = max(0, time() - start - self.hub_lag_interval)
+            usec = int(lag * 1000000)
+            if usec > stats.get('hub_lag_max_usec'):
+                stats.set('hub_lag_max_usec', usec)
+            for limit, stat_name in ((1, 'hub_lag_1s_count'),
+                                     (0.1, 'hub_lag_100ms_count'),
+                                     (0.01, 'hub_lag_10ms_count'),
+                                     (0.001, 'hub_lag_1ms_count')):
+                if lag >= limit:
+                    stats.incr(stat_name)
+                    break
+            if self._hub_lag_stack:
+                self.logger.error('Hub blocked %.3fs in: %s' %
+                                  (lag, self._hub_lag_stack))
+                self._hub_lag_stack = None
+
+    def _watch_hub_lag_stack(self, ident):
+        """Notes the stack blocking the hub for _watch_hub_lag.
+
+        Runs in its own OS thread for the life of the worker since the
+        hub's thread is the one blocked. Once a wakeup of
+        :py:meth:`_watch_hub_lag` is hub_lag_log_threshold seconds late,
+        the stack then running in the hub's thread is noted, innermost
+        frame first. Calls that hold Python's global lock while they
+        block cannot be caught this way.
+
+        :param ident: The thread ident of the hub's thread.
+        """
+        noted_beat = None
+        while True:
+            time_sleep(self.hub_lag_log_threshold / 2.0)
+            beat = self._hub_lag_beat
+            if beat == noted_beat or time() - beat < \
+                    self.hub_lag_interval + self.hub_lag_log_threshold:
+                continue
+            noted_beat = beat
+            frame = sys._current_frames().get(ident)
+            names = []
+            while frame:
+                names.append('%s (%s:%d)' % (
+                    frame.f_code.co_name, frame.f_code.co_filename,
+                    frame.f_lineno))
+                frame = frame.f_back
+            self._hub_lag_stack = ' < '.join(names)
+
+    def _drain_on_sighup(self):
+        """Has the calling worker drain and exit on SIGHUP.
+
+        The worker stops accepting new work and returns once its
+        in-progress work has completed. This is what lets a rolling
+        reload replace workers without dropping any connections.
+        """
+        self.worker_greenlet = getcurrent()
+
+        def _hup_signal(*args):
+            signal(SIGHUP, SIG_IGN)
+            self._drain()
+
+        signal(SIGHUP, _hup_signal)
+
+    def _drain(self):
+        """Has the worker stop accepting new work and drain.
+
+        Requires :py:meth:`_drain_on_sighup` to have been called by the
+        worker first. Calling this more than once has no further effect.
+        Workers using the threads concurrency_model notice within a
+        second; see :py:meth:`_receive`.
+        """
+        if not self.draining:
+            self.draining = True
+            if self.concurrency_model != 'threads':
+                get_hub().schedule_call_global(
+                    0, self.worker_greenlet.throw, _WorkerDrain())
+
+    def _worker_pool(self, nonblocking=True):
+        """Returns the pool the calling worker runs its handlers on.
+
+        This is a GreenPool of concurrent_per_worker size or, with the
+        threads concurrency_model, a pool of threads_per_worker OS
+        threads. With threads, logging is switched to OS thread locks
+        and, if *nonblocking*, the listening socket is made non-blocking
+        for :py:meth:`_receive`.
+
+        :param nonblocking: False for a socket the handlers also use,
+            such as the UDP socket they send replies on, which instead
+            stays blocking with MSG_DONTWAIT passed to its receives.
+        """
+        if self.concurrency_model != 'threads':
+            return GreenPool(size=self.concurrent_per_worker)
+        use_os_threads()
+        if nonblocking:
+            self.sock.setblocking(0)
+        return _ThreadPool(self.threads_per_worker)
+
+    def _receive(self, func, *args):
+        """Returns func(*args), receiving the worker's next connection.
+
+        With the threads concurrency_model, the listening socket is
+        polled each second so a draining worker can stop, raising
+        _WorkerDrain. Otherwise, func is simply called and Eventlet
+        delivers _WorkerDrain instead.
+        """
+        if self.concurrency_model != 'threads':
+            return func(*args)
+        while not self.draining:
+            try:
+                if select([self.sock], [], [], 1)[0]:
+                    return func(*args)
+            except (select_error, socket_error) as err:
+                # Another worker may have taken what was ready.
+                if err.args[0] not in (EAGAIN, EINTR):
+                    raise
+        raise _WorkerDrain()
+
+    def profile(self, seconds):
+        """Returns the calling worker's stacks sampled for *seconds*.
+
+        The caller is blocked while sampling, though other requests and
+        connections continue to be served and are sampled. See
+        :py:class:`brim.service.StackSampler` for the folded format
+        returned.
+
+        :param seconds: The seconds to sample for.
+        :returns: The folded stacks or None if the worker is already
+            being profiled.
+        """
+        results = []
+        if not self.sampler or not self.sampler.start(
+                seconds, results.append):
+            return None
+        wait = time_sleep if self.concurrency_model == 'threads' else sleep
+        wait(seconds)
+        while self.sampler.running:
+            wait(self.sampler.interval)
+        return results[0] if results else ''
+
+    def _pin_worker(self, worker_id):
+        """Pins the calling worker to its CPU if cpu_affinity is set.
+
+        Workers are assigned the cpu_affinity CPUs in order, wrapping
+        around if there are more workers than CPUs. The CPU is recorded
+        in the worker's cpu stat.
+
+        :param worker_id: The id of the calling worker.
+        :returns: The CPU number the worker was pinned to or None.
+        """
+        if not self.cpu_affinity or self.server.no_daemon:
+            return None
+        cpu = self.cpu_affinity[worker_id % len(self.cpu_affinity)]
+        try:
+            set_cpu_affinity([cpu])
+        except OSError as err:
+            self.logger.error('Could not pin worker %s to CPU %s: %s' %
+                              (worker_id, cpu, err))
+            return None
+        self.bucket_stats.set(worker_id, 'cpu', cpu)
+        return cpu
+
+    def _handoff_key(self):
+        """Returns the key for this subserver's listening socket.
+
+        This is used to match up the listening sockets handed off from
+        a previously running brimd during a restart; see
+        :py:meth:`Server._handoff`.
+        """
+        return 'tcp %s:%s' % (self.ip, self.port)
+
+    def _note_handoff_on_sigusr2(self):
+        """Has the calling subserver note a handoff on SIGUSR2.
+
+        The main brimd process signals SIGUSR2 once it has handed the
+        listening sockets off to a new brimd. Since the new brimd is
+        then accepting on the very same sockets, they must be left
+        alone rather than shut down when this subserver exits.
+        """
+        def _usr2_signal(*args):
+            self.handed_off = True
+
+        signal(SIGUSR2, _usr2_signal)
 
 
 class WSGISubserver(IPSubserver):
@@ -489,9 +1557,23 @@ class WSGISubserver(IPSubserver):
             'request_count': 'sum', 'status_2xx_count': 'sum',
             'status_3xx_count': 'sum', 'status_4xx_count': 'sum',
             'status_5xx_count': 'sum'})
+        self.apps_reload_pending = False
 
     def _parse_conf(self, conf):
         IPSubserver._parse_conf(self, conf)
+        self._parse_socket_options(conf, (
+            'tcp_nodelay', 'tcp_defer_accept', 'tcp_fastopen', 'tcp_keepidle',
+            'tcp_keepintvl', 'tcp_keepcnt'))
+        self._parse_ssl_options(conf)
+        self.reload_in_place = conf.get_bool(
+            self.name, 'reload_in_place',
+            conf.get_bool('brim', 'reload_in_place', False))
+        # Everything but the apps themselves is applied when a worker
+        # starts, so an in-place reload may not change any of it.
+        self.subserver_conf = (
+            dict(conf.store.get('brim') or {}),
+            dict(conf.store.get(self.name) or {}))
+        self.subserver_conf[1].pop('apps', None)
         self.log_auth_tokens = conf.get_bool(
             self.name, 'log_auth_tokens',
             conf.get_bool('brim', 'log_auth_tokens', False))
@@ -507,6 +1589,10 @@ class WSGISubserver(IPSubserver):
         except ValueError:
             raise Exception('Invalid [%s] count_status_codes %r.' %
                             (self.name, self.count_status_codes))
+        # Registered here, before the shared stats are allocated, so they
+        # are actually counted.
+        for code in self.count_status_codes:
+            self.stats_conf['status_%d_count' % code] = 'sum'
         self.wsgi_input_iter_chunk_size = conf.get_int(
             self.name, 'wsgi_input_iter_chunk_size',
             conf.get_int('brim', 'wsgi_input_iter_chunk_size', 4096))
@@ -514,92 +1600,100 @@ class WSGISubserver(IPSubserver):
             self.name, 'wsgi_output_iter_chunk_size',
             conf.get_int('brim', 'wsgi_output_iter_chunk_size', 4096))
 
+        self.app_timing = conf.get_bool(
+            self.name, 'app_timing',
+            conf.get_bool('brim', 'app_timing', False))
         self.apps = []
         app_names = conf.get(self.name, 'apps', '').strip().split()
         for app_name in app_names:
-            call = conf.get(app_name, 'call')
-            if not call:
-                raise Exception(
-                    "App [%s] not configured with 'call' option." % app_name)
-            try:
-                mod, cls = call.rsplit('.', 1)
-            except ValueError:
-                raise Exception(
-                    'Invalid call value %r for app [%s].' % (call, app_name))
-            try:
-                app_class = getattr(__import__(mod, fromlist=[cls]), cls)
-            except (AttributeError, ImportError):
-                raise Exception(
-                    'Could not load class %r for app [%s].' % (call, app_name))
-            try:
-                args = len(getargspec(app_class.__init__).args)
-                if args != 4:
-                    raise Exception(
-                        'Would not be able to instantiate %r for app [%s]. '
-                        'Incorrect number of args, %s, should be 4 (self, '
-                        'name, conf, next_app).' % (call, app_name, args))
-            except TypeError as err:
-                if str(err).endswith(' is not a Python function'):
-                    err = 'Probably not a class.'
-                raise Exception(
-                    'Would not be able to instantiate %r for app [%s]. %s' %
-                    (call, app_name, err))
-            try:
-                args = len(getargspec(app_class.__call__).args)
-                if args != 3:
-                    raise Exception(
-                        'Would not be able to use %r for app [%s]. Incorrect '
-                        'number of __call__ args, %s, should be 3 (self, env, '
-                        'start_response).' % (call, app_name, args))
-            except TypeError as err:
-                if str(err).endswith(' is not a Python function'):
-                    err = 'Probably no __call__ method.'
-                raise Exception(
-                    'Would not be able to use %r for app [%s]. %s' %
-                    (call, app_name, err))
-            if hasattr(app_class, 'parse_conf'):
-                try:
-                    args = len(getargspec(app_class.parse_conf).args)
-                    if args != 3:
-                        raise Exception(
-                            'Cannot use %r for app [%s]. Incorrect number of '
-                            'parse_conf args, %s, should be 3 (cls, name, '
-                            'conf).' % (call, app_name, args))
-                except TypeError as err:
-                    if str(err).endswith(' is not a Python function'):
-                        err = 'parse_conf probably not a method.'
-                    raise Exception('Cannot use %r for app [%s]. %s' %
-                                    (call, app_name, err))
-                app_conf = app_class.parse_conf(app_name, conf)
-            else:
-                app_conf = conf
-            if hasattr(app_class, 'stats_conf'):
-                try:
-                    args = len(getargspec(app_class.stats_conf).args)
-                    if args != 3:
-                        raise Exception(
-                            'Cannot use %r for app [%s]. Incorrect number of '
-                            'stats_conf args, %s, should be 3 (cls, name, '
-                            'conf).' % (call, app_name, args))
-                except TypeError as err:
-                    if str(err).endswith(' is not a Python function'):
-                        err = 'stats_conf probably not a method.'
-                    raise Exception('Cannot use %r for app [%s]. %s' %
-                                    (call, app_name, err))
-                for stat_name, stat_type in app_class.stats_conf(
-                        app_name, app_conf):
-                    self.stats_conf[stat_name] = stat_type
+            app_class, app_conf, app_stats = load_wsgi_app(app_name, conf)
+            for stat_name, stat_type in app_stats:
+                self.stats_conf[stat_name] = stat_type
+            if self.app_timing:
+                self.stats_conf['%s.call_count' % app_name] = 'sum'
+                self.stats_conf['%s.self_usec' % app_name] = 'sum'
             self.apps.append((app_name, app_class, app_conf))
 
+    def _check_reload(self, subserver):
+        IPSubserver._check_reload(self, subserver)
+        if self.reload_in_place and subserver.reload_in_place and \
+                subserver.subserver_conf != self.subserver_conf:
+            raise Exception(
+                'Cannot change [%s] options other than apps with an in-place '
+                'reload; set reload_in_place = no for a rolling reload.' %
+                self.name)
+
+    def _reload(self):
+        """Re-reads the configuration ahead of a reload.
+
+        See :py:meth:`IPSubserver._reload`. With reload_in_place set in
+        both the running and the new configuration, True is returned so
+        the workers are signaled to rebuild their apps with
+        :py:meth:`_reload_apps` rather than being replaced.
+        """
+        in_place = self.reload_in_place
+        IPSubserver._reload(self)
+        wsgi.WRITE_TIMEOUT = self.client_timeout
+        return in_place and self.reload_in_place
+
+    def _reload_apps_on_sigusr1(self):
+        """Has the calling worker rebuild its apps after SIGUSR1.
+
+        The rebuild is done by :py:meth:`_reload_apps` just before the
+        worker handles its next request.
+        """
+
+        def _usr1_signal(*args):
+            self.apps_reload_pending = True
+
+        signal(SIGUSR1, _usr1_signal)
+
+    def _reload_apps(self):
+        """Rebuilds the calling worker's apps from the conf files.
+
+        The new chain of apps replaces :py:attr:`first_app` for requests
+        that start afterwards; requests already in progress finish with
+        the chain they started with. If the conf files cannot be read,
+        an app cannot be configured, or anything but the apps has
+        changed, the error is logged and the existing apps are kept.
+        """
+        self.apps_reload_pending = False
+        try:
+            conf = read_conf(
+                self.server.conf_files, exit_on_read_exception=False,
+                cache_path=self.server.conf_cache)
+            if not conf.files:
+                raise Exception('No configuration found.')
+            conf.error = _conf_error
+            subserver = self.__class__(self.server, self.name)
+            subserver._parse_conf(conf)
+            if subserver.cpu_affinity_auto and self.cpu_affinity_auto:
+                # This worker is pinned to its one CPU, so auto was just
+                # worked out from that CPU alone rather than from every
+                # CPU the workers were started with.
+                subserver.cpu_affinity = self.cpu_affinity
+            self._check_reload(subserver)
+            first_app = self._build_apps(subserver.apps)
+        except Exception as err:
+            self.logger.exception('Apps reload abandoned: %s' % err)
+            return
+        self.apps = subserver.apps
+        self.first_app = first_app
+        self.logger.info('Apps reloaded.')
+
     def _privileged_start(self):
         try:
             self.sock = get_listening_tcp_socket(
                 self.ip, self.port, backlog=self.backlog,
-                retry=self.listen_retry, certfile=self.certfile,
-                keyfile=self.keyfile, style='eventlet')
+                retry=self.listen_retry,
+                style=None if self.concurrency_model == 'threads' else
+                'eventlet',
+                sock=self.server.handoff_socks.pop(self._handoff_key(), None))
         except socket_error as err:
                 raise Exception(
                     'Could not bind to %s:%s: %s' % (self.ip, self.port, err))
+        self._tune_socket()
+        self._load_ssl_context()
 
     def _start(self, bucket_stats):
         IPSubserver._start(self, bucket_stats)
@@ -612,17 +1706,21 @@ class WSGISubserver(IPSubserver):
         self.start_time = int(time())
         self.logger = get_logger(self.name, self.log_name, self.log_level,
                                  self.log_facility, self.server.no_daemon)
-        for code in self.count_status_codes:
-            self.stats_conf['status_%d_count' % code] = 'sum'
         wsgi.HttpProtocol.default_request_version = 'HTTP/1.0'
         wsgi.HttpProtocol.log_request = lambda *a: None
         wsgi.HttpProtocol.log_message = lambda s, f, *a: self.logger.error(
             'WSGI ERROR: ' + f % a)
         wsgi.WRITE_TIMEOUT = self.client_timeout
+        if not self.server.no_daemon:
+            self._note_handoff_on_sigusr2()
         sustain_workers(
-            self.worker_count, self._wsgi_worker, logger=self.logger)
+            self.worker_count, self._wsgi_worker, logger=self.logger,
+            reload_func=self._reload, reload_batch=self.reload_batch,
+            scale_func=self._scale if self.max_workers else None,
+            scale_interval=self.scale_interval)
         if self.worker_id == -1:
-            shutdown_safe(self.sock)
+            if not self.handed_off:
+                shutdown_safe(self.sock)
             self.sock.close()
 
     def _wsgi_worker(self, worker_id):
@@ -632,26 +1730,97 @@ class WSGISubserver(IPSubserver):
         begins sending incoming requests to them (via the Eventlet WSGI
         layer and our _wsgi_entry below).
         """
+        cpu = self._pin_worker(worker_id)
         if setproctitle:
             if not self.server.no_daemon:
-                setproctitle('%d:%s:brimd' % (worker_id, self.name))
+                setproctitle('%d:%s:brimd%s' % (
+                    worker_id, self.name,
+                    '' if cpu is None else ' cpu%d' % cpu))
         self.worker_id = worker_id
         self.bucket_stats.set(worker_id, 'start_time', time())
+        self._reset_in_flight()
+        self.sampler = StackSampler(self.profile_interval)
         if not self.server.no_daemon:
             use_hub(self.eventlet_hub)
-        self.first_app = self
-        for app_name, app_class, app_conf in reversed(self.apps):
-            self.first_app = app_class(app_name, app_conf, self.first_app)
-        pool = GreenPool(size=self.concurrent_per_worker)
+            self._drain_on_sighup()
+            self._profile_on_sigurg()
+            if self.reload_in_place:
+                self._reload_apps_on_sigusr1()
+        self._start_recycle()
+        self._start_hub_lag_watch()
+        self.first_app = self._build_apps(self.apps)
+        pool = self._worker_pool()
+        worker_ready()
         try:
-            wsgi.server(self.sock, self._wsgi_entry, _EventletWSGINullLogger(),
-                        minimum_chunk_size=self.wsgi_output_iter_chunk_size,
-                        custom_pool=pool)
+            if self.concurrency_model == 'threads' or self.ssl_context:
+                self._wsgi_accept_loop(pool)
+            else:
+                wsgi.server(
+                    self.sock, self._wsgi_entry, _EventletWSGINullLogger(),
+                    minimum_chunk_size=self.wsgi_output_iter_chunk_size,
+                    custom_pool=pool)
         except socket_error as err:
             if err.errno != EINVAL:
                 raise
+        except _WorkerDrain:
+            pass
         pool.waitall()
 
+    def _build_apps(self, apps):
+        """Returns the first app of a new chain of the apps given.
+
+        The last app's next_app is this subserver. With app_timing, each
+        app is wrapped with an :py:class:`_AppTimer`.
+
+        :param apps: A list of (app_name, app_class, app_conf) tuples,
+            such as :py:attr:`apps`.
+        """
+        first_app = self
+        for app_name, app_class, app_conf in reversed(apps):
+            first_app = app_class(app_name, app_conf, first_app)
+            if self.app_timing:
+                first_app = _AppTimer(app_name, first_app)
+        return first_app
+
+    def _wsgi_accept_loop(self, pool):
+        """Accepts the WSGI connections and hands them to the pool.
+
+        Used instead of Eventlet's wsgi.server loop with the threads
+        concurrency_model, serving with wsgiref, and with SSL, so each
+        connection's handshake is done by its own coroutine or thread
+        rather than when accepting; see :py:meth:`_ssl_handshake`.
+        """
+        if self.concurrency_model == 'threads':
+            server = _ThreadsWSGIServer(
+                self.sock, self._wsgi_entry, self.client_timeout)
+            if self.ssl_context:
+                server.base_environ['HTTPS'] = 'on'
+            handle = server.handle_connection
+        else:
+            server = wsgi.Server(
+                self.sock, self.sock.getsockname(), self._wsgi_entry,
+                _EventletWSGINullLogger(),
+                environ={'wsgi.url_scheme': 'https', 'HTTPS': 'on'},
+                minimum_chunk_size=self.wsgi_output_iter_chunk_size)
+
+            def handle(conn, addr):
+                server.process_request(_eventlet_conn_state(conn, addr))
+
+        if self.ssl_context:
+            stats = _Stats(self.bucket_stats, self.worker_id)
+            plain_handle = handle
+
+            def handle(conn, addr):
+                if self.client_timeout:
+                    conn.settimeout(self.client_timeout)
+                conn = self._ssl_handshake(conn, stats)
+                if conn:
+                    plain_handle(conn, addr)
+
+        while True:
+            conn, addr = self._receive(self.sock.accept)
+            pool.spawn_n(handle, conn, addr)
+
     def _wsgi_entry(self, env, start_response=None, next_app=None):
         """Called by Eventlet's WSGI layer or get_response.
 
@@ -668,6 +1837,12 @@ class WSGISubserver(IPSubserver):
             if start_response:
                 start_response(status, headers, exc_info)
 
+        # Subrequests from get_response have no start_response and are
+        # already counted by their parent request.
+        if start_response:
+            if self.apps_reload_pending:
+                self._reload_apps()
+            self._note_in_flight(1)
         try:
             env['brim'] = self
             env['brim.start'] = time()
@@ -697,7 +1872,11 @@ class WSGISubserver(IPSubserver):
         except Exception:
             self.logger.exception('WSGI EXCEPTION:')
         finally:
+            if start_response:
+                self._note_in_flight(-1)
             self._log_request(env)
+            if start_response:
+                self._check_recycle()
 
     def __call__(self, env, start_response):
         """Default WSGI application that responds with 404 Not Found."""
@@ -913,10 +2092,26 @@ class TCPSubserver(IPSubserver):
 
     def __init__(self, server, name):
         IPSubserver.__init__(self, server, name)
-        self.stats_conf.update({'connection_count': 'sum'})
+        self.stats_conf.update({
+            'connection_count': 'sum', 'relay_in_byte_count': 'sum',
+            'relay_out_byte_count': 'sum',
+            'timed_out_connection_count': 'sum'})
 
     def _parse_conf(self, conf):
         IPSubserver._parse_conf(self, conf)
+        self._parse_socket_options(conf, (
+            'tcp_nodelay', 'tcp_defer_accept', 'tcp_fastopen', 'tcp_keepidle',
+            'tcp_keepintvl', 'tcp_keepcnt'))
+        self._parse_ssl_options(conf)
+        if self.client_timeout < 0:
+            raise Exception('Invalid [%s] client_timeout %r.' %
+                            (self.name, self.client_timeout))
+        self.connection_timeout = conf.get_int(
+            self.name, 'connection_timeout',
+            conf.get_int('brim', 'connection_timeout', 0))
+        if self.connection_timeout < 0:
+            raise Exception('Invalid [%s] connection_timeout %r.' %
+                            (self.name, self.connection_timeout))
         call = conf.get(self.name, 'call')
         if not call:
             raise Exception(
@@ -956,6 +2151,20 @@ class TCPSubserver(IPSubserver):
                 err = 'Probably no __call__ method.'
             raise Exception('Would not be able to use %r for [%s]. %s' %
                             (call, self.name, err))
+        if hasattr(self.handler, 'handle_stream'):
+            try:
+                args = len(getargspec(self.handler.handle_stream).args)
+                if args != 6:
+                    raise Exception(
+                        'Would not be able to use %r for [%s]. Incorrect '
+                        'number of handle_stream args, %s, should be 6 '
+                        '(self, subserver, stats, stream, ip, port).' %
+                        (call, self.name, args))
+            except TypeError as err:
+                if str(err).endswith(' is not a Python function'):
+                    err = 'handle_stream probably not a method.'
+                raise Exception('Would not be able to use %r for [%s]. %s' %
+                                (call, self.name, err))
         if hasattr(self.handler, 'parse_conf'):
             try:
                 args = len(getargspec(self.handler.parse_conf).args)
@@ -989,15 +2198,22 @@ class TCPSubserver(IPSubserver):
                     self.name, self.handler_conf):
                 self.stats_conf[stat_name] = stat_type
 
+    def _prepare_reload(self):
+        self.handler = self.handler(self.name, self.handler_conf)
+
     def _privileged_start(self):
         try:
             self.sock = get_listening_tcp_socket(
                 self.ip, self.port, backlog=self.backlog,
-                retry=self.listen_retry, certfile=self.certfile,
-                keyfile=self.keyfile, style='eventlet')
+                retry=self.listen_retry,
+                style=None if self.concurrency_model == 'threads' else
+                'eventlet',
+                sock=self.server.handoff_socks.pop(self._handoff_key(), None))
         except socket_error as err:
                 raise Exception(
                     'Could not bind to %s:%s: %s' % (self.ip, self.port, err))
+        self._tune_socket()
+        self._load_ssl_context()
 
     def _start(self, bucket_stats):
         IPSubserver._start(self, bucket_stats)
@@ -1012,10 +2228,16 @@ class TCPSubserver(IPSubserver):
             self.name, self.log_name, self.log_level, self.log_facility,
             self.server.no_daemon)
         self.handler = self.handler(self.name, self.handler_conf)
+        if not self.server.no_daemon:
+            self._note_handoff_on_sigusr2()
         sustain_workers(
-            self.worker_count, self._tcp_worker, logger=self.logger)
+            self.worker_count, self._tcp_worker, logger=self.logger,
+            reload_func=self._reload, reload_batch=self.reload_batch,
+            scale_func=self._scale if self.max_workers else None,
+            scale_interval=self.scale_interval)
         if self.worker_id == -1:
-            shutdown_safe(self.sock)
+            if not self.handed_off:
+                shutdown_safe(self.sock)
             self.sock.close()
 
     def _tcp_worker(self, worker_id):
@@ -1025,25 +2247,280 @@ class TCPSubserver(IPSubserver):
         it simply constructs the configured handler and then begins
         sending incoming connections to it.
         """
+        cpu = self._pin_worker(worker_id)
         if setproctitle:
             if not self.server.no_daemon:
-                setproctitle('%d:%s:brimd' % (worker_id, self.name))
+                setproctitle('%d:%s:brimd%s' % (
+                    worker_id, self.name,
+                    '' if cpu is None else ' cpu%d' % cpu))
         self.worker_id = worker_id
         self.bucket_stats.set(worker_id, 'start_time', time())
+        self._reset_in_flight()
+        self.sampler = StackSampler(self.profile_interval)
         if not self.server.no_daemon:
             use_hub(self.eventlet_hub)
+            self._drain_on_sighup()
+            self._profile_on_sigurg()
+        self._start_recycle()
+        self._start_hub_lag_watch()
         stats = _Stats(self.bucket_stats, self.worker_id)
-        pool = GreenPool(size=self.concurrent_per_worker)
+        if hasattr(self.handler, 'handle_stream'):
+            handler = self._stream_handler(self.handler.handle_stream)
+        else:
+            handler = self.handler
+        if self.ssl_context:
+            handler = self._ssl_handler(handler)
+        handler = self._wrap_handler(self._timeout_handler(handler))
+        pool = self._worker_pool()
+        self._connections = {}
+        self._connections_lock = Lock()
+        if self.connection_timeout:
+            if self.concurrency_model == 'threads':
+                thread = Thread(target=self._reap_connections)
+                thread.daemon = True
+                thread.start()
+            else:
+                spawn_n(self._reap_connections)
+        worker_ready()
         try:
             while True:
-                sock, (ip, port) = self.sock.accept()
+                sock, (ip, port) = self._receive(self.sock.accept)
                 stats.incr('connection_count')
-                pool.spawn_n(self.handler, self, stats, sock, ip, port)
+                pool.spawn_n(handler, self, stats, sock, ip, port)
         except socket_error as err:
             if err.errno != EINVAL:
                 raise
+        except _WorkerDrain:
+            pass
         pool.waitall()
 
+    def _timeout_handler(self, handler):
+        """Returns handler wrapped to enforce the connection timeouts.
+
+        Each connection's socket is given the client_timeout, so a read
+        or write waiting longer raises socket.timeout, and is tracked
+        for :py:meth:`_reap_connections` to shut down once open longer
+        than connection_timeout. A connection that times out either way
+        is counted in the timed_out_connection_count stat and closed,
+        and the resulting socket errors are not treated as the
+        handler's; the handler returning frees its place in the pool.
+        """
+
+        def _handler(subserver, stats, sock, ip, port):
+            if self.client_timeout:
+                sock.settimeout(self.client_timeout)
+            if self.connection_timeout:
+                with self._connections_lock:
+                    self._connections[sock] = \
+                        time() + self.connection_timeout
+            timed_out = False
+            try:
+                handler(subserver, stats, sock, ip, port)
+            except socket_error as err:
+                timed_out = isinstance(err, socket_timeout) or \
+                    self._connections.get(sock, 0) is None
+                if not timed_out:
+                    raise
+            finally:
+                if self.connection_timeout:
+                    with self._connections_lock:
+                        if self._connections.pop(sock, 0) is None:
+                            timed_out = True
+            if timed_out:
+                stats.incr('timed_out_connection_count')
+                sock.close()
+
+        return _handler
+
+    def _reap_connections(self):
+        """Shuts down connections open longer than connection_timeout.
+
+        Runs for the life of the worker, checking every second or so.
+        Shutting a socket down wakes the handler from any read or write
+        it is waiting on, with end of file or a socket error, and that
+        works alike for coroutines and threads.
+        """
+        while True:
+            now = time()
+            with self._connections_lock:
+                expired = [
+                    sock for sock, deadline in self._connections.iteritems()
+                    if deadline is not None and deadline <= now]
+                for sock in expired:
+                    self._connections[sock] = None
+            for sock in expired:
+                try:
+                    sock.shutdown(SHUT_RDWR)
+                except socket_error:
+                    pass
+            if self.concurrency_model == 'threads':
+                time_sleep(min(1, self.connection_timeout))
+            else:
+                sleep(min(1, self.connection_timeout))
+
+    def _ssl_handler(self, handler):
+        """Returns handler wrapped to do the SSL handshake first.
+
+        The handler is given the SSL wrapped socket once the handshake
+        is done; see :py:meth:`_ssl_handshake`.
+        """
+
+        def _handler(subserver, stats, sock, ip, port):
+            sock = self._ssl_handshake(sock, stats)
+            if sock:
+                handler(subserver, stats, sock, ip, port)
+
+        return _handler
+
+    def _stream_handler(self, handle_stream):
+        """Returns handle_stream wrapped to be called with a stream.
+
+        Each connection's socket is wrapped in a
+        :py:class:`brim.service.SocketStream` for handle_stream, and any
+        writes it left queued are flushed once it returns.
+        """
+
+        def _handler(subserver, stats, sock, ip, port):
+            stream = SocketStream(sock)
+            handle_stream(subserver, stats, stream, ip, port)
+            stream.flush()
+
+        return _handler
+
+    def relay(self, sock, other_sock, chunk_size=65536):
+        """Relays bytes both ways between two connected sockets.
+
+        This is for TCP handlers that proxy their connections, such as
+        to a backend the handler connected other_sock to. It returns
+        once both directions have reached end of file, each being passed
+        along by shutting down writes to the other socket. If either
+        direction fails, such as with a reset or a socket timeout, both
+        sockets are shut down. Neither socket is closed. The bytes
+        relayed are added to the relay_in_byte_count (read from sock)
+        and relay_out_byte_count (written to sock) stats as they go.
+
+        Plain sockets are relayed with splice where supported, the bytes
+        never being copied into Python; otherwise, each direction reuses
+        a single buffer with recv_into. The direction from other_sock
+        runs in its own coroutine or, with the threads
+        concurrency_model, its own thread.
+
+        :param sock: The client socket.socket the handler was given.
+        :param other_sock: The other connected socket.socket.
+        :param chunk_size: The most bytes to move at once.
+        :returns: A (bytes_in, bytes_out) tuple of the bytes read from
+            sock and written to sock.
+        """
+        counts = [0, 0]
+        args = (other_sock, sock, counts, 1, 'relay_out_byte_count',
+                chunk_size)
+        if self.concurrency_model == 'threads':
+            other = Thread(target=self._relay_one, args=args)
+            other.daemon = True
+            other.start()
+        else:
+            other = spawn(self._relay_one, *args)
+        try:
+            self._relay_one(sock, other_sock, counts, 0,
+                            'relay_in_byte_count', chunk_size)
+        finally:
+            if self.concurrency_model == 'threads':
+                other.join()
+            else:
+                other.wait()
+        return tuple(counts)
+
+    def _relay_one(self, src, dst, counts, index, stat_name, chunk_size):
+        """Relays bytes from src to dst for :py:meth:`relay`."""
+        splicer = None
+        # SSL sockets' bytes have to pass through Python to be decrypted.
+        if not hasattr(src, 'cipher') and not hasattr(dst, 'cipher'):
+            try:
+                splicer = SocketSplicer(chunk_size)
+            except OSError:
+                pass
+        try:
+            if splicer:
+                self._relay_spliced(
+                    splicer, src, dst, counts, index, stat_name)
+            else:
+                self._relay_buffered(
+                    src, dst, counts, index, stat_name, chunk_size)
+            try:
+                dst.shutdown(SHUT_WR)
+            except socket_error:
+                pass
+        except Exception as err:
+            # Also wakes the other direction so it ends too.
+            for sock in (src, dst):
+                try:
+                    sock.shutdown(SHUT_RDWR)
+                except socket_error:
+                    pass
+            if not isinstance(err, socket_error):
+                raise
+        finally:
+            if splicer:
+                splicer.close()
+
+    def _relay_spliced(self, splicer, src, dst, counts, index, stat_name):
+        while True:
+            try:
+                if not splicer.receive(src):
+                    return
+            except socket_error as err:
+                if err.errno != EAGAIN:
+                    raise
+                self._wait_socket(src)
+                continue
+            while splicer.pending:
+                try:
+                    count = splicer.send(dst)
+                except socket_error as err:
+                    if err.errno != EAGAIN:
+                        raise
+                    self._wait_socket(dst, write=True)
+                    continue
+                self._note_relayed(counts, index, stat_name, count)
+
+    def _relay_buffered(self, src, dst, counts, index, stat_name,
+                        chunk_size):
+        buf = bytearray(chunk_size)
+        view = memoryview(buf)
+        while True:
+            size = src.recv_into(buf)
+            if not size:
+                return
+            sent = 0
+            while sent < size:
+                count = dst.send(view[sent:size])
+                sent += count
+                self._note_relayed(counts, index, stat_name, count)
+
+    def _note_relayed(self, counts, index, stat_name, count):
+        counts[index] += count
+        with self.bucket_stats.lock:
+            self.bucket_stats.set(
+                self.worker_id, stat_name,
+                self.bucket_stats.get(self.worker_id, stat_name) + count)
+
+    def _wait_socket(self, sock, write=False):
+        """Waits for sock to be readable, or writable if write is set.
+
+        A socket.timeout is raised if the socket's timeout passes first.
+        """
+        timeout = sock.gettimeout()
+        if self.concurrency_model == 'threads':
+            if write:
+                ready = select([], [sock], [], timeout)[1]
+            else:
+                ready = select([sock], [], [], timeout)[0]
+            if not ready:
+                raise socket_timeout('timed out')
+        else:
+            trampoline(sock, read=not write, write=write, timeout=timeout,
+                       timeout_exc=socket_timeout('timed out'))
+
     def _capture_exception(self, *excinfo):
         self.logger.error('UNCAUGHT EXCEPTION: tid:%03d %s' %
                           (self.worker_id, sysloggable_excinfo(*excinfo)))
@@ -1074,12 +2551,51 @@ class UDPSubserver(IPSubserver):
     def __init__(self, server, name):
         IPSubserver.__init__(self, server, name)
         self.stats_conf.update({'datagram_count': 'sum'})
+        self._reply_sender = None
 
     def _parse_conf(self, conf):
         IPSubserver._parse_conf(self, conf)
         self.max_datagram_size = conf.get_int(
             self.name, 'max_datagram_size',
             conf.get_int('brim', 'max_datagram_size', 65536))
+        self.batch_size = conf.get_int(
+            self.name, 'batch_size', conf.get_int('brim', 'batch_size', 0))
+        if self.batch_size < 0:
+            raise Exception(
+                'Invalid [%s] batch_size %r.' % (self.name, self.batch_size))
+        if self.batch_size:
+            # The receiver checks for platform support on creation.
+            try:
+                DatagramBatchReceiver(None, 1, 1)
+            except OSError as err:
+                raise Exception(
+                    'Cannot use [%s] batch_size: %s' % (self.name, err))
+        self.reply_batch_size = conf.get_int(
+            self.name, 'reply_batch_size',
+            conf.get_int('brim', 'reply_batch_size', 0))
+        if self.reply_batch_size < 0:
+            raise Exception('Invalid [%s] reply_batch_size %r.' %
+                            (self.name, self.reply_batch_size))
+        if self.reply_batch_size:
+            try:
+                DatagramBatchSender(None, 1)
+            except OSError as err:
+                raise Exception(
+                    'Cannot use [%s] reply_batch_size: %s' % (self.name, err))
+        self.reply_queue_size = conf.get_int(
+            self.name, 'reply_queue_size',
+            conf.get_int('brim', 'reply_queue_size', 1024))
+        if self.reply_queue_size < 1:
+            raise Exception('Invalid [%s] reply_queue_size %r.' %
+                            (self.name, self.reply_queue_size))
+        self.drop_check_interval = conf.get_int(
+            self.name, 'drop_check_interval',
+            conf.get_int('brim', 'drop_check_interval', 5))
+        if self.drop_check_interval < 0:
+            raise Exception('Invalid [%s] drop_check_interval %r.' %
+                            (self.name, self.drop_check_interval))
+        if self.drop_check_interval:
+            self.stats_conf['datagram_drop_count'] = 'max'
         call = conf.get(self.name, 'call')
         if not call:
             raise Exception(
@@ -1120,6 +2636,20 @@ class UDPSubserver(IPSubserver):
                 err = 'Probably no __call__ method.'
             raise Exception('Would not be able to use %r for [%s]. %s' %
                             (call, self.name, err))
+        if hasattr(self.handler, 'handle_batch'):
+            try:
+                args = len(getargspec(self.handler.handle_batch).args)
+                if args != 5:
+                    raise Exception(
+                        'Would not be able to use %r for [%s]. Incorrect '
+                        'number of handle_batch args, %s, should be 5 (self, '
+                        'subserver, stats, sock, datagrams).' %
+                        (call, self.name, args))
+            except TypeError as err:
+                if str(err).endswith(' is not a Python function'):
+                    err = 'handle_batch probably not a method.'
+                raise Exception('Would not be able to use %r for [%s]. %s' %
+                                (call, self.name, err))
         if hasattr(self.handler, 'parse_conf'):
             try:
                 args = len(getargspec(self.handler.parse_conf).args)
@@ -1153,13 +2683,23 @@ class UDPSubserver(IPSubserver):
                     self.name, self.handler_conf):
                 self.stats_conf[stat_name] = stat_type
 
+    def _prepare_reload(self):
+        self.handler = self.handler(self.name, self.handler_conf)
+
+    def _handoff_key(self):
+        return 'udp %s:%s' % (self.ip, self.port)
+
     def _privileged_start(self):
         try:
             self.sock = get_listening_udp_socket(
-                self.ip, self.port, retry=self.listen_retry, style='eventlet')
+                self.ip, self.port, retry=self.listen_retry,
+                style=None if self.concurrency_model == 'threads' else
+                'eventlet',
+                sock=self.server.handoff_socks.pop(self._handoff_key(), None))
         except socket_error as err:
                 raise Exception(
                     'Could not bind to %s:%s: %s' % (self.ip, self.port, err))
+        self._tune_socket()
 
     def _start(self, bucket_stats):
         IPSubserver._start(self, bucket_stats)
@@ -1174,10 +2714,16 @@ class UDPSubserver(IPSubserver):
             self.name, self.log_name, self.log_level, self.log_facility,
             self.server.no_daemon)
         self.handler = self.handler(self.name, self.handler_conf)
+        if not self.server.no_daemon:
+            self._note_handoff_on_sigusr2()
         sustain_workers(
-            self.worker_count, self._udp_worker, logger=self.logger)
+            self.worker_count, self._udp_worker, logger=self.logger,
+            reload_func=self._reload, reload_batch=self.reload_batch,
+            scale_func=self._scale if self.max_workers else None,
+            scale_interval=self.scale_interval)
         if self.worker_id == -1:
-            shutdown_safe(self.sock)
+            if not self.handed_off:
+                shutdown_safe(self.sock)
             self.sock.close()
 
     def _udp_worker(self, worker_id):
@@ -1187,26 +2733,218 @@ class UDPSubserver(IPSubserver):
         it simply constructs the configured handler and then begins
         sending incoming datagrams to it.
         """
+        cpu = self._pin_worker(worker_id)
         if setproctitle:
             if not self.server.no_daemon:
-                setproctitle('%d:%s:brimd' % (worker_id, self.name))
+                setproctitle('%d:%s:brimd%s' % (
+                    worker_id, self.name,
+                    '' if cpu is None else ' cpu%d' % cpu))
         self.worker_id = worker_id
         self.bucket_stats.set(self.worker_id, 'start_time', time())
+        self._reset_in_flight()
+        self.sampler = StackSampler(self.profile_interval)
         if not self.server.no_daemon:
             use_hub(self.eventlet_hub)
+            self._drain_on_sighup()
+            self._profile_on_sigurg()
+        self._start_recycle()
+        self._start_hub_lag_watch()
         stats = _Stats(self.bucket_stats, self.worker_id)
-        pool = GreenPool(size=self.concurrent_per_worker)
+        handler = self._wrap_handler(self.handler)
+        pool = self._worker_pool(nonblocking=False)
+        self._replies = []
+        self._replies_lock = Lock()
+        self._replies_flushing = False
+        self._reply_sender = None
+        if self.reply_batch_size:
+            self._reply_sender = DatagramBatchSender(
+                self.sock, self.reply_batch_size)
+        if self.drop_check_interval:
+            if self.concurrency_model == 'threads':
+                thread = Thread(target=self._watch_drops, args=(stats,))
+                thread.daemon = True
+                thread.start()
+            else:
+                spawn_n(self._watch_drops, stats)
+        worker_ready()
+        if self.batch_size:
+            self._udp_batch_loop(stats, handler, pool)
+            return
+        # The socket is shared with the handlers, so rather than make it
+        # non-blocking, just the receives are with the threads model.
+        recv_args = (self.max_datagram_size,)
+        if self.concurrency_model == 'threads':
+            recv_args += (MSG_DONTWAIT,)
         try:
             while True:
-                datagram, (ip, port) = self.sock.recvfrom(
-                    self.max_datagram_size)
+                datagram, (ip, port) = self._receive(
+                    self.sock.recvfrom, *recv_args)
                 stats.incr('datagram_count')
                 pool.spawn_n(
-                    self.handler, self, stats, self.sock, datagram, ip, port)
+                    handler, self, stats, self.sock, datagram, ip, port)
         except socket_error as err:
             if err.errno != EINVAL:
                 raise
+        except _WorkerDrain:
+            pass
+        pool.waitall()
+        self._finish_replies()
+
+    def _udp_batch_loop(self, stats, handler, pool):
+        """Receives datagrams in batches of up to batch_size at a time.
+
+        Each batch is read with a single recvmmsg call into buffers
+        reused for the life of the worker. If the handler has a
+        handle_batch method, it is given each whole batch; otherwise
+        each datagram is sent to the handler as usual.
+        """
+        receiver = DatagramBatchReceiver(
+            self.sock, self.batch_size, self.max_datagram_size)
+        batch_handler = None
+        if hasattr(self.handler, 'handle_batch'):
+            batch_handler = self._wrap_handler(
+                self.handler.handle_batch, batch=True)
+        try:
+            while True:
+                datagrams = self._receive_batch(receiver)
+                stats.set('datagram_count',
+                          stats.get('datagram_count') + len(datagrams))
+                if batch_handler:
+                    pool.spawn_n(
+                        batch_handler, self, stats, self.sock, datagrams)
+                else:
+                    for datagram, ip, port in datagrams:
+                        pool.spawn_n(
+                            handler, self, stats, self.sock, datagram, ip,
+                            port)
+        except socket_error as err:
+            if err.errno != EINVAL:
+                raise
+        except _WorkerDrain:
+            pass
         pool.waitall()
+        self._finish_replies()
+
+    def _receive_batch(self, receiver):
+        """Returns the next batch of (datagram, ip, port) received.
+
+        The socket is never left blocking on recvmmsg; with eventlet,
+        the worker waits on the hub until the socket is readable.
+        """
+        if self.concurrency_model == 'threads':
+            return self._receive(receiver.receive, MSG_DONTWAIT)
+        while True:
+            try:
+                return receiver.receive(MSG_DONTWAIT)
+            except socket_error as err:
+                if err.errno != EAGAIN:
+                    raise
+            trampoline(self.sock, read=True)
+
+    def _watch_drops(self, stats):
+        """Keeps the datagram_drop_count stat current.
+
+        Runs for the life of the worker, reading the count of datagrams
+        the kernel dropped for the socket every drop_check_interval
+        seconds. Every worker shares the socket, so they all report the
+        same count. A rising count means the workers aren't keeping up
+        with bursts; more workers or a larger socket_rcvbuf may help.
+        """
+        while True:
+            try:
+                stats.set('datagram_drop_count', get_udp_drops(self.sock))
+            except (IOError, OSError) as err:
+                self.logger.error('Could not read [%s] datagram drops: %s' %
+                                  (self.name, err))
+                return
+            if self.concurrency_model == 'threads':
+                time_sleep(self.drop_check_interval)
+            else:
+                sleep(self.drop_check_interval)
+
+    def reply(self, datagram, ip, port):
+        """Sends a datagram from the subserver's socket to ip:port.
+
+        Handlers may use this instead of sock.sendto. With a
+        reply_batch_size set, the datagram is queued and the queue is
+        flushed with sendmmsg, batching the replies of all the worker's
+        handlers. When the socket's send buffer is full, the flush waits
+        for it to drain and, once reply_queue_size datagrams are queued,
+        callers wait as well. Without a reply_batch_size, the datagram
+        is simply sent with sendto.
+
+        :param datagram: The datagram to send.
+        :param ip: The numeric IP address to send to.
+        :param port: The IP port to send to.
+        """
+        if not self._reply_sender:
+            self.sock.sendto(datagram, (ip, port))
+            return
+        with self._replies_lock:
+            self._replies.append((datagram, ip, port))
+            flush = not self._replies_flushing
+            self._replies_flushing = True
+        if flush:
+            if self.concurrency_model == 'threads':
+                # This thread sends whatever the other threads queue
+                # while it is busy.
+                self._flush_replies()
+            else:
+                # Flushing once the other ready greenthreads have run
+                # lets their replies join the batch.
+                spawn_n(self._flush_replies)
+            return
+        while len(self._replies) >= self.reply_queue_size and \
+                self._replies_flushing:
+            if self.concurrency_model == 'threads':
+                time_sleep(0.001)
+            else:
+                sleep(0.001)
+
+    def _flush_replies(self):
+        """Sends the queued replies until the queue is empty."""
+        try:
+            while True:
+                with self._replies_lock:
+                    batch = self._replies[:self.reply_batch_size]
+                    del self._replies[:self.reply_batch_size]
+                    if not batch:
+                        self._replies_flushing = False
+                        return
+                while batch:
+                    try:
+                        batch = batch[self._reply_sender.send(
+                            batch, MSG_DONTWAIT):]
+                    except socket_error as err:
+                        if err.errno == EAGAIN:
+                            self._wait_writable()
+                            continue
+                        # Only the first datagram failed, much as a
+                        # sendto would have, so it is dropped and the
+                        # rest sent.
+                        self.logger.error(
+                            'Could not send reply to %s:%s: %s' %
+                            (batch[0][1], batch[0][2], err))
+                        batch = batch[1:]
+        except Exception:
+            # The next reply will start a new flush.
+            self._replies_flushing = False
+            raise
+
+    def _finish_replies(self):
+        """Waits for any queued replies to be sent."""
+        while self._replies_flushing:
+            if self.concurrency_model == 'threads':
+                time_sleep(0.01)
+            else:
+                sleep(0.01)
+
+    def _wait_writable(self):
+        """Waits for the socket to have room to send."""
+        if self.concurrency_model == 'threads':
+            select([], [self.sock], [], 1)
+        else:
+            trampoline(self.sock, write=True)
 
     def _capture_exception(self, *excinfo):
         self.logger.error('UNCAUGHT EXCEPTION: uid:%03d %s' %
@@ -1348,6 +3086,9 @@ class DaemonsSubserver(Subserver):
             setproctitle('%s:%s:brimd' % (name, self.name))
         self.worker_id = worker_id
         self.bucket_stats.set(worker_id, 'start_time', time())
+        self.sampler = StackSampler(self.profile_interval)
+        if not self.server.no_daemon:
+            self._profile_on_sigurg()
         stats = _Stats(self.bucket_stats, worker_id)
         stats.set('start_time', time())
         daemon = cls(name, conf)
@@ -1401,6 +3142,10 @@ class Server(object):
             self.stderr = sys_stderr
         self.subservers = []
         self.error_stack_trace = False
+        self.handoff_pid = 0
+        self.handoff_socks = {}
+        self.handoff_sock = None
+        self.conf_cache = None
 
     def main(self):
         """Performs the brimd actions (start, stop, shutdown, etc.).
@@ -1441,9 +3186,17 @@ Brim.Net Core Server %s
 Command (defaults to 'no-daemon'):
 
   start                 Starts brimd if it isn't already running.
-  restart               Starts a new brimd which will wait for any previously
-                        existing one to release the listening port(s) and then
-                        tells any previously existing brimd to shutdown.
+  restart               Starts a new brimd which takes over the listening
+                        port(s) from any previously existing brimd, so no
+                        connections are refused, and then tells the
+                        previously existing brimd to shutdown. If the
+                        port(s) cannot be handed over, waits for the
+                        previously existing brimd to release them instead.
+  reload                Has the running brimd reread its configuration and
+                        replace its subprocesses a few at a time, keeping the
+                        listening port(s) open throughout. Daemons are not
+                        replaced, and options like ip, port, and workers
+                        cannot be changed this way; use restart for those.
   shutdown              Immediately releases the listening port(s) and the main
                         process exits. Any subprocesses will continue to serve
                         any existing connections and then exit once those
@@ -1451,7 +3204,6 @@ Command (defaults to 'no-daemon'):
   stop                  Terminates brimd immediately, severing any existing
                         connections and therefore any in-progress requests.
   status                Displays whether brimd is currently running or not.
-  reload                Same as restart.
   force-reload          Same as restart.
   no-daemon             Starts the server in the foreground with no
                         subprocesses, PID files are ignored and not created,
@@ -1469,6 +3221,12 @@ Command (defaults to 'no-daemon'):
                  'specific conf file with -c. This option may be specified '
                  'more than once and the conf files will each be read in '
                  'order.')
+        parser.add_option(
+            '--conf-cache', dest='conf_cache', metavar='PATH',
+            help='The path to a compiled cache of the conf files read, '
+                 'reused on later starts and reloads as long as none of the '
+                 'conf files have changed. This can speed up starting with '
+                 'large sets of conf files. By default, no cache is used.')
         parser.add_option(
             '-p', '--pid-file', dest='pid_file',
             metavar='PATH',
@@ -1508,11 +3266,16 @@ Command (defaults to 'no-daemon'):
         if not options.conf_files:
             options.conf_files = DEFAULT_CONF_FILES
         self.pid_file = options.pid_file
+        # Kept absolute for reloads since droppriv changes directories.
+        self.conf_files = [abspath(expanduser(f)) for f in options.conf_files]
+        self.conf_cache = options.conf_cache
+        if self.conf_cache:
+            self.conf_cache = abspath(expanduser(self.conf_cache))
         command = args[0] if args else 'no-daemon'
         self.no_daemon = command == 'no-daemon'
         self.output = options.output or self.no_daemon
         self.error_stack_trace = options.error_stack_trace
-        conf = read_conf(options.conf_files)
+        conf = read_conf(options.conf_files, cache_path=self.conf_cache)
         if not conf.files:
             raise Exception('No configuration found.')
         if not self.pid_file:
@@ -1539,19 +3302,25 @@ Command (defaults to 'no-daemon'):
                     self.stdout.flush()
                 else:
                     result = conf
-        elif command in ('restart', 'reload', 'force-reload'):
+        elif command in ('restart', 'force-reload'):
             if self.pid_file == '-':
                 raise Exception(
                     'pid_file not in use so %s cannot be used.' % command)
             success, pid = _send_pid_sig(self.pid_file, 0)
-            # If brimd is already running, we fork a child to shut it down
-            # after a second so we, as the new brimd, can grab the port.
-            if success and not fork():
-                sleep(1)
-                _send_pid_sig(self.pid_file, SIGHUP, expect_exit=True,
-                              pid_override=pid)
-            else:
-                result = conf
+            # If brimd is already running, we, as the new brimd, take over
+            # the listening sockets it hands off and only then shut it
+            # down; see _start.
+            if success:
+                self.handoff_pid = pid
+            result = conf
+        elif command == 'reload':
+            if self.pid_file == '-':
+                raise Exception(
+                    'pid_file not in use so %s cannot be used.' % command)
+            success, pid = _send_pid_sig(self.pid_file, SIGUSR1)
+            if not success:
+                self.stdout.write('not running\n')
+                self.stdout.flush()
         elif command == 'shutdown':
             if self.pid_file == '-':
                 raise Exception(
@@ -1586,12 +3355,6 @@ Command (defaults to 'no-daemon'):
         This method is responsible for ensuring we have a good
         configuration before we try starting the server.
         """
-
-        def _conf_error(section, option, value, conversion_type, err):
-            raise Exception('Configuration value [%s] %s of %r cannot be '
-                            'converted to %s.' %
-                            (section, option, value, conversion_type))
-
         conf.error = _conf_error
         self.user = conf.get('brim', 'user')
         self.group = conf.get('brim', 'group')
@@ -1634,17 +3397,33 @@ Command (defaults to 'no-daemon'):
     def _start(self):
         """This is the last method run by the main brimd server process.
 
-        It calls the subservers' ``_privileged_start`` methods (to bind
-        the listening sockets, for example), drops privileges,
-        daemonizes if enabled (and updates the pid file), configures a
-        default logger, and then calls the subservers' ``_start``
-        methods.
+        It takes over the listening sockets of any previously running
+        brimd being restarted, calls the subservers'
+        ``_privileged_start`` methods (to bind the listening sockets,
+        for example), drops privileges, daemonizes if enabled (and
+        updates the pid file), configures a default logger, and then
+        calls the subservers' ``_start`` methods.
         """
         if not self.subservers:
             raise Exception('No subservers configured.')
+        if self.handoff_pid:
+            self._receive_handoff()
+            # With the listening sockets handed off (or, failing that, to
+            # be bound once released) we fork a child to shut down the
+            # previous brimd and wait for it to exit.
+            if not fork():
+                _send_pid_sig(self.pid_file, SIGHUP, expect_exit=True,
+                              pid_override=self.handoff_pid)
+                return 0
         for subserver in self.subservers:
             subserver._privileged_start()
+        # Any sockets handed off but no longer configured are just closed.
+        for sock in self.handoff_socks.itervalues():
+            sock.close()
+        self.handoff_socks = {}
         if not self.no_daemon:
+            if self.pid_file != '-':
+                self._listen_for_handoff()
             pid = fork()
             if pid:
                 with open(self.pid_file, 'w') as pid_file:
@@ -1678,9 +3457,73 @@ Command (defaults to 'no-daemon'):
         else:
             if setproctitle:
                 setproctitle('main:brimd')
+            if self.handoff_sock:
+                signal(SIGUSR2, self._handoff)
             sustain_workers(len(self.subservers), self._start_subserver,
                             logger=self.logger)
 
+    def _receive_handoff(self):
+        """Takes over the listening sockets of the brimd being restarted.
+
+        The previously running brimd, :py:attr:`handoff_pid`, is sent
+        SIGUSR2 and then hands its listening sockets over its handoff
+        socket; see :py:meth:`_handoff`. It is not sent SIGHUP to shut
+        down until this returns. If this fails for any reason, the
+        subservers will simply bind their sockets as usual, waiting for
+        the previous brimd to release them.
+        """
+        try:
+            self.handoff_socks = receive_listening_sockets(
+                self.pid_file + '.handoff',
+                request_func=lambda: kill(self.handoff_pid, SIGUSR2))
+        except (OSError, socket_error) as err:
+            # A previous brimd that doesn't support handoffs won't have a
+            # handoff socket to connect to.
+            if err.errno not in (ECONNREFUSED, ENOENT):
+                self.stderr.write(
+                    'Could not take over listening sockets from %s: %s\n' %
+                    (self.handoff_pid, err))
+                self.stderr.flush()
+
+    def _listen_for_handoff(self):
+        """Creates the handoff socket a future restart will connect to.
+
+        The socket is created next to the pid file and is only usable by
+        the user starting brimd (usually root), since it is created
+        before privileges are dropped.
+        """
+        path = self.pid_file + '.handoff'
+        try:
+            unlink(path)
+        except OSError as err:
+            if err.errno != ENOENT:
+                raise
+        self.handoff_sock = socket(AF_UNIX, SOCK_STREAM)
+        self.handoff_sock.bind(path)
+        chmod(path, 0600)
+        self.handoff_sock.listen(1)
+
+    def _handoff(self, *args):
+        """Hands the listening sockets off to a new brimd on SIGUSR2.
+
+        Once handed off, the rest of this brimd's processes are sent
+        SIGUSR2 as well so the subservers know to leave the now shared
+        sockets open for the new brimd when they exit.
+        """
+        socks = dict(
+            (subserver._handoff_key(), subserver.sock)
+            for subserver in self.subservers
+            if isinstance(subserver, IPSubserver))
+        try:
+            handoff_listening_sockets(self.handoff_sock, socks)
+        except Exception as err:
+            self.logger.exception('Listening socket handoff failed: %s' % err)
+            return
+        self.logger.info('Listening sockets handed off.')
+        signal(SIGUSR2, SIG_IGN)
+        killpg(0, SIGUSR2)
+        signal(SIGUSR2, self._handoff)
+
     def _start_subserver(self, index):
         subserver = self.subservers[index]
         if setproctitle:
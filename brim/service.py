@@ -17,19 +17,27 @@ limitations under the License.
 """
 
 import sys
-from errno import EADDRINUSE, ECHILD, EINTR, EPERM
+from errno import EADDRINUSE, EAGAIN, ECHILD, EINTR, ENOENT, EPERM
 from grp import getgrnam
-from os import chdir, devnull, dup2, fork, getegid, geteuid, getpid, getppid, \
-    killpg, setgid, setgroups, setsid, setuid, umask as os_umask, \
-    wait as os_wait, WIFEXITED, WIFSIGNALED
+from math import ceil
+from os import chdir, close as os_close, devnull, dup2, fork, fstat, \
+    getegid, geteuid, getpid, getppid, kill, killpg, pipe, \
+    read as os_read, setgid, setgroups, setsid, setuid, umask as os_umask, \
+    wait as os_wait, waitpid, WIFEXITED, WIFSIGNALED, WNOHANG, \
+    write as os_write
+from select import error as select_error, select
 from pwd import getpwnam
-from signal import SIG_DFL, SIGHUP, SIG_IGN, SIGINT, signal, SIGTERM
-from time import time
+from signal import alarm, SIG_DFL, SIGALRM, SIGHUP, SIG_IGN, SIGINT, signal, \
+    SIGTERM, SIGUSR1, SIGUSR2
+from thread import get_ident
+from threading import Thread
+from time import sleep, time
 
 
 _captured_exception = None
 _captured_stdout = None
 _captured_stderr = None
+_ready_fd = None
 
 
 def _capture_exception(exctype, value, traceback):
@@ -164,8 +172,700 @@ def droppriv(user, group=None, umask=0022):
     chdir('/')
 
 
+def parse_cpu_list(value):
+    """Translates a CPU list str into a list of CPU numbers.
+
+    The format is the same as used by Linux in places like
+    /sys/devices/system/node/node0/cpulist; comma or space separated
+    CPU numbers or ranges of CPU numbers.
+
+    Example::
+
+        >>> print parse_cpu_list('0-3,8 10')
+        [0, 1, 2, 3, 8, 10]
+
+    :param value: The str to translate.
+    :returns: A list of CPU numbers in the order given.
+    """
+    cpus = []
+    for item in value.replace(',', ' ').split():
+        if '-' in item:
+            start, end = item.split('-', 1)
+            cpus.extend(xrange(int(start), int(end) + 1))
+        else:
+            cpus.append(int(item))
+    return cpus
+
+
+def get_numa_nodes(path='/sys/devices/system/node'):
+    """Returns the CPU numbers for each NUMA node.
+
+    :param path: The sysfs directory describing the NUMA nodes.
+    :returns: A list of lists of CPU numbers, one list per NUMA node
+        sorted by node number, or an empty list if the NUMA nodes could
+        not be discovered.
+    """
+    from os import listdir
+    from os.path import join as path_join
+    try:
+        names = listdir(path)
+    except OSError:
+        return []
+    nodes = []
+    for name in names:
+        if name.startswith('node') and name[4:].isdigit():
+            try:
+                with open(path_join(path, name, 'cpulist')) as fp:
+                    nodes.append((int(name[4:]), parse_cpu_list(fp.read())))
+            except (IOError, ValueError):
+                return []
+    return [cpus for number, cpus in sorted(nodes)]
+
+
+def _libc():
+    from ctypes import CDLL
+    from ctypes.util import find_library
+    return CDLL(find_library('c'), use_errno=True)
+
+
+def get_cpu_affinity(pid=0):
+    """Returns the CPU numbers a process is allowed to run on.
+
+    This is only supported on platforms with sched_getaffinity, such as
+    Linux; an OSError is raised otherwise.
+
+    :param pid: The process to query; the default of 0 is the calling
+        process.
+    :returns: A sorted list of CPU numbers.
+    """
+    from ctypes import c_ulong, get_errno, sizeof
+    from os import strerror
+    bits = sizeof(c_ulong) * 8
+    mask = (c_ulong * (1024 // bits))()
+    try:
+        sched_getaffinity = _libc().sched_getaffinity
+    except AttributeError:
+        raise OSError('CPU affinity is not supported on this platform.')
+    if sched_getaffinity(pid, sizeof(mask), mask) != 0:
+        errno = get_errno()
+        raise OSError(errno, strerror(errno))
+    return [cpu for cpu in xrange(len(mask) * bits)
+            if mask[cpu // bits] & (1 << (cpu % bits))]
+
+
+def set_cpu_affinity(cpus, pid=0):
+    """Restricts a process to running on the CPUs given.
+
+    This is only supported on platforms with sched_setaffinity, such as
+    Linux; an OSError is raised otherwise.
+
+    :param cpus: A list of CPU numbers.
+    :param pid: The process to restrict; the default of 0 is the calling
+        process.
+    """
+    from ctypes import c_ulong, get_errno, sizeof
+    from os import strerror
+    bits = sizeof(c_ulong) * 8
+    mask = (c_ulong * (max(cpus) // bits + 1))()
+    for cpu in cpus:
+        mask[cpu // bits] |= 1 << (cpu % bits)
+    try:
+        sched_setaffinity = _libc().sched_setaffinity
+    except AttributeError:
+        raise OSError('CPU affinity is not supported on this platform.')
+    if sched_setaffinity(pid, sizeof(mask), mask) != 0:
+        errno = get_errno()
+        raise OSError(errno, strerror(errno))
+
+
+#: The posix_fadvise advice that the file will be read sequentially,
+#: which has Linux read further ahead.
+POSIX_FADV_SEQUENTIAL = 2
+
+
+def posix_fadvise(fd, offset, length, advice):
+    """Advises the kernel how a file's data will be accessed.
+
+    This is only supported on platforms with posix_fadvise, such as
+    Linux; an OSError is raised otherwise.
+
+    :param fd: The file descriptor of the file.
+    :param offset: The start of the data the advice is for.
+    :param length: The length of the data the advice is for; 0 means
+        through the end of the file.
+    :param advice: The advice, such as :py:data:`POSIX_FADV_SEQUENTIAL`.
+    """
+    from ctypes import c_int, c_int64
+    from os import strerror
+    try:
+        fadvise = _libc().posix_fadvise64
+    except AttributeError:
+        raise OSError('posix_fadvise is not supported on this platform.')
+    fadvise.argtypes = [c_int, c_int64, c_int64, c_int]
+    errno = fadvise(fd, offset, length, advice)
+    if errno:
+        raise OSError(errno, strerror(errno))
+
+
+#: Linux's flag for recvmmsg to return once at least one datagram is in
+#: rather than waiting to fill the whole batch; missing from Python 2's
+#: socket module.
+_MSG_WAITFORONE = 0x10000
+_mmsghdr_types_cache = None
+
+
+def _mmsghdr_types():
+    """Returns the ctypes (iovec, mmsghdr) structures for *mmsg calls."""
+    global _mmsghdr_types_cache
+    if not _mmsghdr_types_cache:
+        from ctypes import c_int, c_size_t, c_uint, c_void_p, Structure
+
+        class iovec(Structure):
+            _fields_ = [('iov_base', c_void_p), ('iov_len', c_size_t)]
+
+        class msghdr(Structure):
+            _fields_ = [
+                ('msg_name', c_void_p), ('msg_namelen', c_uint),
+                ('msg_iov', c_void_p), ('msg_iovlen', c_size_t),
+                ('msg_control', c_void_p), ('msg_controllen', c_size_t),
+                ('msg_flags', c_int)]
+
+        class mmsghdr(Structure):
+            _fields_ = [('msg_hdr', msghdr), ('msg_len', c_uint)]
+
+        _mmsghdr_types_cache = (iovec, mmsghdr)
+    return _mmsghdr_types_cache
+
+
+class DatagramBatchReceiver(object):
+    """Receives batches of datagrams with a single recvmmsg call each.
+
+    The buffers for the datagrams and their sender addresses are
+    allocated once and reused for every batch. This is only supported on
+    platforms with recvmmsg, such as Linux; an OSError is raised
+    otherwise.
+
+    :param sock: The bound UDP socket.socket to receive from.
+    :param batch_size: The most datagrams to receive per call.
+    :param max_datagram_size: The maximum sized datagram to receive; any
+        larger will be truncated.
+    """
+
+    def __init__(self, sock, batch_size, max_datagram_size):
+        from ctypes import addressof, c_int, c_uint, c_void_p, \
+            create_string_buffer, POINTER
+        iovec, mmsghdr = _mmsghdr_types()
+        try:
+            self._recvmmsg = _libc().recvmmsg
+        except AttributeError:
+            raise OSError('recvmmsg is not supported on this platform.')
+        self._recvmmsg.argtypes = [
+            c_int, POINTER(mmsghdr), c_uint, c_int, c_void_p]
+        self.sock = sock
+        self.batch_size = batch_size
+        self.max_datagram_size = max_datagram_size
+        # Large enough for a sockaddr_storage.
+        self._name_size = 128
+        self._buffer = create_string_buffer(batch_size * max_datagram_size)
+        self._names = create_string_buffer(batch_size * self._name_size)
+        self._iovecs = (iovec * batch_size)()
+        self._msgs = (mmsghdr * batch_size)()
+        for index in xrange(batch_size):
+            iov = self._iovecs[index]
+            iov.iov_base = addressof(self._buffer) + \
+                index * max_datagram_size
+            iov.iov_len = max_datagram_size
+            hdr = self._msgs[index].msg_hdr
+            hdr.msg_name = addressof(self._names) + index * self._name_size
+            hdr.msg_namelen = self._name_size
+            hdr.msg_iov = addressof(iov)
+            hdr.msg_iovlen = 1
+        self._last_count = 0
+
+    def receive(self, flags=0):
+        """Returns a list of (datagram, ip, port) received.
+
+        This blocks until at least one datagram is available, returning
+        just those already waiting up to batch_size, unless
+        flags include MSG_DONTWAIT, in which case a socket.error with
+        EAGAIN is raised if none are waiting. Any other failure is
+        raised as a socket.error as well.
+
+        :param flags: The flags to pass to recvmmsg.
+        :returns: A list of up to batch_size (datagram, ip, port)
+            tuples.
+        """
+        from ctypes import get_errno, string_at
+        from os import strerror
+        from socket import AF_INET, AF_INET6, error as socket_error, \
+            inet_ntop
+        from struct import unpack
+        msgs = self._msgs
+        # The kernel overwrites the address lengths of the messages it
+        # fills, so only those need resetting.
+        for index in xrange(self._last_count):
+            msgs[index].msg_hdr.msg_namelen = self._name_size
+        self._last_count = 0
+        count = self._recvmmsg(
+            self.sock.fileno(), msgs, self.batch_size,
+            flags | _MSG_WAITFORONE, None)
+        if count < 0:
+            errno = get_errno()
+            raise socket_error(errno, strerror(errno))
+        self._last_count = count
+        datagrams = []
+        for index in xrange(count):
+            msg = msgs[index]
+            name = string_at(msg.msg_hdr.msg_name, msg.msg_hdr.msg_namelen)
+            if unpack('H', name[:2])[0] == AF_INET6:
+                ip = inet_ntop(AF_INET6, name[8:24])
+            else:
+                ip = inet_ntop(AF_INET, name[4:8])
+            datagrams.append((
+                string_at(self._iovecs[index].iov_base, msg.msg_len), ip,
+                unpack('!H', name[2:4])[0]))
+        return datagrams
+
+
+class DatagramBatchSender(object):
+    """Sends batches of datagrams with a single sendmmsg call each.
+
+    The message headers and address buffers are allocated once and
+    reused for every batch. This is only supported on platforms with
+    sendmmsg, such as Linux; an OSError is raised otherwise.
+
+    :param sock: The UDP socket.socket to send from.
+    :param batch_size: The most datagrams to send per call.
+    """
+
+    def __init__(self, sock, batch_size):
+        from ctypes import addressof, c_int, c_uint, create_string_buffer, \
+            POINTER
+        iovec, mmsghdr = _mmsghdr_types()
+        try:
+            self._sendmmsg = _libc().sendmmsg
+        except AttributeError:
+            raise OSError('sendmmsg is not supported on this platform.')
+        self._sendmmsg.argtypes = [c_int, POINTER(mmsghdr), c_uint, c_int]
+        self.sock = sock
+        self.batch_size = batch_size
+        # Large enough for a sockaddr_in6.
+        self._name_size = 32
+        self._names = create_string_buffer(batch_size * self._name_size)
+        self._iovecs = (iovec * batch_size)()
+        self._msgs = (mmsghdr * batch_size)()
+        for index in xrange(batch_size):
+            hdr = self._msgs[index].msg_hdr
+            hdr.msg_name = addressof(self._names) + index * self._name_size
+            hdr.msg_iov = addressof(self._iovecs[index])
+            hdr.msg_iovlen = 1
+
+    def send(self, datagrams, flags=0):
+        """Sends as many of the datagrams as the socket will take.
+
+        At most batch_size datagrams are sent per call. If none can be
+        sent, a socket.error is raised; with flags including
+        MSG_DONTWAIT, that will be EAGAIN when the socket's send buffer
+        is full.
+
+        :param datagrams: A list of (datagram, ip, port) tuples; the ips
+            must be numeric addresses.
+        :param flags: The flags to pass to sendmmsg.
+        :returns: The number of datagrams, from the start of the list,
+            that were sent.
+        """
+        from ctypes import c_char_p, c_void_p, cast, get_errno, memmove
+        from os import strerror
+        from socket import AF_INET, AF_INET6, error as socket_error, \
+            inet_pton
+        from struct import pack
+        count = min(len(datagrams), self.batch_size)
+        # The iovecs point into the datagram strings themselves, so
+        # references are kept until sendmmsg returns.
+        buffers = []
+        for index in xrange(count):
+            datagram, ip, port = datagrams[index]
+            if ':' in ip:
+                name = pack('H', AF_INET6) + pack('!HI', port, 0) + \
+                    inet_pton(AF_INET6, ip) + pack('I', 0)
+            else:
+                name = pack('H', AF_INET) + pack('!H', port) + \
+                    inet_pton(AF_INET, ip) + '\0' * 8
+            hdr = self._msgs[index].msg_hdr
+            memmove(hdr.msg_name, name, len(name))
+            hdr.msg_namelen = len(name)
+            buf = c_char_p(datagram)
+            buffers.append(buf)
+            iov = self._iovecs[index]
+            iov.iov_base = cast(buf, c_void_p).value
+            iov.iov_len = len(datagram)
+        sent = self._sendmmsg(self.sock.fileno(), self._msgs, count, flags)
+        if sent < 0:
+            errno = get_errno()
+            raise socket_error(errno, strerror(errno))
+        return sent
+
+
+#: Linux's splice flags to move pages rather than copy them where
+#: possible and to not block on the pipe.
+_SPLICE_F_MOVE = 1
+_SPLICE_F_NONBLOCK = 2
+#: Linux's fcntl command to resize a pipe.
+_F_SETPIPE_SZ = 1031
+
+
+class SocketSplicer(object):
+    """Moves bytes between sockets through a pipe with splice.
+
+    The bytes stay in the kernel, moved from one socket into the pipe
+    with :py:meth:`receive` and from the pipe out to another socket with
+    :py:meth:`send`, never being copied into Python strings. The pipe is
+    created once and reused. This is only supported on platforms with
+    splice, such as Linux; an OSError is raised otherwise. Sockets
+    wrapped with SSL cannot be spliced, as their bytes need decrypting.
+
+    :param chunk_size: The most bytes to receive into the pipe at once.
+        The pipe is grown to hold this much where the platform allows;
+        otherwise less may be received at once.
+    """
+
+    def __init__(self, chunk_size=65536):
+        from ctypes import c_int, c_long, c_size_t, c_uint, c_void_p
+        from fcntl import fcntl
+        try:
+            self._splice = _libc().splice
+        except AttributeError:
+            raise OSError('splice is not supported on this platform.')
+        self._splice.argtypes = [
+            c_int, c_void_p, c_int, c_void_p, c_size_t, c_uint]
+        self._splice.restype = c_long
+        self.chunk_size = chunk_size
+        self.pending = 0
+        """The number of bytes received into the pipe not yet sent."""
+        self._pipe_read, self._pipe_write = pipe()
+        if chunk_size > 65536:
+            try:
+                fcntl(self._pipe_write, _F_SETPIPE_SZ, chunk_size)
+            except IOError:
+                pass
+
+    def _call(self, fd_in, fd_out, length):
+        count = self._splice(
+            fd_in, None, fd_out, None, length,
+            _SPLICE_F_MOVE | _SPLICE_F_NONBLOCK)
+        if count < 0:
+            from ctypes import get_errno
+            from os import strerror
+            from socket import error as socket_error
+            errno = get_errno()
+            raise socket_error(errno, strerror(errno))
+        return count
+
+    def receive(self, sock):
+        """Moves up to chunk_size bytes from sock into the pipe.
+
+        This should only be called when :py:attr:`pending` is 0. A
+        socket.error is raised on failure, with EAGAIN if sock is
+        non-blocking and has nothing to read.
+
+        :param sock: The socket.socket to read from.
+        :returns: The number of bytes moved; 0 once sock has reached
+            end of file.
+        """
+        count = self._call(sock.fileno(), self._pipe_write, self.chunk_size)
+        self.pending = count
+        return count
+
+    def send(self, sock):
+        """Moves the pending bytes in the pipe out to sock.
+
+        A socket.error is raised on failure, with EAGAIN if sock is
+        non-blocking and cannot take any more yet.
+
+        :param sock: The socket.socket to write to.
+        :returns: The number of bytes moved, which may be less than
+            :py:attr:`pending`.
+        """
+        count = self._call(self._pipe_read, sock.fileno(), self.pending)
+        self.pending -= count
+        return count
+
+    def close(self):
+        """Closes the pipe."""
+        os_close(self._pipe_read)
+        os_close(self._pipe_write)
+
+
+#: Linux's flag to not raise SIGPIPE when sending to a closed socket.
+_MSG_NOSIGNAL = 0x4000
+#: The most iovecs Linux accepts in one sendmsg call.
+_IOV_MAX = 1024
+
+
+class SocketStream(object):
+    """Buffers reads from and gathers writes to a connected socket.
+
+    Reads are received into a single bytearray that is reused and only
+    grown when a read needs more than it holds, such as a long line.
+    :py:meth:`readline`, :py:meth:`readuntil` and
+    :py:meth:`readexactly` return strs cut from that buffer and
+    :py:meth:`readinto` copies into a caller's buffer, receiving
+    straight into it when nothing is buffered.
+
+    Writes are gathered: :py:meth:`write` queues the data until
+    chunk_size bytes are pending or :py:meth:`flush` is called, and then
+    all the pending buffers go out with a single sendmsg call rather
+    than being joined into one str first. Pending writes are also
+    flushed before any read has to wait on the socket, so a
+    request/response protocol never stalls on an unsent response. SSL
+    sockets and platforms without sendmsg fall back to sendall.
+
+    The socket's own blocking and timeout settings apply, so this works
+    alike with Eventlet green sockets and standard sockets.
+
+    :param sock: The connected socket.socket.
+    :param chunk_size: The most bytes to receive at once and the pending
+        write bytes that cause a flush.
+    :param limit: The most bytes :py:meth:`readuntil` and
+        :py:meth:`readline` will buffer looking for the separator.
+    """
+
+    def __init__(self, sock, chunk_size=65536, limit=1048576):
+        self.sock = sock
+        """The underlying socket.socket."""
+        self.chunk_size = chunk_size
+        self.limit = limit
+        self._buf = bytearray(chunk_size)
+        self._start = 0
+        self._end = 0
+        self._writes = []
+        self._write_size = 0
+        self._sendmsg = None
+        if not hasattr(sock, 'cipher'):
+            from ctypes import c_int, c_long, c_void_p
+            try:
+                self._sendmsg = _libc().sendmsg
+            except AttributeError:
+                pass
+            else:
+                self._sendmsg.argtypes = [c_int, c_void_p, c_int]
+                self._sendmsg.restype = c_long
+
+    def _fill(self):
+        """Receives more bytes onto the end of the buffer.
+
+        :returns: The number of bytes received; 0 at end of file.
+        """
+        if self._writes:
+            self.flush()
+        size = self._end - self._start
+        if not size:
+            self._start = self._end = 0
+        elif self._end == len(self._buf):
+            if self._start:
+                self._buf[:size] = self._buf[self._start:self._end]
+                self._start = 0
+                self._end = size
+            else:
+                self._buf.extend(bytearray(len(self._buf)))
+        count = self.sock.recv_into(memoryview(self._buf)[self._end:])
+        self._end += count
+        return count
+
+    def _take(self, size):
+        data = memoryview(self._buf)[self._start:self._start + size].tobytes()
+        self._start += size
+        return data
+
+    def read(self, size):
+        """Returns up to size bytes.
+
+        Buffered bytes are returned if there are any; otherwise the
+        socket is read from once.
+
+        :param size: The most bytes to return.
+        :returns: A str of the bytes read; empty at end of file.
+        """
+        if self._start == self._end:
+            self._fill()
+        return self._take(min(size, self._end - self._start))
+
+    def readinto(self, buf):
+        """Reads up to len(buf) bytes into buf.
+
+        Buffered bytes are copied if there are any; otherwise the socket
+        is read from straight into buf.
+
+        :param buf: A writable buffer, such as a bytearray.
+        :returns: The number of bytes read; 0 at end of file.
+        """
+        size = self._end - self._start
+        if not size:
+            if self._writes:
+                self.flush()
+            return self.sock.recv_into(buf)
+        size = min(size, len(buf))
+        memoryview(buf)[:size] = \
+            memoryview(self._buf)[self._start:self._start + size]
+        self._start += size
+        return size
+
+    def readexactly(self, size):
+        """Returns exactly size bytes.
+
+        An EOFError is raised if the socket reaches end of file first;
+        the bytes read so far are left buffered.
+
+        :param size: The number of bytes to return.
+        :returns: A str of the bytes read.
+        """
+        while self._end - self._start < size:
+            if not self._fill():
+                raise EOFError(
+                    'End of file after %d of %d bytes.' %
+                    (self._end - self._start, size))
+        return self._take(size)
+
+    def readuntil(self, separator='\n'):
+        """Returns the bytes up to and including separator.
+
+        An EOFError is raised if the socket reaches end of file first
+        and an Exception if more than limit bytes are buffered without
+        finding separator; either way the bytes read so far are left
+        buffered.
+
+        :param separator: The str ending the bytes to return.
+        :returns: A str of the bytes read, ending with separator.
+        """
+        offset = 0
+        while True:
+            index = self._buf.find(
+                separator, self._start + offset, self._end)
+            if index >= 0:
+                return self._take(index + len(separator) - self._start)
+            size = self._end - self._start
+            if size >= self.limit:
+                raise Exception(
+                    'No %r found within %d bytes.' % (separator, self.limit))
+            # The separator may straddle what is buffered and what's next.
+            offset = max(0, size - len(separator) + 1)
+            if not self._fill():
+                raise EOFError(
+                    'End of file after %d bytes without %r.' %
+                    (size, separator))
+
+    def readline(self):
+        """Returns the next line, including its ending newline.
+
+        At end of file, the remaining bytes are returned without a
+        newline, then empty strs. An Exception is raised if a line is
+        longer than limit.
+
+        :returns: A str of the line read.
+        """
+        try:
+            return self.readuntil()
+        except EOFError:
+            return self._take(self._end - self._start)
+
+    def write(self, data):
+        """Queues data to send.
+
+        The queued data is sent once chunk_size bytes are pending or
+        with the next :py:meth:`flush`, :py:meth:`writev` or read that
+        waits on the socket.
+
+        :param data: A str or bytearray to send; it should not be
+            changed until sent.
+        """
+        if data:
+            self._writes.append(data)
+            self._write_size += len(data)
+            if self._write_size >= self.chunk_size:
+                self.flush()
+
+    def flush(self):
+        """Sends all queued data."""
+        if self._writes:
+            self.writev([])
+
+    def writev(self, buffers):
+        """Sends any queued data and then all the buffers given.
+
+        The buffers are gathered into as few sendmsg calls as possible;
+        when the socket cannot take everything at once, the rest is sent
+        with the socket's own sendall, honoring its timeout, before
+        gathering resumes.
+
+        :param buffers: A list of strs or bytearrays to send.
+        """
+        buffers = [b for b in self._writes + list(buffers) if b]
+        self._writes = []
+        self._write_size = 0
+        if not self._sendmsg:
+            if buffers:
+                self.sock.sendall(bytearray().join(buffers))
+            return
+        index = 0
+        while index < len(buffers):
+            sent = self._gather(buffers[index:index + _IOV_MAX])
+            if sent is None:
+                self.sock.sendall(buffers[index])
+                index += 1
+                continue
+            while index < len(buffers) and sent >= len(buffers[index]):
+                sent -= len(buffers[index])
+                index += 1
+            if sent:
+                buffers[index] = buffers[index][sent:]
+
+    def _gather(self, buffers):
+        """Sends the buffers with one sendmsg call.
+
+        :returns: The number of bytes sent, or None if the socket could
+            not take any without waiting.
+        """
+        from ctypes import addressof, byref, c_char, c_char_p, c_void_p, \
+            cast, get_errno
+        iovec, mmsghdr = _mmsghdr_types()
+        # The iovecs point into the buffers themselves, so references
+        # are kept until sendmsg returns.
+        refs = []
+        iovs = (iovec * len(buffers))()
+        for index, buf in enumerate(buffers):
+            if isinstance(buf, bytearray):
+                ref = (c_char * len(buf)).from_buffer(buf)
+                iovs[index].iov_base = addressof(ref)
+            else:
+                ref = c_char_p(buf)
+                iovs[index].iov_base = cast(ref, c_void_p).value
+            refs.append(ref)
+            iovs[index].iov_len = len(buf)
+        hdr = mmsghdr().msg_hdr
+        hdr.msg_iov = addressof(iovs)
+        hdr.msg_iovlen = len(buffers)
+        while True:
+            sent = self._sendmsg(self.sock.fileno(), byref(hdr), _MSG_NOSIGNAL)
+            if sent >= 0:
+                return sent
+            errno = get_errno()
+            if errno == EAGAIN:
+                return None
+            if errno != EINTR:
+                from os import strerror
+                from socket import error as socket_error
+                raise socket_error(errno, strerror(errno))
+
+    def close(self):
+        """Sends any queued data and closes the socket."""
+        try:
+            self.flush()
+        finally:
+            self.sock.close()
+
+
 def get_listening_tcp_socket(ip, port, backlog=4096, retry=30, certfile=None,
-                             keyfile=None, style=None):
+                             keyfile=None, style=None, sock=None):
     """Returns a bound socket.socket for accepting TCP connections.
 
     The socket will be bound to the given ip and tcp port with other
@@ -188,6 +888,10 @@ def get_listening_tcp_socket(ip, port, backlog=4096, retry=30, certfile=None,
         socket. The default will use the standard Python libraries.
         ``'eventlet'`` is recognized and will use the Eventlet
         libraries. Other styles may added in the future.
+    :param sock: An already bound socket.socket to use instead of
+        binding a new one, such as one received with
+        :py:func:`receive_listening_sockets`. It will be listened on
+        with the *backlog* given and ssl wrapped if requested.
     """
     if not style:
         from socket import AF_INET, AF_INET6, AF_UNSPEC, \
@@ -204,6 +908,13 @@ def get_listening_tcp_socket(ip, port, backlog=4096, retry=30, certfile=None,
     else:
         from socket import error as socket_error
         raise socket_error('Socket style %r not understood.' % style)
+    if sock:
+        if style:
+            sock = socket(sock)
+        sock.listen(backlog)
+        if certfile and keyfile:
+            sock = wrap_socket(sock, certfile=certfile, keyfile=keyfile)
+        return sock
     if not ip or ip == '*':
         ip = '0.0.0.0'
     family = None
@@ -239,7 +950,59 @@ def get_listening_tcp_socket(ip, port, backlog=4096, retry=30, certfile=None,
     return good_sock
 
 
-def get_listening_udp_socket(ip, port, retry=30, style=None):
+#: OpenSSL's option to not issue session tickets.
+_OP_NO_TICKET = 0x4000
+
+
+def get_ssl_context(certfile, keyfile, ciphers=None, alpn_protocols=None,
+                    session_tickets=True, style=None):
+    """Returns an ssl.SSLContext for the server side of connections.
+
+    Unlike wrapping a listening socket with ssl.wrap_socket, the one
+    context is meant to be shared by every connection accepted, with
+    each wrapped by its wrap_socket method once accepted. Sharing it
+    keeps the certificate loaded once and lets reconnecting clients
+    resume their sessions with an abbreviated handshake, whether from
+    the context's session cache or with a session ticket. A context
+    created before forking workers gives them all the same ticket keys,
+    so a ticket from one worker is good with any of them.
+
+    SSLv2, SSLv3 and TLS compression are disabled and the server's
+    cipher order is preferred.
+
+    :param certfile: The certificate file.
+    :param keyfile: The key file.
+    :param ciphers: The OpenSSL cipher list to allow, or None for
+        Python's default.
+    :param alpn_protocols: A list of protocols, such as ``['h2',
+        'http/1.1']``, to offer with ALPN, most preferred first.
+    :param session_tickets: False to not issue session tickets, leaving
+        just the session cache for resumption.
+    :param style: The libraries you'd like to use, as with
+        :py:func:`get_listening_tcp_socket`; with ``'eventlet'``, the
+        context wraps sockets with Eventlet's ssl.
+    """
+    if not style:
+        import ssl
+    elif style.lower() == 'eventlet':
+        from eventlet.green import ssl
+    else:
+        raise ValueError('Socket style %r not understood.' % style)
+    context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+    context.options |= ssl.OP_NO_SSLv2 | ssl.OP_NO_SSLv3 | \
+        getattr(ssl, 'OP_NO_COMPRESSION', 0) | \
+        getattr(ssl, 'OP_CIPHER_SERVER_PREFERENCE', 0)
+    if not session_tickets:
+        context.options |= _OP_NO_TICKET
+    context.load_cert_chain(certfile, keyfile)
+    if ciphers:
+        context.set_ciphers(ciphers)
+    if alpn_protocols:
+        context.set_alpn_protocols(alpn_protocols)
+    return context
+
+
+def get_listening_udp_socket(ip, port, retry=30, style=None, sock=None):
     """Returns a bound socket.socket for accepting UDP datagrams.
 
     The socket will be bound to the given ip and tcp port with other
@@ -257,6 +1020,9 @@ def get_listening_udp_socket(ip, port, retry=30, style=None):
         socket. The default will use the standard Python libraries.
         ``'Eventlet'`` is recognized and will use the Eventlet
         libraries. Other styles may added in the future.
+    :param sock: An already bound socket.socket to use instead of
+        binding a new one, such as one received with
+        :py:func:`receive_listening_sockets`.
     """
     if not style:
         from socket import AF_INET, AF_INET6, AF_UNSPEC, \
@@ -271,6 +1037,10 @@ def get_listening_udp_socket(ip, port, retry=30, style=None):
     else:
         from socket import error as socket_error
         raise socket_error('Socket style %r not understood.' % style)
+    if sock:
+        if style:
+            sock = socket(sock)
+        return sock
     if not ip or ip == '*':
         ip = '0.0.0.0'
     family = None
@@ -301,6 +1071,298 @@ def get_listening_udp_socket(ip, port, retry=30, style=None):
     return good_sock
 
 
+# Not defined by Python 2's socket module; the values are Linux's.
+_SO_BUSY_POLL = 46
+_SO_RCVBUFFORCE = 33
+_SO_SNDBUFFORCE = 32
+_TCP_FASTOPEN = 23
+
+
+def tune_socket(sock, socket_rcvbuf=0, socket_sndbuf=0, socket_busy_poll=0,
+                tcp_nodelay=False, tcp_defer_accept=0, tcp_fastopen=0,
+                tcp_keepidle=0, tcp_keepintvl=0, tcp_keepcnt=0):
+    """Sets kernel socket options and returns the values granted.
+
+    Options left at 0 (or False) are not set. Set on a listening TCP
+    socket, these are inherited by the connections it accepts on Linux.
+    The kernel often grants something other than what was asked, such
+    as doubling the buffer sizes for its own bookkeeping, capping them
+    at net.core.rmem_max and wmem_max, or rounding tcp_defer_accept up
+    to a whole number of SYN-ACK retransmits, so the values are read
+    back after being set. The buffer sizes are first tried with
+    SO_RCVBUFFORCE and SO_SNDBUFFORCE, which exceed those caps when
+    running with CAP_NET_ADMIN, as during brimd's privileged start.
+
+    :param sock: The socket.socket to tune.
+    :param socket_rcvbuf: SO_RCVBUF, the receive buffer size in bytes.
+    :param socket_sndbuf: SO_SNDBUF, the send buffer size in bytes.
+    :param socket_busy_poll: SO_BUSY_POLL, the microseconds to busy poll
+        the device queue on blocking receives.
+    :param tcp_nodelay: True to set TCP_NODELAY, disabling Nagle's
+        algorithm.
+    :param tcp_defer_accept: TCP_DEFER_ACCEPT, the seconds to wait for
+        data before waking an accept.
+    :param tcp_fastopen: TCP_FASTOPEN, the queue length of pending TCP
+        Fast Open requests.
+    :param tcp_keepidle: TCP_KEEPIDLE, the seconds idle before sending
+        keepalive probes.
+    :param tcp_keepintvl: TCP_KEEPINTVL, the seconds between keepalive
+        probes.
+    :param tcp_keepcnt: TCP_KEEPCNT, the unanswered keepalive probes
+        before dropping the connection.
+    :returns: A dict of the option names set to the values granted.
+    """
+    from socket import error as socket_error, IPPROTO_TCP, SOL_SOCKET, \
+        SO_RCVBUF, SO_SNDBUF, TCP_DEFER_ACCEPT, TCP_KEEPCNT, TCP_KEEPIDLE, \
+        TCP_KEEPINTVL, TCP_NODELAY
+    options = (
+        ('socket_rcvbuf', socket_rcvbuf, SOL_SOCKET, SO_RCVBUF,
+         _SO_RCVBUFFORCE),
+        ('socket_sndbuf', socket_sndbuf, SOL_SOCKET, SO_SNDBUF,
+         _SO_SNDBUFFORCE),
+        ('socket_busy_poll', socket_busy_poll, SOL_SOCKET, _SO_BUSY_POLL,
+         None),
+        ('tcp_nodelay', int(bool(tcp_nodelay)), IPPROTO_TCP, TCP_NODELAY,
+         None),
+        ('tcp_defer_accept', tcp_defer_accept, IPPROTO_TCP,
+         TCP_DEFER_ACCEPT, None),
+        ('tcp_fastopen', tcp_fastopen, IPPROTO_TCP, _TCP_FASTOPEN, None),
+        ('tcp_keepidle', tcp_keepidle, IPPROTO_TCP, TCP_KEEPIDLE, None),
+        ('tcp_keepintvl', tcp_keepintvl, IPPROTO_TCP, TCP_KEEPINTVL, None),
+        ('tcp_keepcnt', tcp_keepcnt, IPPROTO_TCP, TCP_KEEPCNT, None))
+    granted = {}
+    for name, value, level, option, force_option in options:
+        if not value:
+            continue
+        if force_option:
+            try:
+                sock.setsockopt(level, force_option, value)
+            except socket_error as err:
+                if err.errno != EPERM:
+                    raise
+                force_option = None
+        if not force_option:
+            sock.setsockopt(level, option, value)
+        granted[name] = sock.getsockopt(level, option)
+    return granted
+
+
+def get_udp_drops(sock, paths=('/proc/net/udp', '/proc/net/udp6')):
+    """Returns the number of datagrams the kernel dropped for a socket.
+
+    These are the datagrams that arrived while the socket's receive
+    buffer was full, or that failed their checksum, and so were never
+    seen by any process reading the socket. The count is the socket's
+    total since it was created, read from the drops column of the
+    socket's entry in /proc/net/udp or /proc/net/udp6, found by its
+    inode. Only supported on Linux.
+
+    :param sock: The bound UDP socket.socket.
+    :param paths: The /proc files to search.
+    :returns: The number of datagrams dropped.
+    """
+    inode = str(fstat(sock.fileno()).st_ino)
+    for path in paths:
+        try:
+            fp = open(path)
+        except IOError as err:
+            if err.errno != ENOENT:
+                raise
+            continue
+        try:
+            fp.readline()
+            for line in fp:
+                fields = line.split()
+                if len(fields) > 12 and fields[9] == inode:
+                    return int(fields[12])
+        finally:
+            fp.close()
+    raise OSError(
+        ENOENT, 'No entry for the socket in %s.' % ' or '.join(paths))
+
+
+def handoff_listening_sockets(handoff_sock, socks, timeout=5):
+    """Sends listening sockets to another process.
+
+    A single connection is accepted on *handoff_sock* and the file
+    descriptors of the *socks* are passed over it with SCM_RIGHTS, to
+    be picked up with :py:func:`receive_listening_sockets`. Both
+    processes then share the same underlying sockets, so connections
+    queued or arriving during the handoff are not refused; they are
+    simply accepted by whichever process gets to them first.
+
+    :param handoff_sock: The listening AF_UNIX SOCK_STREAM socket to
+        accept the connection on.
+    :param socks: A dict of keys to the socket.socket instances to send.
+        The keys are sent along as well so the receiving process can
+        tell which socket is which.
+    :param timeout: The number of seconds to wait for the connection.
+    """
+    from json import dumps
+    from select import select
+    from socket import error as socket_error
+    from struct import pack
+    from _multiprocessing import sendfd
+    if not select([handoff_sock], [], [], timeout)[0]:
+        raise socket_error(
+            'No handoff connection after %s seconds.' % timeout)
+    conn = handoff_sock.accept()[0]
+    try:
+        items = sorted(socks.items())
+        header = dumps([(key, sock.family, sock.type) for key, sock in items])
+        conn.sendall(pack('!I', len(header)) + header)
+        for key, sock in items:
+            sendfd(conn.fileno(), sock.fileno())
+    finally:
+        conn.close()
+
+
+def receive_listening_sockets(path, request_func=None, timeout=5):
+    """Receives listening sockets sent by another process.
+
+    Connects to the AF_UNIX socket at *path*, calls *request_func*, and
+    then receives the sockets sent with
+    :py:func:`handoff_listening_sockets`.
+
+    :param path: The path to the other process' handoff socket.
+    :param request_func: If set, this function will be called with no
+        arguments once connected; usually to signal the other process
+        to begin the handoff.
+    :param timeout: The number of seconds to wait for the handoff to
+        complete.
+    :returns: A dict of keys to the socket.socket instances received.
+    """
+    from json import loads
+    from os import close
+    from select import select
+    from socket import AF_UNIX, error as socket_error, fromfd, socket, \
+        SOCK_STREAM
+    from struct import unpack
+    from _multiprocessing import recvfd
+    deadline = time() + timeout
+
+    def wait_readable(conn):
+        if not select([conn], [], [], max(0, deadline - time()))[0]:
+            raise socket_error(
+                'Handoff did not complete after %s seconds.' % timeout)
+
+    def read(conn, size):
+        data = ''
+        while len(data) < size:
+            wait_readable(conn)
+            chunk = conn.recv(size - len(data))
+            if not chunk:
+                raise socket_error('Handoff connection closed early.')
+            data += chunk
+        return data
+
+    socks = {}
+    conn = socket(AF_UNIX, SOCK_STREAM)
+    try:
+        conn.connect(path)
+        if request_func:
+            request_func()
+        size = unpack('!I', read(conn, 4))[0]
+        for key, family, type_ in loads(read(conn, size)):
+            wait_readable(conn)
+            try:
+                fd = recvfd(conn.fileno())
+            except (OSError, RuntimeError) as err:
+                raise socket_error('Handoff of %s failed: %s' % (key, err))
+            socks[key] = fromfd(fd, family, type_)
+            close(fd)
+    except Exception:
+        for sock in socks.itervalues():
+            sock.close()
+        raise
+    finally:
+        conn.close()
+    return socks
+
+
+class StackSampler(object):
+    """Samples the stacks of a running process in folded form.
+
+    Once started, a background OS thread wakes every *interval* seconds
+    and records the current stack of each of the process's other
+    threads. Python only runs signal handlers in the main thread, so a
+    thread is used rather than a profiling timer signal; this way the
+    threads of a threads concurrency_model worker are sampled as well.
+    The greenthreads of an Eventlet worker all run in the main thread,
+    so each sample finds whichever greenthread was running at the time,
+    or the hub waiting for events if none was.
+
+    Identical stacks are counted together regardless of which thread or
+    greenthread they were sampled from, and :py:meth:`folded` reports
+    them in the folded format read by flame graph tools. Nothing runs
+    while the sampler is idle.
+
+    :param interval: The seconds between samples.
+    """
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        """The seconds between samples."""
+        self.counts = {}
+        """The number of samples of each folded stack."""
+        self.running = False
+        """True while sampling."""
+
+    def start(self, seconds, done_func=None):
+        """Starts sampling for *seconds*, clearing any earlier samples.
+
+        :param seconds: The seconds to sample for.
+        :param done_func: Called from the sampling thread with the
+            :py:meth:`folded` stacks once done, if set.
+        :returns: False if already sampling, True otherwise.
+        """
+        if self.running:
+            return False
+        self.running = True
+        self.counts = {}
+        thread = Thread(target=self._run, args=(seconds, done_func))
+        thread.daemon = True
+        thread.start()
+        return True
+
+    def _run(self, seconds, done_func):
+        try:
+            end = time() + seconds
+            while time() < end:
+                sleep(self.interval)
+                self.sample()
+            if done_func:
+                done_func(self.folded())
+        finally:
+            self.running = False
+
+    def sample(self):
+        """Records the current stacks of all threads but the caller's."""
+        ident = get_ident()
+        for thread_ident, frame in sys._current_frames().items():
+            if thread_ident == ident:
+                continue
+            names = []
+            while frame:
+                code = frame.f_code
+                names.append('%s (%s:%d)' % (
+                    code.co_name, code.co_filename, code.co_firstlineno))
+                frame = frame.f_back
+            names.reverse()
+            stack = ';'.join(names)
+            self.counts[stack] = self.counts.get(stack, 0) + 1
+
+    def folded(self):
+        """Returns the samples as folded stacks, one per line.
+
+        Each line is a stack of ``function (file:line)`` frames from
+        outermost to innermost, separated by semicolons, then a space
+        and the number of samples of that stack.
+        """
+        return ''.join(
+            '%s %d\n' % item for item in sorted(self.counts.iteritems()))
+
+
 def signum2str(signum):
     """Translates a signal number to a str.
 
@@ -319,7 +1381,43 @@ def signum2str(signum):
     return 'UNKNOWN'
 
 
-def sustain_workers(workers_desired, worker_func, logger=None):
+def worker_ready():
+    """Tells :py:func:`sustain_workers` the calling worker is ready.
+
+    A worker started to replace another during a rolling reload must
+    call this once it is ready to take over; only then is the worker it
+    replaces told to exit. Otherwise this does nothing.
+    """
+    global _ready_fd
+    if _ready_fd is not None:
+        os_write(_ready_fd, '.')
+        os_close(_ready_fd)
+        _ready_fd = None
+
+
+def _read_ready(fds, timeout):
+    """Returns {fd: ready} for the ready pipes given that have resolved.
+
+    A replacement worker writes a byte to its pipe with
+    :py:func:`worker_ready`; if it exits first, the pipe just closes.
+    Each resolved pipe is closed.
+    """
+    try:
+        readable = select(fds, [], [], timeout)[0]
+    except select_error as err:
+        if err.args[0] != EINTR:
+            raise
+        return {}
+    results = {}
+    for fd in readable:
+        results[fd] = bool(os_read(fd, 1))
+        os_close(fd)
+    return results
+
+
+def sustain_workers(workers_desired, worker_func, logger=None,
+                    reload_func=None, reload_batch=1, scale_func=None,
+                    scale_interval=5):
     """Starts and maintains a set of subprocesses.
 
     For each worker started, it will run the *worker_func*. If a
@@ -337,6 +1435,33 @@ def sustain_workers(workers_desired, worker_func, logger=None):
     SIGTERM generally means the processes should exit immediately,
     canceling anything they may have been doing at the time.
 
+    SIGUSR1 requests a rolling reload. If *reload_func* is set, it is
+    called and then each subprocess is replaced, *reload_batch* at a
+    time, by first starting a new subprocess and then, once it has
+    called :py:func:`worker_ready`, sending SIGHUP to the old one. The
+    next batch is not started until the old subprocesses of the previous
+    batch have exited. If *reload_func* raises an Exception, the reload
+    is abandoned and the existing subprocesses are left running; the
+    same goes for the rest of the reload if a new subprocess exits
+    before it is ready, keeping the old subprocess it was to replace.
+    If *reload_func* returns True, the subprocesses are taken to be able
+    to reload themselves in place and SIGUSR1 is relayed to them instead
+    of replacing them. If *reload_func* is not set, SIGUSR1 is simply
+    relayed to the subprocesses. Subprocesses start with SIGUSR1 and
+    SIGUSR2 ignored, so they must install their own handlers if they
+    wish to act on them.
+
+    If *scale_func* is set, *workers_desired* is instead the maximum
+    number of subprocesses. *scale_func* is called once at startup with
+    0 to get the initial number of subprocesses and then every
+    *scale_interval* seconds with the number currently running; it
+    returns the number wanted, which is kept between 1 and
+    *workers_desired*. Additional subprocesses are started right away
+    and surplus subprocesses, those with the highest worker ids, are
+    sent SIGHUP to finish what they're doing and exit. A worker id is
+    not given to a new subprocess until the retiring subprocess that had
+    it exits. Scaling waits while a rolling reload is in progress.
+
     If *workers_desired* is 0, a special "inproc" mode will be activated
     where just the *worker_func* will be called and then
     *sustain_workers* will return. This can be useful for debugging.
@@ -354,6 +1479,16 @@ def sustain_workers(workers_desired, worker_func, logger=None):
         and the function called again.
     :param logger: If set, debug information will be sent to this
         logging.Logger instance.
+    :param reload_func: If set, this function will be called with no
+        arguments on SIGUSR1 before the subprocesses are replaced or
+        relayed the signal; see above.
+    :param reload_batch: The number of subprocesses to replace at a
+        time during a rolling reload; defaults to 1.
+    :param scale_func: If set, this function will be called with the
+        number of subprocesses running to get the number wanted; see
+        above.
+    :param scale_interval: The number of seconds between calls to
+        *scale_func*; defaults to 5.
     """
     from time import sleep
     if workers_desired == 0:
@@ -365,6 +1500,7 @@ def sustain_workers(workers_desired, worker_func, logger=None):
         return
 
     signal_received = [0]
+    reload_received = [False]
 
     def term_signal(*args):
         signal(SIGTERM, SIG_IGN)
@@ -374,36 +1510,72 @@ def sustain_workers(workers_desired, worker_func, logger=None):
         signal(SIGHUP, SIG_IGN)
         signal_received[0] = SIGHUP
 
+    def usr1_signal(*args):
+        reload_received[0] = True
+
+    def alrm_signal(*args):
+        # Only here to interrupt the os_wait below for the next scaling.
+        pass
+
+    def child(worker_id, ready_fd=None):
+        global _ready_fd
+        _ready_fd = ready_fd
+        signal(SIGTERM, SIG_DFL)
+        signal(SIGHUP, SIG_DFL)
+        signal(SIGUSR1, SIG_IGN)
+        signal(SIGUSR2, SIG_IGN)
+        if scale_func:
+            signal(SIGALRM, SIG_DFL)
+        ppid = getppid()
+        if logger:
+            logger.debug('wid:%03d ppid:%d pid:%d Starting worker.' %
+                         (worker_id, ppid, getpid()))
+        try:
+            worker_func(worker_id)
+        except Exception as err:
+            if logger:
+                logger.exception(
+                    'wid:%03d ppid:%d pid:%d Worker exited due to '
+                    'exception: %s' % (worker_id, ppid, getpid(), err))
+            # Reraised in case of useful installed sys.excepthook.
+            raise
+        if logger:
+            logger.debug('wid:%03d ppid:%d pid:%d Worker exited.' %
+                         (worker_id, ppid, getpid()))
+
     signal(SIGTERM, term_signal)
     signal(SIGHUP, hup_signal)
+    signal(SIGUSR1, usr1_signal)
     worker_pids = [0] * workers_desired
+    workers_active = workers_desired
+    if scale_func:
+        signal(SIGALRM, alrm_signal)
+        workers_active = max(1, min(workers_desired, scale_func(0)))
+        scale_time = time() + scale_interval
+    # Maps each retiring worker's pid to its worker_id.
+    retiring_pids = {}
+    reload_pending = []
+    # Maps the ready pipe of each replacement worker starting up during a
+    # reload to its (worker_id, pid).
+    starting = {}
     initial_forking = True
+
+    def reap(pid, status):
+        if WIFEXITED(status) or WIFSIGNALED(status):
+            if pid in retiring_pids:
+                del retiring_pids[pid]
+            elif pid in worker_pids:
+                worker_pids[worker_pids.index(pid)] = 0
     while not signal_received[0]:
-        while True:
-            try:
-                worker_id = worker_pids.index(0)
-            except ValueError:
-                break
+        # A worker_id isn't reused until its retiring worker has exited,
+        # as the two would share the same stats.
+        retiring_ids = set(retiring_pids.itervalues())
+        for worker_id in xrange(workers_active):
+            if worker_pids[worker_id] or worker_id in retiring_ids:
+                continue
             pid = fork()
             if pid == 0:
-                signal(SIGTERM, SIG_DFL)
-                signal(SIGHUP, SIG_DFL)
-                ppid = getppid()
-                if logger:
-                    logger.debug('wid:%03d ppid:%d pid:%d Starting worker.' %
-                                 (worker_id, ppid, getpid()))
-                try:
-                    worker_func(worker_id)
-                except Exception as err:
-                    if logger:
-                        logger.exception(
-                            'wid:%03d ppid:%d pid:%d Worker exited due to '
-                            'exception: %s' % (worker_id, ppid, getpid(), err))
-                    # Reraised in case of useful installed sys.excepthook.
-                    raise
-                if logger:
-                    logger.debug('wid:%03d ppid:%d pid:%d Worker exited.' %
-                                 (worker_id, ppid, getpid()))
+                child(worker_id)
                 return
             else:
                 worker_pids[worker_id] = pid
@@ -412,16 +1584,96 @@ def sustain_workers(workers_desired, worker_func, logger=None):
                     # will be reforked at a maximum rate of one per second.
                     sleep(1)
         initial_forking = False
+        if reload_received[0]:
+            reload_received[0] = False
+            relay = not reload_func
+            if reload_func:
+                try:
+                    relay = reload_func() is True
+                except Exception as err:
+                    if logger:
+                        logger.exception('Reload abandoned: %s' % err)
+                else:
+                    if relay:
+                        if logger:
+                            logger.info('Reloading workers in place.')
+                    else:
+                        if logger:
+                            logger.info('Reloading workers.')
+                        reload_pending = range(workers_active)
+            if relay:
+                for pid in worker_pids:
+                    if pid:
+                        kill(pid, SIGUSR1)
+        if reload_pending and not retiring_pids and not starting:
+            batch = reload_pending[:reload_batch]
+            del reload_pending[:reload_batch]
+            for worker_id in batch:
+                ready_read, ready_write = pipe()
+                pid = fork()
+                if pid == 0:
+                    os_close(ready_read)
+                    child(worker_id, ready_write)
+                    return
+                os_close(ready_write)
+                starting[ready_read] = (worker_id, pid)
+        if starting:
+            for ready_read, ready in _read_ready(list(starting), 1).items():
+                worker_id, pid = starting.pop(ready_read)
+                if not ready:
+                    if logger:
+                        logger.error(
+                            'Reload abandoned: worker %d exited before it was '
+                            'ready.' % worker_id)
+                    reload_pending = []
+                    continue
+                if worker_pids[worker_id]:
+                    retiring_pids[worker_pids[worker_id]] = worker_id
+                    kill(worker_pids[worker_id], SIGHUP)
+                worker_pids[worker_id] = pid
+            # Exits are collected without blocking so the ready pipes
+            # keep being watched.
+            try:
+                while True:
+                    pid, status = waitpid(-1, WNOHANG)
+                    if not pid:
+                        break
+                    reap(pid, status)
+            except OSError as err:
+                if err.errno not in (EINTR, ECHILD):
+                    raise
+            continue
+        if scale_func and not reload_pending and time() >= scale_time:
+            scale_time = time() + scale_interval
+            workers_wanted = max(
+                1, min(workers_desired, scale_func(workers_active)))
+            if workers_wanted != workers_active:
+                if logger:
+                    logger.info('Scaling from %d to %d workers.' %
+                                (workers_active, workers_wanted))
+                for worker_id in xrange(workers_wanted, workers_active):
+                    if worker_pids[worker_id]:
+                        retiring_pids[worker_pids[worker_id]] = worker_id
+                        kill(worker_pids[worker_id], SIGHUP)
+                        worker_pids[worker_id] = 0
+                if workers_wanted > workers_active:
+                    # Added workers are wanted now, not at the relaunch rate.
+                    initial_forking = True
+                workers_active = workers_wanted
+                continue
+        if scale_func:
+            alarm(max(1, int(ceil(scale_time - time()))))
         try:
             pid, status = os_wait()
-            if WIFEXITED(status) or WIFSIGNALED(status):
-                worker_pids[worker_pids.index(pid)] = 0
+            reap(pid, status)
         except OSError as err:
             if err.errno not in (EINTR, ECHILD):
                 raise
         except KeyboardInterrupt:
             signal_received[0] = SIGINT
             break
+    if scale_func:
+        alarm(0)
     if logger:
         logger.info('Exiting due to %s.' % signum2str(signal_received[0]))
     killpg(0, signal_received[0])
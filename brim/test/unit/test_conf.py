@@ -16,7 +16,10 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 from ConfigParser import Error, SafeConfigParser
+from os.path import exists, join as path_join
+from shutil import rmtree
 from StringIO import StringIO
+from tempfile import mkdtemp
 from unittest import main, TestCase
 from uuid import uuid4
 
@@ -282,5 +285,95 @@ additional_confs = same_file
                 'Files read so far: test.conf same_file same_file'))
 
 
+class TestReadConfCache(TestCase):
+
+    def setUp(self):
+        self.testdir = mkdtemp()
+        self.main_conf = path_join(self.testdir, 'main.conf')
+        self.extra_conf = path_join(self.testdir, 'extra.conf')
+        self.missing_conf = path_join(self.testdir, 'missing.conf')
+        self.cache_path = path_join(self.testdir, 'conf.cache')
+        self._write(
+            self.main_conf,
+            '[brim]\nport = 80\nadditional_confs = %s %s\n\n'
+            '[wsgi]\nworkers = 2\n' % (self.extra_conf, self.missing_conf))
+        self._write(self.extra_conf, '[wsgi]\nworkers = 3\n')
+
+    def tearDown(self):
+        rmtree(self.testdir)
+
+    def _write(self, path, contents):
+        with open(path, 'w') as fp:
+            fp.write(contents)
+
+    def _read_conf_cached(self, conf_files=None):
+        return conf.read_conf(
+            conf_files or [self.main_conf], exit_on_read_exception=False,
+            cache_path=self.cache_path)
+
+    def _read_conf_no_parse(self, conf_files=None):
+        # Only checks whether the cache is used; nothing is saved.
+        with patch.object(conf.SafeConfigParser, 'read') as mock_read, \
+                patch.object(conf, '_save_conf_cache'):
+            mock_read.return_value = []
+            c = self._read_conf_cached(conf_files)
+        return c, mock_read.call_count
+
+    def test_writes_and_reuses_cache(self):
+        c = self._read_conf_cached()
+        self.assertTrue(exists(self.cache_path))
+        self.assertEqual(
+            c.store, {'brim': {'port': '80'}, 'wsgi': {'workers': '3'}})
+        self.assertEqual(c.files, [self.main_conf, self.extra_conf])
+        c2, read_count = self._read_conf_no_parse()
+        self.assertEqual(read_count, 0)
+        self.assertEqual(c2.store, c.store)
+        self.assertEqual(c2.files, c.files)
+
+    def test_no_cache_path(self):
+        conf.read_conf([self.main_conf], exit_on_read_exception=False)
+        self.assertFalse(exists(self.cache_path))
+
+    def test_additional_conf_changed(self):
+        self._read_conf_cached()
+        self._write(self.extra_conf, '[wsgi]\nworkers = 42\n')
+        c, read_count = self._read_conf_no_parse()
+        self.assertEqual(read_count, 1)
+        self.assertEqual(c.store, {})
+        c = self._read_conf_cached()
+        self.assertEqual(c.store['wsgi'], {'workers': '42'})
+        c, read_count = self._read_conf_no_parse()
+        self.assertEqual(read_count, 0)
+        self.assertEqual(c.store['wsgi'], {'workers': '42'})
+
+    def test_missing_conf_appears(self):
+        self._read_conf_cached()
+        self._write(self.missing_conf, '[wsgi]\nworkers = 5\n')
+        c = self._read_conf_cached()
+        self.assertEqual(c.store['wsgi'], {'workers': '5'})
+        self.assertEqual(
+            c.files, [self.main_conf, self.extra_conf, self.missing_conf])
+
+    def test_other_conf_files(self):
+        self._read_conf_cached()
+        c, read_count = self._read_conf_no_parse(
+            [self.main_conf, self.extra_conf])
+        self.assertEqual(read_count, 2)
+
+    def test_corrupt_cache(self):
+        self._write(self.cache_path, 'not a cache')
+        c = self._read_conf_cached()
+        self.assertEqual(c.store['wsgi'], {'workers': '3'})
+        c, read_count = self._read_conf_no_parse()
+        self.assertEqual(read_count, 0)
+        self.assertEqual(c.store['wsgi'], {'workers': '3'})
+
+    def test_unwritable_cache(self):
+        self.cache_path = path_join(self.testdir, 'nodir', 'conf.cache')
+        c = self._read_conf_cached()
+        self.assertEqual(c.store['wsgi'], {'workers': '3'})
+        self.assertFalse(exists(self.cache_path))
+
+
 if __name__ == '__main__':
     main()
@@ -15,6 +15,9 @@ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 See the License for the specific language governing permissions and
 limitations under the License.
 """
+import logging
+import thread
+import threading
 from logging.handlers import SysLogHandler
 from logging import DEBUG, getLogger, INFO, StreamHandler
 from sys import stdout
@@ -166,5 +169,31 @@ class TestGetLogger(TestCase):
         self.assertTrue(handler.stream, stdout)
 
 
+class TestUseOSThreads(TestCase):
+
+    def setUp(self):
+        self.orig_thread = logging.thread
+        self.orig_threading = logging.threading
+        self.orig_lock = logging._lock
+
+    def tearDown(self):
+        logging.thread = self.orig_thread
+        logging.threading = self.orig_threading
+        logging._lock = self.orig_lock
+
+    def test_use_os_threads(self):
+        logger = log.get_logger('route', 'name', 'DEBUG', 'LOG_LOCAL0', True)
+        self.assertTrue(logging.threading is not threading)
+        log.use_os_threads()
+        self.assertTrue(logging.thread is thread)
+        self.assertTrue(logging.threading is threading)
+        os_rlock_type = type(threading.RLock())
+        self.assertTrue(isinstance(logging._lock, os_rlock_type))
+        for handler in logger.logger.handlers:
+            self.assertTrue(isinstance(handler.lock, os_rlock_type))
+            self.assertTrue(isinstance(
+                handler.lock._RLock__block, thread.LockType))
+
+
 if __name__ == '__main__':
     main()
@@ -16,13 +16,22 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 from contextlib import contextmanager
+from os import listdir, stat
+from os.path import abspath, expanduser, join as path_join
 from pickle import dumps as pickle_dumps, loads as pickle_loads
 from json import dumps as json_dumps, loads as json_loads
+from shutil import rmtree
+from socket import AF_INET, create_connection, SHUT_WR, SOCK_DGRAM, socket, \
+    socketpair
+from ssl import SSLError
 from StringIO import StringIO
 from sys import exc_info
+from tempfile import mkdtemp
+from threading import Thread
 from unittest import main, TestCase
 from uuid import uuid4
 
+from eventlet.greenio import GreenSocket
 from mock import mock_open, patch
 
 from brim import server, __version__
@@ -58,6 +67,8 @@ class TestStats(TestCase):
         self.assertEqual(bs.get(0, 'test'), 123)
         bs.incr(0, 'test')
         self.assertEqual(bs.get(0, 'test'), 124)
+        bs.incr(0, 'test', 10)
+        self.assertEqual(bs.get(0, 'test'), 134)
 
         self.assertEqual(bs.get(0, 'test2'), 0)
         bs.set(0, 'test2', 123)
@@ -92,6 +103,8 @@ class TestStats(TestCase):
         self.assertEqual(s.get('test'), 123)
         s.incr('test')
         self.assertEqual(s.get('test'), 124)
+        s.incr('test', 10)
+        self.assertEqual(s.get('test'), 134)
 
         self.assertEqual(s.get('test2'), 0)
         s.set('test2', 123)
@@ -186,6 +199,204 @@ class TestWsgiOutput(TestCase):
         self.assertEqual([c for c in o], ['456', '78', '90'])
 
 
+class TestAppTimer(TestCase):
+
+    def setUp(self):
+        self.now = [100.0]
+        self.time_orig = server.time
+        server.time = lambda: self.now[0]
+        self.stats = server._Stats(server._BucketStats(['0'], {
+            'outer.call_count': 'sum', 'outer.self_usec': 'sum',
+            'inner.call_count': 'sum', 'inner.self_usec': 'sum'}), 0)
+
+    def tearDown(self):
+        server.time = self.time_orig
+
+    def test_app_timer(self):
+        now = self.now
+
+        def inner(env, start_response):
+            now[0] += 0.002
+            start_response('200 OK', [])
+
+            def body():
+                now[0] += 0.003
+                yield 'a'
+                now[0] += 0.004
+                yield 'b'
+
+            return body()
+
+        def outer(env, start_response):
+            now[0] += 0.001
+            body = inner_timer(env, start_response)
+
+            def body_wrapper():
+                for chunk in body:
+                    now[0] += 0.010
+                    yield chunk.upper()
+
+            return body_wrapper()
+
+        inner_timer = server._AppTimer('inner', inner)
+        outer_timer = server._AppTimer('outer', outer)
+        env = {'brim.stats': self.stats}
+        body = outer_timer(env, lambda *a: None)
+        self.assertEqual(self.stats.get('outer.self_usec'), 1000)
+        self.assertEqual(self.stats.get('inner.self_usec'), 2000)
+        self.assertEqual(list(body), ['A', 'B'])
+        self.assertEqual(self.stats.get('outer.call_count'), 1)
+        self.assertEqual(self.stats.get('inner.call_count'), 1)
+        self.assertEqual(self.stats.get('outer.self_usec'), 21000)
+        self.assertEqual(self.stats.get('inner.self_usec'), 9000)
+        # Everything timed is accounted to the outermost level.
+        self.assertEqual(env['brim._app_usec'], 30000)
+
+    def test_app_timer_raises(self):
+
+        def app(env, start_response):
+            self.now[0] += 0.005
+            raise Exception('testing')
+
+        env = {'brim.stats': self.stats}
+        self.assertRaises(
+            Exception, server._AppTimer('inner', app), env, None)
+        self.assertEqual(self.stats.get('inner.call_count'), 1)
+        self.assertEqual(self.stats.get('inner.self_usec'), 5000)
+
+
+class TestThreadPool(TestCase):
+
+    def test_thread_pool(self):
+        calls = []
+        pool = server._ThreadPool(3)
+        self.assertEqual(len(pool._threads), 3)
+        for i in xrange(10):
+            pool.spawn_n(calls.append, i)
+        pool.waitall()
+        self.assertEqual(sorted(calls), range(10))
+        for thread in pool._threads:
+            self.assertFalse(thread.is_alive())
+
+    def test_spawn_n_blocks_when_busy(self):
+        pool = server._ThreadPool(1)
+        self.assertTrue(pool._idle.acquire(False))
+        pool._idle.release()
+        pool.spawn_n(lambda: None)
+        pool.waitall()
+        self.assertTrue(pool._idle.acquire(False))
+        self.assertFalse(pool._idle.acquire(False))
+
+    def test_exception(self):
+        excepthook_calls = []
+
+        def _func():
+            raise Exception('testing')
+
+        excepthook_orig = server.sys.excepthook
+        try:
+            server.sys.excepthook = lambda *a: excepthook_calls.append(a)
+            pool = server._ThreadPool(1)
+            pool.spawn_n(_func)
+            pool.spawn_n(_func)
+            pool.waitall()
+        finally:
+            server.sys.excepthook = excepthook_orig
+        self.assertEqual(len(excepthook_calls), 2)
+        self.assertEqual(str(excepthook_calls[0][1]), 'testing')
+
+
+class TestThreadsWSGIInput(TestCase):
+
+    def test_read(self):
+        inp = server._ThreadsWSGIInput(StringIO('abcdefghij'), 6)
+        self.assertEqual(inp.read(2), 'ab')
+        self.assertEqual(inp.read(), 'cdef')
+        self.assertEqual(inp.read(), '')
+        self.assertEqual(inp.read(2), '')
+        inp = server._ThreadsWSGIInput(StringIO('abcdefghij'), 6)
+        self.assertEqual(inp.read(-1), 'abcdef')
+        inp = server._ThreadsWSGIInput(StringIO('abcdefghij'), 0)
+        self.assertEqual(inp.read(), '')
+        inp.close()
+
+    def test_readline(self):
+        inp = server._ThreadsWSGIInput(StringIO('ab\ncd\nef\ngh'), 7)
+        self.assertEqual(inp.readline(), 'ab\n')
+        self.assertEqual(inp.readline(1), 'c')
+        self.assertEqual(inp.readline(), 'd\n')
+        self.assertEqual(inp.readline(), 'e')
+        self.assertEqual(inp.readline(), '')
+
+    def test_readlines(self):
+        inp = server._ThreadsWSGIInput(StringIO('ab\ncd\nef\ngh'), 8)
+        self.assertEqual(inp.readlines(), ['ab\n', 'cd\n', 'ef'])
+
+
+class TestThreadsWSGIServer(TestCase):
+
+    def _request(self, request, app):
+        sock = socket()
+        sock.bind(('127.0.0.1', 0))
+        sock.listen(1)
+        wsgi_server = server._ThreadsWSGIServer(sock, app, 5)
+        self.assertEqual(wsgi_server.server_port, sock.getsockname()[1])
+        self.assertEqual(wsgi_server.client_timeout, 5)
+        client = create_connection(sock.getsockname())
+        client.settimeout(5)
+        client.sendall(request)
+        client.shutdown(SHUT_WR)
+        conn, addr = sock.accept()
+        thread = Thread(
+            target=wsgi_server.handle_connection, args=(conn, addr))
+        thread.start()
+        response = ''
+        while True:
+            chunk = client.recv(4096)
+            if not chunk:
+                break
+            response += chunk
+        thread.join()
+        client.close()
+        sock.close()
+        return response
+
+    def test_handle_connection(self):
+        envs = []
+
+        def _app(env, start_response):
+            envs.append(env)
+            body = env['wsgi.input'].read()
+            start_response('200 OK', [('Content-Length', str(len(body)))])
+            return [body]
+
+        response = self._request(
+            'PUT /path?a=b HTTP/1.0\r\nContent-Length: 5\r\n\r\nhello', _app)
+        self.assertTrue(response.startswith('HTTP/1.0 200 OK\r\n'))
+        self.assertTrue(response.endswith('\r\n\r\nhello'))
+        self.assertEqual(envs[0]['REQUEST_METHOD'], 'PUT')
+        self.assertEqual(envs[0]['PATH_INFO'], '/path')
+        self.assertEqual(envs[0]['QUERY_STRING'], 'a=b')
+        self.assertEqual(envs[0]['REMOTE_ADDR'], '127.0.0.1')
+
+    def test_handle_connection_no_content_length(self):
+        bodies = []
+
+        def _app(env, start_response):
+            bodies.append(env['wsgi.input'].read())
+            start_response('204 No Content', [])
+            return []
+
+        response = self._request('POST / HTTP/1.0\r\n\r\n', _app)
+        self.assertTrue(response.startswith('HTTP/1.0 204 No Content\r\n'))
+        self.assertEqual(bodies, [''])
+
+    def test_handle_connection_bad_request(self):
+        response = self._request('GET / HTTP/2.0\r\n\r\n', None)
+        self.assertTrue('Error code 505.' in response)
+        self.assertEqual(self._request('', None), '')
+
+
 class TestSendPidSig(TestCase):
 
     def setUp(self):
@@ -395,6 +606,8 @@ class FakeServer(object):
     def __init__(self, no_daemon=False, output=False):
         self.no_daemon = no_daemon
         self.output = output
+        self.handoff_socks = {}
+        self.conf_cache = None
 
 
 class TestSubserver(TestCase):
@@ -631,6 +844,101 @@ class TestSubserver(TestCase):
             str(exc),
             "Could not load function 'pickle.blah' for [test] json_loads.")
 
+    def test_parse_conf_profile(self):
+        ss = self._class(FakeServer(), 'test')
+        ss._parse_conf(Conf(self._get_default_confd()))
+        self.assertEqual(ss.profile_seconds, 30)
+        self.assertEqual(ss.profile_interval, 0.01)
+        self.assertEqual(ss.profile_dir, '/tmp')
+
+        ss = self._class(FakeServer(), 'test')
+        confd = self._get_default_confd()
+        confd.setdefault('brim', {}).update({
+            'profile_seconds': '5', 'profile_interval': '0.5',
+            'profile_dir': '~/profiles'})
+        ss._parse_conf(Conf(confd))
+        self.assertEqual(ss.profile_seconds, 5)
+        self.assertEqual(ss.profile_interval, 0.5)
+        self.assertEqual(ss.profile_dir, expanduser('~/profiles'))
+
+        ss = self._class(FakeServer(), 'test')
+        confd.setdefault('test', {}).update({
+            'profile_seconds': '6', 'profile_interval': '0.1',
+            'profile_dir': '/var/tmp'})
+        ss._parse_conf(Conf(confd))
+        self.assertEqual(ss.profile_seconds, 6)
+        self.assertEqual(ss.profile_interval, 0.1)
+        self.assertEqual(ss.profile_dir, '/var/tmp')
+
+        for option, value in (('profile_seconds', '0'),
+                              ('profile_interval', '0.0')):
+            ss = self._class(FakeServer(), 'test')
+            confd = self._get_default_confd()
+            confd.setdefault('test', {})[option] = value
+            exc = None
+            try:
+                ss._parse_conf(Conf(confd))
+            except Exception as err:
+                exc = err
+            self.assertEqual(
+                str(exc), 'Invalid [test] %s %s.' % (option, value))
+
+    def test_profile_on_sigurg(self):
+        signal_calls = []
+        start_calls = []
+        started = [True]
+
+        class FakeSampler(object):
+
+            def start(self, *args):
+                start_calls.append(args)
+                return started[0]
+
+        tempdir = mkdtemp()
+        signal_orig = server.signal
+        try:
+            server.signal = lambda *a: signal_calls.append(a)
+            ss = self._class(FakeServer(), 'test')
+            ss._parse_conf(Conf(self._get_default_confd()))
+            ss.profile_dir = tempdir
+            ss.sampler = FakeSampler()
+            ss.logger = FakeLogger()
+            ss._profile_on_sigurg()
+            self.assertEqual(len(signal_calls), 1)
+            self.assertEqual(signal_calls[0][0], server.SIGURG)
+            signal_calls[0][1](server.SIGURG, None)
+            self.assertEqual(len(start_calls), 1)
+            self.assertEqual(start_calls[0][0], 30)
+            self.assertEqual(len(ss.logger.info_calls), 1)
+            message = ss.logger.info_calls[0][0]
+            self.assertTrue(message.startswith('Profiling for 30s to '))
+            path = message[len('Profiling for 30s to '):]
+            self.assertTrue(path.startswith(
+                path_join(tempdir, 'test-%d-' % server.getpid())))
+            self.assertTrue(path.endswith('.folded'))
+            # Created by the worker alone, rather than opening whatever
+            # may already be at a predictable path.
+            self.assertEqual(stat(path).st_mode & 0777, 0600)
+            start_calls[0][1]('a;b 1\n')
+            with open(path) as fp:
+                self.assertEqual(fp.read(), 'a;b 1\n')
+
+            started[0] = False
+            signal_calls[0][1](server.SIGURG, None)
+            self.assertEqual(len(start_calls), 2)
+            self.assertEqual(ss.logger.info_calls[1], ('Already profiling.',))
+            self.assertEqual(listdir(tempdir), [path.rsplit('/', 1)[1]])
+
+            ss.profile_dir = path_join(tempdir, 'missing')
+            signal_calls[0][1](server.SIGURG, None)
+            self.assertEqual(len(start_calls), 2)
+            self.assertEqual(len(ss.logger.error_calls), 1)
+            self.assertTrue(ss.logger.error_calls[0][0].startswith(
+                'Could not create profile in %s: ' % ss.profile_dir))
+        finally:
+            server.signal = signal_orig
+            rmtree(tempdir)
+
     def test_privileged_start(self):
         # Just makes sure the method exists [it is just "pass" by default].
         self._class(FakeServer(), 'test')._privileged_start()
@@ -667,6 +975,16 @@ class TestIPSubserver(TestSubserver):
         self.assertEqual(ss.concurrent_per_worker, 1024)
         self.assertEqual(ss.backlog, 4096)
         self.assertEqual(ss.listen_retry, 30)
+        self.assertEqual(ss.reload_batch, 1)
+        self.assertEqual(ss.cpu_affinity, [])
+        self.assertFalse('cpu' in ss.stats_conf)
+        self.assertEqual(ss.max_workers, 0)
+        self.assertEqual(ss.min_workers, 1)
+        self.assertEqual(ss.scale_target, 8)
+        self.assertEqual(ss.scale_interval, 5)
+        self.assertFalse('in_flight' in ss.stats_conf)
+        self.assertEqual(ss.concurrency_model, 'eventlet')
+        self.assertEqual(ss.threads_per_worker, 32)
         self.assertEqual(ss.eventlet_hub, None)
 
         ss.server.no_daemon = True
@@ -910,6 +1228,45 @@ class TestIPSubserver(TestSubserver):
             "Configuration value [test] listen_retry of 'abc' cannot be "
             "converted to int.")
 
+    def test_parse_conf_reload_batch(self):
+        ss = self._class(FakeServer(), 'test')
+        confd = self._get_default_confd()
+        confd.setdefault('brim', {})['reload_batch'] = '3'
+        ss._parse_conf(Conf(confd))
+        self.assertEqual(ss.reload_batch, 3)
+
+        ss = self._class(FakeServer(), 'test')
+        exc = None
+        try:
+            confd = self._get_default_confd()
+            confd.setdefault('brim', {})['reload_batch'] = 'abc'
+            ss._parse_conf(Conf(confd))
+        except SystemExit as err:
+            exc = err
+        self.assertEqual(
+            str(exc),
+            "Configuration value [brim] reload_batch of 'abc' cannot be "
+            "converted to int.")
+
+        ss = self._class(FakeServer(), 'test')
+        confd = self._get_default_confd()
+        confd.setdefault('test', {})['reload_batch'] = '3'
+        ss._parse_conf(Conf(confd))
+        self.assertEqual(ss.reload_batch, 3)
+
+        ss = self._class(FakeServer(), 'test')
+        exc = None
+        try:
+            confd = self._get_default_confd()
+            confd.setdefault('test', {})['reload_batch'] = 'abc'
+            ss._parse_conf(Conf(confd))
+        except SystemExit as err:
+            exc = err
+        self.assertEqual(
+            str(exc),
+            "Configuration value [test] reload_batch of 'abc' cannot be "
+            "converted to int.")
+
     def test_parse_conf_eventlet_hub(self):
         ss = self._class(FakeServer(), 'test')
         confd = self._get_default_confd()
@@ -1006,104 +1363,1445 @@ class TestIPSubserver(TestSubserver):
             "Configuration value [test] workers of 'abc' cannot be converted "
             "to int.")
 
+    def test_parse_conf_max_workers(self):
+        for section in ('brim', 'test'):
+            ss = self._class(FakeServer(), 'test')
+            confd = self._get_default_confd()
+            confd.setdefault(section, {}).update({
+                'workers': '2', 'max_workers': '3', 'min_workers': '2',
+                'scale_target': '4', 'scale_interval': '6'})
+            ss._parse_conf(Conf(confd))
+            self.assertEqual(ss.worker_count, 3)
+            self.assertEqual(ss.worker_names, ['0', '1', '2'])
+            self.assertEqual(ss.min_workers, 2)
+            self.assertEqual(ss.scale_target, 4)
+            self.assertEqual(ss.scale_interval, 6)
+            self.assertEqual(ss.stats_conf['in_flight'], 'sum')
+            self.assertEqual(ss.stats_conf['in_flight_peak'], 'worker')
+
+            ss = self._class(FakeServer(no_daemon=True), 'test')
+            ss._parse_conf(Conf(confd))
+            self.assertEqual(ss.worker_count, 0)
+            self.assertEqual(ss.worker_names, ['0'])
+
+    def test_parse_conf_max_workers_invalid(self):
+        for options, msg in (
+                ({'max_workers': '2', 'min_workers': '0'},
+                 'Invalid [test] min_workers 0; must be from 1 to max_workers '
+                 '2.'),
+                ({'max_workers': '2', 'min_workers': '3'},
+                 'Invalid [test] min_workers 3; must be from 1 to max_workers '
+                 '2.'),
+                ({'scale_target': '0'}, 'Invalid [test] scale_target 0.'),
+                ({'scale_interval': '0'},
+                 'Invalid [test] scale_interval 0.')):
+            ss = self._class(FakeServer(), 'test')
+            exc = None
+            try:
+                confd = self._get_default_confd()
+                confd.setdefault('test', {}).update(options)
+                ss._parse_conf(Conf(confd))
+            except Exception as err:
+                exc = err
+            self.assertEqual(str(exc), msg)
+
+    def test_parse_conf_concurrency_model(self):
+        for section in ('brim', 'test'):
+            ss = self._class(FakeServer(), 'test')
+            confd = self._get_default_confd()
+            confd.setdefault(section, {}).update({
+                'concurrency_model': 'Threads', 'threads_per_worker': '4'})
+            ss._parse_conf(Conf(confd))
+            self.assertEqual(ss.concurrency_model, 'threads')
+            self.assertEqual(ss.threads_per_worker, 4)
 
-class AppWithInvalidInit(object):
+            # The no_daemon mode always uses Eventlet.
+            ss = self._class(FakeServer(no_daemon=True), 'test')
+            ss._parse_conf(Conf(confd))
+            self.assertEqual(ss.concurrency_model, 'eventlet')
+
+        for options, msg in (
+                ({'concurrency_model': 'fibers'},
+                 "Invalid [test] concurrency_model 'fibers'."),
+                ({'threads_per_worker': '0'},
+                 'Invalid [test] threads_per_worker 0.')):
+            ss = self._class(FakeServer(), 'test')
+            exc = None
+            try:
+                confd = self._get_default_confd()
+                confd.setdefault('test', {}).update(options)
+                ss._parse_conf(Conf(confd))
+            except Exception as err:
+                exc = err
+            self.assertEqual(str(exc), msg)
 
-    def __init__(self):
-        pass
+    def test_worker_pool(self):
+        GreenPool_calls = []
+        use_os_threads_calls = []
+        GreenPool_orig = server.GreenPool
+        use_os_threads_orig = server.use_os_threads
+        try:
+            server.GreenPool = lambda **kw: GreenPool_calls.append(kw)
+            server.use_os_threads = lambda: use_os_threads_calls.append(())
+            ss = self._class(FakeServer(), 'test')
+            ss._parse_conf(Conf(self._get_default_confd()))
+            ss._worker_pool()
+            self.assertEqual(GreenPool_calls, [{'size': 1024}])
+            self.assertEqual(use_os_threads_calls, [])
 
+            ss = self._class(FakeServer(), 'test')
+            confd = self._get_default_confd()
+            confd.setdefault('test', {}).update({
+                'concurrency_model': 'threads', 'threads_per_worker': '2'})
+            ss._parse_conf(Conf(confd))
+            ss.sock = socket()
+            pool = ss._worker_pool()
+            pool.waitall()
+        finally:
+            server.GreenPool = GreenPool_orig
+            server.use_os_threads = use_os_threads_orig
+        self.assertEqual(len(GreenPool_calls), 1)
+        self.assertEqual(use_os_threads_calls, [()])
+        self.assertEqual(pool.size, 2)
+        self.assertEqual(ss.sock.gettimeout(), 0.0)
+        ss.sock.close()
+        ss.sock = socket()
+        pool = ss._worker_pool(nonblocking=False)
+        pool.waitall()
+        self.assertEqual(ss.sock.gettimeout(), None)
+        ss.sock.close()
+
+    def test_receive(self):
+        ss = self._class(FakeServer(), 'test')
+        ss._parse_conf(Conf(self._get_default_confd()))
+        self.assertEqual(ss._receive(lambda *a: a, 1, 2), (1, 2))
 
-class AppWithInvalidCall(object):
+    def test_receive_threads(self):
+        ss = self._class(FakeServer(), 'test')
+        confd = self._get_default_confd()
+        confd.setdefault('test', {})['concurrency_model'] = 'threads'
+        ss._parse_conf(Conf(confd))
+        ss.sock = socket(AF_INET, SOCK_DGRAM)
+        ss.sock.bind(('127.0.0.1', 0))
+        client = socket(AF_INET, SOCK_DGRAM)
+        try:
+            client.sendto('one', ss.sock.getsockname())
+            self.assertEqual(
+                ss._receive(ss.sock.recvfrom, 10, server.MSG_DONTWAIT)[0],
+                'one')
+
+            # Another worker taking what was ready just means waiting on.
+            recvfrom_calls = []
+
+            def _recvfrom(*args):
+                recvfrom_calls.append(args)
+                if len(recvfrom_calls) == 1:
+                    ss.sock.recvfrom(*args)
+                    raise server.socket_error(server.EAGAIN, 'testing')
+                return ss.sock.recvfrom(*args)
+
+            client.sendto('two', ss.sock.getsockname())
+            client.sendto('three', ss.sock.getsockname())
+            self.assertEqual(ss._receive(_recvfrom, 10)[0], 'three')
+            self.assertEqual(len(recvfrom_calls), 2)
+
+            def _recvfrom_other(*args):
+                raise server.socket_error(server.EINVAL, 'testing')
+
+            client.sendto('four', ss.sock.getsockname())
+            exc = None
+            try:
+                ss._receive(_recvfrom_other)
+            except Exception as err:
+                exc = err
+            self.assertEqual(str(exc), '[Errno %s] testing' % server.EINVAL)
+
+            ss.draining = True
+            self.assertRaises(
+                server._WorkerDrain, ss._receive, ss.sock.recvfrom, 10)
+        finally:
+            client.close()
+            ss.sock.close()
 
-    def __init__(self, name, conf, next_app):
-        pass
+    def test_profile(self, concurrency_model='eventlet'):
+        sleep_calls = []
+        start_calls = []
 
-    def __call__(self):
-        pass
+        class FakeSampler(object):
 
+            interval = 0.5
+            running = False
 
-class AppWithNoCall(object):
+            def start(self, seconds, done_func):
+                start_calls.append(seconds)
+                if len(start_calls) > 1:
+                    return False
+                self.running = True
+                self.done_func = done_func
+                return True
 
-    def __init__(self, name, conf, next_app):
-        pass
+        def _sleep(seconds):
+            sleep_calls.append(seconds)
+            if len(sleep_calls) == 2:
+                ss.sampler.done_func('a;b 1\n')
+                ss.sampler.running = False
 
+        ss = self._class(FakeServer(), 'test')
+        confd = self._get_default_confd()
+        confd.setdefault('test', {})['concurrency_model'] = concurrency_model
+        ss._parse_conf(Conf(confd))
+        self.assertEqual(ss.profile(5), None)
+        self.assertEqual(start_calls, [])
+        ss.sampler = FakeSampler()
+        sleep_orig = server.sleep
+        time_sleep_orig = server.time_sleep
+        try:
+            if concurrency_model == 'threads':
+                server.time_sleep = _sleep
+            else:
+                server.sleep = _sleep
+            self.assertEqual(ss.profile(5), 'a;b 1\n')
+            self.assertEqual(start_calls, [5])
+            self.assertEqual(sleep_calls, [5, 0.5])
+            self.assertEqual(ss.profile(5), None)
+            self.assertEqual(start_calls, [5, 5])
+        finally:
+            server.sleep = sleep_orig
+            server.time_sleep = time_sleep_orig
 
-class AppWithInvalidParseConf1(object):
+    def test_profile_threads(self):
+        self.test_profile(concurrency_model='threads')
 
-    def __init__(self, name, conf, next_app):
-        pass
+    def test_parse_conf_hub_lag(self):
+        ss = self._class(FakeServer(), 'test')
+        ss._parse_conf(Conf(self._get_default_confd()))
+        self.assertEqual(ss.hub_lag_interval, 0)
+        self.assertEqual(ss.hub_lag_log_threshold, 0)
+        self.assertFalse('hub_lag_max_usec' in ss.stats_conf)
+
+        stats = ('hub_lag_max_usec', 'hub_lag_1ms_count',
+                 'hub_lag_10ms_count', 'hub_lag_100ms_count',
+                 'hub_lag_1s_count')
+        for section in ('brim', 'test'):
+            ss = self._class(FakeServer(), 'test')
+            confd = self._get_default_confd()
+            confd.setdefault(section, {}).update({
+                'hub_lag_interval': '0.5', 'hub_lag_log_threshold': '0.1'})
+            ss._parse_conf(Conf(confd))
+            self.assertEqual(ss.hub_lag_interval, 0.5)
+            self.assertEqual(ss.hub_lag_log_threshold, 0.1)
+            self.assertEqual(
+                [ss.stats_conf.get(s) for s in stats],
+                ['max', 'sum', 'sum', 'sum', 'sum'])
 
-    def __call__(self, env, start_response):
-        pass
+        ss = self._class(FakeServer(), 'test')
+        confd = self._get_default_confd()
+        confd.setdefault('test', {}).update({
+            'hub_lag_interval': '0.5', 'concurrency_model': 'threads'})
+        ss._parse_conf(Conf(confd))
+        self.assertFalse('hub_lag_max_usec' in ss.stats_conf)
 
-    @classmethod
-    def parse_conf(cls):
-        pass
+        for option in ('hub_lag_interval', 'hub_lag_log_threshold'):
+            ss = self._class(FakeServer(), 'test')
+            confd = self._get_default_confd()
+            confd.setdefault('test', {})[option] = '-1'
+            exc = None
+            try:
+                ss._parse_conf(Conf(confd))
+            except Exception as err:
+                exc = err
+            self.assertEqual(str(exc), 'Invalid [test] %s -1.0.' % option)
+
+    def test_start_hub_lag_watch(self):
+        spawn_n_calls = []
+        thread_calls = []
 
+        class FakeThread(object):
 
-class AppWithInvalidParseConf2(object):
+            def __init__(self, **kwargs):
+                thread_calls.append(kwargs)
 
-    parse_conf = 'blah'
+            def start(self):
+                thread_calls.append(('start', self.daemon))
 
-    def __init__(self, name, conf, next_app):
-        pass
+        ss = self._class(FakeServer(), 'test')
+        confd = self._get_default_confd()
+        ss._parse_conf(Conf(confd))
+        ss.worker_id = 0
+        ss.bucket_stats = server._BucketStats(['0'], ss.stats_conf)
+        spawn_n_orig = server.spawn_n
+        Thread_orig = server.Thread
+        try:
+            server.spawn_n = lambda *a: spawn_n_calls.append(a)
+            server.Thread = FakeThread
+            ss._start_hub_lag_watch()
+            self.assertEqual(spawn_n_calls, [])
+            self.assertEqual(thread_calls, [])
+
+            ss.hub_lag_interval = 1
+            ss._start_hub_lag_watch()
+            self.assertEqual(len(spawn_n_calls), 1)
+            self.assertEqual(spawn_n_calls[0][0], ss._watch_hub_lag)
+            self.assertEqual(thread_calls, [])
+
+            ss.hub_lag_log_threshold = 0.1
+            ss._start_hub_lag_watch()
+            self.assertEqual(len(spawn_n_calls), 2)
+            self.assertEqual(thread_calls, [
+                {'target': ss._watch_hub_lag_stack,
+                 'args': (server.get_ident(),)},
+                ('start', True)])
+
+            ss.concurrency_model = 'threads'
+            ss._start_hub_lag_watch()
+            self.assertEqual(len(spawn_n_calls), 2)
+        finally:
+            server.spawn_n = spawn_n_orig
+            server.Thread = Thread_orig
 
-    def __call__(self, env, start_response):
-        pass
+    def test_watch_hub_lag(self):
+        now = [100.0]
+        # Each sleep of 0.5s runs late by the amount given.
+        lags = [0, 0.0005, 0.002, 0.05, 0.25, 2, 0.003]
+        sleep_calls = []
 
+        def _sleep(seconds):
+            sleep_calls.append(seconds)
+            if len(sleep_calls) > len(lags):
+                raise Exception('done')
+            now[0] += seconds + lags[len(sleep_calls) - 1]
+            if len(sleep_calls) == 6:
+                ss._hub_lag_stack = 'f (x.py:1)'
 
-class AppWithNoParseConf(object):
+        ss = self._class(FakeServer(), 'test')
+        confd = self._get_default_confd()
+        confd.setdefault('test', {})['hub_lag_interval'] = '0.5'
+        ss._parse_conf(Conf(confd))
+        ss.logger = FakeLogger()
+        ss._hub_lag_stack = None
+        bucket_stats = server._BucketStats(['0'], ss.stats_conf)
+        stats = server._Stats(bucket_stats, 0)
+        time_orig = server.time
+        sleep_orig = server.sleep
+        exc = None
+        try:
+            server.time = lambda: now[0]
+            server.sleep = _sleep
+            ss._watch_hub_lag(stats)
+        except Exception as err:
+            exc = err
+        finally:
+            server.time = time_orig
+            server.sleep = sleep_orig
+        self.assertEqual(str(exc), 'done')
+        self.assertEqual(sleep_calls, [0.5] * 8)
+        self.assertEqual(stats.get('hub_lag_max_usec'), 2000000)
+        self.assertEqual(stats.get('hub_lag_1ms_count'), 2)
+        self.assertEqual(stats.get('hub_lag_10ms_count'), 1)
+        self.assertEqual(stats.get('hub_lag_100ms_count'), 1)
+        self.assertEqual(stats.get('hub_lag_1s_count'), 1)
+        self.assertEqual(ss.logger.error_calls, [
+            ('Hub blocked 2.000s in: f (x.py:1)',)])
+        self.assertEqual(ss._hub_lag_stack, None)
+        self.assertEqual(ss._hub_lag_beat, now[0])
 
-    def __init__(self, name, conf, next_app):
-        pass
+    def test_watch_hub_lag_stack(self):
+        now = [100.0]
+        sleep_calls = []
+        stacks = []
 
-    def __call__(self, env, start_response):
-        pass
+        def _time_sleep(seconds):
+            sleep_calls.append(seconds)
+            stacks.append(ss._hub_lag_stack)
+            ss._hub_lag_stack = None
+            if len(sleep_calls) > 6:
+                raise Exception('done')
+            now[0] += 0.25
 
+        ss = self._class(FakeServer(), 'test')
+        ss._parse_conf(Conf(self._get_default_confd()))
+        ss.hub_lag_interval = 0.5
+        ss.hub_lag_log_threshold = 0.5
+        ss._hub_lag_beat = 100.0
+        ss._hub_lag_stack = None
+        time_orig = server.time
+        time_sleep_orig = server.time_sleep
+        exc = None
+        try:
+            server.time = lambda: now[0]
+            server.time_sleep = _time_sleep
+            ss._watch_hub_lag_stack(server.get_ident())
+        except Exception as err:
+            exc = err
+        finally:
+            server.time = time_orig
+            server.time_sleep = time_sleep_orig
+        self.assertEqual(str(exc), 'done')
+        self.assertEqual(sleep_calls, [0.25] * 7)
+        # Noted once the beat is a second old and only once per beat.
+        self.assertEqual(stacks[:4], [None, None, None, None])
+        self.assertTrue(stacks[4].startswith('_watch_hub_lag_stack ('))
+        self.assertTrue(' < test_watch_hub_lag_stack (' in stacks[4])
+        self.assertEqual(stacks[5:], [None, None])
+
+    @contextmanager
+    def _threads_worker(self, sock):
+        """Yields a threads subserver whose worker can run in-process."""
+        setproctitle_orig = server.setproctitle
+        use_hub_orig = server.use_hub
+        signal_orig = server.signal
+        use_os_threads_orig = server.use_os_threads
+        try:
+            server.setproctitle = None
+            server.use_hub = lambda *a: None
+            server.signal = lambda *a: None
+            server.use_os_threads = lambda: None
+            ss = self._class(FakeServer(output=True), 'test')
+            confd = self._get_default_confd()
+            confd.setdefault('test', {}).update({
+                'concurrency_model': 'threads', 'threads_per_worker': '2'})
+            ss._parse_conf(Conf(confd))
+            ss.logger = FakeLogger()
+            ss.bucket_stats = server._BucketStats(['0'], ss.stats_conf)
+            sock.bind(('127.0.0.1', 0))
+            ss.sock = sock
+            yield ss
+        finally:
+            server.setproctitle = setproctitle_orig
+            server.use_hub = use_hub_orig
+            server.signal = signal_orig
+            server.use_os_threads = use_os_threads_orig
+            sock.close()
 
-class AppWithParseConf(object):
+    def _scale_subserver(self, peaks, in_flights=None):
+        ss = self._class(FakeServer(), 'test')
+        confd = self._get_default_confd()
+        confd.setdefault('test', {}).update({
+            'max_workers': '4', 'min_workers': '2', 'scale_target': '3',
+            'concurrent_per_worker': '5'})
+        ss._parse_conf(Conf(confd))
+        ss.bucket_stats = server._BucketStats(ss.worker_names, ss.stats_conf)
+        for worker_id, peak in enumerate(peaks):
+            ss.bucket_stats.set(worker_id, 'in_flight_peak', peak)
+        for worker_id, in_flight in enumerate(in_flights or []):
+            ss.bucket_stats.set(worker_id, 'in_flight', in_flight)
+        return ss
 
-    def __init__(self, name, conf, next_app):
-        pass
+    def test_scale(self):
+        ss = self._scale_subserver([])
+        self.assertEqual(ss._scale(0), 2)
+        # Enough workers to average scale_target in flight.
+        ss = self._scale_subserver([4, 4])
+        self.assertEqual(ss._scale(2), 3)
+        ss = self._scale_subserver([9, 9])
+        self.assertEqual(ss._scale(2), 4)
+        # Kept from min_workers to max_workers.
+        ss = self._scale_subserver([0, 0])
+        self.assertEqual(ss._scale(2), 2)
+        ss = self._scale_subserver([9, 9, 9, 9])
+        self.assertEqual(ss._scale(4), 4)
+        # Retired one at a time.
+        ss = self._scale_subserver([1, 0, 0, 0])
+        self.assertEqual(ss._scale(4), 3)
+        # A saturated worker means another is wanted.
+        ss = self._scale_subserver([5, 0])
+        self.assertEqual(ss._scale(2), 3)
+
+    def test_scale_active_workers_only(self):
+        # Worker ids beyond those active may hold the stats of retired or
+        # killed workers and aren't counted.
+        ss = self._scale_subserver([1, 1, 9, 9])
+        self.assertEqual(ss._scale(2), 2)
+        self.assertEqual(ss.bucket_stats.get(2, 'in_flight_peak'), 9)
+
+    def test_scale_retire_resets(self):
+        ss = self._scale_subserver([1, 0, 0, 4], [1, 0, 0, 2])
+        self.assertEqual(ss._scale(4), 3)
+        self.assertEqual(ss.bucket_stats.get(3, 'in_flight'), 0)
+        self.assertEqual(ss.bucket_stats.get(3, 'in_flight_peak'), 0)
+        self.assertEqual(ss.bucket_stats.get(0, 'in_flight'), 1)
+        self.assertEqual(ss.bucket_stats.get(0, 'in_flight_peak'), 1)
+
+    def test_scale_threads_saturated(self):
+        # With threads, threads_per_worker is the limit of each worker.
+        ss = self._scale_subserver([2, 0])
+        ss.concurrency_model = 'threads'
+        ss.threads_per_worker = 2
+        self.assertEqual(ss._scale(2), 3)
+        ss = self._scale_subserver([5, 0])
+        ss.concurrency_model = 'threads'
+        ss.threads_per_worker = 32
+        self.assertEqual(ss._scale(2), 2)
+
+    def test_scale_resets_peaks(self):
+        ss = self._scale_subserver([5, 6], [1, 2])
+        ss._scale(2)
+        self.assertEqual(ss.bucket_stats.get(0, 'in_flight_peak'), 1)
+        self.assertEqual(ss.bucket_stats.get(1, 'in_flight_peak'), 2)
+
+    def test_note_in_flight(self):
+        ss = self._scale_subserver([])
+        ss.worker_id = 1
+        ss._note_in_flight(1)
+        ss._note_in_flight(1)
+        ss._note_in_flight(-1)
+        self.assertEqual(ss.bucket_stats.get(1, 'in_flight'), 1)
+        self.assertEqual(ss.bucket_stats.get(1, 'in_flight_peak'), 2)
+        ss._note_in_flight(-1)
+        ss._note_in_flight(-1)
+        self.assertEqual(ss.bucket_stats.get(1, 'in_flight'), 0)
+        # Not tracked outside of workers.
+        ss.worker_id = -1
+        ss._note_in_flight(1)
+        self.assertEqual(ss.bucket_stats.get(0, 'in_flight'), 0)
+
+    def test_reset_in_flight(self):
+        ss = self._scale_subserver([4], in_flights=[3])
+        ss.worker_id = 0
+        ss._reset_in_flight()
+        self.assertEqual(ss.bucket_stats.get(0, 'in_flight'), 0)
+        self.assertEqual(ss.bucket_stats.get(0, 'in_flight_peak'), 0)
+        # Not tracked outside of workers.
+        ss = self._scale_subserver([4], in_flights=[3])
+        ss.worker_id = -1
+        ss._reset_in_flight()
+        self.assertEqual(ss.bucket_stats.get(0, 'in_flight'), 3)
+
+    def test_wrap_handler(self):
+        in_flight = []
+        ss = self._scale_subserver([])
+        ss.worker_id = 0
 
-    def __call__(self, env, start_response):
-        pass
+        def _handler(*args):
+            in_flight.append((args, ss.bucket_stats.get(0, 'in_flight')))
+            if args:
+                raise Exception('testing')
 
-    @classmethod
-    def parse_conf(cls, name, conf):
-        return {'ok': True}
+        handler = ss._wrap_handler(_handler)
+        handler()
+        exc = None
+        try:
+            handler(1)
+        except Exception as err:
+            exc = err
+        self.assertEqual(str(exc), 'testing')
+        self.assertEqual(in_flight, [((), 1), ((1,), 1)])
+        self.assertEqual(ss.bucket_stats.get(0, 'in_flight'), 0)
 
+        ss = self._class(FakeServer(), 'test')
+        ss._parse_conf(Conf(self._get_default_confd()))
+        self.assertTrue(ss._wrap_handler(_handler) is _handler)
 
-class AppWithInvalidStatsConf1(object):
+    def test_wrap_handler_recycle(self):
+        check_calls = []
+        ss = self._class(FakeServer(), 'test')
+        confd = self._get_default_confd()
+        confd.setdefault('test', {})['max_requests_per_worker'] = '10'
+        ss._parse_conf(Conf(confd))
+        ss._check_recycle = lambda *args: check_calls.append(args)
 
-    def __init__(self, name, conf, next_app):
-        pass
+        def _handler(*args):
+            if args[0]:
+                raise Exception('testing')
 
-    def __call__(self, env, start_response):
-        pass
+        handler = ss._wrap_handler(_handler)
+        handler(0, 'datagram')
+        exc = None
+        try:
+            handler(1, 'datagram')
+        except Exception as err:
+            exc = err
+        self.assertEqual(str(exc), 'testing')
+        self.assertEqual(check_calls, [(1,), (1,)])
+        del check_calls[:]
+        handler = ss._wrap_handler(_handler, batch=True)
+        handler(0, ['one', 'two', 'three'])
+        self.assertEqual(check_calls, [(3,)])
 
-    @classmethod
-    def stats_conf(cls):
-        pass
+        ss = self._class(FakeServer(no_daemon=True), 'test')
+        ss._parse_conf(Conf(confd))
+        self.assertTrue(ss._wrap_handler(_handler) is _handler)
 
+    def test_start_recycle(self):
+        randint_calls = []
 
-class AppWithInvalidStatsConf2(object):
+        def _randint(*args):
+            randint_calls.append(args)
+            return 7
 
-    stats_conf = 'blah'
+        ss = self._class(FakeServer(), 'test')
+        confd = self._get_default_confd()
+        confd.setdefault('test', {}).update(
+            {'max_requests_per_worker': '100', 'max_requests_jitter': '10'})
+        ss._parse_conf(Conf(confd))
+        ss.worker_request_count = 5
+        randint_orig = server.randint
+        try:
+            server.randint = _randint
+            ss._start_recycle()
+        finally:
+            server.randint = randint_orig
+        self.assertEqual(randint_calls, [(0, 10)])
+        self.assertEqual(ss.worker_request_limit, 107)
+        self.assertEqual(ss.worker_request_count, 0)
 
-    def __init__(self, name, conf, next_app):
-        pass
+        ss = self._class(FakeServer(no_daemon=True), 'test')
+        ss._parse_conf(Conf(confd))
+        ss._start_recycle()
+        self.assertEqual(ss.worker_request_limit, 0)
 
-    def __call__(self, env, start_response):
-        pass
+    def test_recycle_stats(self):
+        ss = self._class(FakeServer(), 'test')
+        self.assertEqual(ss.stats_conf.get('recycle_requests_count'), 'sum')
+        self.assertEqual(ss.stats_conf.get('recycle_rss_count'), 'sum')
 
+    def test_parse_conf_recycle_limits(self):
+        for option in ('max_requests_per_worker', 'max_requests_jitter',
+                       'max_worker_rss'):
+            for section in ('brim', 'test'):
+                ss = self._class(FakeServer(), 'test')
+                confd = self._get_default_confd()
+                confd.setdefault(section, {})[option] = '123'
+                ss._parse_conf(Conf(confd))
+                self.assertEqual(getattr(ss, option), 123)
+
+                ss = self._class(FakeServer(), 'test')
+                exc = None
+                try:
+                    confd = self._get_default_confd()
+                    confd.setdefault(section, {})[option] = 'abc'
+                    ss._parse_conf(Conf(confd))
+                except SystemExit as err:
+                    exc = err
+                self.assertEqual(
+                    str(exc),
+                    "Configuration value [%s] %s of 'abc' cannot be "
+                    "converted to int." % (section, option))
 
-class AppWithNoStatsConf(object):
+    def _check_recycle(self, requests=1, maxrss=1000, no_daemon=False,
+                       draining=False, **confd_test):
+        ss = self._class(FakeServer(no_daemon=no_daemon), 'test')
+        confd = self._get_default_confd()
+        confd.setdefault('test', {}).update(confd_test)
+        ss._parse_conf(Conf(confd))
+        ss.logger = FakeLogger()
+        ss.bucket_stats = server._BucketStats(['0'], ss.stats_conf)
+        ss.worker_id = 0
+        ss.draining = draining
+        if ss.max_requests_per_worker:
+            ss.worker_request_limit = ss.max_requests_per_worker
+        drain_calls = []
+        getrusage_calls = []
+
+        def _getrusage(*args):
+            getrusage_calls.append(args)
+            rusage = PropertyObject()
+            rusage.ru_maxrss = maxrss
+            return rusage
+
+        ss._drain = lambda: drain_calls.append(True)
+        getrusage_orig = server.getrusage
+        try:
+            server.getrusage = _getrusage
+            for _junk in xrange(requests):
+                ss._check_recycle()
+        finally:
+            server.getrusage = getrusage_orig
+        return ss, drain_calls, getrusage_calls
+
+    def test_check_recycle_no_limits(self):
+        ss, drain_calls, getrusage_calls = self._check_recycle(requests=10)
+        self.assertEqual(ss.worker_request_count, 10)
+        self.assertEqual(drain_calls, [])
+        self.assertEqual(getrusage_calls, [])
+        self.assertEqual(ss.bucket_stats.get(0, 'recycle_requests_count'), 0)
+        self.assertEqual(ss.bucket_stats.get(0, 'recycle_rss_count'), 0)
+
+    def test_check_recycle_requests(self):
+        ss, drain_calls, getrusage_calls = self._check_recycle(
+            requests=2, max_requests_per_worker='3')
+        self.assertEqual(drain_calls, [])
+        ss, drain_calls, getrusage_calls = self._check_recycle(
+            requests=3, max_requests_per_worker='3')
+        self.assertEqual(drain_calls, [True])
+        self.assertEqual(ss.bucket_stats.get(0, 'recycle_requests_count'), 1)
+        self.assertEqual(ss.bucket_stats.get(0, 'recycle_rss_count'), 0)
+        self.assertEqual(ss.logger.info_calls, [
+            ('Recycling worker 0 due to max_requests_per_worker after 3 '
+             'requests.',)])
+
+    def test_check_recycle_rss(self):
+        ss, drain_calls, getrusage_calls = self._check_recycle(
+            maxrss=1000, max_worker_rss='1024001')
+        self.assertEqual(drain_calls, [])
+        self.assertEqual(getrusage_calls, [(server.RUSAGE_SELF,)])
+        ss, drain_calls, getrusage_calls = self._check_recycle(
+            maxrss=1000, max_worker_rss='1024000')
+        self.assertEqual(drain_calls, [True])
+        self.assertEqual(ss.bucket_stats.get(0, 'recycle_requests_count'), 0)
+        self.assertEqual(ss.bucket_stats.get(0, 'recycle_rss_count'), 1)
+        self.assertEqual(ss.logger.info_calls, [
+            ('Recycling worker 0 due to max_worker_rss after 1 requests.',)])
+
+    def test_check_recycle_no_daemon(self):
+        ss, drain_calls, getrusage_calls = self._check_recycle(
+            requests=3, no_daemon=True, max_requests_per_worker='1',
+            max_worker_rss='1')
+        self.assertEqual(ss.worker_request_count, 0)
+        self.assertEqual(drain_calls, [])
+        self.assertEqual(getrusage_calls, [])
+
+    def test_check_recycle_already_draining(self):
+        ss, drain_calls, getrusage_calls = self._check_recycle(
+            requests=3, draining=True, max_requests_per_worker='1',
+            max_worker_rss='1')
+        self.assertEqual(drain_calls, [])
+        self.assertEqual(ss.bucket_stats.get(0, 'recycle_requests_count'), 0)
+
+    def test_check_recycle_batch(self):
+        ss, drain_calls, getrusage_calls = self._check_recycle(
+            requests=0, max_requests_per_worker='3')
+        ss._check_recycle(2)
+        self.assertEqual(drain_calls, [])
+        ss._check_recycle(2)
+        self.assertEqual(drain_calls, [True])
+        self.assertEqual(ss.worker_request_count, 4)
+
+    def _reload(self, confd, files=['ok.conf'], orig_confd=None):
+        read_conf_calls = []
+
+        def _read_conf(*args, **kwargs):
+            read_conf_calls.append((args, kwargs))
+            return Conf(confd, files=files)
+
+        read_conf_orig = server.read_conf
+        get_logger_orig = server.get_logger
+        try:
+            server.read_conf = _read_conf
+            server.get_logger = lambda *a: FakeLogger()
+            ss = self._class(FakeServer(), 'test')
+            ss.server.conf_files = ['ok.conf']
+            ss._parse_conf(Conf(orig_confd or self._get_default_confd()))
+            ss.sock = 'sock'
+            ss.bucket_stats = 'bucket_stats'
+            ss.worker_id = -1
+            ss.start_time = 1
+            ss.handed_off = True
+            ss.ssl_context = 'ssl_context'
+            stats_conf = ss.stats_conf
+            exc = None
+            self.reload_result = None
+            try:
+                self.reload_result = ss._reload()
+            except Exception as err:
+                exc = err
+        finally:
+            server.read_conf = read_conf_orig
+            server.get_logger = get_logger_orig
+        self.assertEqual(
+            read_conf_calls,
+            [((['ok.conf'],),
+              {'exit_on_read_exception': False, 'cache_path': None})])
+        self.assertEqual(ss.sock, 'sock')
+        self.assertEqual(ss.bucket_stats, 'bucket_stats')
+        self.assertEqual(ss.worker_id, -1)
+        self.assertEqual(ss.start_time, 1)
+        self.assertTrue(ss.handed_off)
+        self.assertEqual(ss.ssl_context, 'ssl_context')
+        self.assertTrue(ss.stats_conf is stats_conf)
+        return ss, exc
 
-    def __init__(self, name, conf, next_app):
-        pass
+    def test_reload(self):
+        confd = self._get_default_confd()
+        confd.setdefault('test', {})['concurrent_per_worker'] = '123'
+        ss, exc = self._reload(confd)
+        self.assertEqual(exc, None)
+        self.assertEqual(ss.concurrent_per_worker, 123)
+        self.assertEqual(ss.logger.__class__.__name__, 'FakeLogger')
 
-    def __call__(self, env, start_response):
+    def test_reload_no_conf(self):
+        confd = self._get_default_confd()
+        confd.setdefault('test', {})['concurrent_per_worker'] = '123'
+        ss, exc = self._reload(confd, files=[])
+        self.assertEqual(str(exc), 'No configuration found.')
+        self.assertEqual(ss.concurrent_per_worker, 1024)
+
+    def test_reload_invalid_conf(self):
+        confd = self._get_default_confd()
+        confd.setdefault('test', {})['concurrent_per_worker'] = 'abc'
+        ss, exc = self._reload(confd)
+        self.assertEqual(
+            str(exc),
+            "Configuration value [test] concurrent_per_worker of 'abc' cannot "
+            "be converted to int.")
+        self.assertEqual(ss.concurrent_per_worker, 1024)
+
+    def test_reload_cannot_change_port(self):
+        confd = self._get_default_confd()
+        confd.setdefault('test', {}).update(
+            {'port': '1234', 'concurrent_per_worker': '123'})
+        ss, exc = self._reload(confd)
+        self.assertEqual(
+            str(exc),
+            'Cannot change [test] port with a reload; a restart is required.')
+        self.assertEqual(ss.port, 80)
+        self.assertEqual(ss.concurrent_per_worker, 1024)
+
+    def test_reload_cannot_change_max_workers(self):
+        confd = self._get_default_confd()
+        confd.setdefault('test', {}).update({'max_workers': '1'})
+        ss, exc = self._reload(confd)
+        self.assertEqual(
+            str(exc),
+            'Cannot change [test] max_workers with a reload; a restart is '
+            'required.')
+
+    def test_reload_cannot_change_concurrency_model(self):
+        confd = self._get_default_confd()
+        confd.setdefault('test', {}).update({'concurrency_model': 'threads'})
+        ss, exc = self._reload(confd)
+        self.assertEqual(
+            str(exc),
+            'Cannot change [test] concurrency_model with a reload; a restart '
+            'is required.')
+
+    def test_reload_cannot_change_cpu_affinity(self):
+        confd = self._get_default_confd()
+        confd.setdefault('test', {})['cpu_affinity'] = '0'
+        ss, exc = self._reload(confd)
+        self.assertEqual(
+            str(exc),
+            'Cannot change [test] cpu_affinity with a reload; a restart is '
+            'required.')
+
+    def test_reload_cannot_change_workers(self):
+        confd = self._get_default_confd()
+        confd.setdefault('test', {})['workers'] = '2'
+        ss, exc = self._reload(confd)
+        self.assertEqual(
+            str(exc),
+            'Cannot change [test] worker_count with a reload; a restart is '
+            'required.')
+
+    def test_reload_cannot_change_socket_options(self):
+        confd = self._get_default_confd()
+        confd.setdefault('test', {})['socket_rcvbuf'] = '65536'
+        ss, exc = self._reload(confd)
+        self.assertEqual(
+            str(exc),
+            'Cannot change [test] socket_options with a reload; a restart is '
+            'required.')
+
+    def test_reload_cannot_change_ssl_options(self):
+        confd = self._get_default_confd()
+        confd.setdefault('test', {})['ssl_ciphers'] = 'HIGH'
+        ss, exc = self._reload(confd)
+        if self._class not in (server.TCPSubserver, server.WSGISubserver):
+            self.assertEqual(exc, None)
+        else:
+            self.assertEqual(
+                str(exc),
+                'Cannot change [test] ssl_ciphers with a reload; a restart '
+                'is required.')
+
+    def test_parse_ssl_options(self):
+        ss = self._class(FakeServer(), 'test')
+        ss._parse_conf(Conf(self._get_default_confd()))
+        ss._parse_ssl_options(Conf(self._get_default_confd()))
+        self.assertEqual(ss.ssl_ciphers, None)
+        self.assertEqual(ss.ssl_alpn_protocols, None)
+        self.assertTrue(ss.ssl_session_tickets)
+        self.assertFalse('ssl_handshake_count' in ss.stats_conf)
+        for section in ('brim', 'test'):
+            ss = self._class(FakeServer(), 'test')
+            confd = self._get_default_confd()
+            confd.setdefault(section, {}).update({
+                'certfile': 'cert', 'keyfile': 'key', 'ssl_ciphers': 'HIGH',
+                'ssl_alpn_protocols': 'h2, http/1.1,',
+                'ssl_session_tickets': 'no'})
+            ss._parse_conf(Conf(confd))
+            ss._parse_ssl_options(Conf(confd))
+            self.assertEqual(ss.ssl_ciphers, 'HIGH')
+            self.assertEqual(ss.ssl_alpn_protocols, ['h2', 'http/1.1'])
+            self.assertFalse(ss.ssl_session_tickets)
+            self.assertEqual(ss.ssl_handshake_timeout, 10)
+            for name in ('ssl_handshake_count', 'ssl_handshake_failure_count',
+                         'ssl_handshake_timeout_count', 'ssl_handshake_usec',
+                         'ssl_session_hit_count'):
+                self.assertEqual(ss.stats_conf.get(name), 'sum')
+        for value, result in (('0', 0), ('3', 3), ('-1', None)):
+            ss = self._class(FakeServer(), 'test')
+            confd = self._get_default_confd()
+            confd.setdefault('test', {})['ssl_handshake_timeout'] = value
+            exc = None
+            try:
+                ss._parse_conf(Conf(confd))
+                ss._parse_ssl_options(Conf(confd))
+            except Exception as err:
+                exc = err
+            if result is None:
+                self.assertEqual(
+                    str(exc), 'Invalid [test] ssl_handshake_timeout -1.')
+            else:
+                self.assertEqual(ss.ssl_handshake_timeout, result)
+
+    def test_load_ssl_context(self):
+        get_ssl_context_calls = []
+
+        def _get_ssl_context(*args, **kwargs):
+            get_ssl_context_calls.append((args, kwargs))
+            return 'context'
+
+        orig_get_ssl_context = server.get_ssl_context
+        try:
+            server.get_ssl_context = _get_ssl_context
+            ss = self._class(FakeServer(), 'test')
+            ss._parse_conf(Conf(self._get_default_confd()))
+            ss._load_ssl_context()
+            self.assertEqual(ss.ssl_context, None)
+            self.assertEqual(get_ssl_context_calls, [])
+            confd = self._get_default_confd()
+            confd.setdefault('test', {}).update({
+                'certfile': 'cert', 'keyfile': 'key',
+                'ssl_alpn_protocols': 'http/1.1'})
+            ss._parse_conf(Conf(confd))
+            ss._parse_ssl_options(Conf(confd))
+            ss._load_ssl_context()
+            self.assertEqual(ss.ssl_context, 'context')
+            self.assertEqual(get_ssl_context_calls, [(('cert', 'key'), {
+                'ciphers': None, 'alpn_protocols': ['http/1.1'],
+                'session_tickets': True, 'style': 'eventlet'})])
+            server.get_ssl_context = lambda *a, **kw: open('/no/such/file')
+            exc = None
+            try:
+                ss._load_ssl_context()
+            except Exception as err:
+                exc = err
+            self.assertEqual(
+                str(exc),
+                "Could not load [test] SSL context: [Errno 2] No such file "
+                "or directory: '/no/such/file'")
+        finally:
+            server.get_ssl_context = orig_get_ssl_context
+
+    def test_ssl_handshake(self):
+        calls = []
+
+        class SSLSock(object):
+
+            def __init__(self, error=None):
+                self.error = error
+
+            def do_handshake(self):
+                calls.append('do_handshake')
+                if self.error:
+                    raise self.error
+
+            def settimeout(self, timeout):
+                calls.append(('settimeout', timeout))
+
+            def close(self):
+                calls.append('close')
+
+        class Sock(object):
+
+            def gettimeout(self):
+                return 60
+
+            def settimeout(self, timeout):
+                calls.append(('settimeout', timeout))
+
+            def close(self):
+                calls.append('close')
+
+        class Context(object):
+
+            def __init__(self, error=None):
+                self.error = error
+
+            def wrap_socket(self, sock, **kwargs):
+                calls.append(kwargs)
+                return SSLSock(self.error)
+
+            def session_stats(self):
+                return {'hits': 7}
+
+        ss = self._class(FakeServer(), 'test')
+        ss.stats_conf.update({
+            'ssl_handshake_count': 'sum', 'ssl_handshake_failure_count': 'sum',
+            'ssl_handshake_usec': 'sum', 'ssl_session_hit_count': 'sum',
+            'ssl_handshake_timeout_count': 'sum'})
+        bs = server._BucketStats(['0'], ss.stats_conf)
+        stats = server._Stats(bs, 0)
+        times = [10, 10.25]
+        orig_time = server.time
+        try:
+            server.time = lambda: times.pop(0)
+            ss.ssl_context = Context()
+            ss.ssl_handshake_timeout = 5
+            sock = ss._ssl_handshake(Sock(), stats)
+            self.assertEqual(sock.__class__.__name__, 'SSLSock')
+            self.assertEqual(calls, [
+                ('settimeout', 5),
+                {'server_side': True, 'do_handshake_on_connect': False},
+                'do_handshake', ('settimeout', 60)])
+            self.assertEqual(stats.get('ssl_handshake_count'), 1)
+            self.assertEqual(stats.get('ssl_handshake_usec'), 250000)
+            self.assertEqual(stats.get('ssl_session_hit_count'), 7)
+            self.assertEqual(stats.get('ssl_handshake_failure_count'), 0)
+            del calls[:]
+            times[:] = [11, 12]
+            ss.ssl_context = Context(server.socket_error('bad handshake'))
+            self.assertEqual(ss._ssl_handshake(Sock(), stats), None)
+            self.assertEqual(calls[2:], ['do_handshake', 'close'])
+            self.assertEqual(stats.get('ssl_handshake_count'), 1)
+            self.assertEqual(stats.get('ssl_handshake_failure_count'), 1)
+            self.assertEqual(stats.get('ssl_handshake_timeout_count'), 0)
+            del calls[:]
+            times[:] = [11, 16]
+            ss.ssl_context = Context(SSLError('timed out'))
+            self.assertEqual(ss._ssl_handshake(Sock(), stats), None)
+            self.assertEqual(stats.get('ssl_handshake_failure_count'), 2)
+            self.assertEqual(stats.get('ssl_handshake_timeout_count'), 1)
+            del calls[:]
+            times[:] = [11]
+            ss.ssl_handshake_timeout = 0
+            ss.ssl_context = Context(server.socket_error('bad handshake'))
+            self.assertEqual(ss._ssl_handshake(Sock(), stats), None)
+            self.assertEqual(calls[1:], ['do_handshake', 'close'])
+            self.assertEqual(stats.get('ssl_handshake_failure_count'), 3)
+            self.assertEqual(stats.get('ssl_handshake_timeout_count'), 1)
+        finally:
+            server.time = orig_time
+
+    def test_ssl_handshake_usec_single_update(self):
+        # The time is added with one incr so concurrent handshakes with
+        # the threads concurrency_model can't lose each other's updates.
+        calls = []
+
+        class Stats(object):
+
+            def get(self, name):
+                calls.append(('get', name))
+                return 0
+
+            def set(self, name, value):
+                calls.append(('set', name, value))
+
+            def incr(self, name, amount=1):
+                calls.append(('incr', name, amount))
+
+        class SSLSock(object):
+
+            def do_handshake(self):
+                pass
+
+            def settimeout(self, timeout):
+                pass
+
+        class Sock(object):
+
+            def gettimeout(self):
+                return 60
+
+            def settimeout(self, timeout):
+                pass
+
+        class Context(object):
+
+            def wrap_socket(self, sock, **kwargs):
+                return SSLSock()
+
+            def session_stats(self):
+                return {'hits': 7}
+
+        ss = self._class(FakeServer(), 'test')
+        ss.ssl_context = Context()
+        ss.ssl_handshake_timeout = 5
+        times = [10, 10.25]
+        orig_time = server.time
+        try:
+            server.time = lambda: times.pop(0)
+            ss._ssl_handshake(Sock(), Stats())
+        finally:
+            server.time = orig_time
+        self.assertEqual(calls, [
+            ('incr', 'ssl_handshake_count', 1),
+            ('incr', 'ssl_handshake_usec', 250000),
+            ('set', 'ssl_session_hit_count', 7)])
+
+    def test_parse_conf_socket_options(self):
+        ss = self._class(FakeServer(), 'test')
+        ss._parse_conf(Conf(self._get_default_confd()))
+        self.assertEqual(ss.socket_options, {})
+        self.assertFalse('socket_rcvbuf' in ss.stats_conf)
+        for option in ('socket_rcvbuf', 'socket_sndbuf', 'socket_busy_poll'):
+            for section in ('brim', 'test'):
+                ss = self._class(FakeServer(), 'test')
+                confd = self._get_default_confd()
+                confd.setdefault(section, {})[option] = '123'
+                ss._parse_conf(Conf(confd))
+                self.assertEqual(ss.socket_options, {option: 123})
+                self.assertEqual(ss.stats_conf.get(option), 'max')
+
+                ss = self._class(FakeServer(), 'test')
+                exc = None
+                try:
+                    confd = self._get_default_confd()
+                    confd.setdefault(section, {})[option] = '-1'
+                    ss._parse_conf(Conf(confd))
+                except Exception as err:
+                    exc = err
+                self.assertEqual(
+                    str(exc), 'Invalid [test] %s -1.' % option)
+
+    def test_tune_socket(self):
+        tune_socket_calls = []
+
+        def _tune_socket(*args, **kwargs):
+            tune_socket_calls.append((args, kwargs))
+            return {'socket_rcvbuf': 246}
+
+        ss = self._class(FakeServer(), 'test')
+        confd = self._get_default_confd()
+        confd.setdefault('test', {})['socket_rcvbuf'] = '123'
+        ss._parse_conf(Conf(confd))
+        ss.sock = 'sock'
+        tune_socket_orig = server.tune_socket
+        try:
+            server.tune_socket = _tune_socket
+            ss._tune_socket()
+        finally:
+            server.tune_socket = tune_socket_orig
+        self.assertEqual(
+            tune_socket_calls, [(('sock',), {'socket_rcvbuf': 123})])
+        self.assertEqual(ss.socket_granted, {'socket_rcvbuf': 246})
+
+    def test_tune_socket_fails(self):
+
+        def _tune_socket(*args, **kwargs):
+            raise server.socket_error('testing')
+
+        ss = self._class(FakeServer(), 'test')
+        ss._parse_conf(Conf(self._get_default_confd()))
+        ss.sock = 'sock'
+        exc = None
+        tune_socket_orig = server.tune_socket
+        try:
+            server.tune_socket = _tune_socket
+            ss._tune_socket()
+        except Exception as err:
+            exc = err
+        finally:
+            server.tune_socket = tune_socket_orig
+        self.assertEqual(str(exc), 'Could not tune [test] socket: testing')
+
+    def test_start_socket_granted(self):
+        ss = self._class(FakeServer(), 'test')
+        confd = self._get_default_confd()
+        confd.setdefault('test', {}).update(
+            {'socket_rcvbuf': '123', 'workers': '2'})
+        ss._parse_conf(Conf(confd))
+        ss.socket_granted = {'socket_rcvbuf': 246}
+        bucket_stats = server._BucketStats(ss.worker_names, ss.stats_conf)
+        server.IPSubserver._start(ss, bucket_stats)
+        self.assertEqual(bucket_stats.get(0, 'socket_rcvbuf'), 246)
+        self.assertEqual(bucket_stats.get(1, 'socket_rcvbuf'), 246)
+
+    def test_drain_on_sighup(self):
+        signal_calls = []
+        schedule_calls = []
+        hub = PropertyObject()
+        hub.schedule_call_global = lambda *a: schedule_calls.append(a)
+        signal_orig = server.signal
+        get_hub_orig = server.get_hub
+        try:
+            server.signal = lambda *a: signal_calls.append(a)
+            server.get_hub = lambda: hub
+            ss = self._class(FakeServer(), 'test')
+            ss._drain_on_sighup()
+            self.assertEqual(len(signal_calls), 1)
+            self.assertEqual(signal_calls[0][0], server.SIGHUP)
+            self.assertEqual(schedule_calls, [])
+            signal_calls[0][1](server.SIGHUP, None)
+        finally:
+            server.signal = signal_orig
+            server.get_hub = get_hub_orig
+        self.assertEqual(signal_calls[1], (server.SIGHUP, server.SIG_IGN))
+        self.assertEqual(len(schedule_calls), 1)
+        self.assertEqual(schedule_calls[0][0], 0)
+        self.assertEqual(schedule_calls[0][1], server.getcurrent().throw)
+        self.assertTrue(isinstance(schedule_calls[0][2], server._WorkerDrain))
+
+    def test_parse_conf_cpu_affinity(self):
+        for section in ('brim', 'test'):
+            ss = self._class(FakeServer(), 'test')
+            confd = self._get_default_confd()
+            confd.setdefault(section, {})['cpu_affinity'] = '2-3,0'
+            ss._parse_conf(Conf(confd))
+            self.assertEqual(ss.cpu_affinity, [2, 3, 0])
+            self.assertEqual(ss.stats_conf['cpu'], 'worker')
+
+            for value in ('abc', ', '):
+                ss = self._class(FakeServer(), 'test')
+                exc = None
+                try:
+                    confd = self._get_default_confd()
+                    confd.setdefault(section, {})['cpu_affinity'] = value
+                    ss._parse_conf(Conf(confd))
+                except Exception as err:
+                    exc = err
+                self.assertEqual(
+                    str(exc), 'Invalid [test] cpu_affinity %r.' % value)
+
+    def _parse_conf_cpu_affinity_auto(self, allowed, nodes):
+        get_cpu_affinity_orig = server.get_cpu_affinity
+        get_numa_nodes_orig = server.get_numa_nodes
+
+        def _get_cpu_affinity():
+            if isinstance(allowed, Exception):
+                raise allowed
+            return allowed
+
+        try:
+            server.get_cpu_affinity = _get_cpu_affinity
+            server.get_numa_nodes = lambda: nodes
+            ss = self._class(FakeServer(), 'test')
+            confd = self._get_default_confd()
+            confd.setdefault('test', {})['cpu_affinity'] = 'auto'
+            ss._parse_conf(Conf(confd))
+        finally:
+            server.get_cpu_affinity = get_cpu_affinity_orig
+            server.get_numa_nodes = get_numa_nodes_orig
+        return ss
+
+    def test_parse_conf_cpu_affinity_auto(self):
+        ss = self._parse_conf_cpu_affinity_auto(
+            range(8), [[0, 1, 2, 3], [4, 5, 6, 7]])
+        self.assertEqual(ss.cpu_affinity, [0, 4, 1, 5, 2, 6, 3, 7])
+        self.assertEqual(ss.stats_conf['cpu'], 'worker')
+        # Only allowed CPUs are used and uneven nodes are fine.
+        ss = self._parse_conf_cpu_affinity_auto(
+            [1, 2, 3, 4, 5], [[0, 1, 2, 3], [4, 5, 6, 7], [8, 9]])
+        self.assertEqual(ss.cpu_affinity, [1, 4, 2, 5, 3])
+        # Without NUMA information the allowed CPUs are used in order.
+        ss = self._parse_conf_cpu_affinity_auto([3, 1, 2], [])
+        self.assertEqual(ss.cpu_affinity, [1, 2, 3])
+
+    def test_parse_conf_cpu_affinity_auto_unsupported(self):
+        exc = None
+        try:
+            self._parse_conf_cpu_affinity_auto(
+                OSError('CPU affinity is not supported on this platform.'),
+                [])
+        except Exception as err:
+            exc = err
+        self.assertEqual(
+            str(exc),
+            'Cannot use [test] cpu_affinity: CPU affinity is not supported on '
+            'this platform.')
+
+    def _pin_worker(self, worker_id, no_daemon=False, raises=False,
+                    cpu_affinity='4,5'):
+        set_cpu_affinity_calls = []
+
+        def _set_cpu_affinity(*args):
+            set_cpu_affinity_calls.append(args)
+            if raises:
+                raise OSError(22, 'Invalid argument')
+
+        ss = self._class(FakeServer(no_daemon=no_daemon), 'test')
+        confd = self._get_default_confd()
+        if cpu_affinity:
+            confd.setdefault('test', {})['cpu_affinity'] = cpu_affinity
+        ss._parse_conf(Conf(confd))
+        ss.logger = FakeLogger()
+        ss.bucket_stats = server._BucketStats(['0', '1', '2'], ss.stats_conf)
+        set_cpu_affinity_orig = server.set_cpu_affinity
+        try:
+            server.set_cpu_affinity = _set_cpu_affinity
+            cpu = ss._pin_worker(worker_id)
+        finally:
+            server.set_cpu_affinity = set_cpu_affinity_orig
+        return ss, cpu, set_cpu_affinity_calls
+
+    def test_pin_worker(self):
+        ss, cpu, set_cpu_affinity_calls = self._pin_worker(1)
+        self.assertEqual(cpu, 5)
+        self.assertEqual(set_cpu_affinity_calls, [([5],)])
+        self.assertEqual(ss.bucket_stats.get(1, 'cpu'), 5)
+        # Wraps around when there are more workers than CPUs.
+        ss, cpu, set_cpu_affinity_calls = self._pin_worker(2)
+        self.assertEqual(cpu, 4)
+        self.assertEqual(set_cpu_affinity_calls, [([4],)])
+
+    def test_pin_worker_not_configured(self):
+        ss, cpu, set_cpu_affinity_calls = self._pin_worker(
+            0, cpu_affinity=None)
+        self.assertEqual(cpu, None)
+        self.assertEqual(set_cpu_affinity_calls, [])
+
+    def test_pin_worker_no_daemon(self):
+        ss, cpu, set_cpu_affinity_calls = self._pin_worker(0, no_daemon=True)
+        self.assertEqual(cpu, None)
+        self.assertEqual(set_cpu_affinity_calls, [])
+
+    def test_pin_worker_fails(self):
+        ss, cpu, set_cpu_affinity_calls = self._pin_worker(0, raises=True)
+        self.assertEqual(cpu, None)
+        self.assertEqual(ss.logger.error_calls, [
+            ('Could not pin worker 0 to CPU 4: [Errno 22] Invalid argument',)])
+        self.assertEqual(ss.bucket_stats.get(0, 'cpu'), 0)
+
+    def test_drain(self):
+        schedule_calls = []
+        hub = PropertyObject()
+        hub.schedule_call_global = lambda *a: schedule_calls.append(a)
+        get_hub_orig = server.get_hub
+        try:
+            server.get_hub = lambda: hub
+            ss = self._class(FakeServer(), 'test')
+            ss.worker_greenlet = server.getcurrent()
+            ss._drain()
+            ss._drain()
+        finally:
+            server.get_hub = get_hub_orig
+        self.assertTrue(ss.draining)
+        self.assertEqual(len(schedule_calls), 1)
+        self.assertEqual(schedule_calls[0][1], server.getcurrent().throw)
+
+    def test_drain_threads(self):
+        get_hub_calls = []
+        get_hub_orig = server.get_hub
+        try:
+            server.get_hub = lambda: get_hub_calls.append(())
+            ss = self._class(FakeServer(), 'test')
+            ss.concurrency_model = 'threads'
+            ss._drain()
+        finally:
+            server.get_hub = get_hub_orig
+        self.assertTrue(ss.draining)
+        self.assertEqual(get_hub_calls, [])
+
+    def test_handoff_key(self):
+        ss = self._class(FakeServer(), 'test')
+        ss._parse_conf(Conf(self._get_default_confd()))
+        self.assertEqual(ss._handoff_key(), 'tcp *:80')
+
+    def test_note_handoff_on_sigusr2(self):
+        signal_calls = []
+        signal_orig = server.signal
+        try:
+            server.signal = lambda *a: signal_calls.append(a)
+            ss = self._class(FakeServer(), 'test')
+            self.assertFalse(ss.handed_off)
+            ss._note_handoff_on_sigusr2()
+        finally:
+            server.signal = signal_orig
+        self.assertEqual(len(signal_calls), 1)
+        self.assertEqual(signal_calls[0][0], server.SIGUSR2)
+        self.assertFalse(ss.handed_off)
+        signal_calls[0][1](server.SIGUSR2, None)
+        self.assertTrue(ss.handed_off)
+
+
+class AppWithInvalidInit(object):
+
+    def __init__(self):
+        pass
+
+
+class AppWithInvalidCall(object):
+
+    def __init__(self, name, conf, next_app):
+        pass
+
+    def __call__(self):
+        pass
+
+
+class AppWithNoCall(object):
+
+    def __init__(self, name, conf, next_app):
+        pass
+
+
+class AppWithInvalidParseConf1(object):
+
+    def __init__(self, name, conf, next_app):
+        pass
+
+    def __call__(self, env, start_response):
+        pass
+
+    @classmethod
+    def parse_conf(cls):
+        pass
+
+
+class AppWithInvalidParseConf2(object):
+
+    parse_conf = 'blah'
+
+    def __init__(self, name, conf, next_app):
+        pass
+
+    def __call__(self, env, start_response):
+        pass
+
+
+class AppWithNoParseConf(object):
+
+    def __init__(self, name, conf, next_app):
+        pass
+
+    def __call__(self, env, start_response):
+        pass
+
+
+class AppWithParseConf(object):
+
+    def __init__(self, name, conf, next_app):
+        pass
+
+    def __call__(self, env, start_response):
+        pass
+
+    @classmethod
+    def parse_conf(cls, name, conf):
+        return {'ok': True}
+
+
+class AppWithInvalidStatsConf1(object):
+
+    def __init__(self, name, conf, next_app):
+        pass
+
+    def __call__(self, env, start_response):
+        pass
+
+    @classmethod
+    def stats_conf(cls):
+        pass
+
+
+class AppWithInvalidStatsConf2(object):
+
+    stats_conf = 'blah'
+
+    def __init__(self, name, conf, next_app):
+        pass
+
+    def __call__(self, env, start_response):
+        pass
+
+
+class AppWithNoStatsConf(object):
+
+    def __init__(self, name, conf, next_app):
+        pass
+
+    def __call__(self, env, start_response):
         pass
 
 
@@ -1148,6 +2846,15 @@ class FakeLogger(object):
         self.exception_calls.append((args, exc_info()))
 
 
+class FakeSocket(object):
+
+    def __init__(self):
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
 class PropertyObject(object):
     pass
 
@@ -1170,8 +2877,32 @@ class TestWSGISubserver(TestIPSubserver):
         self.assertEqual(ss.log_headers, False)
         self.assertEqual(ss.count_status_codes, [404, 408, 499, 501])
         self.assertEqual(ss.wsgi_input_iter_chunk_size, 4096)
+        self.assertEqual(ss.max_requests_per_worker, 0)
+        self.assertEqual(ss.max_requests_jitter, 0)
+        self.assertEqual(ss.max_worker_rss, 0)
         self.assertEqual(ss.apps, [])
 
+    def test_parse_conf_tcp_socket_options(self):
+        for option in ('tcp_defer_accept', 'tcp_fastopen', 'tcp_keepidle',
+                       'tcp_keepintvl', 'tcp_keepcnt'):
+            for section in ('brim', 'test'):
+                ss = self._class(FakeServer(), 'test')
+                confd = self._get_default_confd()
+                confd.setdefault(section, {})[option] = '12'
+                ss._parse_conf(Conf(confd))
+                self.assertEqual(ss.socket_options, {option: 12})
+                self.assertEqual(ss.stats_conf.get(option), 'max')
+        ss = self._class(FakeServer(), 'test')
+        confd = self._get_default_confd()
+        confd.setdefault('test', {})['tcp_nodelay'] = 'yes'
+        ss._parse_conf(Conf(confd))
+        self.assertEqual(ss.socket_options, {'tcp_nodelay': 1})
+        ss = self._class(FakeServer(), 'test')
+        confd = self._get_default_confd()
+        confd.setdefault('test', {})['tcp_nodelay'] = 'no'
+        ss._parse_conf(Conf(confd))
+        self.assertEqual(ss.socket_options, {})
+
     def test_parse_conf_log_auth_tokens(self):
         ss = self._class(FakeServer(), 'test')
         confd = self._get_default_confd()
@@ -1211,6 +2942,113 @@ class TestWSGISubserver(TestIPSubserver):
             "Configuration value [test] log_auth_tokens of 'abc' cannot be "
             "converted to boolean.")
 
+    def test_parse_conf_app_timing(self):
+        for section in ('brim', 'test'):
+            ss = self._class(FakeServer(), 'test')
+            confd = self._get_default_confd()
+            confd.setdefault('test', {})['apps'] = 'one'
+            confd.setdefault('one', {})['call'] = 'brim.wsgi_echo.WSGIEcho'
+            ss._parse_conf(Conf(confd))
+            self.assertEqual(ss.app_timing, False)
+            self.assertFalse('one.self_usec' in ss.stats_conf)
+            confd.setdefault(section, {})['app_timing'] = 'yes'
+            ss = self._class(FakeServer(), 'test')
+            ss._parse_conf(Conf(confd))
+            self.assertEqual(ss.app_timing, True)
+            self.assertEqual(ss.stats_conf.get('one.call_count'), 'sum')
+            self.assertEqual(ss.stats_conf.get('one.self_usec'), 'sum')
+            self.assertEqual(ss.stats_conf.get('one.requests'), 'sum')
+
+    def test_build_apps(self):
+        confd = self._get_default_confd()
+        confd.setdefault('test', {})['apps'] = 'one two'
+        confd.setdefault('one', {})['call'] = 'brim.wsgi_echo.WSGIEcho'
+        confd.setdefault('two', {})['call'] = 'brim.wsgi_echo.WSGIEcho'
+        ss = self._class(FakeServer(), 'test')
+        ss._parse_conf(Conf(confd))
+        app = ss._build_apps(ss.apps)
+        self.assertEqual(app.name, 'one')
+        self.assertEqual(app.next_app.name, 'two')
+        self.assertEqual(app.next_app.next_app, ss)
+        self.assertEqual(ss._build_apps([]), ss)
+
+        confd['test']['app_timing'] = 'yes'
+        ss = self._class(FakeServer(), 'test')
+        ss._parse_conf(Conf(confd))
+        app = ss._build_apps(ss.apps)
+        self.assertEqual(app.__class__, server._AppTimer)
+        self.assertEqual(app.name, 'one')
+        self.assertEqual(app.app.name, 'one')
+        self.assertEqual(app.app.next_app.__class__, server._AppTimer)
+        self.assertEqual(app.app.next_app.app.name, 'two')
+        self.assertEqual(app.app.next_app.app.next_app, ss)
+
+    def test_parse_conf_reload_in_place(self):
+        ss = self._class(FakeServer(), 'test')
+        confd = self._get_default_confd()
+        confd.setdefault('test', {})['apps'] = 'one'
+        confd.setdefault('one', {})['call'] = 'brim.wsgi_echo.WSGIEcho'
+        confd.setdefault('brim', {})['log_level'] = 'DEBUG'
+        confd['test']['log_headers'] = 'yes'
+        ss._parse_conf(Conf(confd))
+        self.assertEqual(ss.reload_in_place, False)
+        # The apps may change with an in-place reload, so are left out.
+        self.assertEqual(
+            ss.subserver_conf,
+            ({'log_level': 'DEBUG'}, {'log_headers': 'yes'}))
+
+        for section in ('brim', 'test'):
+            ss = self._class(FakeServer(), 'test')
+            confd = self._get_default_confd()
+            confd.setdefault(section, {})['reload_in_place'] = 'yes'
+            ss._parse_conf(Conf(confd))
+            self.assertEqual(ss.reload_in_place, True)
+
+    def test_reload_in_place(self):
+        orig_confd = self._get_default_confd()
+        orig_confd.setdefault('test', {}).update(
+            {'reload_in_place': 'yes', 'apps': 'one'})
+        orig_confd.setdefault('one', {})['call'] = 'brim.wsgi_echo.WSGIEcho'
+        confd = self._get_default_confd()
+        confd.setdefault('test', {}).update(
+            {'reload_in_place': 'yes', 'apps': 'one'})
+        confd.setdefault('one', {}).update(
+            {'call': 'brim.wsgi_echo.WSGIEcho', 'path': '/one'})
+        ss, exc = self._reload(confd, orig_confd=orig_confd)
+        self.assertEqual(exc, None)
+        self.assertEqual(self.reload_result, True)
+        self.assertEqual(ss.apps[0][2]['path'], '/one')
+
+    def test_reload_in_place_turned_on(self):
+        confd = self._get_default_confd()
+        confd.setdefault('test', {})['reload_in_place'] = 'yes'
+        ss, exc = self._reload(confd)
+        self.assertEqual(exc, None)
+        self.assertEqual(self.reload_result, False)
+        self.assertEqual(ss.reload_in_place, True)
+
+    def test_reload_in_place_turned_off(self):
+        orig_confd = self._get_default_confd()
+        orig_confd.setdefault('test', {})['reload_in_place'] = 'yes'
+        ss, exc = self._reload(
+            self._get_default_confd(), orig_confd=orig_confd)
+        self.assertEqual(exc, None)
+        self.assertEqual(self.reload_result, False)
+        self.assertEqual(ss.reload_in_place, False)
+
+    def test_reload_in_place_cannot_change_other_options(self):
+        orig_confd = self._get_default_confd()
+        orig_confd.setdefault('test', {})['reload_in_place'] = 'yes'
+        confd = self._get_default_confd()
+        confd.setdefault('test', {}).update(
+            {'reload_in_place': 'yes', 'log_headers': 'yes'})
+        ss, exc = self._reload(confd, orig_confd=orig_confd)
+        self.assertEqual(
+            str(exc),
+            'Cannot change [test] options other than apps with an in-place '
+            'reload; set reload_in_place = no for a rolling reload.')
+        self.assertEqual(ss.log_headers, False)
+
     def test_parse_conf_log_headers(self):
         ss = self._class(FakeServer(), 'test')
         confd = self._get_default_confd()
@@ -1256,6 +3094,7 @@ class TestWSGISubserver(TestIPSubserver):
         confd.setdefault('brim', {})['count_status_codes'] = '1'
         ss._parse_conf(Conf(confd))
         self.assertEqual(ss.count_status_codes, [1])
+        self.assertEqual(ss.stats_conf.get('status_1_count'), 'sum')
 
         ss = self._class(FakeServer(), 'test')
         confd = self._get_default_confd()
@@ -1330,6 +3169,40 @@ class TestWSGISubserver(TestIPSubserver):
             "Configuration value [test] wsgi_input_iter_chunk_size of 'abc' "
             "cannot be converted to int.")
 
+    def test_wsgi_worker_request_limit(self):
+        randint_calls = []
+
+        def _randint(*args):
+            randint_calls.append(args)
+            return 7
+
+        ss = self._class(FakeServer(), 'test')
+        confd = self._get_default_confd()
+        confd.setdefault('test', {}).update(
+            {'max_requests_per_worker': '100', 'max_requests_jitter': '10'})
+        ss._parse_conf(Conf(confd))
+        ss.bucket_stats = server._BucketStats(['0'], {'start_time': 'worker'})
+        ss.sock = 'sock'
+        wsgi_orig = server.wsgi
+        use_hub_orig = server.use_hub
+        signal_orig = server.signal
+        randint_orig = server.randint
+        try:
+            server.wsgi = PropertyObject()
+            server.wsgi.server = lambda *a, **kw: None
+            server.use_hub = lambda *a: None
+            server.signal = lambda *a: None
+            server.randint = _randint
+            ss._wsgi_worker(0)
+        finally:
+            server.wsgi = wsgi_orig
+            server.use_hub = use_hub_orig
+            server.signal = signal_orig
+            server.randint = randint_orig
+        self.assertEqual(randint_calls, [(0, 10)])
+        self.assertEqual(ss.worker_request_limit, 107)
+        self.assertEqual(ss.worker_request_count, 0)
+
     def test_configure_wsgi_apps(self):
         ss = self._class(FakeServer(), 'test')
         confd = self._get_default_confd()
@@ -1603,10 +3476,24 @@ class TestWSGISubserver(TestIPSubserver):
             server.get_listening_tcp_socket = get_listening_tcp_socket_orig
         self.assertEqual(ss.sock, 'sock')
         self.assertEqual(get_listening_tcp_socket_calls, [(('*', 80), {
-            'keyfile': None, 'style': 'eventlet', 'retry': 30,
-            'certfile': None, 'backlog': 4096})])
+            'style': 'eventlet', 'retry': 30, 'backlog': 4096,
+            'sock': None})])
 
-    def test_start(self, output=False):
+        del get_listening_tcp_socket_calls[:]
+        ss = self._class(FakeServer(), 'test')
+        ss.server.handoff_socks = {'tcp *:80': 'handedsock', 'other': 'other'}
+        ss._parse_conf(Conf(self._get_default_confd()))
+        try:
+            server.get_listening_tcp_socket = _get_listening_tcp_socket
+            ss._privileged_start()
+        finally:
+            server.get_listening_tcp_socket = get_listening_tcp_socket_orig
+        self.assertEqual(get_listening_tcp_socket_calls, [(('*', 80), {
+            'style': 'eventlet', 'retry': 30, 'backlog': 4096,
+            'sock': 'handedsock'})])
+        self.assertEqual(ss.server.handoff_socks, {'other': 'other'})
+
+    def test_start(self, output=False, handed_off=False):
         capture_exceptions_stdout_stderr_calls = []
         time_calls = []
         get_logger_calls = []
@@ -1648,7 +3535,9 @@ class TestWSGISubserver(TestIPSubserver):
             server.wsgi = fake_wsgi
             server.sustain_workers = _sustain_workers
             server.shutdown_safe = _shutdown_safe
-            ss = TestIPSubserver.test_start(self, output=output)
+            ss = TestIPSubserver.test_start(
+                self, output=output, func_before_start=lambda ss: setattr(
+                    ss, 'handed_off', handed_off))
         finally:
             server.capture_exceptions_stdout_stderr = \
                 capture_exceptions_stdout_stderr_orig
@@ -1671,8 +3560,13 @@ class TestWSGISubserver(TestIPSubserver):
             ss.name, ss.log_name, ss.log_level, ss.log_facility,
             ss.server.no_daemon)])
         self.assertEqual(sustain_workers_calls, [
-            ((1, ss._wsgi_worker), {'logger': fake_logger})])
-        self.assertEqual(shutdown_safe_calls, [(ss.sock,)])
+            ((1, ss._wsgi_worker),
+             {'logger': fake_logger, 'reload_func': ss._reload,
+              'reload_batch': 1, 'scale_func': None, 'scale_interval': 5})])
+        if handed_off:
+            self.assertEqual(shutdown_safe_calls, [])
+        else:
+            self.assertEqual(shutdown_safe_calls, [(ss.sock,)])
         self.assertEqual(ss.worker_id, -1)
         self.assertEqual(ss.start_time, 1)
         self.assertEqual(ss.logger, fake_logger)
@@ -1693,9 +3587,13 @@ class TestWSGISubserver(TestIPSubserver):
     def test_start_with_output(self):
         self.test_start(output=True)
 
+    def test_start_handed_off(self):
+        self.test_start(handed_off=True)
+
     def test_wsgi_worker(self, no_setproctitle=False, no_daemon=False,
-                         with_apps=False, raises=False):
+                         with_apps=False, raises=False, reload_in_place=False):
         setproctitle_calls = []
+        signal_calls = []
         use_hub_calls = []
         fake_wsgi = PropertyObject()
         fake_wsgi.HttpProtocol = PropertyObject()
@@ -1729,6 +3627,7 @@ class TestWSGISubserver(TestIPSubserver):
         use_hub_orig = server.use_hub
         wsgi_orig = server.wsgi
         time_orig = server.time
+        signal_orig = server.signal
         fake_wsgi.server = _server
         exc = None
         try:
@@ -1737,6 +3636,7 @@ class TestWSGISubserver(TestIPSubserver):
             server.use_hub = _use_hub
             server.wsgi = fake_wsgi
             server.time = _time
+            server.signal = lambda *a: signal_calls.append(a)
             ss = self._class(FakeServer(no_daemon=no_daemon, output=True),
                              'test')
             if with_apps:
@@ -1748,6 +3648,8 @@ class TestWSGISubserver(TestIPSubserver):
             else:
                 confd = self._get_default_confd()
                 confd.setdefault('test', {})['port'] = '0'
+            if reload_in_place:
+                confd['test']['reload_in_place'] = 'yes'
             ss._parse_conf(Conf(confd))
             ss._privileged_start()
             bs = server._BucketStats(['0'], {'start_time': 'worker'})
@@ -1761,6 +3663,7 @@ class TestWSGISubserver(TestIPSubserver):
             server.use_hub = use_hub_orig
             server.wsgi = wsgi_orig
             server.time = time_orig
+            server.signal = signal_orig
 
         if no_setproctitle or no_daemon:
             self.assertEqual(setproctitle_calls, [])
@@ -1770,8 +3673,18 @@ class TestWSGISubserver(TestIPSubserver):
         self.assertEqual(ss.bucket_stats.get(ss.worker_id, 'start_time'), 1)
         if no_daemon:
             self.assertEqual(use_hub_calls, [])
+            self.assertEqual(signal_calls, [])
+        elif reload_in_place:
+            self.assertEqual(use_hub_calls, [(None,)])
+            self.assertEqual(
+                [c[0] for c in signal_calls],
+                [server.SIGUSR2, server.SIGHUP, server.SIGURG,
+                 server.SIGUSR1])
         else:
             self.assertEqual(use_hub_calls, [(None,)])
+            self.assertEqual(
+                [c[0] for c in signal_calls],
+                [server.SIGUSR2, server.SIGHUP, server.SIGURG])
         if with_apps:
             self.assertEqual(ss.first_app.__class__.__name__, 'WSGIEcho')
             self.assertEqual(ss.first_app.name, 'one')
@@ -1800,6 +3713,181 @@ class TestWSGISubserver(TestIPSubserver):
         else:
             self.assertEqual(exc, None)
 
+    def _wsgi_accept_loop_ssl(self, model):
+        calls = []
+
+        class Listener(object):
+
+            def accept(self):
+                if 'accept' in calls:
+                    raise server._WorkerDrain()
+                calls.append('accept')
+                return conn, 'addr'
+
+            def getsockname(self):
+                return ('1.2.3.4', 443)
+
+        class Conn(object):
+
+            def gettimeout(self):
+                return 60
+
+            def settimeout(self, timeout):
+                calls.append(('settimeout', timeout))
+
+        class SSLConn(object):
+
+            def do_handshake(self):
+                calls.append('do_handshake')
+
+            def settimeout(self, timeout):
+                calls.append(('settimeout', timeout))
+
+        class Context(object):
+
+            def wrap_socket(self, sock, **kwargs):
+                return SSLConn()
+
+            def session_stats(self):
+                return {'hits': 0}
+
+        class WSGIServer(object):
+
+            def __init__(self, *args, **kwargs):
+                calls.append(('init', args, kwargs))
+                self.base_environ = {}
+
+            def process_request(self, conn_state):
+                calls.append(('process_request', conn_state))
+
+            def handle_connection(self, conn, addr):
+                calls.append(('handle_connection', conn, addr))
+
+        class Pool(object):
+
+            def spawn_n(self, *args):
+                calls.append(args)
+
+        conn = Conn()
+        ss = self._class(FakeServer(), 'test')
+        confd = self._get_default_confd()
+        confd.setdefault('test', {}).update({
+            'certfile': 'cert', 'keyfile': 'key', 'concurrency_model': model})
+        ss._parse_conf(Conf(confd))
+        ss.sock = Listener()
+        # Skips polling the socket with the threads model.
+        ss._receive = lambda func: func()
+        ss.ssl_context = Context()
+        ss.worker_id = 0
+        ss.bucket_stats = server._BucketStats(['0'], ss.stats_conf)
+        orig_wsgi_Server = server.wsgi.Server
+        orig_ThreadsWSGIServer = server._ThreadsWSGIServer
+        try:
+            server.wsgi.Server = WSGIServer
+            server._ThreadsWSGIServer = WSGIServer
+            self.assertRaises(
+                server._WorkerDrain, ss._wsgi_accept_loop, Pool())
+        finally:
+            server.wsgi.Server = orig_wsgi_Server
+            server._ThreadsWSGIServer = orig_ThreadsWSGIServer
+        init, accept, spawn = calls
+        self.assertEqual(accept, 'accept')
+        del calls[:]
+        # The handshake is done by the spawned handler, not the accept loop.
+        spawn[0](*spawn[1:])
+        self.assertEqual(ss.bucket_stats.get(0, 'ssl_handshake_count'), 1)
+        return init, calls
+
+    def test_wsgi_accept_loop_ssl(self):
+        init, calls = self._wsgi_accept_loop_ssl('eventlet')
+        self.assertEqual(init[1][1], ('1.2.3.4', 443))
+        self.assertEqual(init[1][2].__name__, '_wsgi_entry')
+        self.assertEqual(
+            init[2]['environ'], {'wsgi.url_scheme': 'https', 'HTTPS': 'on'})
+        self.assertEqual(calls[:4], [
+            ('settimeout', 60), ('settimeout', 10), 'do_handshake',
+            ('settimeout', 60)])
+        self.assertEqual(calls[4][0], 'process_request')
+        conn_state = calls[4][1]
+        if hasattr(server.wsgi, 'STATE_IDLE'):
+            self.assertEqual(conn_state[0], 'addr')
+            self.assertEqual(conn_state[1].__class__.__name__, 'SSLConn')
+            self.assertEqual(conn_state[2], server.wsgi.STATE_IDLE)
+        else:
+            self.assertEqual(conn_state[0].__class__.__name__, 'SSLConn')
+            self.assertEqual(conn_state[1], 'addr')
+
+    def test_wsgi_accept_loop_ssl_serves_with_eventlet(self):
+        # Runs a request through Eventlet's own wsgi.Server, with a
+        # stand in for the SSL wrapping, to catch changes in what its
+        # process_request takes.
+        listener = GreenSocket()
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+        accepted = []
+
+        class Listener(object):
+
+            def accept(self):
+                if accepted:
+                    raise server._WorkerDrain()
+                accepted.append(True)
+                return listener.accept()
+
+            def getsockname(self):
+                return listener.getsockname()
+
+        class Context(object):
+
+            def wrap_socket(self, sock, **kwargs):
+                sock.do_handshake = lambda: None
+                return sock
+
+            def session_stats(self):
+                return {'hits': 0}
+
+        def _app(env, start_response):
+            start_response('200 OK', [('Content-Length', '5')])
+            return [env['wsgi.url_scheme']]
+
+        ss = self._class(FakeServer(), 'test')
+        confd = self._get_default_confd()
+        confd.setdefault('test', {}).update({
+            'certfile': 'cert', 'keyfile': 'key'})
+        ss._parse_conf(Conf(confd))
+        ss.sock = Listener()
+        ss._receive = lambda func: func()
+        ss.ssl_context = Context()
+        ss.worker_id = 0
+        ss.bucket_stats = server._BucketStats(['0'], ss.stats_conf)
+        ss._wsgi_entry = _app
+        client = GreenSocket()
+        client.connect(listener.getsockname())
+        client.sendall('GET / HTTP/1.0\r\n\r\n')
+        pool = server.GreenPool()
+        self.assertRaises(server._WorkerDrain, ss._wsgi_accept_loop, pool)
+        pool.waitall()
+        response = ''
+        while True:
+            chunk = client.recv(4096)
+            if not chunk:
+                break
+            response += chunk
+        client.close()
+        listener.close()
+        self.assertTrue(response.startswith('HTTP/1.1 200 OK\r\n'), response)
+        self.assertTrue(response.endswith('\r\n\r\nhttps'), response)
+
+    def test_wsgi_accept_loop_ssl_threads(self):
+        init, calls = self._wsgi_accept_loop_ssl('threads')
+        self.assertEqual(init[1][2], 60)
+        self.assertEqual(calls[:4], [
+            ('settimeout', 60), ('settimeout', 10), 'do_handshake',
+            ('settimeout', 60)])
+        self.assertEqual(calls[4][0], 'handle_connection')
+        self.assertEqual(calls[4][1].__class__.__name__, 'SSLConn')
+        self.assertEqual(calls[4][2], 'addr')
+
     def test_wsgi_worker_no_setproctitle(self):
         self.test_wsgi_worker(no_setproctitle=True)
 
@@ -1809,6 +3897,9 @@ class TestWSGISubserver(TestIPSubserver):
     def test_wsgi_worker_with_apps(self):
         self.test_wsgi_worker(with_apps=True)
 
+    def test_wsgi_worker_reload_in_place(self):
+        self.test_wsgi_worker(reload_in_place=True)
+
     def test_wsgi_worker_raises_socket_einval(self):
         self.test_wsgi_worker(raises='socket einval')
 
@@ -1818,6 +3909,202 @@ class TestWSGISubserver(TestIPSubserver):
     def test_wsgi_worker_raises_other(self):
         self.test_wsgi_worker(raises='other')
 
+    def test_privileged_start_threads(self):
+        calls = []
+        get_listening_orig = server.get_listening_tcp_socket
+        try:
+            server.get_listening_tcp_socket = \
+                lambda *a, **kw: calls.append(kw)
+            ss = self._class(FakeServer(), 'test')
+            confd = self._get_default_confd()
+            confd.setdefault('test', {})['concurrency_model'] = 'threads'
+            ss._parse_conf(Conf(confd))
+            ss._privileged_start()
+        finally:
+            server.get_listening_tcp_socket = get_listening_orig
+        self.assertEqual(calls[0]['style'], None)
+
+    def test_wsgi_worker_threads(self):
+        responses = []
+        with self._threads_worker(socket()) as ss:
+            ss.sock.listen(2)
+            # Each request has the worker drain, though the second one may
+            # be accepted before it notices.
+            ss._check_recycle = lambda: setattr(ss, 'draining', True)
+            clients = [create_connection(ss.sock.getsockname())
+                       for i in xrange(2)]
+            for client in clients:
+                client.sendall('GET / HTTP/1.0\r\n\r\n')
+            ss._wsgi_worker(0)
+            clients[0].settimeout(5)
+            responses.append(clients[0].recv(4096))
+            for client in clients:
+                client.close()
+        self.assertTrue(responses[0].startswith('HTTP/1.0 404 Not Found\r\n'))
+        self.assertTrue(ss.draining)
+        self.assertTrue(ss.bucket_stats.get(0, 'request_count') >= 1)
+
+    def test_reload_apps_on_sigusr1(self):
+        signal_calls = []
+        signal_orig = server.signal
+        try:
+            server.signal = lambda *a: signal_calls.append(a)
+            ss = self._class(FakeServer(), 'test')
+            ss._reload_apps_on_sigusr1()
+        finally:
+            server.signal = signal_orig
+        self.assertEqual(len(signal_calls), 1)
+        self.assertEqual(signal_calls[0][0], server.SIGUSR1)
+        self.assertFalse(ss.apps_reload_pending)
+        signal_calls[0][1](server.SIGUSR1, None)
+        self.assertTrue(ss.apps_reload_pending)
+
+    def _reload_apps(self, confd, files=['ok.conf']):
+        orig_confd = self._get_default_confd()
+        orig_confd.setdefault('test', {}).update(
+            {'reload_in_place': 'yes', 'apps': 'one two'})
+        orig_confd.setdefault('one', {})['call'] = 'brim.wsgi_echo.WSGIEcho'
+        orig_confd.setdefault('two', {})['call'] = 'brim.wsgi_echo.WSGIEcho'
+        confd.setdefault('test', {})['reload_in_place'] = 'yes'
+        read_conf_orig = server.read_conf
+        try:
+            server.read_conf = lambda *a, **kw: Conf(confd, files=files)
+            ss = self._class(FakeServer(), 'test')
+            ss.server.conf_files = ['ok.conf']
+            ss._parse_conf(Conf(orig_confd))
+            ss.logger = FakeLogger()
+            ss.first_app = first_app = 'first_app'
+            ss.apps_reload_pending = True
+            ss._reload_apps()
+        finally:
+            server.read_conf = read_conf_orig
+        self.assertFalse(ss.apps_reload_pending)
+        return ss, first_app
+
+    def test_reload_apps(self):
+        confd = self._get_default_confd()
+        confd.setdefault('test', {})['apps'] = 'two one'
+        confd.setdefault('one', {}).update(
+            {'call': 'brim.wsgi_echo.WSGIEcho', 'path': '/one'})
+        confd.setdefault('two', {})['call'] = 'brim.wsgi_echo.WSGIEcho'
+        ss, first_app = self._reload_apps(confd)
+        self.assertEqual([a[0] for a in ss.apps], ['two', 'one'])
+        self.assertEqual(ss.first_app.name, 'two')
+        self.assertEqual(ss.first_app.next_app.name, 'one')
+        self.assertEqual(ss.first_app.next_app.path, '/one')
+        self.assertEqual(ss.first_app.next_app.next_app, ss)
+        self.assertEqual(ss.logger.info_calls, [('Apps reloaded.',)])
+        self.assertEqual(ss.logger.exception_calls, [])
+
+    def test_reload_apps_no_conf(self):
+        ss, first_app = self._reload_apps(
+            self._get_default_confd(), files=[])
+        self.assertEqual(ss.first_app, first_app)
+        self.assertEqual(
+            ss.logger.exception_calls[0][0],
+            ('Apps reload abandoned: No configuration found.',))
+
+    def test_reload_apps_invalid_app(self):
+        confd = self._get_default_confd()
+        confd.setdefault('test', {})['apps'] = 'one'
+        confd.setdefault('one', {})['call'] = 'brim.wsgi_echo.Nope'
+        ss, first_app = self._reload_apps(confd)
+        self.assertEqual(ss.first_app, first_app)
+        self.assertEqual([a[0] for a in ss.apps], ['one', 'two'])
+        self.assertEqual(
+            ss.logger.exception_calls[0][0],
+            ("Apps reload abandoned: Could not load class "
+             "'brim.wsgi_echo.Nope' for app [one].",))
+
+    def test_reload_apps_cpu_affinity_auto(self):
+        # The worker is pinned to one CPU by the time it reloads, so auto
+        # works out differently there than it did at the start.
+        confd = self._get_default_confd()
+        confd.setdefault('test', {}).update(
+            {'apps': 'two one', 'cpu_affinity': 'auto'})
+        confd.setdefault('one', {})['call'] = 'brim.wsgi_echo.WSGIEcho'
+        confd.setdefault('two', {})['call'] = 'brim.wsgi_echo.WSGIEcho'
+        orig_confd = self._get_default_confd()
+        orig_confd.setdefault('test', {}).update(
+            {'reload_in_place': 'yes', 'apps': 'one two',
+             'cpu_affinity': 'auto'})
+        orig_confd.setdefault('one', {})['call'] = 'brim.wsgi_echo.WSGIEcho'
+        orig_confd.setdefault('two', {})['call'] = 'brim.wsgi_echo.WSGIEcho'
+        confd['test']['reload_in_place'] = 'yes'
+        allowed = [range(4)]
+        read_conf_orig = server.read_conf
+        get_cpu_affinity_orig = server.get_cpu_affinity
+        get_numa_nodes_orig = server.get_numa_nodes
+        try:
+            server.read_conf = lambda *a, **kw: Conf(confd, files=['ok.conf'])
+            server.get_cpu_affinity = lambda: allowed[0]
+            server.get_numa_nodes = lambda: []
+            ss = self._class(FakeServer(), 'test')
+            ss.server.conf_files = ['ok.conf']
+            ss._parse_conf(Conf(orig_confd))
+            self.assertEqual(ss.cpu_affinity, [0, 1, 2, 3])
+            ss.logger = FakeLogger()
+            ss.first_app = 'first_app'
+            allowed[0] = [2]
+            ss._reload_apps()
+            self.assertEqual(ss.logger.exception_calls, [])
+            self.assertEqual([a[0] for a in ss.apps], ['two', 'one'])
+            self.assertEqual(ss.first_app.name, 'two')
+            self.assertEqual(ss.cpu_affinity, [0, 1, 2, 3])
+            # Changing from auto still needs a restart.
+            confd['test']['cpu_affinity'] = '2'
+            ss._reload_apps()
+            self.assertEqual(
+                ss.logger.exception_calls[0][0],
+                ('Apps reload abandoned: Cannot change [test] cpu_affinity '
+                 'with a reload; a restart is required.',))
+        finally:
+            server.read_conf = read_conf_orig
+            server.get_cpu_affinity = get_cpu_affinity_orig
+            server.get_numa_nodes = get_numa_nodes_orig
+
+    def test_reload_apps_other_options_changed(self):
+        confd = self._get_default_confd()
+        confd.setdefault('test', {}).update(
+            {'apps': 'one two', 'log_headers': 'yes'})
+        confd.setdefault('one', {})['call'] = 'brim.wsgi_echo.WSGIEcho'
+        confd.setdefault('two', {})['call'] = 'brim.wsgi_echo.WSGIEcho'
+        ss, first_app = self._reload_apps(confd)
+        self.assertEqual(ss.first_app, first_app)
+        self.assertEqual(
+            ss.logger.exception_calls[0][0],
+            ('Apps reload abandoned: Cannot change [test] options other than '
+             'apps with an in-place reload; set reload_in_place = no for a '
+             'rolling reload.',))
+
+    def test_wsgi_entry_reloads_apps(self):
+        reload_apps_calls = []
+        ss = self._class(FakeServer(), 'test')
+        ss._parse_conf(Conf(self._get_default_confd()))
+        ss.worker_id = 0
+        ss.bucket_stats = server._BucketStats(['0'], ss.stats_conf)
+        ss.logger = FakeLogger()
+        ss.first_app = lambda env, start_response: ['old']
+
+        def _reload_apps():
+            reload_apps_calls.append(())
+            ss.first_app = lambda env, start_response: ['new']
+
+        ss._reload_apps = _reload_apps
+        env = {'REQUEST_METHOD': 'GET', 'PATH_INFO': '/',
+               'wsgi.input': StringIO()}
+        self.assertEqual(
+            ''.join(ss._wsgi_entry(dict(env), lambda *a: None)), 'old')
+        self.assertEqual(reload_apps_calls, [])
+        ss.apps_reload_pending = True
+        # Subrequests leave the reload to the next request.
+        self.assertEqual(
+            ''.join(ss._wsgi_entry(dict(env), next_app=ss.first_app)), 'old')
+        self.assertEqual(reload_apps_calls, [])
+        self.assertEqual(
+            ''.join(ss._wsgi_entry(dict(env), lambda *a: None)), 'new')
+        self.assertEqual(reload_apps_calls, [()])
+
     def test_wsgi_entry(self, with_app=False, raises=False, with_txn=None):
         ss = self._class(FakeServer(output=True), 'test')
         if with_app:
@@ -2707,6 +4994,25 @@ class TestWSGISubserver(TestIPSubserver):
         self.assertEqual(excinfo, None)
         self.assertEqual(''.join(content_iter), '200 OK')
 
+    def test_get_response_not_recycle_checked(self):
+        check_calls = []
+        ss = self._class(FakeServer(output=True), 'test')
+        ss.logger = FakeLogger()
+        ss._parse_conf(Conf({}))
+        ss.worker_id = 0
+        ss.bucket_stats = server._BucketStats(['test'], ss.stats_conf)
+        ss.first_app = ss
+        ss._check_recycle = lambda *args: check_calls.append(args)
+        status_line, headers_iteritems, excinfo, content_iter = \
+            ss.get_response({
+                'REQUEST_METHOD': 'GET',
+                'PATH_INFO': '/test',
+                'SERVER_PROTOCOL': 'HTTP/1.1',
+                'wsgi.input': StringIO('test value')})
+        self.assertEqual(''.join(content_iter), '404 Not Found\n')
+        # Subrequests are part of their parent request.
+        self.assertEqual(check_calls, [])
+
 
 class TCPWithInvalidInit(object):
 
@@ -2821,6 +5127,58 @@ class TCPWithStatsConf(object):
         return [('ok', 'sum')]
 
 
+class TCPWithInitError(object):
+
+    def __init__(self, name, conf):
+        raise Exception('init failed')
+
+    def __call__(self, subserver, stats, sock, ip, port):
+        pass
+
+    @classmethod
+    def stats_conf(cls, name, conf):
+        # The same stats as the default handler.
+        return [('byte_count', 'sum')]
+
+
+class TCPWithInvalidHandleStream1(object):
+
+    def __init__(self, name, conf):
+        pass
+
+    def __call__(self, subserver, stats, sock, ip, port):
+        pass
+
+    def handle_stream(self, stream):
+        pass
+
+
+class TCPWithInvalidHandleStream2(object):
+
+    handle_stream = 'blah'
+
+    def __init__(self, name, conf):
+        pass
+
+    def __call__(self, subserver, stats, sock, ip, port):
+        pass
+
+
+class TCPWithHandleStream(object):
+
+    def __init__(self, name, conf):
+        pass
+
+    def __call__(self, subserver, stats, sock, ip, port):
+        raise Exception('should not be called')
+
+    def handle_stream(self, subserver, stats, stream, ip, port):
+        line = stream.readline()
+        while line:
+            stream.write(line.upper())
+            line = stream.readline()
+
+
 class TestTCPSubserver(TestIPSubserver):
 
     _class = server.TCPSubserver
@@ -2828,14 +5186,118 @@ class TestTCPSubserver(TestIPSubserver):
     def _get_default_confd(self):
         return {'test': {'call': 'brim.tcp_echo.TCPEcho'}}
 
+    def test_reload_handler(self):
+        ss, exc = self._reload(self._get_default_confd())
+        self.assertEqual(exc, None)
+        self.assertEqual(ss.handler.__class__.__name__, 'TCPEcho')
+
+    def test_reload_handler_init_fails(self):
+        confd = self._get_default_confd()
+        confd['test']['call'] = \
+            'brim.test.unit.test_server.TCPWithInitError'
+        ss, exc = self._reload(confd)
+        self.assertEqual(str(exc), 'init failed')
+        # The running configuration is untouched.
+        self.assertEqual(ss.handler.__name__, 'TCPEcho')
+
+    def test_reload_cannot_change_stats(self):
+        confd = self._get_default_confd()
+        confd['test']['call'] = \
+            'brim.test.unit.test_server.TCPWithStatsConf'
+        ss, exc = self._reload(confd)
+        self.assertEqual(
+            str(exc),
+            'Cannot change [test] stats with a reload; a restart is '
+            'required.')
+        self.assertEqual(ss.handler.__name__, 'TCPEcho')
+
     def test_init(self):
         ss = TestIPSubserver.test_init(self)
         self.assertEqual(ss.stats_conf.get('connection_count'), 'sum')
+        self.assertEqual(ss.stats_conf.get('relay_in_byte_count'), 'sum')
+        self.assertEqual(ss.stats_conf.get('relay_out_byte_count'), 'sum')
+        self.assertEqual(
+            ss.stats_conf.get('timed_out_connection_count'), 'sum')
 
     def test_parse_conf_defaults(self):
         ss = TestIPSubserver.test_parse_conf_defaults(self)
         self.assertEqual(ss.handler.__name__, 'TCPEcho')
 
+    def test_parse_conf_tcp_socket_options(self):
+        for option in ('tcp_defer_accept', 'tcp_fastopen', 'tcp_keepidle',
+                       'tcp_keepintvl', 'tcp_keepcnt'):
+            for section in ('brim', 'test'):
+                ss = self._class(FakeServer(), 'test')
+                confd = self._get_default_confd()
+                confd.setdefault(section, {})[option] = '12'
+                ss._parse_conf(Conf(confd))
+                self.assertEqual(ss.socket_options, {option: 12})
+                self.assertEqual(ss.stats_conf.get(option), 'max')
+        ss = self._class(FakeServer(), 'test')
+        confd = self._get_default_confd()
+        confd.setdefault('test', {})['tcp_nodelay'] = 'yes'
+        ss._parse_conf(Conf(confd))
+        self.assertEqual(ss.socket_options, {'tcp_nodelay': 1})
+        ss = self._class(FakeServer(), 'test')
+        confd = self._get_default_confd()
+        confd.setdefault('test', {})['tcp_nodelay'] = 'no'
+        ss._parse_conf(Conf(confd))
+        self.assertEqual(ss.socket_options, {})
+
+    def test_parse_conf_connection_timeout(self):
+        ss = self._class(FakeServer(), 'test')
+        ss._parse_conf(Conf(self._get_default_confd()))
+        self.assertEqual(ss.connection_timeout, 0)
+        for section in ('brim', 'test'):
+            ss = self._class(FakeServer(), 'test')
+            confd = self._get_default_confd()
+            confd.setdefault(section, {})['connection_timeout'] = '300'
+            ss._parse_conf(Conf(confd))
+            self.assertEqual(ss.connection_timeout, 300)
+        for option in ('client_timeout', 'connection_timeout'):
+            ss = self._class(FakeServer(), 'test')
+            confd = self._get_default_confd()
+            confd['test'][option] = '-1'
+            exc = None
+            try:
+                ss._parse_conf(Conf(confd))
+            except Exception as err:
+                exc = err
+            self.assertEqual(str(exc), 'Invalid [test] %s -1.' % option)
+
+    def test_configure_handler_invalid_handle_stream1(self):
+        ss = self._class(FakeServer(), 'test')
+        confd = self._get_default_confd()
+        confd['test']['call'] = \
+            'brim.test.unit.test_server.TCPWithInvalidHandleStream1'
+        exc = None
+        try:
+            ss._parse_conf(Conf(confd))
+        except Exception as err:
+            exc = err
+        self.assertEqual(
+            str(exc),
+            "Would not be able to use "
+            "'brim.test.unit.test_server.TCPWithInvalidHandleStream1' for "
+            "[test]. Incorrect number of handle_stream args, 2, should be 6 "
+            "(self, subserver, stats, stream, ip, port).")
+
+    def test_configure_handler_invalid_handle_stream2(self):
+        ss = self._class(FakeServer(), 'test')
+        confd = self._get_default_confd()
+        confd['test']['call'] = \
+            'brim.test.unit.test_server.TCPWithInvalidHandleStream2'
+        exc = None
+        try:
+            ss._parse_conf(Conf(confd))
+        except Exception as err:
+            exc = err
+        self.assertEqual(
+            str(exc),
+            "Would not be able to use "
+            "'brim.test.unit.test_server.TCPWithInvalidHandleStream2' for "
+            "[test]. handle_stream probably not a method.")
+
     def test_parse_conf_no_call(self):
         ss = self._class(FakeServer(), 'test')
         conf = Conf({})
@@ -3051,7 +5513,8 @@ class TestTCPSubserver(TestIPSubserver):
     def test_configure_handler_with_stats_conf(self):
         ss = self._class(FakeServer(), 'test')
         confd = self._get_default_confd()
-        confd['test']['call'] = 'brim.test.unit.test_server.TCPWithStatsConf'
+        confd['test']['call'] = \
+            'brim.test.unit.test_server.TCPWithStatsConf'
         ss._parse_conf(Conf(confd))
         self.assertEqual(ss.stats_conf.get('start_time'), 'worker')
         self.assertEqual(ss.stats_conf.get('connection_count'), 'sum')
@@ -3091,10 +5554,24 @@ class TestTCPSubserver(TestIPSubserver):
             server.get_listening_tcp_socket = get_listening_tcp_socket_orig
         self.assertEqual(ss.sock, 'sock')
         self.assertEqual(get_listening_tcp_socket_calls, [(('*', 80), {
-            'keyfile': None, 'style': 'eventlet', 'retry': 30,
-            'certfile': None, 'backlog': 4096})])
+            'style': 'eventlet', 'retry': 30, 'backlog': 4096,
+            'sock': None})])
 
-    def test_start(self, output=False):
+        del get_listening_tcp_socket_calls[:]
+        ss = self._class(FakeServer(), 'test')
+        ss.server.handoff_socks = {'tcp *:80': 'handedsock', 'other': 'other'}
+        ss._parse_conf(Conf(self._get_default_confd()))
+        try:
+            server.get_listening_tcp_socket = _get_listening_tcp_socket
+            ss._privileged_start()
+        finally:
+            server.get_listening_tcp_socket = get_listening_tcp_socket_orig
+        self.assertEqual(get_listening_tcp_socket_calls, [(('*', 80), {
+            'style': 'eventlet', 'retry': 30, 'backlog': 4096,
+            'sock': 'handedsock'})])
+        self.assertEqual(ss.server.handoff_socks, {'other': 'other'})
+
+    def test_start(self, output=False, handed_off=False):
         capture_exceptions_stdout_stderr_calls = []
         time_calls = []
         get_logger_calls = []
@@ -3132,7 +5609,9 @@ class TestTCPSubserver(TestIPSubserver):
             server.get_logger = _get_logger
             server.sustain_workers = _sustain_workers
             server.shutdown_safe = _shutdown_safe
-            ss = TestIPSubserver.test_start(self, output=output)
+            ss = TestIPSubserver.test_start(
+                self, output=output, func_before_start=lambda ss: setattr(
+                    ss, 'handed_off', handed_off))
         finally:
             server.capture_exceptions_stdout_stderr = \
                 capture_exceptions_stdout_stderr_orig
@@ -3153,8 +5632,13 @@ class TestTCPSubserver(TestIPSubserver):
             ss.name, ss.log_name, ss.log_level, ss.log_facility,
             ss.server.no_daemon)])
         self.assertEqual(sustain_workers_calls, [
-            ((1, ss._tcp_worker), {'logger': fake_logger})])
-        self.assertEqual(shutdown_safe_calls, [(ss.sock,)])
+            ((1, ss._tcp_worker),
+             {'logger': fake_logger, 'reload_func': ss._reload,
+              'reload_batch': 1, 'scale_func': None, 'scale_interval': 5})])
+        if handed_off:
+            self.assertEqual(shutdown_safe_calls, [])
+        else:
+            self.assertEqual(shutdown_safe_calls, [(ss.sock,)])
         self.assertEqual(ss.worker_id, -1)
         self.assertEqual(ss.start_time, 1)
         self.assertEqual(ss.logger, fake_logger)
@@ -3164,9 +5648,13 @@ class TestTCPSubserver(TestIPSubserver):
     def test_start_with_output(self):
         self.test_start(output=True)
 
+    def test_start_handed_off(self):
+        self.test_start(handed_off=True)
+
     def test_tcp_worker(self, no_setproctitle=False, no_daemon=False,
                         raises=False):
         setproctitle_calls = []
+        signal_calls = []
         use_hub_calls = []
         spawn_n_calls = []
         GreenPool_calls = []
@@ -3186,6 +5674,8 @@ class TestTCPSubserver(TestIPSubserver):
                 raise err
             elif raises == 'socket other':
                 raise server.socket_error('test socket other')
+            elif raises == 'drain':
+                raise server._WorkerDrain()
             elif raises == 'other':
                 raise Exception('test other')
 
@@ -3213,6 +5703,7 @@ class TestTCPSubserver(TestIPSubserver):
         GreenPool_orig = server.GreenPool
         sustain_workers_orig = server.sustain_workers
         time_orig = server.time
+        signal_orig = server.signal
         exc = None
         try:
             server.setproctitle = None if no_setproctitle else _setproctitle
@@ -3220,6 +5711,7 @@ class TestTCPSubserver(TestIPSubserver):
             server.GreenPool = _GreenPool
             server.sustain_workers = _sustain_workers
             server.time = _time
+            server.signal = lambda *a: signal_calls.append(a)
             ss = self._class(
                 FakeServer(no_daemon=no_daemon, output=True), 'test')
             confd = self._get_default_confd()
@@ -3238,6 +5730,7 @@ class TestTCPSubserver(TestIPSubserver):
             server.GreenPool = GreenPool_orig
             server.sustain_workers = sustain_workers_orig
             server.time = time_orig
+            server.signal = signal_orig
 
         if no_setproctitle or no_daemon:
             self.assertEqual(setproctitle_calls, [])
@@ -3247,14 +5740,19 @@ class TestTCPSubserver(TestIPSubserver):
         self.assertEqual(ss.bucket_stats.get(ss.worker_id, 'start_time'), 1)
         if no_daemon:
             self.assertEqual(use_hub_calls, [])
+            self.assertEqual(signal_calls, [])
         else:
             self.assertEqual(use_hub_calls, [(None,)])
+            self.assertEqual(
+                [c[0] for c in signal_calls],
+                [server.SIGUSR2, server.SIGHUP, server.SIGURG])
         self.assertEqual(ss.handler.__class__.__name__, 'TCPEcho')
         self.assertEqual(
             GreenPool_calls, [((), {'size': ss.concurrent_per_worker})])
         self.assertEqual(len(spawn_n_calls), 1)
         self.assertEqual(len(spawn_n_calls[0]), 6)
-        self.assertEqual(spawn_n_calls[0][0].__class__.__name__, 'TCPEcho')
+        # The handler is wrapped to enforce the connection timeouts.
+        self.assertEqual(spawn_n_calls[0][0].__name__, '_handler')
         self.assertEqual(spawn_n_calls[0][1], ss)
         self.assertEqual(spawn_n_calls[0][2].bucket_stats, ss.bucket_stats)
         self.assertEqual(spawn_n_calls[0][3], 'sock')
@@ -3264,7 +5762,7 @@ class TestTCPSubserver(TestIPSubserver):
             self.assertEqual(accept_calls, [()])
         else:
             self.assertEqual(accept_calls, [(), ()])
-        if raises == 'socket einval':
+        if raises in ('socket einval', 'drain'):
             self.assertEqual(exc, None)
         elif raises == 'socket other':
             self.assertEqual(str(exc), 'test socket other')
@@ -3273,6 +5771,51 @@ class TestTCPSubserver(TestIPSubserver):
         else:
             self.assertEqual(str(exc), 'additional accept')
 
+    def test_tcp_worker_handle_stream(self):
+        spawn_n_calls = []
+
+        def _GreenPool(*args, **kwargs):
+            rv = PropertyObject()
+            rv.spawn_n = lambda *a: spawn_n_calls.append(a)
+            rv.waitall = lambda *a: None
+            return rv
+
+        def _accept(*args):
+            if not spawn_n_calls:
+                return sock, ('ip', 'port')
+            raise server._WorkerDrain()
+
+        sock, client = socketpair()
+        GreenPool_orig = server.GreenPool
+        sustain_workers_orig = server.sustain_workers
+        try:
+            server.GreenPool = _GreenPool
+            server.sustain_workers = lambda *a, **kw: None
+            ss = self._class(
+                FakeServer(no_daemon=True, output=True), 'test')
+            confd = self._get_default_confd()
+            confd['test']['port'] = '0'
+            confd['test']['call'] = \
+                'brim.test.unit.test_server.TCPWithHandleStream'
+            ss._parse_conf(Conf(confd))
+            ss._privileged_start()
+            ss._start(server._BucketStats(['0'], ss.stats_conf))
+            ss.sock.accept = _accept
+            ss._tcp_worker(0)
+        finally:
+            server.GreenPool = GreenPool_orig
+            server.sustain_workers = sustain_workers_orig
+        self.assertEqual(len(spawn_n_calls), 1)
+        handler, subserver, stats, conn, ip, port = spawn_n_calls[0]
+        self.assertEqual(
+            (subserver, conn, ip, port), (ss, sock, 'ip', 'port'))
+        client.sendall('one\ntwo\nthree')
+        client.shutdown(SHUT_WR)
+        handler(subserver, stats, conn, ip, port)
+        self.assertEqual(client.recv(100), 'ONE\nTWO\nTHREE')
+        sock.close()
+        client.close()
+
     def test_tcp_worker_no_setproctitle(self):
         self.test_tcp_worker(no_setproctitle=True)
 
@@ -3282,12 +5825,54 @@ class TestTCPSubserver(TestIPSubserver):
     def test_tcp_worker_raises_socket_einval(self):
         self.test_tcp_worker(raises='socket einval')
 
+    def test_tcp_worker_raises_drain(self):
+        self.test_tcp_worker(raises='drain')
+
     def test_tcp_worker_raises_socket_other(self):
         self.test_tcp_worker(raises='socket other')
 
     def test_tcp_worker_raises_other(self):
         self.test_tcp_worker(raises='other')
 
+    def test_privileged_start_threads(self):
+        calls = []
+        get_listening_orig = server.get_listening_tcp_socket
+        try:
+            server.get_listening_tcp_socket = \
+                lambda *a, **kw: calls.append(kw)
+            ss = self._class(FakeServer(), 'test')
+            confd = self._get_default_confd()
+            confd.setdefault('test', {})['concurrency_model'] = 'threads'
+            ss._parse_conf(Conf(confd))
+            ss._privileged_start()
+        finally:
+            server.get_listening_tcp_socket = get_listening_orig
+        self.assertEqual(calls[0]['style'], None)
+
+    def test_tcp_worker_threads(self):
+        handled = []
+
+        def _handler(subserver, stats, sock, ip, port):
+            handled.append((subserver, ip, sock.recv(10)))
+            sock.close()
+            subserver.draining = True
+
+        with self._threads_worker(socket()) as ss:
+            ss.sock.listen(2)
+            ss.handler = _handler
+            clients = [create_connection(ss.sock.getsockname())
+                       for i in xrange(2)]
+            for client in clients:
+                client.sendall('hello')
+            ss._tcp_worker(0)
+            for client in clients:
+                client.close()
+            self.assertEqual(ss.sock.gettimeout(), 0.0)
+        self.assertTrue(len(handled) >= 1)
+        self.assertEqual(handled[0], (ss, '127.0.0.1', 'hello'))
+        self.assertEqual(
+            ss.bucket_stats.get(0, 'connection_count'), len(handled))
+
     def test_capture_exception(self):
         ss = self._class(FakeServer(output=True), 'test')
         ss.logger = FakeLogger()
@@ -3345,6 +5930,309 @@ class TestTCPSubserver(TestIPSubserver):
             ('STDERR: tid:123 four',)])
         self.assertEqual(ss.logger.exception_calls, [])
 
+    def _relay(self, threads=False, no_splice=False, chunk_size=65536,
+               ssl=False):
+        ss = self._class(FakeServer(), 'test')
+        ss.concurrency_model = 'threads' if threads else 'eventlet'
+        ss.worker_id = 0
+        ss.bucket_stats = server._BucketStats(['0'], ss.stats_conf)
+        sock, client = socketpair()
+        other_sock, backend = socketpair()
+        if not threads:
+            sock = GreenSocket(sock)
+            other_sock = GreenSocket(other_sock)
+        if ssl:
+            sock.cipher = lambda: None
+        client.sendall('request' * 10000)
+        client.shutdown(SHUT_WR)
+        backend.sendall('response')
+        backend.shutdown(SHUT_WR)
+        splicers = []
+        orig_SocketSplicer = server.SocketSplicer
+
+        def _SocketSplicer(*args):
+            if no_splice:
+                raise OSError('testing')
+            splicers.append(orig_SocketSplicer(*args))
+            return splicers[-1]
+
+        try:
+            server.SocketSplicer = _SocketSplicer
+            results = []
+
+            def _drain():
+                results.append(''.join(iter(lambda: backend.recv(65536), '')))
+
+            drainer = Thread(target=_drain)
+            drainer.daemon = True
+            drainer.start()
+            counts = ss.relay(sock, other_sock, chunk_size)
+            drainer.join()
+        finally:
+            server.SocketSplicer = orig_SocketSplicer
+        self.assertEqual(counts, (70000, 8))
+        self.assertEqual(results, ['request' * 10000])
+        self.assertEqual(client.recv(100), 'response')
+        self.assertEqual(client.recv(100), '')
+        self.assertEqual(
+            ss.bucket_stats.get(0, 'relay_in_byte_count'), 70000)
+        self.assertEqual(ss.bucket_stats.get(0, 'relay_out_byte_count'), 8)
+        for s in (sock, client, other_sock, backend):
+            s.close()
+        return splicers
+
+    def test_ssl_handler(self):
+        ss = self._class(FakeServer(), 'test')
+        handshakes = []
+        calls = []
+
+        def _ssl_handshake(sock, stats):
+            handshakes.append((sock, stats))
+            return None if sock == 'bad' else 'ssl' + sock
+
+        ss._ssl_handshake = _ssl_handshake
+        handler = ss._ssl_handler(lambda *args: calls.append(args))
+        handler(ss, 'stats', 'sock', 'ip', 'port')
+        handler(ss, 'stats', 'bad', 'ip', 'port')
+        self.assertEqual(
+            handshakes, [('sock', 'stats'), ('bad', 'stats')])
+        self.assertEqual(calls, [(ss, 'stats', 'sslsock', 'ip', 'port')])
+
+    def _timeout_subserver(self, model='eventlet', client_timeout=0,
+                           connection_timeout=0):
+        ss = self._class(FakeServer(), 'test')
+        ss.concurrency_model = model
+        ss.client_timeout = client_timeout
+        ss.connection_timeout = connection_timeout
+        ss.worker_id = 0
+        ss.bucket_stats = server._BucketStats(['0'], ss.stats_conf)
+        ss._connections = {}
+        ss._connections_lock = server.Lock()
+        return ss, server._Stats(ss.bucket_stats, 0)
+
+    def test_timeout_handler_idle(self):
+        for model in ('eventlet', 'threads'):
+            ss, stats = self._timeout_subserver(model, client_timeout=0.01)
+            sock, client = socketpair()
+            if model == 'eventlet':
+                sock = GreenSocket(sock)
+            handler = ss._timeout_handler(
+                lambda subserver, stats, sock, ip, port: sock.recv(10))
+            handler(ss, stats, sock, 'ip', 'port')
+            self.assertEqual(stats.get('timed_out_connection_count'), 1)
+            self.assertEqual(client.recv(10), '')
+            client.close()
+
+    def test_timeout_handler_no_timeout(self):
+        ss, stats = self._timeout_subserver(client_timeout=0)
+        sock, client = socketpair()
+        calls = []
+
+        def _handler(subserver, stats, sock, ip, port):
+            calls.append(sock.gettimeout())
+            sock.close()
+
+        ss._timeout_handler(_handler)(ss, stats, sock, 'ip', 'port')
+        self.assertEqual(calls, [None])
+        self.assertEqual(stats.get('timed_out_connection_count'), 0)
+        client.close()
+
+    def test_timeout_handler_other_errors(self):
+        ss, stats = self._timeout_subserver(
+            client_timeout=5, connection_timeout=5)
+        sock, client = socketpair()
+
+        def _handler(subserver, stats, sock, ip, port):
+            raise server.socket_error('testing')
+
+        exc = None
+        try:
+            ss._timeout_handler(_handler)(ss, stats, sock, 'ip', 'port')
+        except server.socket_error as err:
+            exc = err
+        self.assertEqual(str(exc), 'testing')
+        self.assertEqual(stats.get('timed_out_connection_count'), 0)
+        self.assertEqual(ss._connections, {})
+        sock.close()
+        client.close()
+
+    def test_reap_connections(self):
+        ss, stats = self._timeout_subserver(connection_timeout=30)
+        sleep_calls = []
+
+        def _sleep(*args):
+            sleep_calls.append(args)
+            raise Exception('testing')
+
+        shutdown_calls = []
+
+        class Sock(object):
+
+            def __init__(self, error=None):
+                self.error = error
+
+            def shutdown(self, how):
+                shutdown_calls.append(how)
+                if self.error:
+                    raise self.error
+
+        old, older, new = Sock(), Sock(server.socket_error('gone')), Sock()
+        ss._connections = {old: 10, older: 5, new: 100}
+        orig_sleep = server.sleep
+        orig_time = server.time
+        try:
+            server.sleep = _sleep
+            server.time = lambda: 50
+            exc = None
+            try:
+                ss._reap_connections()
+            except Exception as err:
+                exc = err
+        finally:
+            server.sleep = orig_sleep
+            server.time = orig_time
+        self.assertEqual(str(exc), 'testing')
+        self.assertEqual(sleep_calls, [(1,)])
+        self.assertEqual(shutdown_calls, [server.SHUT_RDWR] * 2)
+        self.assertEqual(ss._connections, {old: None, older: None, new: 100})
+
+    def test_connection_timeout(self):
+        stopping = []
+        orig_time_sleep = server.time_sleep
+
+        def _time_sleep(seconds):
+            if stopping:
+                raise Exception('stopping')
+            orig_time_sleep(seconds)
+
+        try:
+            server.time_sleep = _time_sleep
+            self._connection_timeout(stopping)
+        finally:
+            server.time_sleep = orig_time_sleep
+
+    def _connection_timeout(self, stopping):
+        for model in ('eventlet', 'threads'):
+            ss, stats = self._timeout_subserver(
+                model, client_timeout=5, connection_timeout=0.05)
+            sock, client = socketpair()
+            if model == 'eventlet':
+                sock = GreenSocket(sock)
+                reaper = server.spawn(ss._reap_connections)
+            else:
+
+                def _reap():
+                    try:
+                        ss._reap_connections()
+                    except Exception as err:
+                        self.assertEqual(str(err), 'stopping')
+
+                reaper = Thread(target=_reap)
+                reaper.daemon = True
+                reaper.start()
+            received = []
+
+            def _handler(subserver, stats, sock, ip, port):
+                received.append(sock.recv(10))
+                sock.sendall('more')
+
+            ss._timeout_handler(_handler)(ss, stats, sock, 'ip', 'port')
+            if model == 'eventlet':
+                reaper.kill()
+            else:
+                stopping.append(True)
+                reaper.join()
+            self.assertEqual(received, [''])
+            self.assertEqual(stats.get('timed_out_connection_count'), 1)
+            self.assertEqual(ss._connections, {})
+            client.close()
+
+    def test_relay(self):
+        splicers = self._relay()
+        if splicers:
+            self.assertEqual(len(splicers), 2)
+
+    def test_relay_threads(self):
+        self._relay(threads=True)
+
+    def test_relay_small_chunk_size(self):
+        self._relay(chunk_size=7)
+        self._relay(threads=True, chunk_size=7)
+
+    def test_relay_no_splice(self):
+        self.assertEqual(self._relay(no_splice=True), [])
+        self.assertEqual(self._relay(threads=True, no_splice=True), [])
+
+    def test_relay_ssl_not_spliced(self):
+        self.assertEqual(self._relay(ssl=True), [])
+
+    def test_relay_error_shuts_down_both(self):
+        ss = self._class(FakeServer(), 'test')
+        ss.concurrency_model = 'threads'
+        ss.worker_id = 0
+        ss.bucket_stats = server._BucketStats(['0'], ss.stats_conf)
+        calls = []
+
+        class Sock(object):
+
+            def __init__(self, name, error=None):
+                self.name = name
+                self.error = error
+
+            def recv_into(self, buf):
+                if self.error:
+                    raise self.error
+                return 0
+
+            def shutdown(self, how):
+                calls.append((self.name, how))
+
+        orig_SocketSplicer = server.SocketSplicer
+        try:
+            server.SocketSplicer = lambda *args: None
+            ss._relay_one(
+                Sock('src', server.socket_error(104, 'reset')),
+                Sock('dst'), [0, 0], 0, 'relay_in_byte_count', 10)
+            self.assertEqual(calls, [
+                ('src', server.SHUT_RDWR), ('dst', server.SHUT_RDWR)])
+            del calls[:]
+            exc = None
+            try:
+                ss._relay_one(
+                    Sock('src', ValueError('testing')), Sock('dst'),
+                    [0, 0], 0, 'relay_in_byte_count', 10)
+            except ValueError as err:
+                exc = err
+            self.assertEqual(str(exc), 'testing')
+            self.assertEqual(calls, [
+                ('src', server.SHUT_RDWR), ('dst', server.SHUT_RDWR)])
+            del calls[:]
+            ss._relay_one(Sock('src'), Sock('dst'), [0, 0], 0,
+                          'relay_in_byte_count', 10)
+            self.assertEqual(calls, [('dst', server.SHUT_WR)])
+        finally:
+            server.SocketSplicer = orig_SocketSplicer
+
+    def test_wait_socket_timeout(self):
+        ss = self._class(FakeServer(), 'test')
+        for model in ('threads', 'eventlet'):
+            ss.concurrency_model = model
+            sock, peer = socketpair()
+            if model == 'eventlet':
+                sock = GreenSocket(sock)
+            sock.settimeout(0.01)
+            exc = None
+            try:
+                ss._wait_socket(sock)
+            except server.socket_timeout as err:
+                exc = err
+            self.assertEqual(str(exc), 'timed out')
+            ss._wait_socket(sock, write=True)
+            peer.sendall('x')
+            ss._wait_socket(sock)
+            sock.close()
+            peer.close()
+
 
 class UDPWithInvalidInit(object):
 
@@ -3459,6 +6347,43 @@ class UDPWithStatsConf(object):
         return [('ok', 'sum')]
 
 
+class UDPWithInvalidHandleBatch1(object):
+
+    def __init__(self, name, conf):
+        pass
+
+    def __call__(self, subserver, stats, sock, datagram, ip, port):
+        pass
+
+    def handle_batch(self, datagrams):
+        pass
+
+
+class UDPWithInvalidHandleBatch2(object):
+
+    handle_batch = 'blah'
+
+    def __init__(self, name, conf):
+        pass
+
+    def __call__(self, subserver, stats, sock, datagram, ip, port):
+        pass
+
+
+class UDPWithInitError(object):
+
+    def __init__(self, name, conf):
+        raise Exception('init failed')
+
+    def __call__(self, subserver, stats, sock, datagram, ip, port):
+        pass
+
+    @classmethod
+    def stats_conf(cls, name, conf):
+        # The same stats as the default handler.
+        return [('byte_count', 'sum')]
+
+
 class TestUDPSubserver(TestIPSubserver):
 
     _class = server.UDPSubserver
@@ -3466,6 +6391,31 @@ class TestUDPSubserver(TestIPSubserver):
     def _get_default_confd(self):
         return {'test': {'call': 'brim.udp_echo.UDPEcho'}}
 
+    def test_reload_handler(self):
+        ss, exc = self._reload(self._get_default_confd())
+        self.assertEqual(exc, None)
+        self.assertEqual(ss.handler.__class__.__name__, 'UDPEcho')
+
+    def test_reload_handler_init_fails(self):
+        confd = self._get_default_confd()
+        confd['test']['call'] = \
+            'brim.test.unit.test_server.UDPWithInitError'
+        ss, exc = self._reload(confd)
+        self.assertEqual(str(exc), 'init failed')
+        # The running configuration is untouched.
+        self.assertEqual(ss.handler.__name__, 'UDPEcho')
+
+    def test_reload_cannot_change_stats(self):
+        confd = self._get_default_confd()
+        confd['test']['call'] = \
+            'brim.test.unit.test_server.UDPWithStatsConf'
+        ss, exc = self._reload(confd)
+        self.assertEqual(
+            str(exc),
+            'Cannot change [test] stats with a reload; a restart is '
+            'required.')
+        self.assertEqual(ss.handler.__name__, 'UDPEcho')
+
     def test_init(self):
         ss = TestIPSubserver.test_init(self)
         self.assertEqual(ss.stats_conf.get('datagram_count'), 'sum')
@@ -3475,6 +6425,15 @@ class TestUDPSubserver(TestIPSubserver):
         self.assertEqual(ss.handler.__name__, 'UDPEcho')
         self.assertEqual(ss.max_datagram_size, 65536)
 
+    def test_parse_conf_tcp_socket_options_ignored(self):
+        ss = self._class(FakeServer(), 'test')
+        confd = self._get_default_confd()
+        confd.setdefault('brim', {}).update(
+            {'tcp_nodelay': 'yes', 'tcp_keepidle': '12',
+             'socket_rcvbuf': '123'})
+        ss._parse_conf(Conf(confd))
+        self.assertEqual(ss.socket_options, {'socket_rcvbuf': 123})
+
     def test_parse_conf_max_datagram_size(self):
         ss = self._class(FakeServer(), 'test')
         confd = self._get_default_confd()
@@ -3514,6 +6473,56 @@ class TestUDPSubserver(TestIPSubserver):
             "Configuration value [test] max_datagram_size of 'abc' cannot be "
             "converted to int.")
 
+    def test_parse_conf_batch_size(self):
+        ss = self._class(FakeServer(), 'test')
+        ss._parse_conf(Conf(self._get_default_confd()))
+        self.assertEqual(ss.batch_size, 0)
+
+        ss = self._class(FakeServer(), 'test')
+        confd = self._get_default_confd()
+        confd.setdefault('brim', {})['batch_size'] = '16'
+        ss._parse_conf(Conf(confd))
+        self.assertEqual(ss.batch_size, 16)
+
+        ss = self._class(FakeServer(), 'test')
+        confd = self._get_default_confd()
+        confd['test']['batch_size'] = '32'
+        ss._parse_conf(Conf(confd))
+        self.assertEqual(ss.batch_size, 32)
+
+        ss = self._class(FakeServer(), 'test')
+        exc = None
+        try:
+            confd = self._get_default_confd()
+            confd['test']['batch_size'] = '-1'
+            ss._parse_conf(Conf(confd))
+        except Exception as err:
+            exc = err
+        self.assertEqual(str(exc), 'Invalid [test] batch_size -1.')
+
+    def test_parse_conf_batch_size_unsupported(self):
+
+        def _DatagramBatchReceiver(*args):
+            raise OSError('recvmmsg is not supported on this platform.')
+
+        DatagramBatchReceiver_orig = server.DatagramBatchReceiver
+        exc = None
+        try:
+            server.DatagramBatchReceiver = _DatagramBatchReceiver
+            ss = self._class(FakeServer(), 'test')
+            confd = self._get_default_confd()
+            ss._parse_conf(Conf(confd))
+            confd['test']['batch_size'] = '8'
+            ss._parse_conf(Conf(confd))
+        except Exception as err:
+            exc = err
+        finally:
+            server.DatagramBatchReceiver = DatagramBatchReceiver_orig
+        self.assertEqual(
+            str(exc),
+            'Cannot use [test] batch_size: recvmmsg is not supported on this '
+            'platform.')
+
     def test_parse_conf_no_call(self):
         ss = self._class(FakeServer(), 'test')
         conf = Conf({})
@@ -3587,33 +6596,147 @@ class TestUDPSubserver(TestIPSubserver):
         exc = None
         try:
             ss._parse_conf(Conf(confd))
-        except Exception as err:
-            exc = err
-        self.assertEqual(
-            str(exc),
-            "Would not be able to instantiate 'brim.server._send_pid_sig' for "
-            "[test]. Probably not a class.")
+        except Exception as err:
+            exc = err
+        self.assertEqual(
+            str(exc),
+            "Would not be able to instantiate 'brim.server._send_pid_sig' for "
+            "[test]. Probably not a class.")
+
+    def test_configure_handler_invalid_init(self):
+        ss = self._class(FakeServer(), 'test')
+        confd = self._get_default_confd()
+        confd['test']['call'] = 'brim.test.unit.test_server.UDPWithInvalidInit'
+        exc = None
+        try:
+            ss._parse_conf(Conf(confd))
+        except Exception as err:
+            exc = err
+        self.assertEqual(
+            str(exc),
+            "Would not be able to instantiate "
+            "'brim.test.unit.test_server.UDPWithInvalidInit' for [test]. "
+            "Incorrect number of args, 1, should be 3 (self, name, "
+            "parsed_conf).")
+
+    def test_configure_handler_invalid_call_option(self):
+        ss = self._class(FakeServer(), 'test')
+        confd = self._get_default_confd()
+        confd['test']['call'] = 'brim.test.unit.test_server.UDPWithInvalidCall'
+        exc = None
+        try:
+            ss._parse_conf(Conf(confd))
+        except Exception as err:
+            exc = err
+        self.assertEqual(
+            str(exc),
+            "Would not be able to use "
+            "'brim.test.unit.test_server.UDPWithInvalidCall' for [test]. "
+            "Incorrect number of __call__ args, 1, should be 7 (self, "
+            "subserver, stats, sock, datagram, ip, port).")
+
+    def test_configure_handler_no_call(self):
+        ss = self._class(FakeServer(), 'test')
+        confd = self._get_default_confd()
+        confd['test']['call'] = 'brim.test.unit.test_server.UDPWithNoCall'
+        exc = None
+        try:
+            ss._parse_conf(Conf(confd))
+        except Exception as err:
+            exc = err
+        self.assertEqual(
+            str(exc),
+            "Would not be able to use "
+            "'brim.test.unit.test_server.UDPWithNoCall' for [test]. Probably "
+            "no __call__ method.")
+
+    def test_parse_conf_reply_batch_size(self):
+        ss = self._class(FakeServer(), 'test')
+        ss._parse_conf(Conf(self._get_default_confd()))
+        self.assertEqual(ss.reply_batch_size, 0)
+        self.assertEqual(ss.reply_queue_size, 1024)
+
+        ss = self._class(FakeServer(), 'test')
+        confd = self._get_default_confd()
+        confd.setdefault('brim', {}).update(
+            {'reply_batch_size': '16', 'reply_queue_size': '64'})
+        ss._parse_conf(Conf(confd))
+        self.assertEqual(ss.reply_batch_size, 16)
+        self.assertEqual(ss.reply_queue_size, 64)
+
+        ss = self._class(FakeServer(), 'test')
+        confd = self._get_default_confd()
+        confd['test'].update(
+            {'reply_batch_size': '32', 'reply_queue_size': '128'})
+        ss._parse_conf(Conf(confd))
+        self.assertEqual(ss.reply_batch_size, 32)
+        self.assertEqual(ss.reply_queue_size, 128)
+
+        for name, value in (
+                ('reply_batch_size', -1), ('reply_queue_size', 0)):
+            ss = self._class(FakeServer(), 'test')
+            exc = None
+            try:
+                confd = self._get_default_confd()
+                confd['test'][name] = str(value)
+                ss._parse_conf(Conf(confd))
+            except Exception as err:
+                exc = err
+            self.assertEqual(
+                str(exc), 'Invalid [test] %s %r.' % (name, value))
+
+    def test_parse_conf_reply_batch_size_unsupported(self):
+
+        def _DatagramBatchSender(*args):
+            raise OSError('sendmmsg is not supported on this platform.')
+
+        DatagramBatchSender_orig = server.DatagramBatchSender
+        exc = None
+        try:
+            server.DatagramBatchSender = _DatagramBatchSender
+            ss = self._class(FakeServer(), 'test')
+            confd = self._get_default_confd()
+            ss._parse_conf(Conf(confd))
+            confd['test']['reply_batch_size'] = '8'
+            ss._parse_conf(Conf(confd))
+        except Exception as err:
+            exc = err
+        finally:
+            server.DatagramBatchSender = DatagramBatchSender_orig
+        self.assertEqual(
+            str(exc),
+            'Cannot use [test] reply_batch_size: sendmmsg is not supported on '
+            'this platform.')
+
+    def test_parse_conf_drop_check_interval(self):
+        ss = self._class(FakeServer(), 'test')
+        ss._parse_conf(Conf(self._get_default_confd()))
+        self.assertEqual(ss.drop_check_interval, 5)
+        self.assertEqual(ss.stats_conf.get('datagram_drop_count'), 'max')
+
+        for section in ('brim', 'test'):
+            ss = self._class(FakeServer(), 'test')
+            confd = self._get_default_confd()
+            confd.setdefault(section, {})['drop_check_interval'] = '0'
+            ss._parse_conf(Conf(confd))
+            self.assertEqual(ss.drop_check_interval, 0)
+            self.assertFalse('datagram_drop_count' in ss.stats_conf)
 
-    def test_configure_handler_invalid_init(self):
         ss = self._class(FakeServer(), 'test')
-        confd = self._get_default_confd()
-        confd['test']['call'] = 'brim.test.unit.test_server.UDPWithInvalidInit'
         exc = None
         try:
+            confd = self._get_default_confd()
+            confd['test']['drop_check_interval'] = '-1'
             ss._parse_conf(Conf(confd))
         except Exception as err:
             exc = err
-        self.assertEqual(
-            str(exc),
-            "Would not be able to instantiate "
-            "'brim.test.unit.test_server.UDPWithInvalidInit' for [test]. "
-            "Incorrect number of args, 1, should be 3 (self, name, "
-            "parsed_conf).")
+        self.assertEqual(str(exc), 'Invalid [test] drop_check_interval -1.')
 
-    def test_configure_handler_invalid_call_option(self):
+    def test_configure_handler_invalid_handle_batch1(self):
         ss = self._class(FakeServer(), 'test')
         confd = self._get_default_confd()
-        confd['test']['call'] = 'brim.test.unit.test_server.UDPWithInvalidCall'
+        confd['test']['call'] = \
+            'brim.test.unit.test_server.UDPWithInvalidHandleBatch1'
         exc = None
         try:
             ss._parse_conf(Conf(confd))
@@ -3622,14 +6745,15 @@ class TestUDPSubserver(TestIPSubserver):
         self.assertEqual(
             str(exc),
             "Would not be able to use "
-            "'brim.test.unit.test_server.UDPWithInvalidCall' for [test]. "
-            "Incorrect number of __call__ args, 1, should be 7 (self, "
-            "subserver, stats, sock, datagram, ip, port).")
+            "'brim.test.unit.test_server.UDPWithInvalidHandleBatch1' for "
+            "[test]. Incorrect number of handle_batch args, 2, should be 5 "
+            "(self, subserver, stats, sock, datagrams).")
 
-    def test_configure_handler_no_call(self):
+    def test_configure_handler_invalid_handle_batch2(self):
         ss = self._class(FakeServer(), 'test')
         confd = self._get_default_confd()
-        confd['test']['call'] = 'brim.test.unit.test_server.UDPWithNoCall'
+        confd['test']['call'] = \
+            'brim.test.unit.test_server.UDPWithInvalidHandleBatch2'
         exc = None
         try:
             ss._parse_conf(Conf(confd))
@@ -3638,8 +6762,8 @@ class TestUDPSubserver(TestIPSubserver):
         self.assertEqual(
             str(exc),
             "Would not be able to use "
-            "'brim.test.unit.test_server.UDPWithNoCall' for [test]. Probably "
-            "no __call__ method.")
+            "'brim.test.unit.test_server.UDPWithInvalidHandleBatch2' for "
+            "[test]. handle_batch probably not a method.")
 
     def test_configure_handler_invalid_parse_conf1(self):
         ss = self._class(FakeServer(), 'test')
@@ -3729,7 +6853,8 @@ class TestUDPSubserver(TestIPSubserver):
     def test_configure_handler_with_stats_conf(self):
         ss = self._class(FakeServer(), 'test')
         confd = self._get_default_confd()
-        confd['test']['call'] = 'brim.test.unit.test_server.UDPWithStatsConf'
+        confd['test']['call'] = \
+            'brim.test.unit.test_server.UDPWithStatsConf'
         ss._parse_conf(Conf(confd))
         self.assertEqual(ss.stats_conf.get('start_time'), 'worker')
         self.assertEqual(ss.stats_conf.get('datagram_count'), 'sum')
@@ -3770,9 +6895,29 @@ class TestUDPSubserver(TestIPSubserver):
         self.assertEqual(ss.sock, 'sock')
         self.assertEqual(
             get_listening_udp_socket_calls,
-            [(('*', 80), {'style': 'eventlet', 'retry': 30})])
+            [(('*', 80), {'style': 'eventlet', 'retry': 30, 'sock': None})])
 
-    def test_start(self, output=False):
+        del get_listening_udp_socket_calls[:]
+        ss = self._class(FakeServer(), 'test')
+        ss.server.handoff_socks = {'udp *:80': 'handedsock', 'other': 'other'}
+        ss._parse_conf(Conf(self._get_default_confd()))
+        try:
+            server.get_listening_udp_socket = _get_listening_udp_socket
+            ss._privileged_start()
+        finally:
+            server.get_listening_udp_socket = get_listening_udp_socket_orig
+        self.assertEqual(
+            get_listening_udp_socket_calls,
+            [(('*', 80), {'style': 'eventlet', 'retry': 30,
+                          'sock': 'handedsock'})])
+        self.assertEqual(ss.server.handoff_socks, {'other': 'other'})
+
+    def test_handoff_key(self):
+        ss = self._class(FakeServer(), 'test')
+        ss._parse_conf(Conf(self._get_default_confd()))
+        self.assertEqual(ss._handoff_key(), 'udp *:80')
+
+    def test_start(self, output=False, handed_off=False):
         capture_exceptions_stdout_stderr_calls = []
         time_calls = []
         get_logger_calls = []
@@ -3810,7 +6955,9 @@ class TestUDPSubserver(TestIPSubserver):
             server.get_logger = _get_logger
             server.sustain_workers = _sustain_workers
             server.shutdown_safe = _shutdown_safe
-            ss = TestIPSubserver.test_start(self, output=output)
+            ss = TestIPSubserver.test_start(
+                self, output=output, func_before_start=lambda ss: setattr(
+                    ss, 'handed_off', handed_off))
         finally:
             server.capture_exceptions_stdout_stderr = \
                 capture_exceptions_stdout_stderr_orig
@@ -3831,8 +6978,13 @@ class TestUDPSubserver(TestIPSubserver):
             ss.name, ss.log_name, ss.log_level, ss.log_facility,
             ss.server.no_daemon)])
         self.assertEqual(sustain_workers_calls, [
-            ((1, ss._udp_worker), {'logger': fake_logger})])
-        self.assertEqual(shutdown_safe_calls, [(ss.sock,)])
+            ((1, ss._udp_worker),
+             {'logger': fake_logger, 'reload_func': ss._reload,
+              'reload_batch': 1, 'scale_func': None, 'scale_interval': 5})])
+        if handed_off:
+            self.assertEqual(shutdown_safe_calls, [])
+        else:
+            self.assertEqual(shutdown_safe_calls, [(ss.sock,)])
         self.assertEqual(ss.worker_id, -1)
         self.assertEqual(ss.start_time, 1)
         self.assertEqual(ss.logger, fake_logger)
@@ -3842,9 +6994,13 @@ class TestUDPSubserver(TestIPSubserver):
     def test_start_with_output(self):
         self.test_start(output=True)
 
+    def test_start_handed_off(self):
+        self.test_start(handed_off=True)
+
     def test_udp_worker(self, no_setproctitle=False, no_daemon=False,
                         raises=False):
         setproctitle_calls = []
+        signal_calls = []
         use_hub_calls = []
         spawn_n_calls = []
         GreenPool_calls = []
@@ -3864,6 +7020,8 @@ class TestUDPSubserver(TestIPSubserver):
                 raise err
             elif raises == 'socket other':
                 raise server.socket_error('test socket other')
+            elif raises == 'drain':
+                raise server._WorkerDrain()
             elif raises == 'other':
                 raise Exception('test other')
 
@@ -3891,6 +7049,7 @@ class TestUDPSubserver(TestIPSubserver):
         GreenPool_orig = server.GreenPool
         sustain_workers_orig = server.sustain_workers
         time_orig = server.time
+        signal_orig = server.signal
         exc = None
         try:
             server.setproctitle = None if no_setproctitle else _setproctitle
@@ -3898,6 +7057,7 @@ class TestUDPSubserver(TestIPSubserver):
             server.GreenPool = _GreenPool
             server.sustain_workers = _sustain_workers
             server.time = _time
+            server.signal = lambda *a: signal_calls.append(a)
             ss = self._class(
                 FakeServer(no_daemon=no_daemon, output=True), 'test')
             confd = self._get_default_confd()
@@ -3916,6 +7076,7 @@ class TestUDPSubserver(TestIPSubserver):
             server.GreenPool = GreenPool_orig
             server.sustain_workers = sustain_workers_orig
             server.time = time_orig
+            server.signal = signal_orig
 
         if no_setproctitle or no_daemon:
             self.assertEqual(setproctitle_calls, [])
@@ -3925,8 +7086,12 @@ class TestUDPSubserver(TestIPSubserver):
         self.assertEqual(ss.bucket_stats.get(ss.worker_id, 'start_time'), 1)
         if no_daemon:
             self.assertEqual(use_hub_calls, [])
+            self.assertEqual(signal_calls, [])
         else:
             self.assertEqual(use_hub_calls, [(None,)])
+            self.assertEqual(
+                [c[0] for c in signal_calls],
+                [server.SIGUSR2, server.SIGHUP, server.SIGURG])
         self.assertEqual(
             GreenPool_calls, [((), {'size': ss.concurrent_per_worker})])
         self.assertEqual(len(spawn_n_calls), 1)
@@ -3943,7 +7108,7 @@ class TestUDPSubserver(TestIPSubserver):
         else:
             self.assertEqual(recvfrom_calls, [
                 (ss.max_datagram_size,), (ss.max_datagram_size,)])
-        if raises == 'socket einval':
+        if raises in ('socket einval', 'drain'):
             self.assertEqual(exc, None)
         elif raises == 'socket other':
             self.assertEqual(str(exc), 'test socket other')
@@ -3955,12 +7120,411 @@ class TestUDPSubserver(TestIPSubserver):
     def test_udp_worker_no_setproctitle(self):
         self.test_udp_worker(no_setproctitle=True)
 
+    def test_privileged_start_threads(self):
+        calls = []
+        get_listening_orig = server.get_listening_udp_socket
+        try:
+            server.get_listening_udp_socket = \
+                lambda *a, **kw: calls.append(kw)
+            ss = self._class(FakeServer(), 'test')
+            confd = self._get_default_confd()
+            confd.setdefault('test', {})['concurrency_model'] = 'threads'
+            ss._parse_conf(Conf(confd))
+            ss._privileged_start()
+        finally:
+            server.get_listening_udp_socket = get_listening_orig
+        self.assertEqual(calls[0]['style'], None)
+
+    def test_udp_worker_watch_drops(self):
+        spawn_n_calls = []
+
+        def _recvfrom(*args):
+            raise server._WorkerDrain()
+
+        for interval in ('5', '0'):
+            ss = self._class(FakeServer(), 'test')
+            confd = self._get_default_confd()
+            confd['test']['drop_check_interval'] = interval
+            ss._parse_conf(Conf(confd))
+            ss.bucket_stats = server._BucketStats(['0'], ss.stats_conf)
+            ss.sock = PropertyObject()
+            ss.sock.recvfrom = _recvfrom
+            use_hub_orig = server.use_hub
+            signal_orig = server.signal
+            spawn_n_orig = server.spawn_n
+            try:
+                server.use_hub = lambda *a: None
+                server.signal = lambda *a: None
+                server.spawn_n = lambda *a: spawn_n_calls.append(a)
+                ss._udp_worker(0)
+            finally:
+                server.use_hub = use_hub_orig
+                server.signal = signal_orig
+                server.spawn_n = spawn_n_orig
+        self.assertEqual(len(spawn_n_calls), 1)
+        self.assertEqual(spawn_n_calls[0][0].__name__, '_watch_drops')
+
+    def test_udp_worker_threads(self):
+        handled = []
+
+        def _handler(subserver, stats, sock, datagram, ip, port):
+            handled.append((subserver, sock, datagram, ip, sock.gettimeout()))
+            subserver.draining = True
+
+        with self._threads_worker(socket(AF_INET, SOCK_DGRAM)) as ss:
+            ss.handler = _handler
+            client = socket(AF_INET, SOCK_DGRAM)
+            for datagram in ('one', 'two'):
+                client.sendto(datagram, ss.sock.getsockname())
+            ss._udp_worker(0)
+            client.close()
+        self.assertTrue(len(handled) >= 1)
+        # The handlers share the socket to send replies, so it is left
+        # blocking and only the receives are non-blocking.
+        self.assertEqual(
+            handled[0], (ss, ss.sock, 'one', '127.0.0.1', None))
+        self.assertEqual(
+            ss.bucket_stats.get(0, 'datagram_count'), len(handled))
+
+    def test_udp_worker_batch(self):
+        handled = []
+
+        def _handler(subserver, stats, sock, datagram, ip, port):
+            handled.append((datagram, ip))
+            if len(handled) == 3:
+                subserver.draining = True
+
+        with self._threads_worker(socket(AF_INET, SOCK_DGRAM)) as ss:
+            ss.batch_size = 4
+            ss.handler = _handler
+            client = socket(AF_INET, SOCK_DGRAM)
+            for datagram in ('one', 'two', 'three'):
+                client.sendto(datagram, ss.sock.getsockname())
+            ss._udp_worker(0)
+            client.close()
+        self.assertEqual(
+            sorted(handled), [
+                ('one', '127.0.0.1'), ('three', '127.0.0.1'),
+                ('two', '127.0.0.1')])
+        self.assertEqual(ss.bucket_stats.get(0, 'datagram_count'), 3)
+
+    def test_udp_worker_handle_batch(self):
+        batches = []
+
+        class _Handler(object):
+
+            def __call__(self, subserver, stats, sock, datagram, ip, port):
+                raise Exception('should not be called')
+
+            def handle_batch(self, subserver, stats, sock, datagrams):
+                batches.append(datagrams)
+                if sum(len(b) for b in batches) == 3:
+                    subserver.draining = True
+
+        with self._threads_worker(socket(AF_INET, SOCK_DGRAM)) as ss:
+            ss.batch_size = 4
+            ss.handler = _Handler()
+            client = socket(AF_INET, SOCK_DGRAM)
+            for datagram in ('one', 'two', 'three'):
+                client.sendto(datagram, ss.sock.getsockname())
+            port = client.getsockname()[1]
+            ss._udp_worker(0)
+            client.close()
+        self.assertEqual(
+            [d for b in batches for d in b], [
+                ('one', '127.0.0.1', port), ('two', '127.0.0.1', port),
+                ('three', '127.0.0.1', port)])
+        self.assertEqual(ss.bucket_stats.get(0, 'datagram_count'), 3)
+
+    def test_receive_batch_eventlet(self):
+        receive_calls = []
+        trampoline_calls = []
+
+        def _receive(flags):
+            receive_calls.append(flags)
+            if len(receive_calls) == 1:
+                raise server.socket_error(server.EAGAIN, 'again')
+            return [('datagram', 'ip', 'port')]
+
+        receiver = PropertyObject()
+        receiver.receive = _receive
+        trampoline_orig = server.trampoline
+        try:
+            server.trampoline = \
+                lambda *a, **kw: trampoline_calls.append((a, kw))
+            ss = self._class(FakeServer(), 'test')
+            ss._parse_conf(Conf(self._get_default_confd()))
+            ss.sock = 'sock'
+            self.assertEqual(
+                ss._receive_batch(receiver), [('datagram', 'ip', 'port')])
+        finally:
+            server.trampoline = trampoline_orig
+        self.assertEqual(
+            receive_calls, [server.MSG_DONTWAIT, server.MSG_DONTWAIT])
+        self.assertEqual(trampoline_calls, [(('sock',), {'read': True})])
+
+    def test_receive_batch_eventlet_error(self):
+
+        def _receive(flags):
+            raise server.socket_error(server.EINVAL, 'invalid')
+
+        receiver = PropertyObject()
+        receiver.receive = _receive
+        ss = self._class(FakeServer(), 'test')
+        ss._parse_conf(Conf(self._get_default_confd()))
+        exc = None
+        try:
+            ss._receive_batch(receiver)
+        except server.socket_error as err:
+            exc = err
+        self.assertEqual(exc.errno, server.EINVAL)
+
+    def _reply_subserver(self, concurrency_model='eventlet'):
+        ss = self._class(FakeServer(), 'test')
+        confd = self._get_default_confd()
+        confd['test'].update({
+            'concurrency_model': concurrency_model,
+            'reply_batch_size': '2', 'reply_queue_size': '3'})
+        ss._parse_conf(Conf(confd))
+        ss.logger = FakeLogger()
+        ss.sock = 'sock'
+        ss._replies = []
+        ss._replies_lock = server.Lock()
+        ss._replies_flushing = False
+        ss._reply_sender = PropertyObject()
+        ss._reply_sender.send_calls = []
+        return ss
+
+    def _watch_drops(self, concurrency_model='eventlet', fails=False):
+        get_udp_drops_calls = []
+        sleep_calls = []
+
+        def _get_udp_drops(*args):
+            get_udp_drops_calls.append(args)
+            if fails:
+                raise OSError(server.ENOENT, 'testing')
+            return 10 * len(get_udp_drops_calls)
+
+        def _sleep(*args):
+            sleep_calls.append(args)
+            if len(sleep_calls) > 1:
+                raise Exception('stop')
+
+        ss = self._class(FakeServer(), 'test')
+        ss._parse_conf(Conf(self._get_default_confd()))
+        ss.concurrency_model = concurrency_model
+        ss.logger = FakeLogger()
+        ss.sock = 'sock'
+        ss.bucket_stats = server._BucketStats(['0'], ss.stats_conf)
+        stats = server._Stats(ss.bucket_stats, 0)
+        get_udp_drops_orig = server.get_udp_drops
+        sleep_orig = server.sleep
+        time_sleep_orig = server.time_sleep
+        exc = None
+        try:
+            server.get_udp_drops = _get_udp_drops
+            if concurrency_model == 'threads':
+                server.time_sleep = _sleep
+            else:
+                server.sleep = _sleep
+            ss._watch_drops(stats)
+        except Exception as err:
+            exc = err
+        finally:
+            server.get_udp_drops = get_udp_drops_orig
+            server.sleep = sleep_orig
+            server.time_sleep = time_sleep_orig
+        return ss, stats, get_udp_drops_calls, sleep_calls, exc
+
+    def test_watch_drops(self):
+        for concurrency_model in ('eventlet', 'threads'):
+            ss, stats, get_udp_drops_calls, sleep_calls, exc = \
+                self._watch_drops(concurrency_model)
+            self.assertEqual(str(exc), 'stop')
+            self.assertEqual(get_udp_drops_calls, [('sock',), ('sock',)])
+            self.assertEqual(sleep_calls, [(5,), (5,)])
+            self.assertEqual(stats.get('datagram_drop_count'), 20)
+
+    def test_watch_drops_fails(self):
+        ss, stats, get_udp_drops_calls, sleep_calls, exc = \
+            self._watch_drops(fails=True)
+        self.assertEqual(exc, None)
+        self.assertEqual(sleep_calls, [])
+        self.assertEqual(ss.logger.error_calls, [
+            ('Could not read [test] datagram drops: [Errno 2] testing',)])
+
+    def test_reply_unbatched(self):
+        sendto_calls = []
+        ss = self._class(FakeServer(), 'test')
+        ss.sock = PropertyObject()
+        ss.sock.sendto = lambda *a: sendto_calls.append(a)
+        ss.reply('datagram', 'ip', 'port')
+        self.assertEqual(sendto_calls, [('datagram', ('ip', 'port'))])
+
+    def test_reply_eventlet(self):
+        spawn_n_calls = []
+        ss = self._reply_subserver()
+        # Room for every reply, as the stubbed flush never drains it.
+        ss.reply_queue_size = 10
+
+        def _send(datagrams, flags):
+            ss._reply_sender.send_calls.append((list(datagrams), flags))
+            return len(datagrams)
+
+        ss._reply_sender.send = _send
+        spawn_n_orig = server.spawn_n
+        try:
+            server.spawn_n = lambda *a: spawn_n_calls.append(a)
+            for index in xrange(3):
+                ss.reply('d%d' % index, 'ip', index)
+        finally:
+            server.spawn_n = spawn_n_orig
+        # Only the first reply starts a flush; the rest join its queue.
+        self.assertEqual(spawn_n_calls, [(ss._flush_replies,)])
+        self.assertEqual(ss._reply_sender.send_calls, [])
+        ss._flush_replies()
+        self.assertEqual(ss._reply_sender.send_calls, [
+            ([('d0', 'ip', 0), ('d1', 'ip', 1)], server.MSG_DONTWAIT),
+            ([('d2', 'ip', 2)], server.MSG_DONTWAIT)])
+        self.assertFalse(ss._replies_flushing)
+        self.assertEqual(ss._replies, [])
+
+    def test_reply_back_pressure(self):
+        sleep_calls = []
+        ss = self._reply_subserver()
+        ss._replies_flushing = True
+        ss._replies.extend([('d', 'ip', 0)] * 2)
+
+        def _sleep(*args):
+            sleep_calls.append(args)
+            del ss._replies[0]
+
+        sleep_orig = server.sleep
+        try:
+            server.sleep = _sleep
+            ss.reply('d', 'ip', 1)
+        finally:
+            server.sleep = sleep_orig
+        self.assertEqual(sleep_calls, [(0.001,)])
+        self.assertEqual(len(ss._replies), 2)
+
+    def test_flush_replies_eagain(self):
+        wait_calls = []
+        ss = self._reply_subserver()
+        ss._replies.extend([('d0', 'ip', 0), ('d1', 'ip', 1)])
+        ss._replies_flushing = True
+
+        def _send(datagrams, flags):
+            ss._reply_sender.send_calls.append(list(datagrams))
+            if len(ss._reply_sender.send_calls) == 2:
+                raise server.socket_error(server.EAGAIN, 'again')
+            return 1
+
+        ss._reply_sender.send = _send
+        ss._wait_writable = lambda: wait_calls.append(True)
+        ss._flush_replies()
+        self.assertEqual(ss._reply_sender.send_calls, [
+            [('d0', 'ip', 0), ('d1', 'ip', 1)], [('d1', 'ip', 1)],
+            [('d1', 'ip', 1)]])
+        self.assertEqual(wait_calls, [True])
+        self.assertFalse(ss._replies_flushing)
+
+    def test_flush_replies_error(self):
+        ss = self._reply_subserver()
+        ss._replies.extend([('d0', 'ip', 0), ('d1', 'ip', 1)])
+        ss._replies_flushing = True
+
+        def _send(datagrams, flags):
+            ss._reply_sender.send_calls.append(list(datagrams))
+            if len(ss._reply_sender.send_calls) == 1:
+                raise server.socket_error(server.EINVAL, 'invalid')
+            return len(datagrams)
+
+        ss._reply_sender.send = _send
+        ss._flush_replies()
+        self.assertEqual(ss._reply_sender.send_calls, [
+            [('d0', 'ip', 0), ('d1', 'ip', 1)], [('d1', 'ip', 1)]])
+        self.assertEqual(
+            ss.logger.error_calls,
+            [('Could not send reply to ip:0: [Errno 22] invalid',)])
+        self.assertFalse(ss._replies_flushing)
+
+    def test_flush_replies_exception(self):
+        ss = self._reply_subserver()
+        ss._replies.append(('d0', 'ip', 0))
+        ss._replies_flushing = True
+
+        def _send(datagrams, flags):
+            raise Exception('test')
+
+        ss._reply_sender.send = _send
+        self.assertRaises(Exception, ss._flush_replies)
+        self.assertFalse(ss._replies_flushing)
+
+    def test_finish_replies(self):
+        sleep_calls = []
+        ss = self._reply_subserver('threads')
+        ss._replies_flushing = True
+
+        def _time_sleep(*args):
+            sleep_calls.append(args)
+            ss._replies_flushing = False
+
+        time_sleep_orig = server.time_sleep
+        try:
+            server.time_sleep = _time_sleep
+            ss._finish_replies()
+        finally:
+            server.time_sleep = time_sleep_orig
+        self.assertEqual(sleep_calls, [(0.01,)])
+
+    def test_wait_writable(self):
+        trampoline_calls = []
+        select_calls = []
+        trampoline_orig = server.trampoline
+        select_orig = server.select
+        try:
+            server.trampoline = \
+                lambda *a, **kw: trampoline_calls.append((a, kw))
+            server.select = lambda *a: select_calls.append(a)
+            self._reply_subserver()._wait_writable()
+            self._reply_subserver('threads')._wait_writable()
+        finally:
+            server.trampoline = trampoline_orig
+            server.select = select_orig
+        self.assertEqual(trampoline_calls, [(('sock',), {'write': True})])
+        self.assertEqual(select_calls, [([], ['sock'], [], 1)])
+
+    def test_udp_worker_threads_reply_batch(self):
+        with self._threads_worker(socket(AF_INET, SOCK_DGRAM)) as ss:
+            ss.reply_batch_size = 4
+            handler = ss.handler(ss.name, ss.handler_conf)
+
+            def _handler(subserver, stats, sock, datagram, ip, port):
+                try:
+                    handler(subserver, stats, sock, datagram, ip, port)
+                finally:
+                    subserver.draining = True
+
+            ss.handler = _handler
+            client = socket(AF_INET, SOCK_DGRAM)
+            client.settimeout(5)
+            client.sendto('one', ss.sock.getsockname())
+            ss._udp_worker(0)
+            self.assertEqual(
+                client.recvfrom(10), ('one', ss.sock.getsockname()))
+            client.close()
+        self.assertFalse(ss._replies_flushing)
+
     def test_start_no_daemon(self):
         self.test_udp_worker(no_daemon=True)
 
     def test_start_raises_socket_einval(self):
         self.test_udp_worker(raises='socket einval')
 
+    def test_start_raises_drain(self):
+        self.test_udp_worker(raises='drain')
+
     def test_start_raises_socket_other(self):
         self.test_udp_worker(raises='socket other')
 
@@ -4452,6 +8016,7 @@ class TestDaemonsSubserver(TestSubserver):
 
     def test_daemon(self, no_setproctitle=False):
         setproctitle_calls = []
+        signal_calls = []
 
         def _setproctitle(*args):
             setproctitle_calls.append(args)
@@ -4465,10 +8030,12 @@ class TestDaemonsSubserver(TestSubserver):
         setproctitle_orig = server.setproctitle
         time_orig = server.time
         sustain_workers_orig = server.sustain_workers
+        signal_orig = server.signal
         try:
             server.setproctitle = None if no_setproctitle else _setproctitle
             server.time = _time
             server.sustain_workers = _sustain_workers
+            server.signal = lambda *a: signal_calls.append(a)
             ss = self._class(FakeServer(output=True), 'test')
             confd = self._get_default_confd()
             confd.setdefault('test', {})['daemons'] = 'one'
@@ -4483,12 +8050,15 @@ class TestDaemonsSubserver(TestSubserver):
             server.setproctitle = setproctitle_orig
             server.time = time_orig
             server.sustain_workers = sustain_workers_orig
+            server.signal = signal_orig
 
         if no_setproctitle:
             self.assertEqual(setproctitle_calls, [])
         else:
             self.assertEqual(setproctitle_calls, [('one:test:brimd',)])
         self.assertEqual(ss.worker_id, 0)
+        self.assertEqual([c[0] for c in signal_calls], [server.SIGURG])
+        self.assertEqual(ss.sampler.interval, 0.01)
         self.assertEqual(ss.bucket_stats.get(ss.worker_id, 'start_time'), 1)
         self.assertEqual(ss.daemons[0][0], 'one')
         self.assertEqual(ss.daemons[0][1].__name__, 'DaemonWithStatsConf')
@@ -4584,8 +8154,8 @@ class TestServer(TestCase):
         self.get_logger_calls = []
         self.capture_calls = []
 
-        def _read_conf(*args):
-            self.read_conf_calls.append(args)
+        def _read_conf(*args, **kwargs):
+            self.read_conf_calls.append((args, kwargs))
             return self.conf
 
         def _fork(*args):
@@ -4623,6 +8193,9 @@ class TestServer(TestCase):
         self.stdout = StringIO()
         self.stderr = StringIO()
         self.serv = server.Server([], self.stdin, self.stdout, self.stderr)
+        self.listen_for_handoff_calls = []
+        self.serv._listen_for_handoff = \
+            lambda: self.listen_for_handoff_calls.append(())
 
     def tearDown(self):
         server.read_conf = self.orig_read_conf
@@ -4707,22 +8280,37 @@ class TestServer(TestCase):
 
     def test_args_default_conf(self):
         self.assertEqual(self.serv.main(), 1)
-        self.assertEqual(self.read_conf_calls, [(server.DEFAULT_CONF_FILES,)])
+        self.assertEqual(
+            self.read_conf_calls,
+            [((server.DEFAULT_CONF_FILES,), {'cache_path': None})])
 
     def test_args_override_conf1(self):
         self.serv.args = ['-c', 'one.conf']
         self.assertEqual(self.serv.main(), 1)
-        self.assertEqual(self.read_conf_calls, [(['one.conf'],)])
+        self.assertEqual(
+            self.read_conf_calls, [((['one.conf'],), {'cache_path': None})])
         self.assertEqual(self.stdout.getvalue(), '')
         self.assertEqual(self.stderr.getvalue(), 'No configuration found.\n')
 
     def test_args_override_conf2(self):
         self.serv.args = ['-c', 'one.conf', '--conf', 'two.conf']
         self.assertEqual(self.serv.main(), 1)
-        self.assertEqual(self.read_conf_calls, [(['one.conf', 'two.conf'],)])
+        self.assertEqual(
+            self.read_conf_calls,
+            [((['one.conf', 'two.conf'],), {'cache_path': None})])
         self.assertEqual(self.stdout.getvalue(), '')
         self.assertEqual(self.stderr.getvalue(), 'No configuration found.\n')
 
+    def test_args_conf_cache(self):
+        self.serv.args = ['-c', 'one.conf', '--conf-cache', '~/brimd.cache']
+        self.assertEqual(self.serv.main(), 1)
+        self.assertEqual(
+            self.read_conf_calls,
+            [((['one.conf'],),
+              {'cache_path': abspath(expanduser('~/brimd.cache'))})])
+        self.assertEqual(
+            self.serv.conf_cache, abspath(expanduser('~/brimd.cache')))
+
     def test_args_default_pid_file(self):
         self.conf.files = ['ok.conf']
         self.serv.args = ['status']
@@ -4851,7 +8439,18 @@ class TestServer(TestCase):
         self.assertEqual(self.serv._parse_args(), self.conf)
         self.assertEqual(self.stdout.getvalue(), '')
         self.assertEqual(self.stderr.getvalue(), '')
-        self.assertEqual(self.fork_calls, [()])
+        self.assertEqual(self.fork_calls, [])
+        self.assertEqual(self.send_pid_sig_calls, [
+            ((self.serv.pid_file, 0), {})])
+        self.assertEqual(self.serv.handoff_pid, 12345)
+
+    def test_restart_not_running(self):
+        self.conf.files = ['ok.conf']
+        self.serv.args = ['restart']
+        self.send_pid_sig_retval[0] = False
+        self.assertEqual(self.serv._parse_args(), self.conf)
+        self.assertEqual(self.fork_calls, [])
+        self.assertEqual(self.serv.handoff_pid, 0)
 
     def test_restart_has_conf_no_pid_file_in_use(self):
         self.conf.files = ['ok.conf']
@@ -4864,19 +8463,6 @@ class TestServer(TestCase):
         self.assertEqual(
             str(exc), 'pid_file not in use so restart cannot be used.')
 
-    def test_restart_has_conf_fork_side(self):
-        self.fork_retval[0] = 0
-        self.conf.files = ['ok.conf']
-        self.serv.args = ['restart']
-        self.assertEqual(self.serv.main(), 0)
-        self.assertEqual(self.stdout.getvalue(), '')
-        self.assertEqual(self.stderr.getvalue(), '')
-        self.assertEqual(self.fork_calls, [()])
-        self.assertEqual(self.send_pid_sig_calls, [
-            ((self.serv.pid_file, 0), {}),
-            ((self.serv.pid_file, server.SIGHUP),
-                {'expect_exit': True, 'pid_override': 12345})])
-
     def test_reload_no_conf(self):
         self.serv.args = ['reload']
         self.assertEqual(self.serv.main(), 1)
@@ -4886,10 +8472,19 @@ class TestServer(TestCase):
     def test_reload_has_conf(self):
         self.conf.files = ['ok.conf']
         self.serv.args = ['reload']
-        self.assertEqual(self.serv._parse_args(), self.conf)
+        self.assertEqual(self.serv._parse_args(), None)
         self.assertEqual(self.stdout.getvalue(), '')
         self.assertEqual(self.stderr.getvalue(), '')
-        self.assertEqual(self.fork_calls, [()])
+        self.assertEqual(self.fork_calls, [])
+        self.assertEqual(self.send_pid_sig_calls, [
+            ((self.serv.pid_file, server.SIGUSR1), {})])
+
+    def test_reload_not_running(self):
+        self.send_pid_sig_retval = [False, 0]
+        self.conf.files = ['ok.conf']
+        self.serv.args = ['reload']
+        self.assertEqual(self.serv._parse_args(), None)
+        self.assertEqual(self.stdout.getvalue(), 'not running\n')
 
     def test_reload_has_conf_no_pid_file_in_use(self):
         self.conf.files = ['ok.conf']
@@ -4902,19 +8497,6 @@ class TestServer(TestCase):
         self.assertEqual(
             str(exc), 'pid_file not in use so reload cannot be used.')
 
-    def test_reload_has_conf_fork_side(self):
-        self.fork_retval[0] = 0
-        self.conf.files = ['ok.conf']
-        self.serv.args = ['reload']
-        self.assertEqual(self.serv.main(), 0)
-        self.assertEqual(self.stdout.getvalue(), '')
-        self.assertEqual(self.stderr.getvalue(), '')
-        self.assertEqual(self.fork_calls, [()])
-        self.assertEqual(self.send_pid_sig_calls, [
-            ((self.serv.pid_file, 0), {}),
-            ((self.serv.pid_file, server.SIGHUP),
-                {'expect_exit': True, 'pid_override': 12345})])
-
     def test_force_reload_no_conf(self):
         self.serv.args = ['force-reload']
         self.assertEqual(self.serv.main(), 1)
@@ -4927,20 +8509,8 @@ class TestServer(TestCase):
         self.assertEqual(self.serv._parse_args(), self.conf)
         self.assertEqual(self.stdout.getvalue(), '')
         self.assertEqual(self.stderr.getvalue(), '')
-        self.assertEqual(self.fork_calls, [()])
-
-    def test_force_reload_has_conf_fork_side(self):
-        self.fork_retval[0] = 0
-        self.conf.files = ['ok.conf']
-        self.serv.args = ['force-reload']
-        self.assertEqual(self.serv.main(), 0)
-        self.assertEqual(self.stdout.getvalue(), '')
-        self.assertEqual(self.stderr.getvalue(), '')
-        self.assertEqual(self.fork_calls, [()])
-        self.assertEqual(self.send_pid_sig_calls, [
-            ((self.serv.pid_file, 0), {}),
-            ((self.serv.pid_file, server.SIGHUP),
-                {'expect_exit': True, 'pid_override': 12345})])
+        self.assertEqual(self.fork_calls, [])
+        self.assertEqual(self.serv.handoff_pid, 12345)
 
     def test_shutdown(self):
         self.conf.files = ['ok.conf']
@@ -5185,7 +8755,10 @@ class TestServer(TestCase):
         # Since we're in no-daemon, Server didn't call sustain_workers, but the
         # wsgi subserver did.
         self.assertEqual(sustain_workers_calls, [
-            ((0, subserv._wsgi_worker), {'logger': subserv.logger})])
+            ((0, subserv._wsgi_worker),
+             {'logger': subserv.logger, 'reload_func': subserv._reload,
+              'reload_batch': 1, 'scale_func': None, 'scale_interval': 5})])
+        self.assertEqual(self.listen_for_handoff_calls, [])
 
     def test_start_no_subservers(self):
         self.conf = Conf({'brim': {'port': '0'}})
@@ -5241,6 +8814,7 @@ class TestServer(TestCase):
         self.assertEqual(sustain_workers_calls, [])
         self.assertEqual(open_calls, [('/var/run/brimd.pid', 'w')])
         self.assertEqual(open_retval[0].getvalue(), '12345\n')
+        self.assertEqual(self.listen_for_handoff_calls, [()])
 
     def test_start_daemoned_child_side(self):
         self.conf = Conf({'brim': {'port': '0'}, 'wsgi': {}})
@@ -5293,6 +8867,217 @@ class TestServer(TestCase):
             ((1, self.serv._start_subserver), {'logger': self.serv.logger})])
         self.assertEqual(self.capture_calls, [])
 
+    def test_start_daemoned_child_side_handoff_signal(self):
+        self.conf = Conf({'brim': {'port': '0'}, 'wsgi': {}})
+        self.conf.files = ['ok.conf']
+        self.serv.args = ['start']
+        self.serv._parse_args()
+        self.serv._parse_conf(self.conf)
+        self.serv.subservers[0]._parse_conf(self.conf)
+        self.fork_retval[0] = 0
+        signal_calls = []
+
+        def _listen_for_handoff():
+            self.serv.handoff_sock = 'handoffsock'
+
+        self.serv._listen_for_handoff = _listen_for_handoff
+        orig_sustain_workers = server.sustain_workers
+        orig_signal = server.signal
+        try:
+            server.sustain_workers = lambda *a, **kw: None
+            server.signal = lambda *a: signal_calls.append(a)
+            self.serv._start()
+        finally:
+            server.sustain_workers = orig_sustain_workers
+            server.signal = orig_signal
+        self.assertEqual(signal_calls, [(server.SIGUSR2, self.serv._handoff)])
+
+    def test_start_receives_handoff(self):
+        self.conf = Conf({'brim': {'port': '0'}, 'wsgi': {}})
+        self.conf.files = ['ok.conf']
+        self.serv.args = ['start']
+        self.serv._parse_args()
+        self.serv._parse_conf(self.conf)
+        subserv = self.serv.subservers[0]
+        subserv._parse_conf(self.conf)
+        self.serv.handoff_pid = 54321
+        handed_sock = server.socket()
+        handed_sock.bind(('127.0.0.1', 0))
+        unused_sock = FakeSocket()
+        receive_calls = []
+        kill_calls = []
+
+        def _receive_listening_sockets(*args, **kwargs):
+            receive_calls.append((args, kwargs))
+            # The previous brimd must not be shut down until its
+            # listening sockets have been handed off.
+            self.assertEqual(self.fork_calls, [])
+            kwargs['request_func']()
+            return {'tcp *:0': handed_sock, 'tcp *:1': unused_sock}
+
+        @contextmanager
+        def _open(*args):
+            yield StringIO()
+
+        orig_receive_listening_sockets = server.receive_listening_sockets
+        orig_kill = server.kill
+        try:
+            server.receive_listening_sockets = _receive_listening_sockets
+            server.kill = lambda *a: kill_calls.append(a)
+            server.open = _open
+            self.serv._start()
+        finally:
+            server.receive_listening_sockets = orig_receive_listening_sockets
+            server.kill = orig_kill
+            del server.open
+        try:
+            self.assertEqual(len(receive_calls), 1)
+            self.assertEqual(
+                receive_calls[0][0], (self.serv.pid_file + '.handoff',))
+            self.assertEqual(kill_calls, [(54321, server.SIGUSR2)])
+            # Once for the child that shuts down the previous brimd and
+            # once to daemonize.
+            self.assertEqual(self.fork_calls, [(), ()])
+            self.assertEqual(self.send_pid_sig_calls, [
+                ((self.serv.pid_file, 0), {})])
+            self.assertTrue(subserv.sock.fd is handed_sock)
+            self.assertTrue(unused_sock.closed)
+            self.assertEqual(self.serv.handoff_socks, {})
+            self.assertEqual(self.stderr.getvalue(), '')
+        finally:
+            handed_sock.close()
+
+    def test_start_handoff_shutdown_side(self):
+        self.conf = Conf({'brim': {'port': '0'}, 'wsgi': {}})
+        self.conf.files = ['ok.conf']
+        self.serv.args = ['start']
+        self.serv._parse_args()
+        self.serv._parse_conf(self.conf)
+        self.serv.handoff_pid = 54321
+        self.fork_retval[0] = 0
+        receive_calls = []
+        privileged_start_calls = []
+
+        def _receive_handoff():
+            receive_calls.append(list(self.send_pid_sig_calls))
+
+        self.serv._receive_handoff = _receive_handoff
+        self.serv.subservers[0]._privileged_start = \
+            lambda: privileged_start_calls.append(True)
+        self.assertEqual(self.serv._start(), 0)
+        self.assertEqual(receive_calls, [[((self.serv.pid_file, 0), {})]])
+        self.assertEqual(self.fork_calls, [()])
+        self.assertEqual(self.send_pid_sig_calls, [
+            ((self.serv.pid_file, 0), {}),
+            ((self.serv.pid_file, server.SIGHUP),
+                {'expect_exit': True, 'pid_override': 54321})])
+        self.assertEqual(privileged_start_calls, [])
+
+    def _receive_handoff_error(self, errno):
+
+        def _receive_listening_sockets(*args, **kwargs):
+            err = server.socket_error('test error')
+            err.errno = errno
+            raise err
+
+        self.serv.pid_file = '/tmp/brimd.pid'
+        self.serv.handoff_pid = 54321
+        orig_receive_listening_sockets = server.receive_listening_sockets
+        try:
+            server.receive_listening_sockets = _receive_listening_sockets
+            self.serv._receive_handoff()
+        finally:
+            server.receive_listening_sockets = orig_receive_listening_sockets
+        self.assertEqual(self.serv.handoff_socks, {})
+
+    def test_receive_handoff_not_supported(self):
+        self._receive_handoff_error(server.ENOENT)
+        self.assertEqual(self.stderr.getvalue(), '')
+        self._receive_handoff_error(server.ECONNREFUSED)
+        self.assertEqual(self.stderr.getvalue(), '')
+
+    def test_receive_handoff_error(self):
+        self._receive_handoff_error(None)
+        self.assertEqual(
+            self.stderr.getvalue(),
+            'Could not take over listening sockets from 54321: test error\n')
+
+    def test_listen_for_handoff(self):
+        tempdir = mkdtemp()
+        try:
+            serv = server.Server([], self.stdin, self.stdout, self.stderr)
+            serv.pid_file = path_join(tempdir, 'brimd.pid')
+            path = serv.pid_file + '.handoff'
+            # A stale handoff socket is replaced.
+            open(path, 'w').close()
+            serv._listen_for_handoff()
+            try:
+                self.assertEqual(stat(path).st_mode & 0777, 0600)
+                client = server.socket(server.AF_UNIX, server.SOCK_STREAM)
+                client.connect(path)
+                client.close()
+            finally:
+                serv.handoff_sock.close()
+        finally:
+            rmtree(tempdir)
+
+    def _handoff(self, raises=False):
+        handoff_calls = []
+        signal_calls = []
+        killpg_calls = []
+
+        def _handoff_listening_sockets(*args):
+            handoff_calls.append(args)
+            if raises:
+                raise Exception('test error')
+
+        self.serv.logger = FakeLogger()
+        self.serv.handoff_sock = 'handoffsock'
+        wsgi_subserv = server.WSGISubserver(self.serv, 'wsgi')
+        wsgi_subserv.ip = '*'
+        wsgi_subserv.port = 80
+        wsgi_subserv.sock = 'wsgisock'
+        udp_subserv = server.UDPSubserver(self.serv, 'udp')
+        udp_subserv.ip = '*'
+        udp_subserv.port = 80
+        udp_subserv.sock = 'udpsock'
+        self.serv.subservers = [
+            wsgi_subserv, udp_subserv, server.DaemonsSubserver(self.serv)]
+        orig_handoff_listening_sockets = server.handoff_listening_sockets
+        orig_signal = server.signal
+        orig_killpg = server.killpg
+        try:
+            server.handoff_listening_sockets = _handoff_listening_sockets
+            server.signal = lambda *a: signal_calls.append(a)
+            server.killpg = lambda *a: killpg_calls.append(a)
+            self.serv._handoff(server.SIGUSR2, None)
+        finally:
+            server.handoff_listening_sockets = orig_handoff_listening_sockets
+            server.signal = orig_signal
+            server.killpg = orig_killpg
+        self.assertEqual(handoff_calls, [
+            ('handoffsock', {'tcp *:80': 'wsgisock', 'udp *:80': 'udpsock'})])
+        return signal_calls, killpg_calls
+
+    def test_handoff(self):
+        signal_calls, killpg_calls = self._handoff()
+        self.assertEqual(
+            self.serv.logger.info_calls, [('Listening sockets handed off.',)])
+        self.assertEqual(signal_calls, [
+            (server.SIGUSR2, server.SIG_IGN),
+            (server.SIGUSR2, self.serv._handoff)])
+        self.assertEqual(killpg_calls, [(0, server.SIGUSR2)])
+
+    def test_handoff_fails(self):
+        signal_calls, killpg_calls = self._handoff(raises=True)
+        self.assertEqual(len(self.serv.logger.exception_calls), 1)
+        self.assertEqual(
+            self.serv.logger.exception_calls[0][0],
+            ('Listening socket handoff failed: test error',))
+        self.assertEqual(self.serv.logger.info_calls, [])
+        self.assertEqual(signal_calls, [])
+        self.assertEqual(killpg_calls, [])
+
     def test_start_subserver(self, no_setproctitle=False):
         self.conf = Conf({'brim': {'port': '0'}, 'wsgi': {}})
         self.conf.files = ['ok.conf']
@@ -15,11 +15,16 @@ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 See the License for the specific language governing permissions and
 limitations under the License.
 """
+import os
 import socket
 import ssl
 import time
-from errno import EADDRINUSE, EPERM
-from os import devnull
+from errno import EADDRINUSE, EAGAIN, EBADF, EINVAL, ENOENT, EPERM, EPIPE
+from os import devnull, mkdir
+from os.path import join as path_join
+from shutil import rmtree
+from tempfile import mkdtemp, TemporaryFile
+from threading import Event, Thread
 from unittest import main, TestCase
 from nose import SkipTest
 
@@ -521,6 +526,452 @@ class BadBindSocket(FakeSocket):
         raise exc
 
 
+class Test_parse_cpu_list(TestCase):
+
+    def test_parse_cpu_list(self):
+        self.assertEqual(service.parse_cpu_list(''), [])
+        self.assertEqual(service.parse_cpu_list('3'), [3])
+        self.assertEqual(
+            service.parse_cpu_list('0-3,8 10'), [0, 1, 2, 3, 8, 10])
+        self.assertEqual(service.parse_cpu_list('4, 2\n'), [4, 2])
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, service.parse_cpu_list, 'abc')
+        self.assertRaises(ValueError, service.parse_cpu_list, '1-')
+
+
+class Test_get_numa_nodes(TestCase):
+
+    def setUp(self):
+        self.tempdir = mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.tempdir)
+
+    def _node(self, name, cpulist):
+        mkdir(path_join(self.tempdir, name))
+        if cpulist is not None:
+            with open(path_join(self.tempdir, name, 'cpulist'), 'w') as fp:
+                fp.write(cpulist)
+
+    def test_get_numa_nodes(self):
+        self._node('node1', '4-7\n')
+        self._node('node0', '0-3\n')
+        self._node('power', None)
+        self.assertEqual(
+            service.get_numa_nodes(self.tempdir),
+            [[0, 1, 2, 3], [4, 5, 6, 7]])
+
+    def test_no_sysfs(self):
+        self.assertEqual(
+            service.get_numa_nodes(path_join(self.tempdir, 'nonexistent')),
+            [])
+
+    def test_unreadable_node(self):
+        self._node('node0', '0-3\n')
+        self._node('node1', None)
+        self.assertEqual(service.get_numa_nodes(self.tempdir), [])
+
+
+class Test_cpu_affinity(TestCase):
+
+    def setUp(self):
+        try:
+            self.orig_cpus = service.get_cpu_affinity()
+        except OSError:
+            raise SkipTest()
+
+    def tearDown(self):
+        service.set_cpu_affinity(self.orig_cpus)
+
+    def test_set_and_get(self):
+        service.set_cpu_affinity(self.orig_cpus[:1])
+        self.assertEqual(service.get_cpu_affinity(), self.orig_cpus[:1])
+        service.set_cpu_affinity(self.orig_cpus)
+        self.assertEqual(service.get_cpu_affinity(), self.orig_cpus)
+
+    def test_set_invalid(self):
+        exc = None
+        try:
+            service.set_cpu_affinity([1023])
+        except OSError as err:
+            exc = err
+        self.assertEqual(exc.errno, EINVAL)
+
+    def test_unsupported(self):
+        orig_libc = service._libc
+        try:
+            service._libc = lambda: object()
+            self.assertRaises(OSError, service.get_cpu_affinity)
+            self.assertRaises(OSError, service.set_cpu_affinity, [0])
+        finally:
+            service._libc = orig_libc
+
+
+class Test_posix_fadvise(TestCase):
+
+    def test_sequential(self):
+        with TemporaryFile() as fp:
+            fp.write('data')
+            service.posix_fadvise(
+                fp.fileno(), 0, 0, service.POSIX_FADV_SEQUENTIAL)
+
+    def test_bad_fd(self):
+        exc = None
+        try:
+            service.posix_fadvise(-1, 0, 0, service.POSIX_FADV_SEQUENTIAL)
+        except OSError as err:
+            exc = err
+        self.assertEqual(exc.errno, EBADF)
+
+    def test_unsupported(self):
+        orig_libc = service._libc
+        try:
+            service._libc = lambda: object()
+            self.assertRaises(
+                OSError, service.posix_fadvise, 0, 0, 0,
+                service.POSIX_FADV_SEQUENTIAL)
+        finally:
+            service._libc = orig_libc
+
+
+class Test_DatagramBatchReceiver(TestCase):
+
+    def setUp(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(('127.0.0.1', 0))
+        self.client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            self.receiver = service.DatagramBatchReceiver(self.sock, 3, 4)
+        except OSError:
+            self.tearDown()
+            raise SkipTest()
+
+    def tearDown(self):
+        self.sock.close()
+        self.client.close()
+
+    def test_receive(self):
+        for datagram in ('a', 'bb', 'ccc', 'dddd', 'eeeee'):
+            self.client.sendto(datagram, self.sock.getsockname())
+        port = self.client.getsockname()[1]
+        self.assertEqual(self.receiver.receive(), [
+            ('a', '127.0.0.1', port), ('bb', '127.0.0.1', port),
+            ('ccc', '127.0.0.1', port)])
+        # Returns what is waiting rather than blocking for a full batch,
+        # truncating anything over max_datagram_size.
+        self.assertEqual(self.receiver.receive(), [
+            ('dddd', '127.0.0.1', port), ('eeee', '127.0.0.1', port)])
+
+    def test_receive_ipv6(self):
+        try:
+            sock = socket.socket(socket.AF_INET6, socket.SOCK_DGRAM)
+            sock.bind(('::1', 0))
+        except socket.error:
+            raise SkipTest()
+        client = socket.socket(socket.AF_INET6, socket.SOCK_DGRAM)
+        try:
+            client.sendto('six', sock.getsockname()[:2])
+            self.assertEqual(
+                service.DatagramBatchReceiver(sock, 2, 8).receive(),
+                [('six', '::1', client.getsockname()[1])])
+        finally:
+            sock.close()
+            client.close()
+
+    def test_receive_nothing_waiting(self):
+        exc = None
+        try:
+            self.receiver.receive(socket.MSG_DONTWAIT)
+        except socket.error as err:
+            exc = err
+        self.assertEqual(exc.errno, EAGAIN)
+
+    def test_unsupported(self):
+        orig_libc = service._libc
+        try:
+            service._libc = lambda: object()
+            self.assertRaises(
+                OSError, service.DatagramBatchReceiver, self.sock, 3, 4)
+        finally:
+            service._libc = orig_libc
+
+
+class Test_DatagramBatchSender(TestCase):
+
+    def setUp(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.settimeout(5)
+        self.client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.client.bind(('127.0.0.1', 0))
+        try:
+            self.sender = service.DatagramBatchSender(self.client, 2)
+        except OSError:
+            self.tearDown()
+            raise SkipTest()
+
+    def tearDown(self):
+        self.sock.close()
+        self.client.close()
+
+    def test_send(self):
+        port = self.sock.getsockname()[1]
+        datagrams = [
+            ('a', '127.0.0.1', port), ('bb', '127.0.0.1', port),
+            ('ccc', '127.0.0.1', port)]
+        self.assertEqual(self.sender.send(datagrams), 2)
+        self.assertEqual(self.sender.send(datagrams[2:]), 1)
+        for datagram in ('a', 'bb', 'ccc'):
+            self.assertEqual(
+                self.sock.recvfrom(10),
+                (datagram, self.client.getsockname()))
+
+    def test_send_ipv6(self):
+        try:
+            sock = socket.socket(socket.AF_INET6, socket.SOCK_DGRAM)
+            sock.bind(('::1', 0))
+        except socket.error:
+            raise SkipTest()
+        client = socket.socket(socket.AF_INET6, socket.SOCK_DGRAM)
+        try:
+            sock.settimeout(5)
+            self.assertEqual(
+                service.DatagramBatchSender(client, 2).send(
+                    [('six', '::1', sock.getsockname()[1])]), 1)
+            self.assertEqual(sock.recv(10), 'six')
+        finally:
+            sock.close()
+            client.close()
+
+    def test_send_error(self):
+        exc = None
+        try:
+            self.sender.send([('a', '127.0.0.1', 0)])
+        except socket.error as err:
+            exc = err
+        self.assertEqual(exc.errno, EINVAL)
+
+    def test_unsupported(self):
+        orig_libc = service._libc
+        try:
+            service._libc = lambda: object()
+            self.assertRaises(
+                OSError, service.DatagramBatchSender, self.sock, 2)
+        finally:
+            service._libc = orig_libc
+
+
+class Test_SocketSplicer(TestCase):
+
+    def setUp(self):
+        self.src, self.src_peer = socket.socketpair()
+        self.dst, self.dst_peer = socket.socketpair()
+        try:
+            self.splicer = service.SocketSplicer(4)
+        except OSError:
+            self.tearDown()
+            raise SkipTest()
+
+    def tearDown(self):
+        for sock in (self.src, self.src_peer, self.dst, self.dst_peer):
+            sock.close()
+        if hasattr(self, 'splicer'):
+            self.splicer.close()
+
+    def test_splice(self):
+        self.src_peer.sendall('abcdef')
+        self.assertEqual(self.splicer.receive(self.src), 4)
+        self.assertEqual(self.splicer.pending, 4)
+        self.assertEqual(self.splicer.send(self.dst), 4)
+        self.assertEqual(self.splicer.pending, 0)
+        self.assertEqual(self.dst_peer.recv(10), 'abcd')
+        self.assertEqual(self.splicer.receive(self.src), 2)
+        self.assertEqual(self.splicer.send(self.dst), 2)
+        self.assertEqual(self.dst_peer.recv(10), 'ef')
+        self.src_peer.shutdown(socket.SHUT_WR)
+        self.assertEqual(self.splicer.receive(self.src), 0)
+
+    def test_eagain(self):
+        self.src.setblocking(0)
+        exc = None
+        try:
+            self.splicer.receive(self.src)
+        except socket.error as err:
+            exc = err
+        self.assertEqual(exc.errno, EAGAIN)
+        self.assertEqual(self.splicer.pending, 0)
+
+    def test_large_chunk_size(self):
+        splicer = service.SocketSplicer(1 << 20)
+        try:
+            self.src_peer.sendall('x' * 200000)
+            self.src_peer.shutdown(socket.SHUT_WR)
+            received = 0
+            while True:
+                count = splicer.receive(self.src)
+                if not count:
+                    break
+                received += count
+                while splicer.pending:
+                    splicer.send(self.dst)
+                    self.dst_peer.recv(1 << 20)
+            self.assertEqual(received, 200000)
+        finally:
+            splicer.close()
+
+    def test_unsupported(self):
+        orig_libc = service._libc
+        try:
+            service._libc = lambda: object()
+            self.assertRaises(OSError, service.SocketSplicer)
+        finally:
+            service._libc = orig_libc
+
+
+class Test_SocketStream(TestCase):
+
+    def setUp(self):
+        self.sock, self.peer = socket.socketpair()
+        self.stream = service.SocketStream(self.sock, chunk_size=8, limit=32)
+
+    def tearDown(self):
+        self.sock.close()
+        self.peer.close()
+
+    def test_readline(self):
+        self.peer.sendall('one\ntwo is longer\nthr')
+        self.assertEqual(self.stream.readline(), 'one\n')
+        self.assertEqual(self.stream.readline(), 'two is longer\n')
+        self.peer.sendall('ee')
+        self.peer.shutdown(socket.SHUT_WR)
+        self.assertEqual(self.stream.readline(), 'three')
+        self.assertEqual(self.stream.readline(), '')
+
+    def test_readuntil(self):
+        self.peer.sendall('abc\r')
+        self.peer.sendall('\ndef\r\n')
+        self.assertEqual(self.stream.readuntil('\r\n'), 'abc\r\n')
+        self.assertEqual(self.stream.readuntil('\r\n'), 'def\r\n')
+
+    def test_readuntil_eof(self):
+        self.peer.sendall('abc')
+        self.peer.shutdown(socket.SHUT_WR)
+        exc = None
+        try:
+            self.stream.readuntil('\r\n')
+        except EOFError as err:
+            exc = err
+        self.assertEqual(
+            str(exc), "End of file after 3 bytes without '\\r\\n'.")
+        self.assertEqual(self.stream.read(10), 'abc')
+
+    def test_readuntil_limit(self):
+        self.peer.sendall('x' * 40)
+        exc = None
+        try:
+            self.stream.readuntil()
+        except Exception as err:
+            exc = err
+        self.assertEqual(str(exc), "No '\\n' found within 32 bytes.")
+
+    def test_readexactly(self):
+        self.peer.sendall('0123456789' * 3)
+        self.assertEqual(self.stream.readexactly(5), '01234')
+        self.assertEqual(
+            self.stream.readexactly(20), '56789012345678901234')
+        self.peer.shutdown(socket.SHUT_WR)
+        exc = None
+        try:
+            self.stream.readexactly(10)
+        except EOFError as err:
+            exc = err
+        self.assertEqual(str(exc), 'End of file after 5 of 10 bytes.')
+        self.assertEqual(self.stream.readexactly(5), '56789')
+
+    def test_readinto(self):
+        self.peer.sendall('abc\ndefgh')
+        self.assertEqual(self.stream.readline(), 'abc\n')
+        buf = bytearray(10)
+        self.assertEqual(self.stream.readinto(buf), 4)
+        self.assertEqual(buf[:4], 'defg')
+        self.assertEqual(self.stream.readinto(buf), 1)
+        self.assertEqual(buf[:1], 'h')
+        self.peer.sendall('ijklm')
+        self.assertEqual(self.stream.readinto(buf), 5)
+        self.assertEqual(buf[:5], 'ijklm')
+
+    def test_write_and_flush(self):
+        self.stream.write('abc')
+        self.stream.write(bytearray('de'))
+        self.peer.setblocking(0)
+        self.assertRaises(socket.error, self.peer.recv, 10)
+        self.peer.setblocking(1)
+        self.stream.flush()
+        self.assertEqual(self.peer.recv(10), 'abcde')
+        # Reaching chunk_size flushes.
+        self.stream.write('abc')
+        self.stream.write('defghi')
+        self.assertEqual(self.peer.recv(10), 'abcdefghi')
+
+    def test_read_flushes(self):
+        self.stream.write('ping')
+        self.peer.sendall('pong')
+        self.assertEqual(self.stream.read(10), 'pong')
+        self.assertEqual(self.peer.recv(10), 'ping')
+
+    def test_writev(self):
+        self.stream.write('a')
+        self.stream.writev(['bc', '', bytearray('de'), 'f'])
+        self.assertEqual(self.peer.recv(10), 'abcdef')
+
+    def test_writev_large(self):
+        self.sock.settimeout(5)
+        buffers = ['x' * 300000, bytearray('y' * 300000), 'z']
+        received = []
+
+        def _receive():
+            received.extend(iter(lambda: self.peer.recv(65536), ''))
+
+        receiver = Thread(target=_receive)
+        receiver.start()
+        self.stream.writev(buffers * 3)
+        self.sock.shutdown(socket.SHUT_WR)
+        receiver.join()
+        self.assertEqual(''.join(received), ''.join(map(str, buffers)) * 3)
+
+    def test_writev_no_sendmsg(self):
+        self.stream._sendmsg = None
+        self.stream.writev(['ab', bytearray('cd')])
+        self.assertEqual(self.peer.recv(10), 'abcd')
+
+    def test_writev_error(self):
+        self.peer.close()
+        exc = None
+        try:
+            self.stream.writev(['abc'])
+            self.stream.writev(['abc'])
+        except socket.error as err:
+            exc = err
+        self.assertEqual(exc.errno, EPIPE)
+
+    def test_ssl_not_gathered(self):
+
+        class SSLSocket(object):
+
+            def cipher(self):
+                pass
+
+        stream = service.SocketStream(SSLSocket())
+        self.assertEqual(stream._sendmsg, None)
+
+    def test_close(self):
+        self.stream.write('abc')
+        self.stream.close()
+        self.assertEqual(self.peer.recv(10), 'abc')
+        self.assertEqual(self.peer.recv(10), '')
+
+
 class Test_get_listening_tcp_socket(TestCase):
 
     def setUp(self):
@@ -771,6 +1222,111 @@ class Test_get_listening_tcp_socket(TestCase):
             exc = err
         self.assertEqual(str(exc), 'badbind')
 
+    def test_given_sock(self):
+        given = FakeSocket()
+        sock = service.get_listening_tcp_socket(
+            '1.2.3.4', 5678, backlog=1000, sock=given)
+        self.assertTrue(sock is given)
+        self.assertEqual(self.getaddrinfo_calls, [])
+        self.assertEqual(sock.bind_calls, [])
+        self.assertEqual(sock.listen_calls, [(1000,)])
+        self.assertEqual(self.wrap_socket_calls, [])
+
+    def test_given_sock_wrapped(self):
+        sock = service.get_listening_tcp_socket(
+            '1.2.3.4', 5678, certfile='certfile', keyfile='keyfile',
+            sock=FakeSocket())
+        self.assertEqual(sock, 'wrappedsock')
+        self.assertEqual(len(self.wrap_socket_calls), 1)
+
+    def test_given_sock_eventlet(self):
+        try:
+            import eventlet.green.socket
+        except ImportError:
+            raise SkipTest()
+        orig_esocket = eventlet.green.socket.socket
+        given = FakeSocket()
+        try:
+            eventlet.green.socket.socket = FakeSocket
+            sock = service.get_listening_tcp_socket(
+                '1.2.3.4', 5678, style='eventlet', sock=given)
+            self.assertEqual(sock.init, (given,))
+            self.assertEqual(sock.listen_calls, [(4096,)])
+        finally:
+            eventlet.green.socket.socket = orig_esocket
+
+
+class Test_get_ssl_context(TestCase):
+
+    def _get_ssl_context(self, ssl_module, *args, **kwargs):
+        calls = []
+
+        class SSLContext(object):
+
+            def __init__(self, protocol):
+                calls.append(('init', protocol))
+                self.options = 0
+
+            def load_cert_chain(self, certfile, keyfile):
+                calls.append(('load_cert_chain', certfile, keyfile))
+
+            def set_ciphers(self, ciphers):
+                calls.append(('set_ciphers', ciphers))
+
+            def set_alpn_protocols(self, protocols):
+                calls.append(('set_alpn_protocols', protocols))
+
+        orig_SSLContext = ssl_module.SSLContext
+        try:
+            ssl_module.SSLContext = SSLContext
+            context = service.get_ssl_context(*args, **kwargs)
+        finally:
+            ssl_module.SSLContext = orig_SSLContext
+        return context, calls
+
+    def test_defaults(self):
+        context, calls = self._get_ssl_context(ssl, 'cert', 'key')
+        self.assertEqual(calls, [
+            ('init', ssl.PROTOCOL_SSLv23), ('load_cert_chain', 'cert', 'key')])
+        self.assertEqual(
+            context.options,
+            ssl.OP_NO_SSLv2 | ssl.OP_NO_SSLv3 | ssl.OP_NO_COMPRESSION |
+            ssl.OP_CIPHER_SERVER_PREFERENCE)
+
+    def test_options(self):
+        context, calls = self._get_ssl_context(
+            ssl, 'cert', 'key', ciphers='HIGH', alpn_protocols=['http/1.1'],
+            session_tickets=False)
+        self.assertEqual(calls[1:], [
+            ('load_cert_chain', 'cert', 'key'), ('set_ciphers', 'HIGH'),
+            ('set_alpn_protocols', ['http/1.1'])])
+        self.assertTrue(context.options & service._OP_NO_TICKET)
+
+    def test_eventlet(self):
+        try:
+            import eventlet.green.ssl
+        except ImportError:
+            raise SkipTest()
+        context, calls = self._get_ssl_context(
+            eventlet.green.ssl, 'cert', 'key', style='eventlet')
+        self.assertEqual(calls[0], ('init', ssl.PROTOCOL_SSLv23))
+
+    def test_bad_style(self):
+        exc = None
+        try:
+            service.get_ssl_context('cert', 'key', style='bad')
+        except ValueError as err:
+            exc = err
+        self.assertEqual(str(exc), "Socket style 'bad' not understood.")
+
+    def test_real_context(self):
+        exc = None
+        try:
+            service.get_ssl_context('/no/such/cert', '/no/such/key')
+        except IOError as err:
+            exc = err
+        self.assertTrue(exc is not None)
+
 
 class Test_get_listening_udp_socket(TestCase):
 
@@ -951,6 +1507,326 @@ class Test_get_listening_udp_socket(TestCase):
             exc = err
         self.assertEqual(str(exc), 'badbind')
 
+    def test_given_sock(self):
+        given = FakeSocket()
+        sock = service.get_listening_udp_socket('1.2.3.4', 5678, sock=given)
+        self.assertTrue(sock is given)
+        self.assertEqual(self.getaddrinfo_calls, [])
+        self.assertEqual(sock.bind_calls, [])
+
+    def test_given_sock_eventlet(self):
+        try:
+            import eventlet.green.socket
+        except ImportError:
+            raise SkipTest()
+        orig_esocket = eventlet.green.socket.socket
+        given = FakeSocket()
+        try:
+            eventlet.green.socket.socket = FakeSocket
+            sock = service.get_listening_udp_socket(
+                '1.2.3.4', 5678, style='eventlet', sock=given)
+            self.assertEqual(sock.init, (given,))
+        finally:
+            eventlet.green.socket.socket = orig_esocket
+
+
+class Test_tune_socket(TestCase):
+
+    def test_nothing_set(self):
+        sock = socket.socket()
+        try:
+            self.assertEqual(service.tune_socket(sock), {})
+        finally:
+            sock.close()
+
+    def test_granted(self):
+        sock = socket.socket()
+        try:
+            granted = service.tune_socket(
+                sock, socket_sndbuf=65536, tcp_nodelay=True,
+                tcp_keepidle=30, tcp_keepintvl=10, tcp_keepcnt=3)
+        finally:
+            sock.close()
+        # The kernel doubles the buffer sizes asked for.
+        self.assertTrue(granted['socket_sndbuf'] >= 65536)
+        del granted['socket_sndbuf']
+        self.assertEqual(granted, {
+            'tcp_nodelay': 1, 'tcp_keepidle': 30, 'tcp_keepintvl': 10,
+            'tcp_keepcnt': 3})
+
+    def test_calls(self):
+        calls = []
+
+        class FakeSocket(object):
+
+            def setsockopt(self, *args):
+                calls.append(('set',) + args)
+
+            def getsockopt(self, *args):
+                calls.append(('get',) + args)
+                return 7
+
+        granted = service.tune_socket(
+            FakeSocket(), socket_rcvbuf=1, socket_busy_poll=2,
+            tcp_defer_accept=5, tcp_fastopen=4)
+        self.assertEqual(granted, {
+            'socket_rcvbuf': 7, 'socket_busy_poll': 7, 'tcp_defer_accept': 7,
+            'tcp_fastopen': 7})
+        self.assertEqual(calls, [
+            ('set', socket.SOL_SOCKET, service._SO_RCVBUFFORCE, 1),
+            ('get', socket.SOL_SOCKET, socket.SO_RCVBUF),
+            ('set', socket.SOL_SOCKET, service._SO_BUSY_POLL, 2),
+            ('get', socket.SOL_SOCKET, service._SO_BUSY_POLL),
+            ('set', socket.IPPROTO_TCP, socket.TCP_DEFER_ACCEPT, 5),
+            ('get', socket.IPPROTO_TCP, socket.TCP_DEFER_ACCEPT),
+            ('set', socket.IPPROTO_TCP, service._TCP_FASTOPEN, 4),
+            ('get', socket.IPPROTO_TCP, service._TCP_FASTOPEN)])
+
+    def test_force_not_permitted(self):
+        calls = []
+
+        class FakeSocket(object):
+
+            def setsockopt(self, *args):
+                calls.append(args)
+                if args[1] == service._SO_SNDBUFFORCE:
+                    raise socket.error(EPERM, 'testing')
+
+            def getsockopt(self, *args):
+                return 42
+
+        granted = service.tune_socket(FakeSocket(), socket_sndbuf=10)
+        self.assertEqual(granted, {'socket_sndbuf': 42})
+        self.assertEqual(calls, [
+            (socket.SOL_SOCKET, service._SO_SNDBUFFORCE, 10),
+            (socket.SOL_SOCKET, socket.SO_SNDBUF, 10)])
+
+    def test_error(self):
+
+        class FakeSocket(object):
+
+            def setsockopt(self, *args):
+                raise socket.error(EINVAL, 'testing')
+
+        exc = None
+        try:
+            service.tune_socket(FakeSocket(), tcp_nodelay=True)
+        except socket.error as err:
+            exc = err
+        self.assertEqual(exc.errno, EINVAL)
+
+
+class Test_get_udp_drops(TestCase):
+
+    def setUp(self):
+        self.testdir = mkdtemp()
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.inode = os.fstat(self.sock.fileno()).st_ino
+
+    def tearDown(self):
+        self.sock.close()
+        rmtree(self.testdir)
+
+    def _write(self, name, inode, drops):
+        path = path_join(self.testdir, name)
+        with open(path, 'w') as fp:
+            fp.write(
+                '   sl  local_address rem_address   st tx_queue rx_queue tr '
+                'tm->when retrnsmt   uid  timeout inode ref pointer drops\n')
+            fp.write(
+                ' 1: 00000000:0044 00000000:0000 07 00000000:00000000 '
+                '00:00000000 00000000     0        0 %d 2 0000000000000000 '
+                '%d\n' % (inode, drops))
+        return path
+
+    def test_real(self):
+        self.sock.bind(('127.0.0.1', 0))
+        try:
+            self.assertEqual(service.get_udp_drops(self.sock), 0)
+        except OSError:
+            raise SkipTest('/proc/net/udp not available')
+
+    def test_found(self):
+        paths = (self._write('udp', self.inode + 1, 3),
+                 self._write('udp6', self.inode, 42))
+        self.assertEqual(service.get_udp_drops(self.sock, paths), 42)
+
+    def test_not_found(self):
+        paths = (self._write('udp', self.inode + 1, 3),
+                 path_join(self.testdir, 'missing'))
+        exc = None
+        try:
+            service.get_udp_drops(self.sock, paths)
+        except OSError as err:
+            exc = err
+        self.assertEqual(exc.errno, ENOENT)
+        self.assertEqual(
+            exc.strerror, 'No entry for the socket in %s or %s.' % paths)
+
+
+class Test_handoff_listening_sockets(TestCase):
+
+    def setUp(self):
+        self.tempdir = mkdtemp()
+        self.path = path_join(self.tempdir, 'handoff')
+        self.handoff_sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.handoff_sock.bind(self.path)
+        self.handoff_sock.listen(1)
+        self.tcp_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.tcp_sock.bind(('127.0.0.1', 0))
+        self.tcp_sock.listen(5)
+        self.udp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.udp_sock.bind(('127.0.0.1', 0))
+
+    def tearDown(self):
+        self.handoff_sock.close()
+        self.tcp_sock.close()
+        self.udp_sock.close()
+        rmtree(self.tempdir)
+
+    def test_handoff(self):
+        request_calls = []
+
+        def _request():
+            request_calls.append(True)
+            service.handoff_listening_sockets(
+                self.handoff_sock,
+                {'tcp': self.tcp_sock, 'udp': self.udp_sock})
+
+        socks = service.receive_listening_sockets(
+            self.path, request_func=_request)
+        try:
+            self.assertEqual(request_calls, [True])
+            self.assertEqual(sorted(socks.keys()), ['tcp', 'udp'])
+            self.assertEqual(socks['tcp'].type, socket.SOCK_STREAM)
+            self.assertEqual(
+                socks['tcp'].getsockname(), self.tcp_sock.getsockname())
+            self.assertEqual(socks['udp'].type, socket.SOCK_DGRAM)
+            self.assertEqual(
+                socks['udp'].getsockname(), self.udp_sock.getsockname())
+            # The received socket is the very same listening socket.
+            client = socket.create_connection(self.tcp_sock.getsockname())
+            try:
+                conn = socks['tcp'].accept()[0]
+                conn.close()
+            finally:
+                client.close()
+        finally:
+            for sock in socks.itervalues():
+                sock.close()
+
+    def test_handoff_nothing(self):
+        socks = service.receive_listening_sockets(
+            self.path, request_func=lambda: service.handoff_listening_sockets(
+                self.handoff_sock, {}))
+        self.assertEqual(socks, {})
+
+    def test_handoff_times_out_without_connection(self):
+        exc = None
+        try:
+            service.handoff_listening_sockets(
+                self.handoff_sock, {'tcp': self.tcp_sock}, timeout=0)
+        except socket.error as err:
+            exc = err
+        self.assertEqual(str(exc), 'No handoff connection after 0 seconds.')
+
+    def test_receive_times_out_without_handoff(self):
+        exc = None
+        try:
+            service.receive_listening_sockets(self.path, timeout=0)
+        except socket.error as err:
+            exc = err
+        self.assertEqual(
+            str(exc), 'Handoff did not complete after 0 seconds.')
+
+    def test_receive_connection_closed_early(self):
+
+        def _request():
+            self.handoff_sock.accept()[0].close()
+
+        exc = None
+        try:
+            service.receive_listening_sockets(self.path, request_func=_request)
+        except socket.error as err:
+            exc = err
+        self.assertEqual(str(exc), 'Handoff connection closed early.')
+
+    def test_receive_no_such_path(self):
+        exc = None
+        try:
+            service.receive_listening_sockets(self.path + '-nonexistent')
+        except socket.error as err:
+            exc = err
+        self.assertEqual(exc.errno, ENOENT)
+
+
+class Test_StackSampler(TestCase):
+
+    def test_sample(self):
+        ready = []
+        released = []
+
+        def _busy_here():
+            ready.append(True)
+            while not released:
+                pass
+
+        thread = Thread(target=_busy_here)
+        thread.start()
+        try:
+            while not ready:
+                time.sleep(0.001)
+            sampler = service.StackSampler()
+            sampler.sample()
+            sampler.sample()
+        finally:
+            released.append(True)
+            thread.join()
+        stacks = [s for s in sampler.counts if '_busy_here (' in s]
+        self.assertEqual(len(stacks), 1)
+        self.assertEqual(sampler.counts[stacks[0]], 2)
+        names = stacks[0].split(';')
+        self.assertTrue(names[0].startswith('__bootstrap ('))
+        self.assertTrue(names[-1].startswith('_busy_here ('))
+        self.assertTrue(names[-1].endswith('test_service.py:%d)' % (
+            _busy_here.__code__.co_firstlineno)))
+        # The sampling thread itself is never sampled.
+        self.assertFalse(
+            [s for s in sampler.counts if 'test_sample (' in s])
+
+    def test_folded(self):
+        sampler = service.StackSampler()
+        self.assertEqual(sampler.folded(), '')
+        sampler.counts = {'b (x.py:1);c (x.py:5)': 2, 'a (x.py:9)': 7}
+        self.assertEqual(
+            sampler.folded(), 'a (x.py:9) 7\nb (x.py:1);c (x.py:5) 2\n')
+
+    def test_start(self):
+        done = []
+        finished = Event()
+        sample_calls = []
+
+        def _done(folded):
+            done.append(folded)
+            finished.set()
+
+        sampler = service.StackSampler(interval=0.001)
+        sampler.counts = {'old': 1}
+        sampler.sample = lambda: sample_calls.append(1)
+        self.assertTrue(sampler.start(0.01, _done))
+        self.assertTrue(sampler.running)
+        self.assertEqual(sampler.counts, {})
+        self.assertFalse(sampler.start(0.01, _done))
+        finished.wait(5)
+        self.assertEqual(done, [''])
+        self.assertTrue(sample_calls)
+        for _junk in xrange(500):
+            if not sampler.running:
+                break
+            time.sleep(0.01)
+        self.assertFalse(sampler.running)
+        self.assertEqual(len(done), 1)
+
 
 class Test_signum2str(TestCase):
 
@@ -965,6 +1841,7 @@ class FakeLogger(object):
     def __init__(self):
         self.debug_calls = []
         self.info_calls = []
+        self.error_calls = []
         self.exception_calls = []
 
     def debug(self, *args):
@@ -973,10 +1850,43 @@ class FakeLogger(object):
     def info(self, *args):
         self.info_calls.append(args)
 
+    def error(self, *args):
+        self.error_calls.append(args)
+
     def exception(self, *args):
         self.exception_calls.append(args)
 
 
+class Test_worker_ready(TestCase):
+
+    def tearDown(self):
+        service._ready_fd = None
+
+    def test_worker_ready(self):
+        read_fd, write_fd = os.pipe()
+        try:
+            service._ready_fd = write_fd
+            self.assertEqual(service._read_ready([read_fd], 0), {})
+            service.worker_ready()
+            self.assertEqual(service._ready_fd, None)
+            self.assertEqual(
+                service._read_ready([read_fd], 0), {read_fd: True})
+        finally:
+            try:
+                os.close(read_fd)
+            except OSError:
+                pass
+
+    def test_worker_exited(self):
+        read_fd, write_fd = os.pipe()
+        os.close(write_fd)
+        self.assertEqual(service._read_ready([read_fd], 0), {read_fd: False})
+
+    def test_not_replacing(self):
+        service.worker_ready()
+        self.assertEqual(service._ready_fd, None)
+
+
 class Test_sustain_workers(TestCase):
 
     def setUp(self):
@@ -987,9 +1897,18 @@ class Test_sustain_workers(TestCase):
         self.orig_wifexited = service.WIFEXITED
         self.orig_wifsignaled = service.WIFSIGNALED
         self.orig_killpg = service.killpg
+        self.orig_kill = service.kill
+        self.orig_alarm = service.alarm
+        self.orig_time = service.time
+        self.orig_pipe = service.pipe
+        self.orig_os_close = service.os_close
+        self.orig_read_ready = service._read_ready
+        self.orig_waitpid = service.waitpid
         self.sleep_calls = []
         self.signal_calls = []
         self.killpg_calls = []
+        self.kill_calls = []
+        self.alarm_calls = []
         self.worker_func_calls = []
         time.sleep = lambda *a: self.sleep_calls.append(a)
         service.signal = lambda *a: self.signal_calls.append(a)
@@ -998,7 +1917,27 @@ class Test_sustain_workers(TestCase):
         service.WIFEXITED = lambda *a: True
         service.WIFSIGNALED = lambda *a: True
         service.killpg = lambda *a: self.killpg_calls.append(a)
+        service.kill = lambda *a: self.kill_calls.append(a)
+        service.alarm = lambda *a: self.alarm_calls.append(a)
+        self.now = [0]
+        service.time = lambda: self.now[0]
         self.worker_func = lambda *a: self.worker_func_calls.append(a)
+        self.pipes = []
+        self.read_ready_calls = []
+
+        def _pipe():
+            self.pipes.append((100 + len(self.pipes) * 2,
+                               101 + len(self.pipes) * 2))
+            return self.pipes[-1]
+
+        def _read_ready(fds, timeout):
+            self.read_ready_calls.append((sorted(fds), timeout))
+            return dict((fd, True) for fd in fds)
+
+        service.pipe = _pipe
+        service.os_close = lambda *a: None
+        service._read_ready = _read_ready
+        service.waitpid = lambda *a: (0, 0)
 
     def tearDown(self):
         time.sleep = self.orig_sleep
@@ -1008,6 +1947,14 @@ class Test_sustain_workers(TestCase):
         service.WIFEXITED = self.orig_wifexited
         service.WIFSIGNALED = self.orig_wifsignaled
         service.killpg = self.orig_killpg
+        service.kill = self.orig_kill
+        service.alarm = self.orig_alarm
+        service.time = self.orig_time
+        service.pipe = self.orig_pipe
+        service.os_close = self.orig_os_close
+        service._read_ready = self.orig_read_ready
+        service.waitpid = self.orig_waitpid
+        service._ready_fd = None
 
     def test_workers0(self):
         logger = FakeLogger()
@@ -1127,10 +2074,12 @@ class Test_sustain_workers(TestCase):
         logger = FakeLogger()
         service.fork = lambda *a: 0
         service.sustain_workers(1, self.worker_func, logger)
-        # Asserts the TERM and HUP signal handlers are cleared with the child.
+        # Asserts the TERM and HUP signal handlers are cleared with the child
+        # and USR1 and USR2 are ignored.
         self.assertEqual(
-            set(self.signal_calls[-2:]),
-            set([(service.SIGHUP, 0), (service.SIGTERM, 0)]))
+            set(self.signal_calls[-4:]),
+            set([(service.SIGHUP, 0), (service.SIGTERM, 0),
+                 (service.SIGUSR1, 1), (service.SIGUSR2, 1)]))
         self.assertEqual(self.worker_func_calls, [(0,)])
         self.assertEqual(logger.debug_calls, [
             ('wid:000 ppid:%s pid:%s Starting worker.' %
@@ -1196,6 +2145,354 @@ class Test_sustain_workers(TestCase):
         self.assertEqual(fork_calls, [()] * 6)
         self.assertEqual(self.sleep_calls, [(1,)])
 
+    def _reload_os_wait(self, exits):
+        calls = []
+
+        def _os_wait(*args):
+            calls.append(args)
+            if len(calls) == 1:
+                # Calls the SIGUSR1 handler.
+                self.signal_calls[2][1]()
+                err = OSError('testing')
+                err.errno = service.EINTR
+                raise err
+            if exits:
+                return exits.pop(0), 0
+            raise KeyboardInterrupt()
+
+        return _os_wait
+
+    def test_reload(self):
+        fork_calls = []
+        reload_calls = []
+
+        def _fork(*args):
+            fork_calls.append(args)
+            return len(fork_calls)
+
+        service.os_wait = self._reload_os_wait([1, 2])
+        service.fork = _fork
+        service.sustain_workers(
+            2, self.worker_func, reload_func=lambda: reload_calls.append(()))
+        self.assertEqual(reload_calls, [()])
+        self.assertEqual(fork_calls, [()] * 4)
+        self.assertEqual(
+            self.kill_calls, [(1, service.SIGHUP), (2, service.SIGHUP)])
+        self.assertEqual(self.sleep_calls, [])
+        self.assertEqual(self.read_ready_calls, [([100], 1), ([102], 1)])
+
+    def test_reload_waits_for_ready(self):
+        fork_calls = []
+        waitpid_calls = []
+
+        def _fork(*args):
+            fork_calls.append(args)
+            return len(fork_calls)
+
+        def _read_ready(fds, timeout):
+            self.read_ready_calls.append((sorted(fds), timeout))
+            if len(self.read_ready_calls) == 1:
+                # Nothing is ready yet, so the old worker is kept.
+                self.assertEqual(self.kill_calls, [])
+                return {}
+            return dict((fd, True) for fd in fds)
+
+        def _waitpid(*args):
+            waitpid_calls.append(args)
+            return (0, 0)
+
+        service.os_wait = self._reload_os_wait([1])
+        service.fork = _fork
+        service._read_ready = _read_ready
+        service.waitpid = _waitpid
+        service.sustain_workers(1, self.worker_func, reload_func=lambda: None)
+        self.assertEqual(fork_calls, [()] * 2)
+        self.assertEqual(self.read_ready_calls, [([100], 1), ([100], 1)])
+        self.assertEqual(self.kill_calls, [(1, service.SIGHUP)])
+        self.assertEqual(waitpid_calls, [(-1, service.WNOHANG)] * 2)
+
+    def test_reload_abandoned_when_replacement_exits(self):
+        logger = FakeLogger()
+        fork_calls = []
+        waitpid_calls = []
+
+        def _fork(*args):
+            fork_calls.append(args)
+            return len(fork_calls)
+
+        def _read_ready(fds, timeout):
+            self.read_ready_calls.append((sorted(fds), timeout))
+            return dict((fd, False) for fd in fds)
+
+        def _waitpid(*args):
+            waitpid_calls.append(args)
+            if len(waitpid_calls) == 1:
+                # The replacement worker's exit.
+                return (3, 0)
+            return (0, 0)
+
+        service.os_wait = self._reload_os_wait([])
+        service.fork = _fork
+        service._read_ready = _read_ready
+        service.waitpid = _waitpid
+        service.sustain_workers(
+            2, self.worker_func, logger, reload_func=lambda: None)
+        # Neither old worker is replaced and no more are tried.
+        self.assertEqual(fork_calls, [()] * 3)
+        self.assertEqual(self.kill_calls, [])
+        self.assertEqual(
+            logger.error_calls,
+            [('Reload abandoned: worker 0 exited before it was ready.',)])
+
+    def test_reload_waits_for_retiring(self):
+        fork_calls = []
+
+        def _fork(*args):
+            fork_calls.append(args)
+            return len(fork_calls)
+
+        # The first exit is from an unknown pid, so the second worker should
+        # not be replaced yet.
+        service.os_wait = self._reload_os_wait([99])
+        service.fork = _fork
+        service.sustain_workers(2, self.worker_func, reload_func=lambda: None)
+        self.assertEqual(fork_calls, [()] * 3)
+        self.assertEqual(self.kill_calls, [(1, service.SIGHUP)])
+
+    def test_reload_batch(self):
+        fork_calls = []
+
+        def _fork(*args):
+            fork_calls.append(args)
+            return len(fork_calls)
+
+        service.os_wait = self._reload_os_wait([])
+        service.fork = _fork
+        service.sustain_workers(
+            2, self.worker_func, reload_func=lambda: None, reload_batch=2)
+        self.assertEqual(fork_calls, [()] * 4)
+        self.assertEqual(
+            self.kill_calls, [(1, service.SIGHUP), (2, service.SIGHUP)])
+
+    def test_reload_exception(self):
+        logger = FakeLogger()
+        fork_calls = []
+
+        def _fork(*args):
+            fork_calls.append(args)
+            return len(fork_calls)
+
+        def _reload_func():
+            raise Exception('testing')
+
+        service.os_wait = self._reload_os_wait([])
+        service.fork = _fork
+        service.sustain_workers(
+            2, self.worker_func, logger, reload_func=_reload_func)
+        self.assertEqual(fork_calls, [()] * 2)
+        self.assertEqual(self.kill_calls, [])
+        self.assertEqual(
+            logger.exception_calls, [('Reload abandoned: testing',)])
+
+    def test_reload_child(self):
+        fork_calls = []
+
+        def _fork(*args):
+            fork_calls.append(args)
+            return 0 if len(fork_calls) > 1 else 1
+
+        service.os_wait = self._reload_os_wait([])
+        service.fork = _fork
+        service.sustain_workers(1, self.worker_func, reload_func=lambda: None)
+        self.assertEqual(fork_calls, [()] * 2)
+        self.assertEqual(self.worker_func_calls, [(0,)])
+        self.assertEqual(self.kill_calls, [])
+        self.assertEqual(service._ready_fd, 101)
+
+    def test_reload_relayed_without_reload_func(self):
+        fork_calls = []
+
+        def _fork(*args):
+            fork_calls.append(args)
+            return len(fork_calls)
+
+        service.os_wait = self._reload_os_wait([])
+        service.fork = _fork
+        service.sustain_workers(2, self.worker_func)
+        self.assertEqual(fork_calls, [()] * 2)
+        self.assertEqual(
+            self.kill_calls, [(1, service.SIGUSR1), (2, service.SIGUSR1)])
+
+    def test_reload_in_place(self):
+        logger = FakeLogger()
+        fork_calls = []
+        reload_calls = []
+
+        def _fork(*args):
+            fork_calls.append(args)
+            return len(fork_calls)
+
+        def _reload_func():
+            reload_calls.append(())
+            return True
+
+        service.os_wait = self._reload_os_wait([])
+        service.fork = _fork
+        service.sustain_workers(
+            2, self.worker_func, logger, reload_func=_reload_func)
+        self.assertEqual(reload_calls, [()])
+        self.assertEqual(fork_calls, [()] * 2)
+        self.assertEqual(
+            self.kill_calls, [(1, service.SIGUSR1), (2, service.SIGUSR1)])
+        self.assertEqual(self.read_ready_calls, [])
+        self.assertTrue(('Reloading workers in place.',) in logger.info_calls)
+
+    def _scale_os_wait(self, exits):
+        calls = []
+
+        def _os_wait(*args):
+            calls.append(args)
+            if len(calls) == 1:
+                # As if interrupted by the alarm for the next scaling.
+                self.now[0] += 10
+                err = OSError('testing')
+                err.errno = service.EINTR
+                raise err
+            if exits:
+                return exits.pop(0), 0
+            raise KeyboardInterrupt()
+
+        return _os_wait
+
+    def _scale_func(self, counts):
+        self.scale_calls = []
+
+        def _scale_func(workers_active):
+            self.scale_calls.append(workers_active)
+            return counts.pop(0)
+
+        return _scale_func
+
+    def test_scale_up(self):
+        logger = FakeLogger()
+        fork_calls = []
+
+        def _fork(*args):
+            fork_calls.append(args)
+            return len(fork_calls)
+
+        service.os_wait = self._scale_os_wait([])
+        service.fork = _fork
+        service.sustain_workers(
+            4, self.worker_func, logger, scale_func=self._scale_func([1, 3]))
+        self.assertEqual(self.scale_calls, [0, 1])
+        self.assertEqual(fork_calls, [()] * 3)
+        # Added workers are started right away.
+        self.assertEqual(self.sleep_calls, [])
+        self.assertEqual(self.kill_calls, [])
+        self.assertEqual(self.alarm_calls, [(5,), (5,), (0,)])
+        self.assertTrue(service.SIGALRM in [c[0] for c in self.signal_calls])
+        self.assertEqual(logger.info_calls, [
+            ('Scaling from 1 to 3 workers.',), ('Exiting due to SIGINT.',)])
+
+    def test_scale_down(self):
+        fork_calls = []
+
+        def _fork(*args):
+            fork_calls.append(args)
+            return len(fork_calls)
+
+        # The retired worker exiting should not cause a relaunch.
+        service.os_wait = self._scale_os_wait([2])
+        service.fork = _fork
+        service.sustain_workers(
+            4, self.worker_func, scale_func=self._scale_func([3, 1]),
+            scale_interval=7)
+        self.assertEqual(self.scale_calls, [0, 3])
+        self.assertEqual(fork_calls, [()] * 3)
+        self.assertEqual(
+            self.kill_calls, [(2, service.SIGHUP), (3, service.SIGHUP)])
+        self.assertEqual(self.alarm_calls, [(7,), (7,), (7,), (0,)])
+
+    def test_scale_up_waits_for_retiring(self):
+        fork_calls = []
+        os_wait_calls = []
+
+        def _fork(*args):
+            fork_calls.append(args)
+            return len(fork_calls)
+
+        def _os_wait(*args):
+            os_wait_calls.append(len(fork_calls))
+            if len(os_wait_calls) <= 2:
+                self.now[0] += 10
+                err = OSError('testing')
+                err.errno = service.EINTR
+                raise err
+            if len(os_wait_calls) == 3:
+                return 2, 0
+            if len(os_wait_calls) == 4:
+                return 3, 0
+            raise KeyboardInterrupt()
+
+        service.os_wait = _os_wait
+        service.fork = _fork
+        service.sustain_workers(
+            4, self.worker_func, scale_func=self._scale_func([3, 1, 3]))
+        self.assertEqual(self.scale_calls, [0, 3, 1])
+        self.assertEqual(
+            self.kill_calls, [(2, service.SIGHUP), (3, service.SIGHUP)])
+        # Worker ids 1 and 2 are only reused once pids 2 and 3 exit.
+        self.assertEqual(os_wait_calls, [3, 3, 3, 4, 5])
+
+    def test_scale_clamped(self):
+        fork_calls = []
+
+        def _fork(*args):
+            fork_calls.append(args)
+            return len(fork_calls)
+
+        service.os_wait = self._scale_os_wait([])
+        service.fork = _fork
+        service.sustain_workers(
+            2, self.worker_func, scale_func=self._scale_func([0, 10]))
+        self.assertEqual(self.scale_calls, [0, 1])
+        self.assertEqual(fork_calls, [()] * 2)
+
+    def test_scale_waits_for_reload(self):
+        fork_calls = []
+
+        def _fork(*args):
+            fork_calls.append(args)
+            return len(fork_calls)
+
+        def _os_wait(*args):
+            if not self.now[0]:
+                self.now[0] = 100
+                # Calls the SIGUSR1 handler.
+                self.signal_calls[2][1]()
+                err = OSError('testing')
+                err.errno = service.EINTR
+                raise err
+            raise KeyboardInterrupt()
+
+        service.os_wait = _os_wait
+        service.fork = _fork
+        service.sustain_workers(
+            4, self.worker_func, reload_func=lambda: None,
+            scale_func=self._scale_func([2, 4]))
+        self.assertEqual(self.scale_calls, [0])
+        self.assertEqual(fork_calls, [()] * 3)
+        self.assertEqual(self.kill_calls, [(1, service.SIGHUP)])
+
+    def test_scale_child(self):
+        service.fork = lambda *a: 0
+        service.sustain_workers(
+            2, self.worker_func, scale_func=self._scale_func([1]))
+        self.assertEqual(self.signal_calls[-1], (service.SIGALRM, 0))
+        self.assertEqual(self.worker_func_calls, [(0,)])
+        self.assertEqual(self.alarm_calls, [])
+
 
 if __name__ == '__main__':
     main()
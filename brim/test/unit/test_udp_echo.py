@@ -34,6 +34,10 @@ class FakeSubserver(object):
 
     def __init__(self):
         self.logger = FakeLogger()
+        self.reply_calls = []
+
+    def reply(self, *args, **kwargs):
+        self.reply_calls.append((args, kwargs))
 
 
 class FakeStats(object):
@@ -77,7 +81,8 @@ class TestUDPEcho(TestCase):
             subserver.logger.notice_calls,
             [(('served request of 4 bytes from %s:%d' % (ip, port),), {})])
         self.assertEqual(stats.stats, {'byte_count': len(datagram)})
-        self.assertEqual(sock.sendto_calls, [((datagram, (ip, port)), {})])
+        self.assertEqual(sock.sendto_calls, [])
+        self.assertEqual(subserver.reply_calls, [((datagram, ip, port), {})])
 
     def test_parse_conf(self):
         c = udp_echo.UDPEcho.parse_conf('test', Conf({}))
@@ -0,0 +1,481 @@
+"""Tests for brim.wsgi_cache."""
+"""Copyright and License.
+
+Copyright 2014 Gregory Holt
+
+Licensed under the Apache License, Version 2.0 (the "License"); you may
+not use this file except in compliance with the License. You may obtain
+a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+from threading import Event, Thread
+from unittest import main, TestCase
+
+import eventlet
+
+from brim import wsgi_cache
+from brim.conf import Conf
+
+
+class FakeStats(object):
+
+    def __init__(self):
+        self.stats = {}
+
+    def get(self, name):
+        return self.stats.get(name, 0)
+
+    def set(self, name, value):
+        self.stats[name] = value
+
+    def incr(self, name):
+        self.stats[name] = self.stats.get(name, 0) + 1
+
+
+class FakeServer(object):
+
+    def __init__(self, concurrency_model='eventlet'):
+        self.concurrency_model = concurrency_model
+
+
+class Body(object):
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.closed = False
+
+    def __iter__(self):
+        return iter(self.chunks)
+
+    def close(self):
+        self.closed = True
+
+
+class TestWSGICache(TestCase):
+
+    def setUp(self):
+        self.status = '200 OK'
+        self.headers = [('Cache-Control', 'max-age=60')]
+        self.body = 'body'
+        self.next_app_calls = []
+        self.start_response_calls = []
+        self.stats = FakeStats()
+        self.now = 1000.0
+        self.orig_time = wsgi_cache.time
+        wsgi_cache.time = lambda: self.now
+
+    def tearDown(self):
+        wsgi_cache.time = self.orig_time
+
+    def _next_app(self, env, start_response):
+        self.next_app_calls.append(env['PATH_INFO'])
+        start_response(self.status, list(self.headers))
+        return [self.body]
+
+    def _start_response(self, *args):
+        self.start_response_calls.append(args)
+
+    def _cache(self, **confd):
+        return wsgi_cache.WSGICache(
+            'cache', wsgi_cache.WSGICache.parse_conf(
+                'cache', Conf({'cache': confd})), self._next_app)
+
+    def _env(self, path='/path', method='GET', concurrency_model='eventlet',
+             **headers):
+        env = {'PATH_INFO': path, 'REQUEST_METHOD': method,
+               'QUERY_STRING': '', 'HTTP_HOST': 'host',
+               'brim': FakeServer(concurrency_model),
+               'brim.stats': self.stats}
+        env.update(headers)
+        return env
+
+    def _call(self, cache, path='/path', method='GET', **headers):
+        del self.next_app_calls[:]
+        del self.start_response_calls[:]
+        return ''.join(cache(
+            self._env(path, method, **headers), self._start_response))
+
+    def test_hit(self):
+        cache = self._cache()
+        self.assertEqual(self._call(cache), 'body')
+        self.assertEqual(self.next_app_calls, ['/path'])
+        self.assertEqual(self.start_response_calls, [
+            ('200 OK', [('Cache-Control', 'max-age=60')], None)])
+        self.now += 10
+        self.assertEqual(self._call(cache), 'body')
+        self.assertEqual(self.next_app_calls, [])
+        self.assertEqual(self.start_response_calls, [
+            ('200 OK', [('Cache-Control', 'max-age=60'), ('Age', '10')])])
+        self.assertEqual(self.stats.get('cache.hits'), 1)
+        self.assertEqual(self.stats.get('cache.misses'), 1)
+        self.assertEqual(self.stats.get('cache.bytes'), 4)
+
+    def test_key(self):
+        cache = self._cache()
+        self._call(cache)
+        self._call(cache, '/other')
+        self.assertEqual(self.next_app_calls, ['/other'])
+        self._call(cache, QUERY_STRING='a=b')
+        self.assertEqual(self.next_app_calls, ['/path'])
+        self._call(cache, HTTP_HOST='other')
+        self.assertEqual(self.next_app_calls, ['/path'])
+
+    def test_expires(self):
+        cache = self._cache()
+        self._call(cache)
+        self.now += 60
+        self._call(cache)
+        self.assertEqual(self.next_app_calls, [])
+        self.now += 1
+        self._call(cache)
+        self.assertEqual(self.next_app_calls, ['/path'])
+        self.assertEqual(self.stats.get('cache.bytes'), 4)
+
+    def test_s_maxage(self):
+        self.headers = [('cache-control', 'max-age=0, s-maxage="5"')]
+        cache = self._cache()
+        self._call(cache)
+        self.now += 5
+        self._call(cache)
+        self.assertEqual(self.next_app_calls, [])
+
+    def test_head(self):
+        cache = self._cache()
+        self.assertEqual(self._call(cache, method='HEAD'), 'body')
+        self.assertEqual(self.next_app_calls, ['/path'])
+        self.assertEqual(cache.entries, {})
+        self._call(cache)
+        self.assertEqual(self._call(cache, method='HEAD'), '')
+        self.assertEqual(self.next_app_calls, [])
+
+    def test_other_methods(self):
+        cache = self._cache()
+        self._call(cache)
+        self._call(cache, method='POST')
+        self.assertEqual(self.next_app_calls, ['/path'])
+        self.assertEqual(self.stats.get('cache.misses'), 1)
+
+    def test_not_cacheable(self):
+        for status, headers in (
+                ('200 OK', []),
+                ('200 OK', [('Cache-Control', 'max-age=nope')]),
+                ('200 OK', [('Cache-Control', 'max-age=60, no-store')]),
+                ('200 OK', [('Cache-Control', 'max-age=60, no-cache')]),
+                ('200 OK', [('Cache-Control', 'private, max-age=60')]),
+                ('200 OK', [('Cache-Control', 'max-age=60'),
+                            ('Set-Cookie', 'a=b')]),
+                ('200 OK', [('Cache-Control', 'max-age=60'),
+                            ('Vary', 'Accept, *')]),
+                ('500 Internal Server Error',
+                 [('Cache-Control', 'max-age=60')]),
+                ('nope', [('Cache-Control', 'max-age=60')])):
+            self.status = status
+            self.headers = headers
+            cache = self._cache()
+            self._call(cache)
+            self.assertEqual(self._call(cache), 'body')
+            self.assertEqual(self.next_app_calls, ['/path'], headers)
+            self.assertEqual(self.start_response_calls, [
+                (status, headers, None)])
+
+    def test_default_max_age(self):
+        self.headers = []
+        cache = self._cache(default_max_age='30')
+        self._call(cache)
+        self.now += 30
+        self._call(cache)
+        self.assertEqual(self.next_app_calls, [])
+        self.now += 1
+        self._call(cache)
+        self.assertEqual(self.next_app_calls, ['/path'])
+
+    def test_vary(self):
+        self.headers = [('Cache-Control', 'max-age=60'),
+                        ('Vary', 'Accept-Encoding, accept')]
+        cache = self._cache()
+        self._call(cache, HTTP_ACCEPT_ENCODING='gzip')
+        self.body = 'plain'
+        self.assertEqual(self._call(cache), 'plain')
+        self.assertEqual(self.next_app_calls, ['/path'])
+        self.assertEqual(
+            self._call(cache, HTTP_ACCEPT_ENCODING='gzip'), 'body')
+        self.assertEqual(self._call(cache), 'plain')
+        self.assertEqual(self.next_app_calls, [])
+        self.assertEqual(self._call(cache, HTTP_ACCEPT='text/html'), 'plain')
+        self.assertEqual(self.next_app_calls, ['/path'])
+        self.assertEqual(cache.entries[('host', '/path', '')],
+                         ('vary', ['HTTP_ACCEPT', 'HTTP_ACCEPT_ENCODING']))
+
+    def test_vary_dropped(self):
+        self.headers = [('Cache-Control', 'max-age=60'), ('Vary', 'Accept')]
+        cache = self._cache()
+        self._call(cache)
+        self.now += 61
+        self.headers = [('Cache-Control', 'max-age=60')]
+        self._call(cache)
+        self.assertEqual(cache.entries.keys(), [('host', '/path', '')])
+        self._call(cache)
+        self.assertEqual(self.next_app_calls, [])
+
+    def test_authorization(self):
+        cache = self._cache()
+        self._call(cache)
+        self._call(cache, HTTP_AUTHORIZATION='Basic x')
+        self.assertEqual(self.next_app_calls, ['/path'])
+        self.now += 61
+        self.body = 'new'
+        self._call(cache, HTTP_AUTHORIZATION='Basic x')
+        self.assertEqual(cache.entries.values()[0][4], 'body')
+        self.assertEqual(self.stats.get('cache.misses'), 1)
+        self.headers = [('Cache-Control', 'public, max-age=60')]
+        self._call(cache, HTTP_AUTHORIZATION='Basic x')
+        self._call(cache)
+        self.assertEqual(self.next_app_calls, [])
+
+    def test_request_no_cache(self):
+        cache = self._cache()
+        self._call(cache)
+        self.body = 'new'
+        for headers in ({'HTTP_CACHE_CONTROL': 'no-cache'},
+                        {'HTTP_CACHE_CONTROL': 'max-age=0'},
+                        {'HTTP_PRAGMA': 'No-Cache'}):
+            self.assertEqual(self._call(cache, **headers), 'new')
+            self.assertEqual(self.next_app_calls, ['/path'])
+        self.assertEqual(self._call(cache), 'new')
+
+    def test_request_no_store(self):
+        cache = self._cache()
+        self._call(cache, HTTP_CACHE_CONTROL='no-store')
+        self.assertEqual(cache.entries, {})
+        self.assertEqual(self.stats.get('cache.misses'), 0)
+
+    def test_evictions(self):
+        cache = self._cache(max_bytes='8', max_body_size='4')
+        self._call(cache, '/one')
+        self._call(cache, '/two')
+        self._call(cache, '/one')
+        self._call(cache, '/three')
+        self.assertEqual([k[1] for k in cache.entries], ['/one', '/three'])
+        self.assertEqual(self.stats.get('cache.evictions'), 1)
+        self.assertEqual(self.stats.get('cache.bytes'), 8)
+
+    def test_max_body_size(self):
+        bodies = [Body(['12', '34', '56']), Body(['12', '3'])]
+
+        def _next_app(env, start_response):
+            start_response(self.status, self.headers)
+            return bodies[0]
+
+        self._next_app = _next_app
+        cache = self._cache(max_body_size='3')
+        self.assertEqual(self._call(cache), '123456')
+        self.assertTrue(bodies.pop(0).closed)
+        self.assertEqual(cache.entries, {})
+        self.assertEqual(self._call(cache), '123')
+        self.assertTrue(bodies[0].closed)
+        self.assertEqual(len(cache.entries), 1)
+
+    def test_not_cacheable_body_passed_through(self):
+        self.headers = []
+        body = Body(['12', '34'])
+
+        def _next_app(env, start_response):
+            start_response(self.status, self.headers)
+            return body
+
+        self._next_app = _next_app
+        cache = self._cache()
+        self.assertTrue(cache(self._env(), self._start_response) is body)
+
+    def test_write(self):
+
+        def _next_app(env, start_response):
+            start_response(self.status, self.headers)('12')
+            return ['34']
+
+        self._next_app = _next_app
+        cache = self._cache()
+        self.assertEqual(self._call(cache), '1234')
+        self.assertEqual(self._call(cache), '1234')
+        self.headers = []
+        self.assertEqual(self._call(cache, '/other'), '1234')
+
+    def test_start_response_when_iterated(self):
+
+        def _next_app(env, start_response):
+            start_response(self.status, self.headers)
+            yield 'body'
+
+        self._next_app = _next_app
+        cache = self._cache()
+        self.assertEqual(self._call(cache), 'body')
+        self.assertEqual(self.start_response_calls, [
+            ('200 OK', [('Cache-Control', 'max-age=60')], None)])
+        self.assertEqual(cache.entries, {})
+        self.assertEqual(cache.pending, {})
+
+    def test_next_app_raises(self):
+
+        def _next_app(env, start_response):
+            raise Exception('test')
+
+        self._next_app = _next_app
+        cache = self._cache()
+        exc = None
+        try:
+            self._call(cache)
+        except Exception as err:
+            exc = err
+        self.assertEqual(str(exc), 'test')
+        self.assertEqual(cache.pending, {})
+
+    def test_collapse_eventlet(self):
+        release = eventlet.event.Event()
+
+        def _next_app(env, start_response):
+            self.next_app_calls.append(env['PATH_INFO'])
+            release.wait()
+            start_response(self.status, self.headers)
+            return [self.body]
+
+        self._next_app = _next_app
+        cache = self._cache()
+        threads = [eventlet.spawn(cache, self._env(), self._start_response)
+                   for _junk in xrange(3)]
+        eventlet.sleep(0)
+        self.assertEqual(self.next_app_calls, ['/path'])
+        release.send()
+        self.assertEqual([''.join(t.wait()) for t in threads], ['body'] * 3)
+        self.assertEqual(self.next_app_calls, ['/path'])
+        self.assertEqual(self.stats.get('cache.collapsed'), 2)
+        self.assertEqual(self.stats.get('cache.hits'), 2)
+        self.assertEqual(self.stats.get('cache.misses'), 1)
+        self.assertEqual(cache.pending, {})
+
+    def test_collapse_not_cacheable(self):
+        release = eventlet.event.Event()
+        self.headers = []
+
+        def _next_app(env, start_response):
+            self.next_app_calls.append(env['PATH_INFO'])
+            release.wait()
+            start_response(self.status, self.headers)
+            return [self.body]
+
+        self._next_app = _next_app
+        cache = self._cache()
+        threads = [eventlet.spawn(cache, self._env(), self._start_response)
+                   for _junk in xrange(2)]
+        eventlet.sleep(0)
+        release.send()
+        self.assertEqual([''.join(t.wait()) for t in threads], ['body'] * 2)
+        self.assertEqual(self.next_app_calls, ['/path', '/path'])
+        self.assertEqual(self.stats.get('cache.misses'), 2)
+
+    def test_collapse_timeout(self):
+        release = eventlet.event.Event()
+        calls = []
+
+        def _next_app(env, start_response):
+            self.next_app_calls.append(env['PATH_INFO'])
+            calls.append(env['PATH_INFO'])
+            if len(calls) == 1:
+                release.wait()
+            start_response(self.status, self.headers)
+            return [self.body]
+
+        self._next_app = _next_app
+        cache = self._cache(collapse_timeout='0.01')
+        first = eventlet.spawn(cache, self._env(), self._start_response)
+        eventlet.sleep(0)
+        self.assertEqual(self._call(cache), 'body')
+        self.assertEqual(self.next_app_calls, ['/path'])
+        self.assertEqual(self.stats.get('cache.collapsed'), 1)
+        release.send()
+        self.assertEqual(''.join(first.wait()), 'body')
+
+    def test_collapse_threads(self):
+        entered = Event()
+        release = Event()
+
+        def _next_app(env, start_response):
+            self.next_app_calls.append(env['PATH_INFO'])
+            entered.set()
+            release.wait()
+            start_response(self.status, self.headers)
+            return [self.body]
+
+        self._next_app = _next_app
+        cache = self._cache()
+        results = []
+
+        def _request():
+            results.append(''.join(cache(
+                self._env(concurrency_model='threads'),
+                self._start_response)))
+
+        first = Thread(target=_request)
+        first.start()
+        entered.wait()
+        second = Thread(target=_request)
+        second.start()
+        while not self.stats.get('cache.collapsed'):
+            eventlet.sleep(0.001)
+        release.set()
+        first.join()
+        second.join()
+        self.assertEqual(results, ['body', 'body'])
+        self.assertEqual(self.next_app_calls, ['/path'])
+        self.assertEqual(self.stats.get('cache.hits'), 1)
+
+    def test_parse_conf(self):
+        c = wsgi_cache.WSGICache.parse_conf('cache', Conf({}))
+        self.assertEqual(c, {
+            'max_bytes': 67108864, 'max_body_size': 1048576,
+            'default_max_age': 0, 'collapse_timeout': 5.0})
+        c = wsgi_cache.WSGICache.parse_conf('cache', Conf({'cache': {
+            'max_bytes': '100', 'max_body_size': '10',
+            'default_max_age': '60', 'collapse_timeout': '0.5'}}))
+        self.assertEqual(c, {
+            'max_bytes': 100, 'max_body_size': 10,
+            'default_max_age': 60, 'collapse_timeout': 0.5})
+
+    def test_parse_conf_invalid(self):
+        for option in ('max_bytes', 'max_body_size', 'default_max_age',
+                       'collapse_timeout'):
+            exc = None
+            try:
+                wsgi_cache.WSGICache.parse_conf(
+                    'cache', Conf({'cache': {option: '-1'}}))
+            except Exception as err:
+                exc = err
+            self.assertTrue(str(exc).startswith(
+                'Invalid [cache] %s -1' % option), exc)
+        exc = None
+        try:
+            wsgi_cache.WSGICache.parse_conf('cache', Conf({'cache': {
+                'max_bytes': '10', 'max_body_size': '20'}}))
+        except Exception as err:
+            exc = err
+        self.assertEqual(
+            str(exc),
+            'Invalid [cache] max_body_size 20; must not be more than '
+            'max_bytes 10.')
+
+    def test_stats_conf(self):
+        self.assertEqual(
+            wsgi_cache.WSGICache.stats_conf('cache', {}),
+            [('cache.bytes', 'sum'), ('cache.collapsed', 'sum'),
+             ('cache.evictions', 'sum'), ('cache.hits', 'sum'),
+             ('cache.misses', 'sum')])
+
+
+if __name__ == '__main__':
+    main()
@@ -15,15 +15,398 @@ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 See the License for the specific language governing permissions and
 limitations under the License.
 """
+import os
+from shutil import rmtree
+from StringIO import StringIO
+from tempfile import mkdtemp
 from unittest import main, TestCase
 
+from eventlet import spawn, wsgi
+from eventlet.greenio import GreenSocket
+
 from brim import wsgi_fs
+from brim.conf import Conf
+
+
+class FakeStats(object):
+
+    def __init__(self):
+        self.stats = {}
+
+    def get(self, name):
+        return self.stats.get(name, 0)
+
+    def set(self, name, value):
+        self.stats[name] = value
+
+    def incr(self, name):
+        self.stats[name] = self.stats.get(name, 0) + 1
+
+
+class FakeServer(object):
+
+    def __init__(self, concurrency_model='eventlet'):
+        self.concurrency_model = concurrency_model
 
 
 class TestFS(TestCase):
 
-    def test_placeholder(self):
-        self.assertTrue(wsgi_fs is not None)
+    def setUp(self):
+        self.serve_path = mkdtemp()
+        os.mkdir(os.path.join(self.serve_path, 'sub'))
+        with open(os.path.join(self.serve_path, 'one.txt'), 'wb') as fp:
+            fp.write('one')
+        self.start_response_calls = []
+        self.next_app_calls = []
+        self.tpool_calls = []
+        self.fadvise_calls = []
+        self.orig_tpool = wsgi_fs.tpool
+        self.orig_posix_fadvise = wsgi_fs.posix_fadvise
+
+        class FakeTPool(object):
+
+            def set_num_threads(tpself, nthreads):
+                self.tpool_calls.append(('set_num_threads', nthreads))
+
+            def execute(tpself, func, *args):
+                self.tpool_calls.append(
+                    (func.__name__, self.stats.get('fs.io_in_flight')))
+                return func(*args)
+
+        def _posix_fadvise(*args):
+            self.fadvise_calls.append(args)
+
+        wsgi_fs.tpool = FakeTPool()
+        wsgi_fs.posix_fadvise = _posix_fadvise
+        self.stats = FakeStats()
+
+    def tearDown(self):
+        wsgi_fs.tpool = self.orig_tpool
+        wsgi_fs.posix_fadvise = self.orig_posix_fadvise
+        rmtree(self.serve_path)
+
+    def _fs(self, **confd):
+        confd['serve_path'] = self.serve_path
+        return wsgi_fs.WSGIFS(
+            'fs', wsgi_fs.WSGIFS.parse_conf('fs', Conf({'fs': confd})),
+            self._next_app)
+
+    def _next_app(self, env, start_response):
+        self.next_app_calls.append(env['PATH_INFO'])
+        start_response('204 No Content', [('Content-Length', '0')])
+        return []
+
+    def _start_response(self, *args):
+        self.start_response_calls.append(args)
+
+    def _call(self, fs, path, method='GET', concurrency_model='eventlet'):
+        env = {'PATH_INFO': path, 'REQUEST_METHOD': method,
+               'brim': FakeServer(concurrency_model),
+               'brim.stats': self.stats, 'wsgi.input': StringIO()}
+        del self.start_response_calls[:]
+        return ''.join(str(c) for c in fs(env, self._start_response))
+
+    def test_file(self):
+        fs = self._fs()
+        self.assertEqual(self._call(fs, '/one.txt'), 'one')
+        self.assertEqual(self.start_response_calls[0][0], '200 OK')
+        headers = dict(self.start_response_calls[0][1])
+        self.assertEqual(headers['Content-Length'], '3')
+        self.assertEqual(headers['Content-Type'], 'text/plain')
+        self.assertEqual(self.tpool_calls, [])
+        self.assertEqual(self.fadvise_calls, [])
+
+    def test_head(self):
+        fs = self._fs()
+        self.assertEqual(self._call(fs, '/one.txt', 'HEAD'), '')
+        self.assertEqual(self.start_response_calls[0][0], '200 OK')
+
+    def test_not_found(self):
+        fs = self._fs()
+        self._call(fs, '/two.txt')
+        self.assertEqual(self.start_response_calls[0][0], '404 Not Found')
+
+    def test_forbidden(self):
+        fs = self._fs()
+        self._call(fs, '/../one.txt')
+        self.assertEqual(self.start_response_calls[0][0], '403 Forbidden')
+
+    def test_other_path(self):
+        fs = self._fs(path='/files')
+        self._call(fs, '/other/one.txt')
+        self.assertEqual(self.next_app_calls, ['/other/one.txt'])
+        self.assertEqual(self._call(fs, '/files/one.txt'), 'one')
+
+    def test_dir_redirect(self):
+        fs = self._fs()
+        self._call(fs, '/sub')
+        self.assertEqual(
+            self.start_response_calls[0][0], '301 Moved Permanently')
+        self.assertEqual(
+            dict(self.start_response_calls[0][1])['Location'], '/sub/')
+
+    def test_dir_index(self):
+        with open(os.path.join(self.serve_path, 'sub', 'index.html'),
+                  'wb') as fp:
+            fp.write('<html/>')
+        fs = self._fs()
+        self.assertEqual(self._call(fs, '/sub/'), '<html/>')
+
+    def test_listing(self):
+        fs = self._fs()
+        body = self._call(fs, '/')
+        self.assertEqual(self.start_response_calls[0][0], '200 OK')
+        self.assertTrue('<a href="sub">sub</a>' in body)
+        self.assertTrue('<a href="one.txt">one.txt</a>' in body)
+        self.assertTrue('new Number(3)' in body)
+        self.assertTrue(body.index('"sub"') < body.index('one.txt'))
+
+    def test_io_threads(self):
+        fs = self._fs(io_threads='4')
+        self.assertEqual(self.tpool_calls, [('set_num_threads', 4)])
+        del self.tpool_calls[:]
+        self.assertEqual(self._call(fs, '/one.txt'), 'one')
+        self.assertEqual(
+            self.tpool_calls,
+            [('_stat', 1), ('_open', 1), ('read', 1), ('read', 1)])
+        self.assertEqual(self.stats.get('fs.io_in_flight'), 0)
+        self.assertEqual(self.stats.get('fs.io_in_flight_peak'), 1)
+        del self.tpool_calls[:]
+        self._call(fs, '/')
+        self.assertEqual(
+            self.tpool_calls, [('_stat', 1), ('_stat', 1), ('_list_dir', 1)])
+
+    def test_io_threads_with_threads_model(self):
+        fs = self._fs(io_threads='4')
+        del self.tpool_calls[:]
+        self.assertEqual(
+            self._call(fs, '/one.txt', concurrency_model='threads'), 'one')
+        self.assertEqual(self.tpool_calls, [])
+
+    def test_io_in_flight_raises(self):
+        fs = self._fs(io_threads='4')
+
+        def _raise():
+            raise IOError('test')
+
+        exc = None
+        try:
+            fs.io({'brim': FakeServer(), 'brim.stats': self.stats}, _raise)
+        except IOError as err:
+            exc = err
+        self.assertEqual(str(exc), 'test')
+        self.assertEqual(fs.io_in_flight, 0)
+        self.assertEqual(self.stats.get('fs.io_in_flight'), 0)
+
+    def test_fadvise_sequential(self):
+        fs = self._fs(fadvise_sequential='yes')
+        self.assertEqual(self._call(fs, '/one.txt'), 'one')
+        self.assertEqual(len(self.fadvise_calls), 1)
+        self.assertEqual(
+            self.fadvise_calls[0][1:], (0, 0, wsgi_fs.POSIX_FADV_SEQUENTIAL))
+
+    def test_fadvise_sequential_unsupported(self):
+
+        def _posix_fadvise(*args):
+            raise OSError('unsupported')
+
+        wsgi_fs.posix_fadvise = _posix_fadvise
+        fs = self._fs(fadvise_sequential='yes')
+        self.assertEqual(self._call(fs, '/one.txt'), 'one')
+
+    def _write(self, name, data, mtime=None):
+        path = os.path.join(self.serve_path, name)
+        with open(path, 'wb') as fp:
+            fp.write(data)
+        if mtime:
+            os.utime(path, (mtime, mtime))
+        return path
+
+    def test_mmap(self):
+        fs = self._fs(mmap_max_file_size='10')
+        env = {'PATH_INFO': '/one.txt', 'REQUEST_METHOD': 'GET',
+               'brim': FakeServer(), 'brim.stats': self.stats}
+        body = list(fs(env, self._start_response))
+        self.assertEqual([type(c) for c in body], [str])
+        self.assertEqual(''.join(body), 'one')
+        self.assertEqual(self.stats.get('fs.mmap_misses'), 1)
+        self.assertEqual(self.stats.get('fs.mmap_hits'), 0)
+        self.assertEqual(self.stats.get('fs.mmap_bytes'), 3)
+        mapped = fs.mmaps[os.path.join(self.serve_path, 'one.txt')][1]
+        self.assertEqual(self._call(fs, '/one.txt'), 'one')
+        self.assertEqual(self.stats.get('fs.mmap_hits'), 1)
+        self.assertTrue(
+            fs.mmaps[os.path.join(self.serve_path, 'one.txt')][1] is mapped)
+
+    def test_mmap_served_by_eventlet(self):
+        # Serves through Eventlet's WSGI layer as brimd does, since it can
+        # only send the chunk types it can join.
+        self._write('big.txt', 'x' * 65536 + 'y')
+        fs = self._fs(mmap_max_file_size='100000')
+
+        def _app(env, start_response):
+            env['brim'] = FakeServer()
+            env['brim.stats'] = self.stats
+            return fs(env, start_response)
+
+        listener = GreenSocket()
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+        server = spawn(wsgi.server, listener, _app, log=StringIO())
+        try:
+            for path, body in (('/one.txt', 'one'),
+                               ('/big.txt', 'x' * 65536 + 'y'),
+                               ('/one.txt', 'one')):
+                client = GreenSocket()
+                client.connect(listener.getsockname())
+                client.sendall('GET %s HTTP/1.0\r\n\r\n' % path)
+                response = ''
+                while True:
+                    chunk = client.recv(65536)
+                    if not chunk:
+                        break
+                    response += chunk
+                client.close()
+                self.assertTrue(
+                    response.startswith('HTTP/1.1 200 OK\r\n'), response)
+                self.assertEqual(response.split('\r\n\r\n', 1)[1], body)
+        finally:
+            server.kill()
+            listener.close()
+        self.assertEqual(self.stats.get('fs.mmap_misses'), 2)
+        self.assertEqual(self.stats.get('fs.mmap_hits'), 1)
+
+    def test_mmap_large_and_empty_files_read(self):
+        self._write('big.txt', 'x' * 11)
+        self._write('empty.txt', '')
+        fs = self._fs(mmap_max_file_size='10')
+        self.assertEqual(self._call(fs, '/big.txt'), 'x' * 11)
+        self.assertEqual(self._call(fs, '/empty.txt'), '')
+        self.assertEqual(fs.mmaps, {})
+        self.assertEqual(self.stats.get('fs.mmap_misses'), 0)
+
+    def test_mmap_chunks(self):
+        self._write('big.txt', 'x' * 65536 + 'y')
+        fs = self._fs(mmap_max_file_size='100000')
+        env = {'PATH_INFO': '/big.txt', 'REQUEST_METHOD': 'GET',
+               'brim': FakeServer(), 'brim.stats': self.stats}
+        self.assertEqual(
+            [len(c) for c in fs(env, self._start_response)], [65536, 1])
+
+    def test_mmap_changed(self):
+        path = self._write('two.txt', 'two', 1000000000)
+        fs = self._fs(mmap_max_file_size='10')
+        self.assertEqual(self._call(fs, '/two.txt'), 'two')
+        self._write('two.txt', 'TWO', 1000000001)
+        self.assertEqual(self._call(fs, '/two.txt'), 'TWO')
+        self.assertEqual(self.stats.get('fs.mmap_misses'), 2)
+        self.assertEqual(self.stats.get('fs.mmap_bytes'), 3)
+        self.assertEqual(fs.mmaps.keys(), [path])
+
+    def test_mmap_evicts_least_recent(self):
+        self._write('two.txt', 'two')
+        self._write('six.txt', 'six')
+        fs = self._fs(mmap_max_file_size='3', mmap_max_bytes='6')
+        self._call(fs, '/one.txt')
+        self._call(fs, '/two.txt')
+        self._call(fs, '/one.txt')
+        self._call(fs, '/six.txt')
+        self.assertEqual(
+            [os.path.basename(p) for p in fs.mmaps], ['one.txt', 'six.txt'])
+        self.assertEqual(fs.mmap_bytes, 6)
+        self.assertEqual(self.stats.get('fs.mmap_bytes'), 6)
+        self.assertEqual(self.stats.get('fs.mmap_hits'), 1)
+        self.assertEqual(self.stats.get('fs.mmap_misses'), 3)
+
+    def test_mmap_evicted_map_still_served(self):
+        self._write('two.txt', 'two')
+        fs = self._fs(mmap_max_file_size='3', mmap_max_bytes='3')
+        env = {'PATH_INFO': '/one.txt', 'REQUEST_METHOD': 'GET',
+               'brim': FakeServer(), 'brim.stats': self.stats}
+        body = fs(env, self._start_response)
+        self._call(fs, '/two.txt')
+        self.assertEqual(len(fs.mmaps), 1)
+        self.assertEqual(''.join(str(c) for c in body), 'one')
+
+    def test_mmap_fails(self):
+        orig_map = wsgi_fs._map
+
+        def _map(path, size):
+            raise ValueError('mmap length is greater than file size')
+
+        try:
+            wsgi_fs._map = _map
+            fs = self._fs(mmap_max_file_size='10')
+            self.assertEqual(self._call(fs, '/one.txt'), 'one')
+        finally:
+            wsgi_fs._map = orig_map
+        self.assertEqual(fs.mmaps, {})
+
+    def test_mmap_io_threads(self):
+        fs = self._fs(io_threads='4', mmap_max_file_size='10')
+        del self.tpool_calls[:]
+        self.assertEqual(self._call(fs, '/one.txt'), 'one')
+        self.assertEqual(self.tpool_calls, [('_stat', 1), ('_map', 1)])
+
+    def test_parse_conf(self):
+        c = wsgi_fs.WSGIFS.parse_conf(
+            'fs', Conf({'fs': {'serve_path': '/tmp/x/'}}))
+        self.assertEqual(c, {
+            'path': '', 'serve_path': '/tmp/x', 'io_threads': 0,
+            'fadvise_sequential': False, 'mmap_max_file_size': 0,
+            'mmap_max_bytes': 67108864})
+        c = wsgi_fs.WSGIFS.parse_conf('fs', Conf({'fs': {
+            'path': '/files/', 'serve_path': '/tmp/x', 'io_threads': '8',
+            'fadvise_sequential': 'true', 'mmap_max_file_size': '1024',
+            'mmap_max_bytes': '4096'}}))
+        self.assertEqual(c, {
+            'path': 'files', 'serve_path': '/tmp/x', 'io_threads': 8,
+            'fadvise_sequential': True, 'mmap_max_file_size': 1024,
+            'mmap_max_bytes': 4096})
+
+    def test_parse_conf_invalid(self):
+        exc = None
+        try:
+            wsgi_fs.WSGIFS.parse_conf('fs', Conf({'fs': {}}))
+        except Exception as err:
+            exc = err
+        self.assertEqual(str(exc), '[fs] serve_path must be set')
+        exc = None
+        try:
+            wsgi_fs.WSGIFS.parse_conf('fs', Conf({'fs': {
+                'serve_path': '/tmp/x', 'io_threads': '-1'}}))
+        except Exception as err:
+            exc = err
+        self.assertEqual(str(exc), 'Invalid [fs] io_threads -1.')
+        exc = None
+        try:
+            wsgi_fs.WSGIFS.parse_conf('fs', Conf({'fs': {
+                'serve_path': '/tmp/x', 'mmap_max_bytes': '-1'}}))
+        except Exception as err:
+            exc = err
+        self.assertEqual(str(exc), 'Invalid [fs] mmap_max_bytes -1.')
+        exc = None
+        try:
+            wsgi_fs.WSGIFS.parse_conf('fs', Conf({'fs': {
+                'serve_path': '/tmp/x', 'mmap_max_file_size': '2048',
+                'mmap_max_bytes': '1024'}}))
+        except Exception as err:
+            exc = err
+        self.assertEqual(
+            str(exc),
+            'Invalid [fs] mmap_max_file_size 2048; must not be more than '
+            'mmap_max_bytes 1024.')
+
+    def test_stats_conf(self):
+        self.assertEqual(wsgi_fs.WSGIFS.stats_conf(
+            'fs', {'io_threads': 0, 'mmap_max_file_size': 0}), [])
+        self.assertEqual(wsgi_fs.WSGIFS.stats_conf(
+            'fs', {'io_threads': 2, 'mmap_max_file_size': 0}),
+            [('fs.io_in_flight', 'sum'), ('fs.io_in_flight_peak', 'max')])
+        self.assertEqual(wsgi_fs.WSGIFS.stats_conf(
+            'fs', {'io_threads': 0, 'mmap_max_file_size': 1024}),
+            [('fs.mmap_bytes', 'sum'), ('fs.mmap_hits', 'sum'),
+             ('fs.mmap_misses', 'sum')])
 
 
 if __name__ == '__main__':
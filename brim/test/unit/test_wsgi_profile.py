@@ -0,0 +1,171 @@
+"""Tests for brim.wsgi_profile."""
+"""Copyright and License.
+
+Copyright 2014 Gregory Holt
+
+Licensed under the Apache License, Version 2.0 (the "License"); you may
+not use this file except in compliance with the License. You may obtain
+a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+from unittest import main, TestCase
+
+from brim import wsgi_profile
+from brim.conf import Conf
+
+
+class FakeStats(object):
+
+    def __init__(self):
+        self.stats = {}
+
+    def get(self, name):
+        return self.stats.get(name, 0)
+
+    def set(self, name, value):
+        self.stats[name] = value
+
+    def incr(self, name):
+        self.stats[name] = self.stats.get(name, 0) + 1
+
+
+class FakeSubserver(object):
+
+    def __init__(self):
+        self.profile_calls = []
+        self.result = 'a;b 3\n'
+
+    def profile(self, seconds):
+        self.profile_calls.append(seconds)
+        return self.result
+
+
+class TestWSGIProfile(TestCase):
+
+    def setUp(self):
+        self.next_app_calls = []
+        self.start_response_calls = []
+
+        def _next_app(env, start_response):
+            self.next_app_calls.append((env, start_response))
+            start_response('204 No Content', [('Content-Length', '0')])
+            return []
+
+        def _start_response(*args):
+            self.start_response_calls.append(args)
+
+        self.next_app = _next_app
+        self.start_response = _start_response
+        self.subserver = FakeSubserver()
+        self.env = {'PATH_INFO': '/profile', 'REQUEST_METHOD': 'GET',
+                    'REMOTE_ADDR': '127.0.0.1', 'brim': self.subserver,
+                    'brim.stats': FakeStats()}
+        self.parsed_conf = {'path': '/profile', 'default_seconds': 10,
+                            'max_seconds': 60, 'allow': set(['127.0.0.1'])}
+
+    def _call(self):
+        app = wsgi_profile.WSGIProfile(
+            'profile', self.parsed_conf, self.next_app)
+        return ''.join(app(self.env, self.start_response))
+
+    def test_call_ignores_non_path(self):
+        self.env['PATH_INFO'] = '/'
+        self._call()
+        self.assertEqual(len(self.next_app_calls), 1)
+        self.assertEqual(self.subserver.profile_calls, [])
+        self.assertEqual(self.env['brim.stats'].get('profile.requests'), 0)
+
+    def test_call(self):
+        body = self._call()
+        self.assertEqual(body, 'a;b 3\n')
+        self.assertEqual(self.start_response_calls, [(
+            '200 OK', [('Content-Length', '6'),
+                       ('Content-Type', 'text/plain')])])
+        self.assertEqual(self.subserver.profile_calls, [10])
+        self.assertEqual(self.env['brim.stats'].get('profile.requests'), 1)
+
+    def test_call_seconds(self):
+        self.env['QUERY_STRING'] = 'seconds=60'
+        self._call()
+        self.assertEqual(self.subserver.profile_calls, [60])
+        for value in ('0', '61', 'abc', ''):
+            self.env['QUERY_STRING'] = 'seconds=' + value
+            del self.start_response_calls[:]
+            self._call()
+            self.assertEqual(
+                self.start_response_calls[0][0], '400 Bad Request')
+        self.assertEqual(self.subserver.profile_calls, [60])
+
+    def test_call_method(self):
+        self.env['REQUEST_METHOD'] = 'POST'
+        self._call()
+        self.assertEqual(
+            self.start_response_calls[0][0], '405 Method Not Allowed')
+        self.assertTrue(('Allow', 'GET') in self.start_response_calls[0][1])
+        self.assertEqual(self.subserver.profile_calls, [])
+
+    def test_call_not_allowed(self):
+        self.env['REMOTE_ADDR'] = '10.1.2.3'
+        self._call()
+        self.assertEqual(self.start_response_calls[0][0], '403 Forbidden')
+        self.assertEqual(self.subserver.profile_calls, [])
+        del self.env['REMOTE_ADDR']
+        self._call()
+        self.assertEqual(self.start_response_calls[1][0], '403 Forbidden')
+        self.assertEqual(self.subserver.profile_calls, [])
+
+    def test_call_allow_any(self):
+        self.parsed_conf['allow'] = None
+        self.env['REMOTE_ADDR'] = '10.1.2.3'
+        self.assertEqual(self._call(), 'a;b 3\n')
+        self.assertEqual(self.subserver.profile_calls, [10])
+
+    def test_call_already_profiling(self):
+        self.subserver.result = None
+        body = self._call()
+        self.assertEqual(self.start_response_calls[0][0], '409 Conflict')
+        self.assertEqual(body, 'Already profiling.\n')
+
+    def test_parse_conf(self):
+        c = wsgi_profile.WSGIProfile.parse_conf('profile', Conf({}))
+        self.assertEqual(c, {
+            'path': '/profile', 'default_seconds': 10, 'max_seconds': 60,
+            'allow': set(['127.0.0.1', '::1', '::ffff:127.0.0.1'])})
+        c = wsgi_profile.WSGIProfile.parse_conf('profile', Conf({
+            'profile': {'path': '/p', 'max_seconds': '5',
+                        'allow': '10.1.2.3 10.1.2.4'}}))
+        self.assertEqual(c, {'path': '/p', 'default_seconds': 5,
+                             'max_seconds': 5,
+                             'allow': set(['10.1.2.3', '10.1.2.4'])})
+        c = wsgi_profile.WSGIProfile.parse_conf('profile', Conf({
+            'profile': {'allow': '*'}}))
+        self.assertEqual(c['allow'], None)
+        c = wsgi_profile.WSGIProfile.parse_conf('profile', Conf({
+            'profile': {'default_seconds': '3'}}))
+        self.assertEqual(c['default_seconds'], 3)
+        for value in ('0', '61'):
+            exc = None
+            try:
+                wsgi_profile.WSGIProfile.parse_conf('profile', Conf({
+                    'profile': {'default_seconds': value}}))
+            except Exception as err:
+                exc = err
+            self.assertEqual(
+                str(exc),
+                'Invalid [profile] default_seconds %s; must be from 1 to '
+                'max_seconds 60.' % value)
+
+    def test_stats_conf(self):
+        self.assertEqual(wsgi_profile.WSGIProfile.stats_conf(
+            'profile', self.parsed_conf), [('profile.requests', 'sum')])
+
+
+if __name__ == '__main__':
+    main()
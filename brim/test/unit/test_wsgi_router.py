@@ -0,0 +1,262 @@
+"""Tests for brim.wsgi_router."""
+"""Copyright and License.
+
+Copyright 2014 Gregory Holt
+
+Licensed under the Apache License, Version 2.0 (the "License"); you may
+not use this file except in compliance with the License. You may obtain
+a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+from StringIO import StringIO
+from unittest import main, TestCase
+
+from brim import wsgi_router
+from brim.conf import Conf
+
+
+class FakeStats(object):
+
+    def __init__(self):
+        self.stats = {}
+
+    def get(self, name):
+        return self.stats.get(name, 0)
+
+    def set(self, name, value):
+        self.stats[name] = value
+
+    def incr(self, name):
+        self.stats[name] = self.stats.get(name, 0) + 1
+
+
+class Tag(object):
+    """An app that notes it was called and passes the request on."""
+
+    def __init__(self, name, parsed_conf, next_app):
+        self.name = name
+        self.next_app = next_app
+
+    def __call__(self, env, start_response):
+        env.setdefault('tags', []).append(self.name)
+        return self.next_app(env, start_response)
+
+    @classmethod
+    def stats_conf(cls, name, parsed_conf):
+        return [('%s.tagged' % name, 'sum')]
+
+
+class TestWSGIRouter(TestCase):
+
+    def setUp(self):
+        self.next_app_calls = []
+        self.start_response_calls = []
+
+        def _next_app(env, start_response):
+            self.next_app_calls.append(env.get('tags'))
+            start_response('204 No Content', [('Content-Length', '0')])
+            return []
+
+        def _start_response(*args):
+            self.start_response_calls.append(args)
+
+        self.next_app = _next_app
+        self.start_response = _start_response
+        self.confd = {
+            'router': {},
+            'a': {'call': 'brim.test.unit.test_wsgi_router.Tag'},
+            'b': {'call': 'brim.test.unit.test_wsgi_router.Tag'},
+            'echo': {'call': 'brim.wsgi_echo.WSGIEcho'}}
+
+    def _router(self, **routes):
+        for route_name, value in routes.iteritems():
+            self.confd['router']['route.' + route_name] = value
+        conf = Conf(self.confd)
+        return wsgi_router.WSGIRouter(
+            'router', wsgi_router.WSGIRouter.parse_conf('router', conf),
+            self.next_app)
+
+    def _call(self, router, path, method='GET'):
+        env = {'PATH_INFO': path, 'REQUEST_METHOD': method,
+               'brim.stats': FakeStats(), 'wsgi.input': StringIO('body')}
+        del self.next_app_calls[:]
+        del self.start_response_calls[:]
+        body = ''.join(router(env, self.start_response))
+        return env, body
+
+    def _tags(self, router, path, method='GET'):
+        env, body = self._call(router, path, method)
+        if not self.next_app_calls:
+            return None
+        return self.next_app_calls[0] or []
+
+    def test_exact(self):
+        router = self._router(one='/one a', two='/one/two b')
+        self.assertEqual(self._tags(router, '/one'), ['a'])
+        self.assertEqual(self._tags(router, '/one/two'), ['b'])
+        self.assertEqual(self._tags(router, '/one/'), [])
+        self.assertEqual(self._tags(router, '/one/two/three'), [])
+        self.assertEqual(self._tags(router, '/on'), [])
+        self.assertEqual(self._tags(router, '/'), [])
+
+    def test_root(self):
+        router = self._router(root='/ a')
+        self.assertEqual(self._tags(router, '/'), ['a'])
+        self.assertEqual(self._tags(router, '/one'), [])
+
+    def test_prefix(self):
+        router = self._router(files='/files/* a', deep='/files/x/* b')
+        self.assertEqual(self._tags(router, '/files'), ['a'])
+        self.assertEqual(self._tags(router, '/files/'), ['a'])
+        self.assertEqual(self._tags(router, '/files/y/z'), ['a'])
+        self.assertEqual(self._tags(router, '/files/x'), ['b'])
+        self.assertEqual(self._tags(router, '/files/x/z'), ['b'])
+        self.assertEqual(self._tags(router, '/filesx'), [])
+
+    def test_prefix_everything(self):
+        router = self._router(all='/* a', one='/one b')
+        self.assertEqual(self._tags(router, '/'), ['a'])
+        self.assertEqual(self._tags(router, '/two/three'), ['a'])
+        self.assertEqual(self._tags(router, '/one'), ['b'])
+        self.assertEqual(self._tags(router, '/one/two'), ['a'])
+
+    def test_exact_beats_prefix(self):
+        router = self._router(files='/files/* a', index='/files b')
+        self.assertEqual(self._tags(router, '/files'), ['b'])
+        self.assertEqual(self._tags(router, '/files/'), ['a'])
+
+    def test_longer_prefix_beats_exact_below(self):
+        router = self._router(files='/files/* a', deep='/files/x/y b')
+        self.assertEqual(self._tags(router, '/files/x'), ['a'])
+        self.assertEqual(self._tags(router, '/files/x/y'), ['b'])
+        self.assertEqual(self._tags(router, '/files/x/y/z'), ['a'])
+
+    def test_pipeline(self):
+        router = self._router(both='/both a b echo')
+        env, body = self._call(router, '/both')
+        self.assertEqual(self.next_app_calls, [['a', 'b']])
+        # WSGIEcho doesn't match /both so it passes the request on too.
+        self.assertEqual(env['brim.stats'].get('router.routed_count'), 1)
+        self.confd['echo']['path'] = '/both'
+        router = self._router(both='/both a b echo')
+        env, body = self._call(router, '/both')
+        self.assertEqual(self.next_app_calls, [])
+        self.assertEqual(env['tags'], ['a', 'b'])
+        self.assertEqual(body, 'body')
+
+    def test_unrouted(self):
+        router = self._router(one='/one a')
+        env, body = self._call(router, '/two')
+        self.assertEqual(self.next_app_calls, [None])
+        self.assertEqual(env['brim.stats'].get('router.unrouted_count'), 1)
+        self.assertEqual(env['brim.stats'].get('router.routed_count'), 0)
+
+    def test_methods(self):
+        router = self._router(
+            read='get HEAD /one a', write='PUT /one b', other='/two a')
+        self.assertEqual(self._tags(router, '/one', 'GET'), ['a'])
+        self.assertEqual(self._tags(router, '/one', 'HEAD'), ['a'])
+        self.assertEqual(self._tags(router, '/one', 'PUT'), ['b'])
+        self.assertEqual(self._tags(router, '/one', 'POST'), None)
+        self.assertEqual(self.start_response_calls[0][0],
+                         '405 Method Not Allowed')
+        self.assertTrue(
+            ('Allow', 'GET, HEAD, PUT') in self.start_response_calls[0][1])
+        self.assertEqual(self._tags(router, '/two', 'POST'), ['a'])
+
+    def test_methods_with_any_method_route(self):
+        router = self._router(read='GET /one a', other='/one b')
+        self.assertEqual(self._tags(router, '/one', 'GET'), ['a'])
+        self.assertEqual(self._tags(router, '/one', 'POST'), ['b'])
+
+    def test_parse_conf(self):
+        c = wsgi_router.WSGIRouter.parse_conf('router', Conf(self.confd))
+        self.assertEqual(c, {'routes': [], 'stats': []})
+        self.confd['router'].update({
+            'route.one': 'GET /one a b', 'route.two': '/two/* echo',
+            'other': 'ignored'})
+        c = wsgi_router.WSGIRouter.parse_conf('router', Conf(self.confd))
+        self.assertEqual(
+            [(r[0], r[1], r[2], [a[0] for a in r[3]]) for r in c['routes']],
+            [('one', ['GET'], '/one', ['a', 'b']),
+             ('two', [], '/two/*', ['echo'])])
+        self.assertEqual(c['routes'][1][3][0][2]['path'], '/echo')
+        self.assertEqual(
+            c['stats'],
+            [('a.tagged', 'sum'), ('b.tagged', 'sum'),
+             ('echo.requests', 'sum')])
+
+    def test_parse_conf_invalid(self):
+        for value in ('/one', 'GET /one', 'GET a', ''):
+            self.confd['router']['route.one'] = value
+            exc = None
+            try:
+                wsgi_router.WSGIRouter.parse_conf('router', Conf(self.confd))
+            except Exception as err:
+                exc = err
+            self.assertEqual(
+                str(exc),
+                'Invalid [router] route.one %r; should be [<method> ...] '
+                '<path> <app> [<app>] ...' % (value or None))
+
+    def test_parse_conf_invalid_path(self):
+        for path in ('/one*', '/*/one', '/one/*/*'):
+            self.confd['router']['route.one'] = '%s a' % path
+            exc = None
+            try:
+                wsgi_router.WSGIRouter.parse_conf('router', Conf(self.confd))
+            except Exception as err:
+                exc = err
+            self.assertTrue(str(exc).startswith(
+                'Invalid [router] route.one path '), (path, exc))
+
+    def test_parse_conf_invalid_app(self):
+        self.confd['router']['route.one'] = '/one nope'
+        exc = None
+        try:
+            wsgi_router.WSGIRouter.parse_conf('router', Conf(self.confd))
+        except Exception as err:
+            exc = err
+        self.assertEqual(
+            str(exc), "App [nope] not configured with 'call' option.")
+
+    def test_parse_conf_conflict(self):
+        self.confd['router'].update({
+            'route.one': 'GET /one a', 'route.two': 'get /one b'})
+        exc = None
+        try:
+            wsgi_router.WSGIRouter.parse_conf('router', Conf(self.confd))
+        except Exception as err:
+            exc = err
+        self.assertEqual(
+            str(exc),
+            'Routes [router] route.one and route.two both route GET /one.')
+        self.confd['router'].update({
+            'route.one': '/one/* a', 'route.two': '/one/* b'})
+        exc = None
+        try:
+            wsgi_router.WSGIRouter.parse_conf('router', Conf(self.confd))
+        except Exception as err:
+            exc = err
+        self.assertEqual(
+            str(exc),
+            'Routes [router] route.one and route.two both route /one/*.')
+
+    def test_stats_conf(self):
+        self.confd['router']['route.one'] = '/one a'
+        c = wsgi_router.WSGIRouter.parse_conf('router', Conf(self.confd))
+        self.assertEqual(
+            wsgi_router.WSGIRouter.stats_conf('router', c),
+            [('router.routed_count', 'sum'), ('router.unrouted_count', 'sum'),
+             ('a.tagged', 'sum')])
+
+
+if __name__ == '__main__':
+    main()
@@ -84,15 +84,17 @@ class UDPEcho(object):
             managing this app.
         :param stats: The shared memory statistics object as defined
             above.
-        :param sock: The socket associated with the datagram; useful for
-            replying back using sendto.
+        :param sock: The socket associated with the datagram. Replies
+            are usually better sent with the subserver's reply method,
+            which can batch them per reply_batch_size, rather than with
+            sock.sendto.
         :param datagram: The just received datagram.
         :param ip: The remote IP address.
         :param port: The remote IP port.
         """
         try:
             stats.set('byte_count', stats.get('byte_count') + len(datagram))
-            sock.sendto(datagram, (ip, port))
+            subserver.reply(datagram, ip, port)
         finally:
             subserver.logger.notice(
                 'served request of %s bytes from %s:%s' %
@@ -0,0 +1,474 @@
+"""A WSGI application that caches responses of the apps after it.
+
+GET responses the later apps mark as cacheable with a max-age or
+s-maxage Cache-Control directive are kept in memory and served again
+to identical requests, by host, path and query string, until they are
+that many seconds old. Responses with a Vary header are kept separately
+for each value of the named request headers. HEAD requests are answered
+from a kept GET response but otherwise pass through uncached.
+
+Responses are not kept if their Cache-Control has no-store, no-cache or
+private, if they set a cookie, if they Vary on \\*, or if their status is
+not one that can be cached by default, such as 200 or 404. Requests with
+an Authorization header are never answered from or kept in the cache
+unless the response's Cache-Control has public or s-maxage. A request
+with Cache-Control no-cache or max-age=0, or Pragma no-cache, skips the
+cache but its response may still be kept; with no-store it skips the
+cache entirely.
+
+When several requests miss the cache for the same response at once,
+only the first goes on to the later apps and the others wait for its
+response to be kept, for up to collapse_timeout seconds, rather than
+all doing the same work.
+
+The cache is kept in each worker's memory and is not shared between
+workers, so each worker fills its own.
+
+Configuration Options::
+
+    [wsgi_cache]
+    call = brim.wsgi_cache.WSGICache
+    # max_bytes = <bytes>
+    #   The most bytes of response bodies each worker keeps, dropping
+    #   the least recently used responses to stay under it.
+    #   Default: 67108864
+    # max_body_size = <bytes>
+    #   The largest response body to keep. Default: 1048576
+    # default_max_age = <seconds>
+    #   The seconds to keep cacheable responses with no max-age or
+    #   s-maxage of their own. 0 keeps only responses with one.
+    #   Default: 0
+    # collapse_timeout = <seconds>
+    #   The most seconds a request waits for another request's response
+    #   to the same request to be kept before going on itself.
+    #   Default: 5
+
+Stats Variables (where *n.* is the name of the app in the config):
+
+===============  ======  ==============================================
+Name             Type    Description
+===============  ======  ==============================================
+n.bytes          sum     The number of bytes of response bodies kept.
+n.collapsed      sum     The number of requests that waited for another
+                         request's response.
+n.evictions      sum     The number of responses dropped to stay under
+                         max_bytes.
+n.hits           sum     The number of requests answered from the
+                         cache.
+n.misses         sum     The number of requests that could have been
+                         answered from the cache but weren't.
+===============  ======  ==============================================
+"""
+"""Copyright and License.
+
+Copyright 2014 Gregory Holt
+
+Licensed under the Apache License, Version 2.0 (the "License"); you may
+not use this file except in compliance with the License. You may obtain
+a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+from collections import OrderedDict
+from threading import Event, Lock
+from time import time
+
+from eventlet import event, Timeout
+
+
+#: The response statuses that may be cached without being marked so.
+CACHEABLE_STATUSES = (200, 203, 204, 300, 301, 404, 405, 410, 414, 501)
+
+
+def _cache_control(value):
+    """Returns a dict of the directives in a Cache-Control value.
+
+    Directives without a value, such as no-cache, map to True.
+    """
+    directives = {}
+    for directive in (value or '').split(','):
+        name, _junk, arg = directive.partition('=')
+        name = name.strip().lower()
+        if name:
+            directives[name] = arg.strip().strip('"') or True
+    return directives
+
+
+def _max_age(directives, default):
+    """Returns the seconds to keep a response with the directives."""
+    for name in ('s-maxage', 'max-age'):
+        if name in directives:
+            try:
+                return int(directives[name])
+            except (TypeError, ValueError):
+                return 0
+    return default
+
+
+def _iter_and_close(chunks, rest, body):
+    """Yields the chunks then the rest, closing the body after."""
+    try:
+        for chunk in chunks:
+            yield chunk
+        for chunk in rest:
+            yield chunk
+    finally:
+        if hasattr(body, 'close'):
+            body.close()
+
+
+class WSGICache(object):
+    """A WSGI app that caches responses of the apps after it.
+
+    See :py:mod:`brim.wsgi_cache` for more information.
+
+    :param name: The name of the app.
+    :param parsed_conf: The conf result from :py:meth:`parse_conf`.
+    :param next_app: The next WSGI app in the chain.
+    """
+
+    def __init__(self, name, parsed_conf, next_app):
+        self.name = name
+        """The name of the app."""
+        self.next_app = next_app
+        """The next WSGI app in the chain."""
+        self.max_bytes = parsed_conf['max_bytes']
+        """The most bytes of response bodies to keep."""
+        self.max_body_size = parsed_conf['max_body_size']
+        """The largest response body to keep."""
+        self.default_max_age = parsed_conf['default_max_age']
+        """The seconds to keep responses with no max-age of their own."""
+        self.collapse_timeout = parsed_conf['collapse_timeout']
+        """The most seconds to wait for another request's response."""
+        self.entries = OrderedDict()
+        """Maps keys to entries, least recently used first.
+
+        An entry is an (expires, stored, status, headers, body) tuple,
+        or for responses with a Vary header a ('vary', names) tuple
+        saying which request headers, as WSGI env keys, to add to the
+        key to find the entry for the request.
+        """
+        self.bytes = 0
+        """The number of bytes of response bodies in self.entries."""
+        self.pending = {}
+        """Maps keys being fetched to a function waiting for the fetch."""
+        self.lock = Lock()
+        self.bytes_stat = '%s.bytes' % self.name
+        self.collapsed_stat = '%s.collapsed' % self.name
+        self.evictions_stat = '%s.evictions' % self.name
+        self.hits_stat = '%s.hits' % self.name
+        self.misses_stat = '%s.misses' % self.name
+
+    def __call__(self, env, start_response):
+        """Handles incoming WSGI requests.
+
+        GET and HEAD requests are answered from the cache when possible
+        and GET responses are kept when cacheable; other requests are
+        passed on to the next WSGI app in the chain.
+
+        :param env: The WSGI env as per the spec.
+        :param start_response: The WSGI start_response as per the spec.
+        :returns: Calls *start_response* and returns an iterable as per
+            the WSGI spec.
+        """
+        method = env['REQUEST_METHOD']
+        if method not in ('GET', 'HEAD'):
+            return self.next_app(env, start_response)
+        directives = _cache_control(env.get('HTTP_CACHE_CONTROL'))
+        if 'no-store' in directives:
+            return self.next_app(env, start_response)
+        authorized = 'HTTP_AUTHORIZATION' in env
+        base_key = (env.get('HTTP_HOST'),
+                    env.get('SCRIPT_NAME', '') + env['PATH_INFO'],
+                    env.get('QUERY_STRING'))
+        if not authorized and 'no-cache' not in directives and \
+                directives.get('max-age') != '0' and \
+                'no-cache' not in env.get('HTTP_PRAGMA', '').lower():
+            entry = self.get(env, base_key)
+            if not entry and method == 'GET':
+                entry = self.collapse(env, base_key)
+            if entry:
+                return self.respond(entry, env, start_response)
+        if method == 'HEAD':
+            return self.next_app(env, start_response)
+        if not authorized:
+            env['brim.stats'].incr(self.misses_stat)
+        return self.fetch(env, start_response, base_key, authorized)
+
+    def _key(self, env, base_key):
+        """Returns the key of the entry for the request and any Vary."""
+        with self.lock:
+            entry = self.entries.get(base_key)
+            if entry and entry[0] == 'vary':
+                self.entries[base_key] = self.entries.pop(base_key)
+                return base_key + tuple(env.get(n) for n in entry[1])
+        return base_key
+
+    def get(self, env, base_key):
+        """Returns the fresh entry for the request, or None.
+
+        :param env: The WSGI env of the request.
+        :param base_key: The key of the request before any Vary.
+        """
+        key = self._key(env, base_key)
+        with self.lock:
+            entry = self.entries.get(key)
+            if not entry or entry[0] == 'vary':
+                return None
+            if entry[0] < time():
+                self._pop(key)
+                env['brim.stats'].set(self.bytes_stat, self.bytes)
+                return None
+            self.entries[key] = self.entries.pop(key)
+        return entry
+
+    def collapse(self, env, base_key):
+        """Waits for any fetch of the request's key, returning its entry.
+
+        If no other request is fetching the key, or the wait times out,
+        None is returned and this request becomes the one fetching the
+        key.
+
+        :param env: The WSGI env of the request.
+        :param base_key: The key of the request before any Vary.
+        """
+        with self.lock:
+            wait = self.pending.get(base_key)
+            if not wait:
+                if env['brim'].concurrency_model == 'threads':
+                    done = Event()
+                    self.pending[base_key] = lambda: done.wait(
+                        self.collapse_timeout)
+                    env['brim._wsgi_cache_done'] = done.set
+                else:
+                    done = event.Event()
+                    self.pending[base_key] = lambda: self._green_wait(done)
+                    env['brim._wsgi_cache_done'] = done.send
+                return None
+        env['brim.stats'].incr(self.collapsed_stat)
+        wait()
+        return self.get(env, base_key)
+
+    def _green_wait(self, done):
+        with Timeout(self.collapse_timeout, False):
+            done.wait()
+
+    def _done(self, env, base_key):
+        """Wakes any requests waiting on this request's fetch."""
+        done = env.pop('brim._wsgi_cache_done', None)
+        if done:
+            with self.lock:
+                self.pending.pop(base_key, None)
+            done()
+
+    def fetch(self, env, start_response, base_key, authorized):
+        """Returns the next app's response, keeping it if cacheable.
+
+        :param env: The WSGI env of the request.
+        :param start_response: The WSGI start_response of the request.
+        :param base_key: The key of the request before any Vary.
+        :param authorized: Whether the request has authorization.
+        """
+        response = []
+        written = []
+        passthrough = []
+
+        def _start_response(status, headers, exc_info=None):
+            if passthrough:
+                return start_response(status, headers, exc_info)
+            response[:] = [status, headers, exc_info]
+            return written.append
+
+        try:
+            body = self.next_app(env, _start_response)
+            if not response:
+                # The app will call start_response once iterated.
+                passthrough.append(True)
+                return body
+            try:
+                max_age, vary = self._cacheable(response, authorized)
+                chunks = written
+                rest = body
+                if max_age:
+                    size = sum(len(c) for c in chunks)
+                    rest = iter(body)
+                    for chunk in rest:
+                        chunks.append(chunk)
+                        size += len(chunk)
+                        if size > self.max_body_size:
+                            break
+                    else:
+                        if hasattr(body, 'close'):
+                            body.close()
+                        body = ''.join(chunks)
+                        self.put(env, base_key, vary, time() + max_age,
+                                 response[0], response[1], body)
+                        start_response(*response)
+                        return [body]
+            except Exception:
+                if hasattr(body, 'close'):
+                    body.close()
+                raise
+        finally:
+            self._done(env, base_key)
+        start_response(*response)
+        if chunks:
+            return _iter_and_close(chunks, rest, body)
+        return body
+
+    def _cacheable(self, response, authorized):
+        """Returns (max_age, vary) for the response; 0 max_age if not.
+
+        The vary is the list of WSGI env keys of the request headers
+        named by the response's Vary header.
+        """
+        if not response or response[2]:
+            return 0, None
+        try:
+            status = int(response[0].split(' ', 1)[0])
+        except ValueError:
+            return 0, None
+        if status not in CACHEABLE_STATUSES:
+            return 0, None
+        directives = {}
+        vary = []
+        for name, value in response[1]:
+            name = name.lower()
+            if name == 'cache-control':
+                directives.update(_cache_control(value))
+            elif name == 'set-cookie':
+                return 0, None
+            elif name == 'vary':
+                for header in value.split(','):
+                    header = header.strip()
+                    if header == '*':
+                        return 0, None
+                    if header:
+                        vary.append(
+                            'HTTP_' + header.upper().replace('-', '_'))
+        if 'no-store' in directives or 'no-cache' in directives or \
+                'private' in directives:
+            return 0, None
+        if authorized and 'public' not in directives and \
+                's-maxage' not in directives:
+            return 0, None
+        return max(_max_age(directives, self.default_max_age), 0), vary
+
+    def put(self, env, base_key, vary, expires, status, headers, body):
+        """Keeps the response, dropping old ones to stay under max_bytes.
+
+        :param env: The WSGI env of the request.
+        :param base_key: The key of the request before any Vary.
+        :param vary: The WSGI env keys of the request headers the
+            response varies on.
+        :param expires: The time the response should be dropped.
+        :param status: The WSGI response status.
+        :param headers: The WSGI response headers.
+        :param body: The response body.
+        """
+        stats = env['brim.stats']
+        headers = [h for h in headers if h[0].lower() != 'age']
+        with self.lock:
+            key = base_key
+            if vary:
+                self._pop(base_key)
+                self.entries[base_key] = ('vary', sorted(set(vary)))
+                key = base_key + tuple(
+                    env.get(n) for n in self.entries[base_key][1])
+            elif self.entries.get(base_key, ('',))[0] == 'vary':
+                self._pop(base_key)
+            self._pop(key)
+            self.entries[key] = (expires, time(), status, headers, body)
+            self.bytes += len(body)
+            while self.bytes > self.max_bytes:
+                if self._pop(next(iter(self.entries))):
+                    stats.incr(self.evictions_stat)
+            stats.set(self.bytes_stat, self.bytes)
+
+    def _pop(self, key):
+        """Drops the entry, returning True if it was a response."""
+        entry = self.entries.pop(key, None)
+        if entry and entry[0] != 'vary':
+            self.bytes -= len(entry[4])
+            return True
+        return False
+
+    def respond(self, entry, env, start_response):
+        """Answers the request with the kept entry.
+
+        :param entry: The entry from :py:meth:`get`.
+        :param env: The WSGI env of the request.
+        :param start_response: The WSGI start_response of the request.
+        """
+        env['brim.stats'].incr(self.hits_stat)
+        expires, stored, status, headers, body = entry
+        start_response(
+            status, headers + [('Age', str(int(time() - stored)))])
+        if env['REQUEST_METHOD'] == 'HEAD':
+            return []
+        return [body]
+
+    @classmethod
+    def parse_conf(cls, name, conf):
+        """Translates the overall server configuration.
+
+        The conf is translated into an app-specific configuration dict
+        suitable for passing as ``parsed_conf`` in the
+        :py:class:`WSGICache` constructor.
+
+        See the overall docs of :py:mod:`brim.wsgi_cache` for
+        configuration options.
+
+        :param name: The name of the app, indicates the app's section in
+            the overall configuration for the server.
+        :param conf: The :py:class:`brim.conf.Conf` instance
+            representing the overall configuration of the server.
+        :returns: A dict suitable for passing as ``parsed_conf`` in the
+            :py:class:`WSGICache` constructor.
+        """
+        parsed_conf = {
+            'max_bytes': conf.get_int(name, 'max_bytes', 67108864),
+            'max_body_size': conf.get_int(name, 'max_body_size', 1048576),
+            'default_max_age': conf.get_int(name, 'default_max_age', 0),
+            'collapse_timeout': conf.get_float(
+                name, 'collapse_timeout', 5.0)}
+        for option in ('max_bytes', 'max_body_size', 'default_max_age',
+                       'collapse_timeout'):
+            if parsed_conf[option] < 0:
+                raise Exception('Invalid [%s] %s %r.' %
+                                (name, option, parsed_conf[option]))
+        if parsed_conf['max_body_size'] > parsed_conf['max_bytes']:
+            raise Exception(
+                'Invalid [%s] max_body_size %r; must not be more than '
+                'max_bytes %r.' %
+                (name, parsed_conf['max_body_size'],
+                 parsed_conf['max_bytes']))
+        return parsed_conf
+
+    @classmethod
+    def stats_conf(cls, name, parsed_conf):
+        """Returns a list of (stat_name, stat_type) pairs.
+
+        These pairs specify the stat variables this app wants
+        established in the ``stats`` instance passed to
+        :py:meth:`__call__`.
+
+        See the overall docs of :py:mod:`brim.wsgi_cache` for what stats
+        are defined.
+
+        :param name: The name of the app, indicates the app's section in
+            the overall configuration for the daemon server.
+        :param parsed_conf: The result from :py:meth:`parse_conf`.
+        :returns: A list of (stat_name, stat_type) pairs.
+        """
+        return [('%s.bytes' % name, 'sum'),
+                ('%s.collapsed' % name, 'sum'),
+                ('%s.evictions' % name, 'sum'),
+                ('%s.hits' % name, 'sum'),
+                ('%s.misses' % name, 'sum')]
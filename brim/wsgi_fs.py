@@ -2,9 +2,30 @@
 
 .. warning::
 
-    This is an early version of this module. It has no tests, limited
+    This is an early version of this module. It has limited tests and
     documentation, and is subject to major changes.
 
+Reading the file system blocks, and with the eventlet concurrency_model
+a read waiting on the disk would hold up every other request of the
+worker. With io_threads set, the disk calls are instead run on a pool of
+that many OS threads in each worker, Eventlet's tpool, while the
+worker's other requests carry on. Each call pays a little for the trip
+to the pool and back, which is worth it once files are not all cached
+in memory. With the threads concurrency_model, requests are already on
+their own OS threads so the disk calls are just made directly.
+
+With mmap_max_file_size set, files up to that size are instead memory
+mapped and the maps kept, up to mmap_max_bytes in total, to be shared
+by later requests for the same file in the worker. Those requests skip
+opening and reading the file, responding with string slices copied from
+the map, as Eventlet's WSGI layer can only send strings. A map is
+dropped once the file's inode, size or modification time changes, or
+the least recently used maps are dropped to stay under mmap_max_bytes;
+the file is unmapped once any responses still using it finish. Parts of
+a map no longer in memory are read back in by the worker itself rather
+than on the io_threads pool, so this is best for files that are served
+often enough to stay cached.
+
 Configuration Options::
 
     [wsgi_fs]
@@ -15,6 +36,37 @@ Configuration Options::
     #   chain. Default: /
     # serve_path = <path>
     #   The local file path containing files to serve.
+    # io_threads = <number>
+    #   The number of OS threads each worker runs disk calls on. The
+    #   pool is shared with anything else in the worker using Eventlet's
+    #   tpool. 0 makes the disk calls directly. Default: 0
+    # fadvise_sequential = <boolean>
+    #   Whether to tell the kernel each file served will be read
+    #   sequentially, which has Linux read further ahead of the reads.
+    #   Only supported on Linux. Default: no
+    # mmap_max_file_size = <bytes>
+    #   The largest file to memory map and keep mapped for later
+    #   requests. 0 turns off memory mapping. Default: 0
+    # mmap_max_bytes = <bytes>
+    #   The most bytes each worker keeps mapped, dropping the least
+    #   recently used maps to stay under it. Default: 67108864
+
+Stats Variables (where *n.* is the name of the app in the config):
+
+=====================  ======  ========================================
+Name                   Type    Description
+=====================  ======  ========================================
+n.io_in_flight         sum     The number of disk calls waiting for or
+                               running on the io_threads pool.
+n.io_in_flight_peak    max     The most disk calls ever waiting for or
+                               running on the io_threads pool at once.
+n.mmap_bytes           sum     The number of bytes kept mapped.
+n.mmap_hits            sum     The number of responses from a kept map.
+n.mmap_misses          sum     The number of files mapped.
+=====================  ======  ========================================
+
+The io_in_flight stats are only kept with io_threads set and the mmap
+stats only with mmap_max_file_size set.
 """
 """Copyright and License.
 
@@ -36,8 +88,15 @@ import mimetypes
 import os
 import time
 from cgi import escape
+from collections import OrderedDict
+from mmap import ACCESS_READ, mmap
+from stat import S_ISDIR
+from threading import Lock
+
+from eventlet import tpool
 
 from brim import http
+from brim.service import posix_fadvise, POSIX_FADV_SEQUENTIAL
 
 
 MONTH_ABR = (
@@ -55,15 +114,63 @@ def http_date_time(when):
         gmtime.tm_min, gmtime.tm_sec)
 
 
-def _openiter(path, chunk_size, total_size):
-    left = total_size
+def _stat(path):
+    """Returns os.stat(path) or None if that fails."""
+    try:
+        return os.stat(path)
+    except OSError:
+        return None
+
+
+def _open(path, sequential):
+    """Returns the file opened for reading, with any fadvise done."""
+    source = open(path, 'rb')
+    if sequential:
+        try:
+            posix_fadvise(source.fileno(), 0, 0, POSIX_FADV_SEQUENTIAL)
+        except OSError:
+            pass
+    return source
+
+
+def _map(path, size):
+    """Returns the first size bytes of the file mapped read only."""
     with open(path, 'rb') as source:
+        return mmap(source.fileno(), size, access=ACCESS_READ)
+
+
+def _mapiter(mapped, chunk_size):
+    for offset in xrange(0, len(mapped), chunk_size):
+        yield mapped[offset:offset + chunk_size]
+
+
+def _list_dir(path):
+    """Returns a sorted list of (name, isdir, isfile, size, mtime)."""
+    listing = []
+    for item in sorted(os.listdir(path)):
+        itempath = os.path.join(path, item)
+        stat = _stat(itempath)
+        if stat:
+            listing.append((
+                item, S_ISDIR(stat.st_mode), os.path.isfile(itempath),
+                stat.st_size, stat.st_mtime))
+        else:
+            listing.append((item, False, False, 0, 0))
+    return listing
+
+
+def _openiter(path, chunk_size, total_size, io, sequential):
+    left = total_size
+    source = io(_open, path, sequential)
+    try:
         while True:
-            chunk = source.read(min(chunk_size, left))
+            chunk = io(source.read, min(chunk_size, left))
             if not chunk:
                 break
             left -= len(chunk)
             yield chunk
+    finally:
+        source.close()
     if left >= chunk_size:
         chunk = ' ' * chunk_size
         while left >= chunk_size:
@@ -97,6 +204,32 @@ class WSGIFS(object):
         """
         self.serve_path = parsed_conf['serve_path']
         """The local file path containing files to serve."""
+        self.io_threads = parsed_conf['io_threads']
+        """The number of OS threads to run disk calls on, if any."""
+        self.fadvise_sequential = parsed_conf['fadvise_sequential']
+        """Whether to advise the kernel files are read sequentially."""
+        self.io_in_flight = 0
+        """The number of disk calls waiting for or on the pool."""
+        self.io_in_flight_stat = '%s.io_in_flight' % self.name
+        self.io_in_flight_peak_stat = '%s.io_in_flight_peak' % self.name
+        if self.io_threads:
+            tpool.set_num_threads(self.io_threads)
+        self.mmap_max_file_size = parsed_conf['mmap_max_file_size']
+        """The largest file to memory map, or 0 for none."""
+        self.mmap_max_bytes = parsed_conf['mmap_max_bytes']
+        """The most bytes to keep mapped."""
+        self.mmaps = OrderedDict()
+        """Maps paths to (identity, mmap) pairs, least recent first.
+
+        The identity is the (st_ino, st_size, st_mtime) of the file when
+        it was mapped.
+        """
+        self.mmap_bytes = 0
+        """The number of bytes in self.mmaps."""
+        self.mmaps_lock = Lock()
+        self.mmap_bytes_stat = '%s.mmap_bytes' % self.name
+        self.mmap_hits_stat = '%s.mmap_hits' % self.name
+        self.mmap_misses_stat = '%s.mmap_misses' % self.name
 
     def __call__(self, env, start_response):
         """Handles incoming WSGI requests.
@@ -122,20 +255,21 @@ class WSGIFS(object):
         if path == '..' or path.startswith('..' + os.path.sep):
             return http.HTTPForbidden()(env, start_response)
         path = os.path.join(self.serve_path, path)
-        if not os.path.exists(path):
+        stat = self.io(env, _stat, path)
+        if not stat:
             return http.HTTPNotFound()(env, start_response)
-        if os.path.isdir(path):
+        if S_ISDIR(stat.st_mode):
             if not env['PATH_INFO'].endswith('/'):
                 return http.HTTPMovedPermanently(
                     headers={'Location': env['PATH_INFO'] + '/'})(
                     env, start_response)
             dirpath = path
             path = os.path.join(path, 'index.html')
-            if not os.path.exists(path):
+            stat = self.io(env, _stat, path)
+            if not stat:
                 return self.listing(dirpath, env, start_response)
         content_type = mimetypes.guess_type(path)[0] or \
             'application/octet-stream'
-        stat = os.stat(path)
         if not stat.st_size:
             start_response(
                 '204 No Content',
@@ -148,7 +282,73 @@ class WSGIFS(object):
               http_date_time(min(stat.st_mtime, time.time())))])
         if env['REQUEST_METHOD'] == 'HEAD':
             return ''
-        return _openiter(path, 65536, stat.st_size)
+        if 0 < stat.st_size <= self.mmap_max_file_size:
+            mapped = self.mmap(env, path, stat)
+            if mapped is not None:
+                return _mapiter(mapped, 65536)
+        return _openiter(
+            path, 65536, stat.st_size,
+            lambda func, *args: self.io(env, func, *args),
+            self.fadvise_sequential)
+
+    def mmap(self, env, path, stat):
+        """Returns the kept map of the file, mapping it if need be.
+
+        None is returned if the file could not be mapped, such as if it
+        shrank since the stat.
+
+        :param env: The WSGI env of the request for the file.
+        :param path: The local path of the file.
+        :param stat: The os.stat result of the file for the request.
+        """
+        stats = env['brim.stats']
+        identity = (stat.st_ino, stat.st_size, stat.st_mtime)
+        with self.mmaps_lock:
+            entry = self.mmaps.pop(path, None)
+            if entry:
+                if entry[0] == identity:
+                    self.mmaps[path] = entry
+                    stats.incr(self.mmap_hits_stat)
+                    return entry[1]
+                self.mmap_bytes -= len(entry[1])
+                stats.set(self.mmap_bytes_stat, self.mmap_bytes)
+        try:
+            mapped = self.io(env, _map, path, stat.st_size)
+        except (EnvironmentError, ValueError):
+            return None
+        stats.incr(self.mmap_misses_stat)
+        with self.mmaps_lock:
+            entry = self.mmaps.pop(path, None)
+            if entry:
+                self.mmap_bytes -= len(entry[1])
+            self.mmaps[path] = (identity, mapped)
+            self.mmap_bytes += len(mapped)
+            while self.mmap_bytes > self.mmap_max_bytes:
+                entry = self.mmaps.popitem(last=False)[1]
+                self.mmap_bytes -= len(entry[1])
+            stats.set(self.mmap_bytes_stat, self.mmap_bytes)
+        return mapped
+
+    def io(self, env, func, *args):
+        """Returns func(*args), run on the io_threads pool if set.
+
+        :param env: The WSGI env of the request making the call.
+        :param func: The function making the disk calls.
+        :param args: The arguments for the function.
+        """
+        if not self.io_threads or \
+                env['brim'].concurrency_model == 'threads':
+            return func(*args)
+        stats = env['brim.stats']
+        self.io_in_flight += 1
+        stats.set(self.io_in_flight_stat, self.io_in_flight)
+        if self.io_in_flight > stats.get(self.io_in_flight_peak_stat):
+            stats.set(self.io_in_flight_peak_stat, self.io_in_flight)
+        try:
+            return tpool.execute(func, *args)
+        finally:
+            self.io_in_flight -= 1
+            stats.set(self.io_in_flight_stat, self.io_in_flight)
 
     def listing(self, path, env, start_response):
         if not path.startswith(self.serve_path + '/'):
@@ -184,22 +384,18 @@ class WSGIFS(object):
                 '    <td class="colsize">&nbsp;</td>\n'
                 '    <td class="coldate">&nbsp;</td>\n'
                 '   </tr>\n')
-        listing = sorted(os.listdir(path))
-        for item in listing:
-            itempath = os.path.join(path, item)
-            if os.path.isdir(itempath):
+        listing = self.io(env, _list_dir, path)
+        for item, isdir, isfile, size, mtime in listing:
+            if isdir:
                 body += (
                     '   <tr class="item subdir">\n'
                     '    <td class="colname"><a href="%s">%s</a></td>\n'
                     '    <td class="colsize">&nbsp;</td>\n'
                     '    <td class="coldate">&nbsp;</td>\n'
                     '   </tr>\n' % (http.quote(item), escape(item)))
-        for item in listing:
-            itempath = os.path.join(path, item)
-            if os.path.isfile(itempath):
+        for item, isdir, isfile, size, mtime in listing:
+            if isfile:
                 ext = os.path.splitext(item)[1].lstrip('.')
-                size = os.path.getsize(itempath)
-                mtime = os.path.getmtime(itempath)
                 body += (
                     '   <tr class="item %s">\n'
                     '    <td class="colname"><a href="%s">%s</a></td>\n'
@@ -242,7 +438,49 @@ class WSGIFS(object):
         """
         parsed_conf = {
             'path': conf.get(name, 'path', '/').strip('/'),
-            'serve_path': conf.get_path(name, 'serve_path').rstrip('/')}
+            'serve_path': (conf.get_path(name, 'serve_path') or '').rstrip(
+                '/'),
+            'io_threads': conf.get_int(name, 'io_threads', 0),
+            'fadvise_sequential': conf.get_bool(
+                name, 'fadvise_sequential', False),
+            'mmap_max_file_size': conf.get_int(name, 'mmap_max_file_size', 0),
+            'mmap_max_bytes': conf.get_int(name, 'mmap_max_bytes', 67108864)}
         if not parsed_conf['serve_path']:
             raise Exception('[%s] serve_path must be set' % name)
+        for option in ('io_threads', 'mmap_max_file_size', 'mmap_max_bytes'):
+            if parsed_conf[option] < 0:
+                raise Exception('Invalid [%s] %s %r.' %
+                                (name, option, parsed_conf[option]))
+        if parsed_conf['mmap_max_file_size'] > parsed_conf['mmap_max_bytes']:
+            raise Exception(
+                'Invalid [%s] mmap_max_file_size %r; must not be more than '
+                'mmap_max_bytes %r.' %
+                (name, parsed_conf['mmap_max_file_size'],
+                 parsed_conf['mmap_max_bytes']))
         return parsed_conf
+
+    @classmethod
+    def stats_conf(cls, name, parsed_conf):
+        """Returns a list of (stat_name, stat_type) pairs.
+
+        These pairs specify the stat variables this app wants
+        established in the ``stats`` instance passed to
+        :py:meth:`__call__`.
+
+        See the overall docs of :py:mod:`brim.wsgi_fs` for what stats
+        are defined.
+
+        :param name: The name of the app, indicates the app's section in
+            the overall configuration for the daemon server.
+        :param parsed_conf: The result from :py:meth:`parse_conf`.
+        :returns: A list of (stat_name, stat_type) pairs.
+        """
+        stats = []
+        if parsed_conf['io_threads']:
+            stats.extend([('%s.io_in_flight' % name, 'sum'),
+                          ('%s.io_in_flight_peak' % name, 'max')])
+        if parsed_conf['mmap_max_file_size']:
+            stats.extend([('%s.mmap_bytes' % name, 'sum'),
+                          ('%s.mmap_hits' % name, 'sum'),
+                          ('%s.mmap_misses' % name, 'sum')])
+        return stats
@@ -0,0 +1,176 @@
+"""Profiles the brimd worker serving the request.
+
+A GET request samples the stacks of the worker serving it for a number
+of seconds and responds with them in the folded format read by flame
+graph tools, such as flamegraph.pl, one stack per line with its number
+of samples. The worker keeps serving other requests while sampling and
+those are what get profiled. Only the worker serving the request is
+profiled; each worker can also be profiled by sending its pid SIGURG,
+see the profile_seconds option in the [brim] section of brimd.conf-sample.
+
+The response can be large and reveals the code being run, so by default
+only requests from the local host are served and others get 403
+Forbidden. To serve other clients, list their addresses in the allow
+option or, with ``allow = *``, protect the path some other way, such as
+by routing it through :py:class:`brim.wsgi_basic_auth.WSGIBasicAuth`
+with :py:class:`brim.wsgi_router.WSGIRouter`::
+
+    [router]
+    call = brim.wsgi_router.WSGIRouter
+    route.profile = GET /profile basic-auth profile
+
+Configuration Options::
+
+    [wsgi_profile]
+    call = brim.wsgi_profile.WSGIProfile
+    # path = <path>
+    #   The request path to match and serve; any other paths will be
+    #   passed on to the next WSGI app in the chain. Default: /profile
+    # default_seconds = <seconds>
+    #   The seconds to sample for when the request has no seconds query
+    #   parameter. Default: 10
+    # max_seconds = <seconds>
+    #   The most seconds a request may ask to sample for. Default: 60
+    # allow = <ip> [ip] ...
+    #   The client addresses that may profile; others get 403
+    #   Forbidden. Use * to allow any client. Default: 127.0.0.1 ::1
+    #   ::ffff:127.0.0.1
+
+Stats Variables (where *n.* is the name of the app in the config):
+
+==============  ======  ================================================
+Name            Type    Description
+==============  ======  ================================================
+n.requests      sum     The number of requests received.
+==============  ======  ================================================
+"""
+"""Copyright and License.
+
+Copyright 2014 Gregory Holt
+
+Licensed under the Apache License, Version 2.0 (the "License"); you may
+not use this file except in compliance with the License. You may obtain
+a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+from brim import http
+
+
+class WSGIProfile(object):
+    """Profiles the brimd worker serving the request.
+
+    See :py:mod:`brim.wsgi_profile` for more information.
+
+    :param name: The name of the app.
+    :param parsed_conf: The conf result from :py:meth:`parse_conf`.
+    :param next_app: The next WSGI app in the chain.
+    """
+
+    def __init__(self, name, parsed_conf, next_app):
+        self.name = name
+        """The name of the app."""
+        self.next_app = next_app
+        """The next WSGI app in the chain."""
+        self.path = parsed_conf['path']
+        """The URL path to serve."""
+        self.default_seconds = parsed_conf['default_seconds']
+        """The seconds to sample for by default."""
+        self.max_seconds = parsed_conf['max_seconds']
+        """The most seconds a request may sample for."""
+        self.allow = parsed_conf['allow']
+        """The set of client addresses that may profile or None for any."""
+
+    def __call__(self, env, start_response):
+        """Handles incoming WSGI requests.
+
+        Requests for the configured path from allowed clients sample the
+        worker for the seconds query parameter, or default_seconds, and
+        respond with the folded stacks. Other requests are passed on to
+        the next WSGI app in the chain.
+
+        :param env: The WSGI env as per the spec.
+        :param start_response: The WSGI start_response as per the spec.
+        :returns: Calls *start_response* and returns an iterable as per
+            the WSGI spec.
+        """
+        if env['PATH_INFO'] != self.path:
+            return self.next_app(env, start_response)
+        env['brim.stats'].incr('%s.requests' % self.name)
+        try:
+            if self.allow is not None and \
+                    env.get('REMOTE_ADDR') not in self.allow:
+                raise http.HTTPForbidden()
+            if env['REQUEST_METHOD'] != 'GET':
+                raise http.HTTPMethodNotAllowed(headers={'Allow': 'GET'})
+            seconds = http.QueryParser(env.get('QUERY_STRING')).get_int(
+                'seconds', self.default_seconds)
+            if seconds < 1 or seconds > self.max_seconds:
+                raise http.HTTPBadRequest(
+                    'Query parameter seconds must be from 1 to %s.\n' %
+                    self.max_seconds)
+            body = env['brim'].profile(seconds)
+            if body is None:
+                raise http.HTTPConflict('Already profiling.\n')
+        except http.HTTPException as err:
+            return err(env, start_response)
+        start_response('200 OK', [('Content-Length', str(len(body))),
+                                  ('Content-Type', 'text/plain')])
+        return [body]
+
+    @classmethod
+    def parse_conf(cls, name, conf):
+        """Translates the overall server configuration.
+
+        The conf is translated into an app-specific configuration dict
+        suitable for passing as ``parsed_conf`` in the
+        :py:class:`WSGIProfile` constructor.
+
+        See the overall docs of :py:mod:`brim.wsgi_profile` for
+        configuration options.
+
+        :param name: The name of the app, indicates the app's section in
+            the overall configuration for the server.
+        :param conf: The :py:class:`brim.conf.Conf` instance
+            representing the overall configuration of the server.
+        :returns: A dict suitable for passing as ``parsed_conf`` in the
+            :py:class:`WSGIProfile` constructor.
+        """
+        max_seconds = conf.get_int(name, 'max_seconds', 60)
+        default_seconds = conf.get_int(
+            name, 'default_seconds', min(10, max_seconds))
+        if default_seconds < 1 or default_seconds > max_seconds:
+            raise Exception(
+                'Invalid [%s] default_seconds %r; must be from 1 to '
+                'max_seconds %r.' % (name, default_seconds, max_seconds))
+        allow = set(conf.get(
+            name, 'allow', '127.0.0.1 ::1 ::ffff:127.0.0.1').split())
+        if '*' in allow:
+            allow = None
+        return {'path': conf.get(name, 'path', '/profile'),
+                'default_seconds': default_seconds,
+                'max_seconds': max_seconds, 'allow': allow}
+
+    @classmethod
+    def stats_conf(cls, name, parsed_conf):
+        """Returns a list of (stat_name, stat_type) pairs.
+
+        These pairs specify the stat variables this app wants
+        established in the ``stats`` instance passed to
+        :py:meth:`__call__`.
+
+        See the overall docs of :py:mod:`brim.wsgi_profile` for what
+        stats are defined.
+
+        :param name: The name of the app, indicates the app's section in
+            the overall configuration for the daemon server.
+        :param parsed_conf: The result from :py:meth:`parse_conf`.
+        :returns: A list of (stat_name, stat_type) pairs.
+        """
+        return [('%s.requests' % name, 'sum')]
@@ -0,0 +1,260 @@
+"""A WSGI application that routes requests to pipelines of other apps.
+
+Normally each app in a [wsgi] apps pipeline checks the request path
+itself and passes anything else on to the next app, so a request for the
+last app pays for every check before it. The router instead looks the
+request up once, walking a trie of the configured paths one path
+segment at a time, and hands it straight to the pipeline of apps routed
+there. The cost of routing is proportional to the length of the path no
+matter how many routes or apps there are.
+
+The apps of each route are configured in their own sections just as
+[wsgi] apps are. After the last app of a route, or for requests that
+match no route, the request goes on to the next app after the router.
+
+Configuration Options::
+
+    [wsgi_router]
+    call = brim.wsgi_router.WSGIRouter
+    # route.<name> = [<method> ...] <path> <app> [<app>] ...
+    #   Sends requests for <path> to the pipeline of apps named. The <path>
+    #   must match exactly unless it ends with /* in which case it matches
+    #   the path before the /* and anything below it; /* alone matches
+    #   everything. The longest matching path wins, with exact paths winning
+    #   over /* paths of the same length. If methods are given, such as
+    #   GET HEAD, the route is only used for those methods and others get
+    #   405 Method Not Allowed unless another route for the same path
+    #   accepts any method.
+
+For example::
+
+    [wsgi]
+    apps = router
+
+    [router]
+    call = brim.wsgi_router.WSGIRouter
+    route.stats = GET HEAD /stats stats
+    route.files = /files/* auth fs
+
+Stats Variables (where *n.* is the name of the app in the config):
+
+===================  ======  ===========================================
+Name                 Type    Description
+===================  ======  ===========================================
+n.routed_count       sum     The number of requests sent to a route.
+n.unrouted_count     sum     The number of requests matching no route.
+===================  ======  ===========================================
+
+The stats of the apps of each route are kept as well.
+"""
+"""Copyright and License.
+
+Copyright 2014 Gregory Holt
+
+Licensed under the Apache License, Version 2.0 (the "License"); you may
+not use this file except in compliance with the License. You may obtain
+a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+from brim import http
+from brim.server import load_wsgi_app
+
+
+class _RouteNode(object):
+    """A node of the route trie, one per path segment."""
+
+    __slots__ = ('children', 'exact', 'prefix')
+
+    def __init__(self):
+        self.children = {}
+        """Maps each next path segment to its _RouteNode."""
+        self.exact = None
+        """Maps methods to route indexes for the path ending here."""
+        self.prefix = None
+        """Maps methods to route indexes for paths from here on down."""
+
+
+class WSGIRouter(object):
+    """A WSGI app that routes requests to pipelines of other apps.
+
+    See :py:mod:`brim.wsgi_router` for more information.
+
+    :param name: The name of the app.
+    :param parsed_conf: The conf result from :py:meth:`parse_conf`.
+    :param next_app: The next WSGI app in the chain.
+    """
+
+    def __init__(self, name, parsed_conf, next_app):
+        self.name = name
+        """The name of the app."""
+        self.next_app = next_app
+        """The next WSGI app in the chain."""
+        self.routes = parsed_conf['routes']
+        """The list of (route_name, methods, path, apps) routes.
+
+        The apps are (app_name, app_class, app_conf) tuples as returned
+        by :py:meth:`parse_conf`.
+        """
+        self.pipelines = []
+        """The first app of each route's pipeline, by route index."""
+        for route_name, methods, path, apps in self.routes:
+            app = next_app
+            for app_name, app_class, app_conf in reversed(apps):
+                app = app_class(app_name, app_conf, app)
+            self.pipelines.append(app)
+        self.root = self._build_trie(self.name, self.routes)
+        """The root :py:class:`_RouteNode` of the route trie."""
+        self.routed_count_stat = '%s.routed_count' % self.name
+        self.unrouted_count_stat = '%s.unrouted_count' % self.name
+
+    @classmethod
+    def _build_trie(cls, name, routes):
+        root = _RouteNode()
+        for index, (route_name, methods, path, apps) in enumerate(routes):
+            prefix = path == '/*' or path.endswith('/*')
+            if prefix:
+                path = path[:-2]
+            node = root
+            if path:
+                for segment in path.split('/')[1:]:
+                    child = node.children.get(segment)
+                    if not child:
+                        child = node.children[segment] = _RouteNode()
+                    node = child
+            if prefix:
+                if node.prefix is None:
+                    node.prefix = {}
+                table = node.prefix
+            else:
+                if node.exact is None:
+                    node.exact = {}
+                table = node.exact
+            for method in methods or (None,):
+                if method in table:
+                    raise Exception(
+                        'Routes [%s] route.%s and route.%s both route %s%s.' %
+                        (name, routes[table[method]][0], route_name,
+                         method + ' ' if method else '', routes[index][2]))
+                table[method] = index
+        return root
+
+    def match(self, path):
+        """Returns the method table of the route for the path, or None.
+
+        The table maps each method to the index of the route to use,
+        with None mapping to the index of the route for any method.
+
+        :param path: The request path, such as env['PATH_INFO'].
+        """
+        node = self.root
+        table = node.prefix
+        for segment in path.split('/')[1:]:
+            node = node.children.get(segment)
+            if node is None:
+                return table
+            if node.prefix is not None:
+                table = node.prefix
+        if node.exact is not None:
+            return node.exact
+        return table
+
+    def __call__(self, env, start_response):
+        """Handles incoming WSGI requests.
+
+        Requests matching a route are sent to its pipeline of apps;
+        others are passed on to the next WSGI app in the chain.
+
+        :param env: The WSGI env as per the spec.
+        :param start_response: The WSGI start_response as per the spec.
+        :returns: Calls *start_response* and returns an iterable as per
+            the WSGI spec.
+        """
+        table = self.match(env['PATH_INFO'])
+        if table is None:
+            env['brim.stats'].incr(self.unrouted_count_stat)
+            return self.next_app(env, start_response)
+        index = table.get(env['REQUEST_METHOD'])
+        if index is None:
+            index = table.get(None)
+            if index is None:
+                return http.HTTPMethodNotAllowed(headers={
+                    'Allow': ', '.join(sorted(table))})(env, start_response)
+        env['brim.stats'].incr(self.routed_count_stat)
+        return self.pipelines[index](env, start_response)
+
+    @classmethod
+    def parse_conf(cls, name, conf):
+        """Translates the overall server configuration.
+
+        The conf is translated into an app-specific configuration dict
+        suitable for passing as ``parsed_conf`` in the
+        :py:class:`WSGIRouter` constructor. Each app of each route is
+        loaded and configured here with
+        :py:func:`brim.server.load_wsgi_app`.
+
+        See the overall docs of :py:mod:`brim.wsgi_router` for
+        configuration options.
+
+        :param name: The name of the app, indicates the app's section in
+            the overall configuration for the server.
+        :param conf: The :py:class:`brim.conf.Conf` instance
+            representing the overall configuration of the server.
+        :returns: A dict suitable for passing as ``parsed_conf`` in the
+            :py:class:`WSGIRouter` constructor.
+        """
+        routes = []
+        stats = []
+        for option in sorted(conf.store.get(name) or {}):
+            if not option.startswith('route.'):
+                continue
+            route_name = option[len('route.'):]
+            value = conf.get(name, option, '').split()
+            methods = []
+            while value and not value[0].startswith('/'):
+                methods.append(value.pop(0).upper())
+            if len(value) < 2:
+                raise Exception(
+                    'Invalid [%s] %s %r; should be [<method> ...] <path> '
+                    '<app> [<app>] ...' %
+                    (name, option, conf.get(name, option)))
+            path = value.pop(0)
+            if '*' in path[:-1] or (path.endswith('*') and
+                                    not path.endswith('/*')):
+                raise Exception(
+                    'Invalid [%s] %s path %r; * may only end the path as '
+                    '/*.' % (name, option, path))
+            apps = []
+            for app_name in value:
+                app_class, app_conf, app_stats = load_wsgi_app(app_name, conf)
+                apps.append((app_name, app_class, app_conf))
+                stats.extend(app_stats)
+            routes.append((route_name, methods, path, apps))
+        # Raises on conflicting routes now rather than when starting.
+        cls._build_trie(name, routes)
+        return {'routes': routes, 'stats': stats}
+
+    @classmethod
+    def stats_conf(cls, name, parsed_conf):
+        """Returns a list of (stat_name, stat_type) pairs.
+
+        These pairs specify the stat variables this app wants
+        established in the ``stats`` instance passed to
+        :py:meth:`__call__`, along with those of the apps of each route.
+
+        See the overall docs of :py:mod:`brim.wsgi_router` for what
+        stats are defined.
+
+        :param name: The name of the app, indicates the app's section in
+            the overall configuration for the daemon server.
+        :param parsed_conf: The result from :py:meth:`parse_conf`.
+        :returns: A list of (stat_name, stat_type) pairs.
+        """
+        return [('%s.routed_count' % name, 'sum'),
+                ('%s.unrouted_count' % name, 'sum')] + parsed_conf['stats']